@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 from django.conf import settings
 import logging.config
 from django.conf import settings
@@ -29,6 +30,16 @@ app.conf.beat_schedule = {
     },
 }
 
+@worker_process_init.connect
+def preload_nnunet_models(**kwargs):
+    """
+    Keep the nnUNet models resident in every worker process from the start
+    """
+    if not settings.NNUNET_PRELOAD_MODELS:
+        return
+    from segmentation.nnunet_handler import NNUNetHandler
+    NNUNetHandler().preload_models()
+
 @app.task(bind=True)
 def debug_task(self):
     """
@@ -18,7 +18,81 @@ NNUNET_RESULTS = os.path.join(NNUNET_BASE, 'nnUNet_results')
 # Define paths for I/O
 NNUNET_INPUT_DIR = os.path.join(BASE_DIR, 'models', 'input_dir')
 NNUNET_OUTPUT_DIR = os.path.join(BASE_DIR, 'models', 'output_dir')
+# Per-task scratch workspaces (inputs and model outputs), one directory per running task
+NNUNET_SCRATCH_DIR = os.environ.get('NNUNET_SCRATCH_DIR', os.path.join(BASE_DIR, 'models', 'scratch'))
 SEGMENTATION_RESULTS_PATH = os.path.join(BASE_DIR, 'media', 'segmentations')
+
+# nnUNet inference engine:
+# 'exported' runs ONNX Runtime/TorchScript graphs written by `manage.py export_nnunet_models`
+#   (falls back to 'in_process' for models that were not exported)
+# 'in_process' keeps model weights resident in each Celery worker process
+# 'subprocess' runs the nnUNetv2_predict CLI for every prediction
+NNUNET_INFERENCE_ENGINE = os.environ.get('NNUNET_INFERENCE_ENGINE', 'in_process')
+NNUNET_EXPORT_DIR = os.environ.get('NNUNET_EXPORT_DIR', os.path.join(NNUNET_BASE, 'nnUNet_exported'))
+# Intra-op threads per exported session (0 = all cores)
+NNUNET_EXPORTED_THREADS = int(os.environ.get('NNUNET_EXPORTED_THREADS', '0'))
+# Load both models when a worker process starts instead of on its first task
+NNUNET_PRELOAD_MODELS = os.environ.get('NNUNET_PRELOAD_MODELS', 'True') == 'True'
+# How the tumor and lung models run for a task: 'sequential', 'concurrent' or 'auto'
+# 'auto' runs them concurrently on CPU nodes with enough cores and free memory,
+# each model pinned to half of the cores
+NNUNET_EXECUTION_MODE = os.environ.get('NNUNET_EXECUTION_MODE', 'auto')
+NNUNET_CONCURRENT_MIN_CORES = int(os.environ.get('NNUNET_CONCURRENT_MIN_CORES', '16'))
+NNUNET_CONCURRENT_MIN_MEMORY_GB = float(os.environ.get('NNUNET_CONCURRENT_MIN_MEMORY_GB', '24'))
+# Lung-first cascade: run the lung model, then the tumor model only on the lung bounding
+# box padded by NNUNET_CASCADE_MARGIN_MM, pasting the tumor mask back into the full volume.
+# The two models then always run one after another
+NNUNET_CASCADE_MODE = os.environ.get('NNUNET_CASCADE_MODE', 'False') == 'True'
+NNUNET_CASCADE_MARGIN_MM = float(os.environ.get('NNUNET_CASCADE_MARGIN_MM', '10'))
+# Speed/quality inference tiers, selectable per upload:
+# folds: fold subset to ensemble (None = every trained fold)
+# use_mirroring: mirroring test-time augmentation
+# tile_step_size: sliding window step as a fraction of the patch size (larger = fewer tiles)
+# config: optional nnUNet configuration used instead of the model's own (when trained)
+NNUNET_INFERENCE_TIERS = {
+    'fast': {'folds': (0,), 'use_mirroring': False, 'tile_step_size': 0.75, 'config': '3d_lowres'},
+    'balanced': {'folds': (0, 1), 'use_mirroring': False, 'tile_step_size': 0.5},
+    'full': {'folds': None, 'use_mirroring': True, 'tile_step_size': 0.5},
+}
+NNUNET_DEFAULT_TIER = os.environ.get('NNUNET_DEFAULT_TIER', 'full')
+# Memory-bounded inference for very large volumes (in-process and exported engines):
+# 'auto' predicts in overlapping slabs from memory-mapped inputs when a whole-volume
+# prediction is estimated to exceed NNUNET_MAX_INFERENCE_MEMORY_GB, 'always' or 'never'
+NNUNET_STREAMING_MODE = os.environ.get('NNUNET_STREAMING_MODE', 'auto')
+NNUNET_MAX_INFERENCE_MEMORY_GB = float(os.environ.get('NNUNET_MAX_INFERENCE_MEMORY_GB', '8'))
+# Slices read at a time when computing volumes and lesion counts from a mask
+SEGMENTATION_METRICS_SLAB_SIZE = int(os.environ.get('SEGMENTATION_METRICS_SLAB_SIZE', '32'))
+# The tumor model saves a float16 foreground probability map for the confidence metrics.
+# Afterwards the map is deleted ('discard') or kept gzip-compressed under
+# MEDIA_ROOT/probabilities ('compressed')
+SEGMENTATION_SAVE_PROBABILITIES = os.environ.get('SEGMENTATION_SAVE_PROBABILITIES', 'True') == 'True'
+SEGMENTATION_PROBABILITY_RETENTION = os.environ.get('SEGMENTATION_PROBABILITY_RETENTION', 'discard')
+# Post-processing removes tumor components farther than SEGMENTATION_LUNG_MARGIN_MM from
+# the lung mask or smaller than SEGMENTATION_MIN_COMPONENT_MM3, and records them on the task
+SEGMENTATION_FILTER_TUMOR_COMPONENTS = os.environ.get('SEGMENTATION_FILTER_TUMOR_COMPONENTS', 'True') == 'True'
+SEGMENTATION_LUNG_MARGIN_MM = float(os.environ.get('SEGMENTATION_LUNG_MARGIN_MM', '5.0'))
+SEGMENTATION_MIN_COMPONENT_MM3 = float(os.environ.get('SEGMENTATION_MIN_COMPONENT_MM3', '5.0'))
+# Store one fused uint8 volume (0 background, 1 lung, 2 tumor) per task instead of separate
+# tumor and lung masks; the separate masks are extracted only when a client requests them
+SEGMENTATION_FUSED_OUTPUT = os.environ.get('SEGMENTATION_FUSED_OUTPUT', 'False') == 'True'
+# Upload resampling: scans are resampled once to the finest spacing of the models' plans
+# (SEGMENTATION_RESAMPLE_SPACING when no plans are available), in chunks of output slices
+# spread over SEGMENTATION_RESAMPLE_THREADS threads (0 = all cores). Order 0-5 spline interpolation
+SEGMENTATION_RESAMPLE_SPACING = tuple(
+    float(v) for v in os.environ.get('SEGMENTATION_RESAMPLE_SPACING', '1.0,1.0,1.0').split(',')
+)
+SEGMENTATION_RESAMPLE_ORDER = int(os.environ.get('SEGMENTATION_RESAMPLE_ORDER', '3'))
+SEGMENTATION_RESAMPLE_THREADS = int(os.environ.get('SEGMENTATION_RESAMPLE_THREADS', '0'))
+SEGMENTATION_RESAMPLE_CHUNK_SLICES = int(os.environ.get('SEGMENTATION_RESAMPLE_CHUNK_SLICES', '16'))
+# Body crop: after resampling, the body bounding box is found on a copy sampled every
+# SEGMENTATION_BODY_STEP_MM (voxels above SEGMENTATION_BODY_THRESHOLD_HU, largest component)
+# and padded by SEGMENTATION_BODY_MARGIN_MM. Both models then only see that box; the masks
+# are pasted back into the full volume
+SEGMENTATION_BODY_CROP = os.environ.get('SEGMENTATION_BODY_CROP', 'True') == 'True'
+SEGMENTATION_BODY_THRESHOLD_HU = float(os.environ.get('SEGMENTATION_BODY_THRESHOLD_HU', '-500'))
+SEGMENTATION_BODY_STEP_MM = float(os.environ.get('SEGMENTATION_BODY_STEP_MM', '4.0'))
+SEGMENTATION_BODY_MARGIN_MM = float(os.environ.get('SEGMENTATION_BODY_MARGIN_MM', '10.0'))
+
 LOG_DIR = BASE_DIR / 'logs'
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -28,6 +102,7 @@ os.makedirs(NNUNET_PREPROCESSED, exist_ok=True)
 os.makedirs(NNUNET_RESULTS, exist_ok=True)
 os.makedirs(NNUNET_INPUT_DIR, exist_ok=True)
 os.makedirs(NNUNET_OUTPUT_DIR, exist_ok=True)
+os.makedirs(NNUNET_SCRATCH_DIR, exist_ok=True)
 os.makedirs(SEGMENTATION_RESULTS_PATH, exist_ok=True)
 
 # SECURITY WARNING: keep the secret key used in production secret!
@@ -188,7 +263,16 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # increase data upload limit
 DATA_UPLOAD_MAX_MEMORY_SIZE = 524288000  # 500 MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 524288000  # 500 MB
+# Multipart uploads above this size stream to a temporary file instead of web-process RAM
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5 MB
+
+# Resumable chunked uploads (/api/segmentation/uploads/): chunks are written straight into
+# a preallocated file under CHUNKED_UPLOAD_DIR; unfinished uploads expire after
+# CHUNKED_UPLOAD_EXPIRY_HOURS and are removed by cleanup_old_tasks
+CHUNKED_UPLOAD_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', os.path.join(BASE_DIR, 'media', 'chunked_uploads'))
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get('CHUNKED_UPLOAD_MAX_SIZE', str(4 * 1024 ** 3)))
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get('CHUNKED_UPLOAD_MAX_CHUNK_SIZE', str(64 * 1024 ** 2)))
+CHUNKED_UPLOAD_EXPIRY_HOURS = float(os.environ.get('CHUNKED_UPLOAD_EXPIRY_HOURS', '24'))
 
 # REST Framework settings
 REST_FRAMEWORK = {
@@ -220,6 +304,47 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Segmentation micro-batching: a worker gathers up to SEGMENTATION_BATCH_SIZE queued
+# tasks, waiting at most SEGMENTATION_BATCH_WAIT_SECONDS, and runs them in one model session
+SEGMENTATION_BATCH_SIZE = int(os.environ.get('SEGMENTATION_BATCH_SIZE', '4'))
+SEGMENTATION_BATCH_WAIT_SECONDS = float(os.environ.get('SEGMENTATION_BATCH_WAIT_SECONDS', '3'))
+
+# Content-addressed segmentation result cache: uploads whose voxel data, affine and
+# model version match an earlier task reuse its masks and metrics instead of re-running
+# inference. Least recently used entries are evicted above SEGMENTATION_CACHE_MAX_BYTES
+SEGMENTATION_CACHE_ENABLED = os.environ.get('SEGMENTATION_CACHE_ENABLED', 'True') == 'True'
+SEGMENTATION_CACHE_DIR = os.environ.get('SEGMENTATION_CACHE_DIR', os.path.join(BASE_DIR, 'models', 'result_cache'))
+SEGMENTATION_CACHE_MAX_BYTES = int(os.environ.get('SEGMENTATION_CACHE_MAX_BYTES', str(20 * 1024 ** 3)))
+# Overrides the model version derived from the checkpoint files, e.g. after retraining in place
+SEGMENTATION_MODEL_VERSION = os.environ.get('SEGMENTATION_MODEL_VERSION', '')
+
+# Uncompressed, memory-mapped copies of task volumes used to serve individual slices
+# (/api/segmentation/tasks/<id>/slices/). Least recently viewed tasks are evicted
+# above VOLUME_CACHE_MAX_BYTES
+VOLUME_CACHE_DIR = os.environ.get('VOLUME_CACHE_DIR', os.path.join(BASE_DIR, 'models', 'volume_cache'))
+VOLUME_CACHE_MAX_BYTES = int(os.environ.get('VOLUME_CACHE_MAX_BYTES', str(20 * 1024 ** 3)))
+
+# Multi-resolution copies of task volumes for progressive viewer loading
+# (/api/segmentation/tasks/<id>/pyramid/), built once a task completes. Each level
+# is stored as independently compressed VOLUME_PYRAMID_CHUNK_SIZE^3 chunks so any
+# region can be read without decompressing the whole level
+VOLUME_PYRAMID_DIR = os.environ.get('VOLUME_PYRAMID_DIR', os.path.join(BASE_DIR, 'models', 'pyramids'))
+VOLUME_PYRAMID_FACTORS = tuple(int(factor) for factor in os.environ.get('VOLUME_PYRAMID_FACTORS', '2,4,8').split(','))
+VOLUME_PYRAMID_CHUNK_SIZE = int(os.environ.get('VOLUME_PYRAMID_CHUNK_SIZE', '64'))
+# Largest region (in voxels) a single pyramid request may return
+VOLUME_PYRAMID_MAX_REGION_VOXELS = int(os.environ.get('VOLUME_PYRAMID_MAX_REGION_VOXELS', str(16 * 1024 ** 2)))
+
+# Sparse copies of completed masks (bounding-box bit-packed and per-slice run-length
+# encoded), served by /api/segmentation/tasks/<id>/masks/<layer>/
+MASK_ENCODING_DIR = os.environ.get('MASK_ENCODING_DIR', os.path.join(BASE_DIR, 'models', 'mask_encodings'))
+
+# Surface meshes for the 3D viewer, cached by mask file hash. One mesh per marching
+# cubes step size in MESH_DECIMATION_STEPS (level 0 is the finest), extracted on
+# MESH_WORKERS threads (0 = all cores)
+MESH_CACHE_DIR = os.environ.get('MESH_CACHE_DIR', os.path.join(BASE_DIR, 'models', 'meshes'))
+MESH_DECIMATION_STEPS = tuple(int(step) for step in os.environ.get('MESH_DECIMATION_STEPS', '1,2,4').split(','))
+MESH_WORKERS = int(os.environ.get('MESH_WORKERS', '0'))
+
 
 # File storage paths
 NIFTI_UPLOAD_PATH = BASE_DIR / 'media' / 'uploads'
@@ -1,11 +1,11 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
-from django.conf.urls.static import static
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from segmentation.admin import admin_dashboard
+from segmentation.media import SERVED_FOLDERS, MediaFileView
 
 # API Documentation setup
 schema_view = get_schema_view(
@@ -36,6 +36,9 @@ urlpatterns = [
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
 ]
 
-# Serve media files in development
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+# Task inputs and segmentations, with the task API's permissions, ETag/Last-Modified
+# validation and byte ranges; nothing else under MEDIA_ROOT is served
+urlpatterns += [
+    re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>(?:{"|".join(SERVED_FOLDERS)})/[^/]+)$',
+            MediaFileView.as_view(), name='media'),
+]
\ No newline at end of file
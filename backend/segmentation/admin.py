@@ -18,16 +18,58 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-from segmentation.models import SegmentationTask
+from segmentation.models import SegmentationTask, Lesion
 
-def generate_segmentation_preview(segmentation_path):
-    """Generate a preview image from a binary segmentation NIFTI file"""
+def _render_preview(axial_slice):
+    """Render an axial segmentation slice as a base64 PNG"""
+    # Create a figure
+    plt.figure(figsize=(4, 4), dpi=75)
+    
+    # Display background in grayscale
+    plt.imshow(np.zeros_like(axial_slice), cmap='gray', alpha=0.5)
+    
+    # Overlay the segmentation in red - handle non-binary segmentation
+    if np.max(axial_slice) > 1:
+        mask = axial_slice > 0  # Convert to binary if multiple labels
+    else:
+        mask = axial_slice > 0
+    plt.imshow(mask, cmap='Reds', alpha=0.7)
+    
+    plt.axis('off')
+    plt.tight_layout(pad=0)
+    
+    # Save the figure to a BytesIO object
+    buf = BytesIO()
+    plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
+    plt.close()
+    
+    # Convert to base64 for embedding in HTML
+    buf.seek(0)
+    image_base64 = base64.b64encode(buf.read()).decode('utf-8')
+    
+    return image_base64
+
+def generate_segmentation_preview(segmentation_path, slice_index=None):
+    """Generate a preview image from a binary segmentation NIFTI file
+    
+    When slice_index is known (SegmentationTask.preview_slice, found during
+    post-processing) only that axial slice is read instead of the whole volume.
+    """
     try:
         # Check if file exists
         if not os.path.exists(segmentation_path):
             print(f"Preview generation failed: File not found at {segmentation_path}")
             return None
             
+        if slice_index is not None:
+            try:
+                seg_img = nib.load(segmentation_path)
+                axial_slice = np.asanyarray(seg_img.dataobj[:, :, slice_index]).T
+            except Exception as e:
+                print(f"Error loading NIFTI slice: {str(e)}")
+                return None
+            return _render_preview(axial_slice)
+        
         # Load the segmentation file
         try:
             seg_img = nib.load(segmentation_path)
@@ -40,9 +82,6 @@ def generate_segmentation_preview(segmentation_path):
         # Find middle slice for each dimension
         middle_slice_z = seg_data.shape[2] // 2
         
-        # Create a figure
-        plt.figure(figsize=(4, 4), dpi=75)
-        
         # Create an axial view (slicing along z-axis)
         axial_slice = seg_data[:, :, middle_slice_z].T
         
@@ -62,29 +101,7 @@ def generate_segmentation_preview(segmentation_path):
             else:
                 print("No non-empty slices found in segmentation")
         
-        # Display background in grayscale
-        plt.imshow(np.zeros_like(axial_slice), cmap='gray', alpha=0.5)
-        
-        # Overlay the segmentation in red - handle non-binary segmentation
-        if np.max(axial_slice) > 1:
-            mask = axial_slice > 0  # Convert to binary if multiple labels
-        else:
-            mask = axial_slice > 0
-        plt.imshow(mask, cmap='Reds', alpha=0.7)
-        
-        plt.axis('off')
-        plt.tight_layout(pad=0)
-        
-        # Save the figure to a BytesIO object
-        buf = BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-        plt.close()
-        
-        # Convert to base64 for embedding in HTML
-        buf.seek(0)
-        image_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        
-        return image_base64
+        return _render_preview(axial_slice)
     except Exception as e:
         print(f"Error generating preview: {str(e)}")
         print(traceback.format_exc())
@@ -201,6 +218,14 @@ class SegmentationTaskAdmin(admin.ModelAdmin):
 
 admin.site.register(SegmentationTask, SegmentationTaskAdmin)
 
+class LesionAdmin(admin.ModelAdmin):
+    list_display = ('task', 'index', 'longest_diameter', 'volume', 'voxel_count', 'diameter_slice')
+    search_fields = ('task__file_name',)
+    readonly_fields = ('centroid', 'centroid_voxel', 'bbox')
+    list_select_related = ('task',)
+
+admin.site.register(Lesion, LesionAdmin)
+
 # Configure the default admin site
 admin.site.site_header = 'MedLearn AI Administration'
 admin.site.site_title = 'MedLearn AI Admin'
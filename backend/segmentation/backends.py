@@ -0,0 +1,300 @@
+import os
+import subprocess
+import threading
+import logging
+from abc import ABC, abstractmethod
+from .inference import get_predictor_pool
+from .probabilities import convert_npz_probabilities, model_has_regions, model_reverses_axes, probability_file_for
+
+# backends.py
+logger = logging.getLogger(__name__)
+
+
+class BackendUnavailable(RuntimeError):
+    """
+    Raised when an inference backend cannot run in this process
+    """
+
+
+def output_file_for(input_file_path, output_dir):
+    """
+    Get the segmentation file nnUNet writes for an input file
+    """
+    # nnUNet drops the _0000 channel suffix from output names
+    case_name = os.path.basename(input_file_path)[:-len("_0000.nii.gz")]
+    return os.path.join(output_dir, f"{case_name}.nii.gz")
+
+
+class InferenceBackend(ABC):
+    """
+    Runs one nnUNet model on a set of input files
+    
+    NNUNetHandler picks the backend named by NNUNET_INFERENCE_ENGINE and walks
+    the fallback chain when a backend cannot run a model in this process.
+    """
+    # Name used in NNUNET_INFERENCE_ENGINE
+    name = None
+    # Backend to use when this one is unavailable
+    fallback = None
+    # True when one predict() call handles the whole input folder at once
+    predicts_folder = False
+    
+    def __init__(self, device):
+        self.device = device
+    
+    def is_available(self, model_config=None):
+        """
+        Check whether this backend can run (a model configuration) in this process
+        """
+        return True
+    
+    def warmup(self, model_configs):
+        """
+        Load model configurations ahead of the first task
+        """
+    
+    @abstractmethod
+    def predict(self, input_files, output_dir, model_config, env, timeout=1800, shared_inputs=None,
+                cpu_set=None):
+        """
+        Run one model on the input files
+        
+        Args:
+            input_files: Paths to the nnUNet-named input files, all in the same folder
+            output_dir: Directory to save the output segmentations
+            model_config: Model configuration dictionary
+            env: Environment variables
+            timeout: Timeout for prediction in seconds (default: 30 minutes)
+            shared_inputs: Optional {input file: SharedPreprocessor} reused across models
+            cpu_set: Optional list of CPU cores this run is limited to
+            
+        Returns:
+            Dictionary mapping each input file to its segmentation file
+        """
+
+
+class CLIBackend(InferenceBackend):
+    """
+    Runs the nnUNetv2_predict CLI, loading the model for every call
+    
+    The CLI predicts every case in the input folder with one model load.
+    """
+    name = "subprocess"
+    predicts_folder = True
+    
+    def predict(self, input_files, output_dir, model_config, env, timeout=1800, shared_inputs=None,
+                cpu_set=None):
+        try:
+            # Get the directory containing the input files
+            input_dir = os.path.dirname(input_files[0])
+            
+            # Run nnUNet prediction
+            cmd = [
+                "nnUNetv2_predict",
+                "-i", input_dir,
+                "-o", output_dir,
+                "-d", model_config["dataset"],
+                "-c", model_config["config"],
+                "-tr", "nnUNetTrainer",  # Add trainer parameter back
+                "-device", self.device,
+                "-step_size", str(model_config.get("tile_step_size", 0.5))
+            ]
+            if model_config.get("folds") is not None:
+                cmd += ["-f", *[str(fold) for fold in model_config["folds"]]]
+            if not model_config.get("use_mirroring", True):
+                cmd.append("--disable_tta")
+            if model_config.get("save_probabilities"):
+                cmd.append("--save_probabilities")
+            
+            # Execute nnUNet prediction
+            cmd_str = ' '.join(cmd)
+            logger.info(f"Running nnUNet prediction with command: {cmd_str}")
+            
+            # Limit the process to its share of the cores when running concurrently
+            preexec_fn = None
+            if cpu_set:
+                env = dict(env)
+                for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "nnUNet_def_n_proc"):
+                    env[var] = str(len(cpu_set))
+                preexec_fn = lambda: os.sched_setaffinity(0, cpu_set)
+            
+            # Modified to stream output in real time
+            process = subprocess.Popen(
+                cmd,
+                env=env,
+                preexec_fn=preexec_fn,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                bufsize=1  # Line buffered
+            )
+            
+            # Stream output in real-time
+            def log_output(pipe, prefix):
+                for line in iter(pipe.readline, ''):
+                    if line:
+                        line = line.strip()
+                        if line:
+                            logger.info(f"{prefix}: {line}")
+            
+            # Create threads to handle stdout and stderr streams
+            stdout_thread = threading.Thread(target=log_output, args=(process.stdout, "nnUNet"))
+            stderr_thread = threading.Thread(target=log_output, args=(process.stderr, "nnUNet"))
+            
+            # Set as daemon threads so they don't block program exit
+            stdout_thread.daemon = True
+            stderr_thread.daemon = True
+            
+            # Start the threads
+            stdout_thread.start()
+            stderr_thread.start()
+            
+            # Wait for the process to complete with timeout
+            try:
+                return_code = process.wait(timeout=timeout)
+                
+                # Wait for output threads to finish
+                stdout_thread.join(5)  # Wait up to 5 seconds
+                stderr_thread.join(5)  # Wait up to 5 seconds
+                
+                # Collect any remaining output
+                stdout, stderr = process.communicate(timeout=5)
+                if stdout:
+                    logger.info(f"nnUNet final output: {stdout}")
+                if stderr:
+                    logger.warning(f"nnUNet final stderr: {stderr}")
+                
+                if return_code != 0:
+                    error_msg = f"nnUNet prediction failed with code {return_code}"
+                    if stderr:
+                        error_msg += f": {stderr}"
+                    logger.error(error_msg)
+                    raise RuntimeError(error_msg)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                logger.error(f"nnUNet prediction timed out after {timeout} seconds")
+                raise RuntimeError(f"nnUNet prediction timed out after {timeout} seconds")
+            
+            # Find the output file for each input
+            output_files = {}
+            for input_file_path in input_files:
+                result_file = output_file_for(input_file_path, output_dir)
+                if os.path.exists(result_file):
+                    output_files[input_file_path] = result_file
+                    logger.info(f"Generated segmentation at {result_file}")
+                    if model_config.get("save_probabilities"):
+                        self._convert_probabilities(result_file, model_config)
+            
+            if not output_files:
+                error_msg = f"No output segmentation file was generated in {output_dir}"
+                logger.error(error_msg)
+                raise FileNotFoundError(error_msg)
+            
+            return output_files
+            
+        except Exception as e:
+            logger.exception(f"Error running prediction: {str(e)}")
+            raise RuntimeError(f"Error running prediction: {str(e)}")
+    
+    def _convert_probabilities(self, result_file, model_config):
+        """
+        Replace the CLI's full probability .npz/.pkl output with a tumor probability map
+        """
+        case_path = result_file[:-len(".nii.gz")]
+        npz_path = f"{case_path}.npz"
+        if not os.path.exists(npz_path):
+            logger.warning(f"nnUNet wrote no probabilities for {result_file}")
+            return
+        try:
+            model_folder = get_predictor_pool().model_folder(model_config)
+            convert_npz_probabilities(npz_path, probability_file_for(result_file), model_has_regions(model_folder),
+                                      model_reverses_axes(model_folder))
+        finally:
+            for path in (npz_path, f"{case_path}.pkl"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class TorchBackend(InferenceBackend):
+    """
+    Runs PyTorch models kept resident in this worker process
+    """
+    name = "in_process"
+    fallback = "subprocess"
+    
+    def _pool(self):
+        return get_predictor_pool()
+    
+    def is_available(self, model_config=None):
+        try:
+            import torch
+            import nnunetv2
+            return True
+        except ImportError:
+            return False
+    
+    def warmup(self, model_configs):
+        self._pool().warmup(model_configs, self.device)
+    
+    def predict(self, input_files, output_dir, model_config, env, timeout=1800, shared_inputs=None,
+                cpu_set=None):
+        shared_inputs = shared_inputs or {}
+        predictor_pool = self._pool()
+        
+        logger.info(f"Running {self.name} nnUNet prediction with {model_config['dataset']} ({model_config['config']})")
+        output_files = {}
+        for input_file_path in input_files:
+            output_file = output_file_for(input_file_path, output_dir)
+            try:
+                output_files[input_file_path] = predictor_pool.predict(
+                    input_file_path, output_file, model_config, self.device,
+                    shared_input=shared_inputs.get(input_file_path),
+                    num_threads=len(cpu_set) if cpu_set else None
+                )
+            except ImportError as e:
+                raise BackendUnavailable(str(e))
+            except Exception as e:
+                logger.exception(f"Error running prediction: {str(e)}")
+                raise RuntimeError(f"Error running prediction: {str(e)}")
+        return output_files
+
+
+class ExportedBackend(TorchBackend):
+    """
+    Runs ONNX Runtime / TorchScript graphs exported with export_nnunet_models
+    
+    Only the network forward pass changes; nnUNet still does the preprocessing,
+    sliding window, mirroring and resampling. Models that were not exported
+    fall back to the in-process PyTorch backend.
+    """
+    name = "exported"
+    fallback = "in_process"
+    
+    def _pool(self):
+        from .exported import get_exported_predictor_pool
+        return get_exported_predictor_pool()
+    
+    def is_available(self, model_config=None):
+        if not super().is_available():
+            return False
+        if model_config is None:
+            return True
+        return self._pool().is_exported(model_config)
+    
+    def warmup(self, model_configs):
+        self._pool().warmup([model_config for model_config in model_configs if self.is_available(model_config)],
+                            self.device)
+
+
+INFERENCE_BACKENDS = {
+    backend.name: backend for backend in (CLIBackend, TorchBackend, ExportedBackend)
+}
+
+
+def get_inference_backend(name, device):
+    """
+    Create the inference backend registered under a NNUNET_INFERENCE_ENGINE name
+    """
+    if name not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference engine '{name}'")
+    return INFERENCE_BACKENDS[name](device)
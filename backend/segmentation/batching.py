@@ -0,0 +1,67 @@
+import time
+import logging
+from django.conf import settings
+
+# batching.py
+logger = logging.getLogger(__name__)
+
+
+def claim_task(task_id):
+    """
+    Atomically move a queued task to 'processing'
+
+    Returns:
+        True if this worker claimed the task, False if it was not queued
+        (another worker's batch already picked it up)
+    """
+    from .models import SegmentationTask
+    from .tasks import PROCESSING_PROGRESS
+    return SegmentationTask.objects.filter(id=task_id, status='queued').update(
+        status='processing', progress=PROCESSING_PROGRESS
+    ) == 1
+
+
+def collect_batch(task_id, max_size=None, max_wait=None, poll_interval=0.5):
+    """
+    Claim a task plus up to max_size - 1 other queued tasks for one inference run
+
+    Waits at most max_wait seconds for more uploads to arrive before returning.
+    Only tasks with the same inference tier are batched, since a batch shares
+    one set of models. Tasks picked up here are skipped when their own Celery
+    message is delivered.
+
+    Args:
+        task_id: Id of the task this worker was asked to process
+        max_size: Maximum batch size (default: settings.SEGMENTATION_BATCH_SIZE)
+        max_wait: Maximum seconds to wait for a full batch (default: settings.SEGMENTATION_BATCH_WAIT_SECONDS)
+        poll_interval: Seconds between queue polls
+
+    Returns:
+        List of claimed task ids, empty if task_id itself was already claimed
+    """
+    from .models import SegmentationTask
+
+    max_size = max_size or settings.SEGMENTATION_BATCH_SIZE
+    max_wait = settings.SEGMENTATION_BATCH_WAIT_SECONDS if max_wait is None else max_wait
+
+    if not claim_task(task_id):
+        return []
+
+    batch = [str(task_id)]
+    tier = SegmentationTask.objects.filter(id=task_id).values_list('inference_tier', flat=True).first()
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_size:
+        candidates = (SegmentationTask.objects
+                      .filter(status='queued', inference_tier=tier)
+                      .order_by('created_at')
+                      .values_list('id', flat=True)[:max_size - len(batch)])
+        for candidate_id in candidates:
+            if claim_task(candidate_id):
+                batch.append(str(candidate_id))
+
+        if len(batch) >= max_size or time.monotonic() >= deadline:
+            break
+        time.sleep(poll_interval)
+
+    logger.info(f"Collected batch of {len(batch)} task(s): {', '.join(batch)}")
+    return batch
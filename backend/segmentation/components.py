@@ -0,0 +1,160 @@
+import os
+import math
+import logging
+import tempfile
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from django.conf import settings
+
+# components.py
+logger = logging.getLogger(__name__)
+
+
+def _bounding_box(selected):
+    """
+    [start, stop) voxel range of the True voxels along each axis, or None if there are none
+    """
+    box = []
+    for axis in range(3):
+        indices = np.flatnonzero(selected.any(axis=tuple(other for other in range(3) if other != axis)))
+        if not len(indices):
+            return None
+        box.append((int(indices[0]), int(indices[-1]) + 1))
+    return box
+
+
+def _intersect(box, other):
+    box = [(max(start, other_start), min(stop, other_stop)) for (start, stop), (other_start, other_stop)
+           in zip(box, other)]
+    return None if any(stop <= start for start, stop in box) else box
+
+
+def _relative(box, origin):
+    return tuple(slice(start - origin_start, stop - origin_start)
+                 for (start, stop), (origin_start, _) in zip(box, origin))
+
+
+def filter_tumor_components(tumor, lung, zooms, margin_mm=None, min_volume_mm3=None, foreground_label=1):
+    """
+    Remove tumor components outside the lungs or below a minimum volume
+
+    The tumor foreground is labelled once (6-connected, like analyze_lesions)
+    on its bounding box. The lung mask is dilated by margin_mm with a
+    Euclidean distance transform restricted to where the margin-padded tumor
+    and lung boxes overlap, and each component's voxel count and voxels near
+    the lung are then weighted bincounts over the labels. Removal is one
+    lookup-table pass; there is no Python loop over components.
+
+    Lung masks without any lung voxels (a failed lung model) do not constrain
+    the tumor, only the volume threshold applies.
+
+    Args:
+        tumor: 3D tumor label array
+        lung: 3D lung label array on the same grid (any non-zero label is lung)
+        zooms: Voxel size in mm
+        margin_mm: Distance from the lung a component may lie within
+            (default: settings.SEGMENTATION_LUNG_MARGIN_MM)
+        min_volume_mm3: Smallest component volume kept (default: settings.SEGMENTATION_MIN_COMPONENT_MM3)
+        foreground_label: Label counted as tumor
+
+    Returns:
+        Tuple of (tumor array with the components set to 0, list of removed
+        component dictionaries with 'reason' ('outside_lung' or 'too_small'),
+        'voxel_count', 'volume' (cm³), 'centroid_voxel' and 'bbox')
+    """
+    margin_mm = settings.SEGMENTATION_LUNG_MARGIN_MM if margin_mm is None else margin_mm
+    min_volume_mm3 = settings.SEGMENTATION_MIN_COMPONENT_MM3 if min_volume_mm3 is None else min_volume_mm3
+    zooms = [float(zoom) for zoom in zooms[:3]]
+
+    foreground = np.asarray(tumor) == foreground_label
+    tumor_box = _bounding_box(foreground)
+    if tumor_box is None:
+        return tumor, []
+    labeled, count = ndimage.label(foreground[tuple(slice(start, stop) for start, stop in tumor_box)],
+                                   structure=ndimage.generate_binary_structure(3, 1))
+    del foreground
+    voxel_counts = np.bincount(labeled.ravel(), minlength=count + 1)
+
+    # Voxels of each component within margin_mm of the lung
+    lung = np.asarray(lung) != 0
+    lung_box = _bounding_box(lung)
+    if lung_box is None:
+        logger.warning("Lung mask is empty, tumor components are not checked against it")
+        near_counts = voxel_counts
+    else:
+        pad = [int(math.ceil(margin_mm / zoom)) for zoom in zooms]
+
+        def padded(box):
+            return [(max(start - p, 0), min(stop + p, size)) for (start, stop), p, size in zip(box, pad, lung.shape)]
+
+        # Only lung voxels in here can lie within the margin of a tumor voxel, and vice versa
+        near_counts = np.zeros(count + 1, dtype=np.int64)
+        region = _intersect(padded(tumor_box), padded(lung_box))
+        overlap = _intersect(region, tumor_box) if region else None
+        if overlap:
+            distance = ndimage.distance_transform_edt(~lung[tuple(slice(start, stop) for start, stop in region)],
+                                                      sampling=zooms)
+            near = distance[_relative(overlap, region)] <= margin_mm
+            del distance
+            near_counts = np.bincount(labeled[_relative(overlap, tumor_box)][near], minlength=count + 1)
+    del lung
+
+    voxel_volume = float(np.prod(zooms))
+    outside = near_counts == 0
+    too_small = voxel_counts * voxel_volume < min_volume_mm3
+    drop = outside | too_small
+    drop[0] = False
+    removed_ids = np.flatnonzero(drop)
+    if not len(removed_ids):
+        return tumor, []
+
+    # Describe the removed components, then clear them through a label lookup table
+    coords = np.nonzero(drop[labeled])
+    ids = labeled[coords]
+    offset = np.array([start for start, _ in tumor_box])
+    centroids = np.stack([np.bincount(ids, weights=axis, minlength=count + 1)[removed_ids]
+                          for axis in coords], axis=1) / voxel_counts[removed_ids, None] + offset
+    objects = ndimage.find_objects(labeled)
+    removed = [{
+        'reason': 'outside_lung' if outside[i] else 'too_small',
+        'voxel_count': int(voxel_counts[i]),
+        'volume': float(voxel_counts[i] * voxel_volume / 1000),
+        'centroid_voxel': [round(float(value), 2) for value in centroid],
+        'bbox': [[int(s.start + o), int(s.stop + o)] for s, o in zip(objects[i - 1], offset)],
+    } for i, centroid in zip(removed_ids, centroids)]
+
+    tumor = np.array(tumor, copy=True)
+    crop = tumor[tuple(slice(start, stop) for start, stop in tumor_box)]
+    crop[drop[labeled]] = 0
+    logger.info(f"Removed {len(removed)} of {count} tumor component(s) "
+                f"({sum(component['voxel_count'] for component in removed)} voxels)")
+    return tumor, removed
+
+
+def replace_mask(file_path, img, data):
+    """
+    Write a modified mask in place of its file
+
+    The mask goes to a new file that is renamed over the old one. Segmentation
+    files may be hard links into the result cache, so they are never rewritten
+    in place.
+
+    Args:
+        file_path: Mask file to replace
+        img: NIfTI image the mask was loaded from (geometry and header)
+        data: New label array, in the stored dtype
+    """
+    header = img.header.copy()
+    header.set_data_dtype(data.dtype)
+    header.set_slope_inter(1, 0)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.nii.gz')
+    os.close(fd)
+    try:
+        nib.save(nib.Nifti1Image(data, img.affine, header), temp_path)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,146 @@
+import math
+import logging
+import nibabel as nib
+import numpy as np
+
+# cropping.py
+logger = logging.getLogger(__name__)
+
+
+def mask_bounding_box(mask_path, margin_mm=0.0):
+    """
+    Get the padded bounding box of the foreground of a mask file
+
+    Args:
+        mask_path: Path to a NIfTI mask
+        margin_mm: Padding added on every side, in millimetres
+
+    Returns:
+        Tuple of slices in voxel coordinates, or None if the mask is empty
+    """
+    img = nib.load(mask_path)
+    # Masks are stored as small integers, read them without a float copy
+    foreground = np.asanyarray(img.dataobj) > 0
+    if not foreground.any():
+        return None
+
+    zooms = img.header.get_zooms()[:3]
+    bbox = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        indices = np.flatnonzero(foreground.any(axis=other_axes))
+        margin = int(math.ceil(margin_mm / zooms[axis])) if zooms[axis] > 0 else 0
+        start = max(int(indices[0]) - margin, 0)
+        stop = min(int(indices[-1]) + 1 + margin, foreground.shape[axis])
+        bbox.append(slice(start, stop))
+    return tuple(bbox)
+
+
+def bounding_box_fraction(bbox, shape):
+    """
+    Fraction of the voxels of a volume of the given shape inside bbox
+    """
+    inside = np.prod([s.stop - s.start for s in bbox])
+    return float(inside) / float(np.prod(shape[:3]))
+
+
+def crop_image(input_file_path, bbox, output_file_path):
+    """
+    Write the bbox region of an image, with its affine shifted to match
+
+    Args:
+        input_file_path: Path to the full NIfTI image
+        bbox: Tuple of slices in voxel coordinates
+        output_file_path: Path to write the cropped image to
+
+    Returns:
+        Path to the cropped image
+    """
+    img = nib.load(input_file_path)
+    # slicer only reads the requested region and keeps world coordinates intact
+    nib.save(img.slicer[bbox], output_file_path)
+    return output_file_path
+
+
+def paste_mask(cropped_mask_path, bbox, reference_file_path, output_file_path):
+    """
+    Place a mask predicted on a crop back into full-volume coordinates
+
+    Args:
+        cropped_mask_path: Path to the mask predicted on the cropped image
+        bbox: Tuple of slices the crop was taken from
+        reference_file_path: Path to an image with the full-volume geometry
+        output_file_path: Path to write the full-volume mask to
+
+    Returns:
+        Path to the full-volume mask
+    """
+    cropped = nib.load(cropped_mask_path)
+    reference = nib.load(reference_file_path)
+    cropped_data = np.asanyarray(cropped.dataobj)
+
+    full = np.zeros(reference.shape[:3], dtype=cropped_data.dtype)
+    full[bbox] = cropped_data
+
+    header = reference.header.copy()
+    header.set_data_dtype(full.dtype)
+    header.set_slope_inter(1, 0)
+    nib.save(nib.Nifti1Image(full, reference.affine, header), output_file_path)
+    return output_file_path
+
+
+def body_bounding_box(image_path, threshold_hu=None, step_mm=None, margin_mm=None):
+    """
+    Get the padded bounding box of the patient's body in a CT image
+
+    A cheap pass over a strided copy of the volume (about step_mm between
+    samples): voxels above threshold_hu are opened once to detach the scanner
+    table and blankets, and the largest connected component is taken as the
+    body. Its box is scaled back to full resolution and padded by margin_mm.
+
+    Args:
+        image_path: Path to a NIfTI CT image in Hounsfield units
+        threshold_hu: Intensity separating tissue from air (default: settings.SEGMENTATION_BODY_THRESHOLD_HU)
+        step_mm: Sampling distance of the pass (default: settings.SEGMENTATION_BODY_STEP_MM)
+        margin_mm: Padding added on every side (default: settings.SEGMENTATION_BODY_MARGIN_MM)
+
+    Returns:
+        Tuple of slices in voxel coordinates, or None if no body is found or
+        the box covers the whole volume
+    """
+    from django.conf import settings
+    from scipy import ndimage
+
+    threshold_hu = settings.SEGMENTATION_BODY_THRESHOLD_HU if threshold_hu is None else threshold_hu
+    step_mm = settings.SEGMENTATION_BODY_STEP_MM if step_mm is None else step_mm
+    margin_mm = settings.SEGMENTATION_BODY_MARGIN_MM if margin_mm is None else margin_mm
+
+    img = nib.load(image_path)
+    shape = img.shape[:3]
+    zooms = [float(zoom) for zoom in img.header.get_zooms()[:3]]
+    steps = [max(int(step_mm // zoom), 1) if zoom > 0 else 1 for zoom in zooms]
+    # The proxy only decodes the sampled voxels into memory
+    sampled = np.asanyarray(img.dataobj[tuple(slice(None, None, step) for step in steps)]) > threshold_hu
+    if sampled.ndim > 3:
+        sampled = sampled.reshape(sampled.shape[:3] + (-1,)).any(axis=3)
+
+    body = ndimage.binary_opening(sampled)
+    labeled, count = ndimage.label(body)
+    if not count:
+        return None
+    largest = int(np.argmax(np.bincount(labeled.ravel())[1:])) + 1
+    # Give back the rim the opening took off, without reaching across to the table
+    body = ndimage.binary_dilation(labeled == largest, mask=sampled)
+
+    bbox = []
+    for axis, (step, zoom) in enumerate(zip(steps, zooms)):
+        indices = np.flatnonzero(body.any(axis=tuple(a for a in range(3) if a != axis)))
+        # A sample stands for the voxels up to the next one on either side
+        margin = int(math.ceil(margin_mm / zoom)) if zoom > 0 else 0
+        start = max((int(indices[0]) - 1) * step + 1 - margin, 0)
+        stop = min((int(indices[-1]) + 1) * step + margin, shape[axis])
+        bbox.append(slice(start, stop))
+
+    if all(s.start == 0 and s.stop == size for s, size in zip(bbox, shape)):
+        return None
+    return tuple(bbox)
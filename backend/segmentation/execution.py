@@ -0,0 +1,87 @@
+import os
+import logging
+from django.conf import settings
+
+# execution.py
+logger = logging.getLogger(__name__)
+
+
+def available_cpus():
+    """
+    Get the CPU cores this process is allowed to run on
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on every platform
+        return list(range(os.cpu_count() or 1))
+
+
+def available_memory_gb():
+    """
+    Get the currently available system memory in GB, or None if unknown
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / (1024 ** 2)
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 ** 3)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def partition_cpus(cpus, parts):
+    """
+    Split a list of CPU cores into contiguous, near-equal groups
+
+    Args:
+        cpus: List of core ids
+        parts: Number of groups
+
+    Returns:
+        List of core id lists
+    """
+    size, extra = divmod(len(cpus), parts)
+    groups = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+def plan_model_execution(num_models, device):
+    """
+    Decide whether to run several models one after another or side by side
+
+    NNUNET_EXECUTION_MODE is 'sequential', 'concurrent' or 'auto'. In auto mode the
+    models only run concurrently on CPU when every model gets at least
+    NNUNET_CONCURRENT_MIN_CORES / num_models cores and NNUNET_CONCURRENT_MIN_MEMORY_GB
+    of memory is available.
+
+    Args:
+        num_models: Number of models to run
+        device: 'cpu' or 'cuda'
+
+    Returns:
+        Tuple of (mode, cpu_sets) with one CPU core list per model. In sequential
+        mode every model gets all available cores.
+    """
+    cpus = available_cpus()
+    mode = settings.NNUNET_EXECUTION_MODE
+
+    if mode == "auto":
+        memory_gb = available_memory_gb()
+        enough_cores = len(cpus) >= settings.NNUNET_CONCURRENT_MIN_CORES
+        enough_memory = memory_gb is not None and memory_gb >= settings.NNUNET_CONCURRENT_MIN_MEMORY_GB
+        mode = "concurrent" if device == "cpu" and enough_cores and enough_memory else "sequential"
+        logger.info(f"Execution mode auto -> {mode} ({len(cpus)} cores, {memory_gb} GB available, device {device})")
+
+    if mode == "concurrent" and num_models > 1 and len(cpus) >= num_models:
+        return "concurrent", partition_cpus(cpus, num_models)
+    return "sequential", [cpus] * num_models
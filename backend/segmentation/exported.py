@@ -0,0 +1,252 @@
+import os
+import json
+import threading
+import logging
+from django.conf import settings
+from .inference import PredictorPool, configure_nnunet_environment
+
+# exported.py
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    'onnx': 'onnx',
+    'torchscript': 'pt',
+}
+
+
+def export_folder(model_config, export_dir=None):
+    """
+    Get the folder holding the exported graphs of a model configuration
+    """
+    return os.path.join(export_dir or settings.NNUNET_EXPORT_DIR, model_config["dataset"], model_config["config"])
+
+
+def export_model(predictor, model_config, fold, export_format='onnx', export_dir=None, opset=17):
+    """
+    Export one fold of an initialised nnUNetPredictor to ONNX or TorchScript
+
+    The graph takes a single sliding-window tile of shape
+    (batch, channels, *patch_size) and returns the logits, which is exactly
+    what nnUNet feeds the network during inference.
+
+    Args:
+        predictor: nnUNetPredictor initialised from the trained model folder with use_folds=(fold,)
+        model_config: Model configuration dictionary
+        fold: Fold being exported
+        export_format: 'onnx' or 'torchscript'
+        export_dir: Root export folder (default: settings.NNUNET_EXPORT_DIR)
+        opset: ONNX opset version
+
+    Returns:
+        Path to the exported graph
+    """
+    import torch
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}'")
+
+    network = predictor.network
+    network.load_state_dict(predictor.list_of_parameters[0])
+    network = network.to('cpu').eval()
+
+    num_channels = len(predictor.dataset_json['channel_names'])
+    example = torch.zeros((1, num_channels, *predictor.configuration_manager.patch_size), dtype=torch.float32)
+
+    folder = export_folder(model_config, export_dir)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"fold_{fold}.{EXPORT_FORMATS[export_format]}")
+
+    with torch.no_grad():
+        if export_format == 'onnx':
+            torch.onnx.export(
+                network, example, path,
+                input_names=['input'], output_names=['logits'],
+                dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+                opset_version=opset
+            )
+        else:
+            traced = torch.jit.trace(network, example)
+            torch.jit.save(torch.jit.freeze(traced), path)
+
+    logger.info(f"Exported {model_config['dataset']} ({model_config['config']}) fold {fold} to {path}")
+    return path
+
+
+def write_export_metadata(predictor, model_config, folds, export_format='onnx', export_dir=None):
+    """
+    Store what the exported runtime needs to rebuild a predictor without the checkpoints
+    """
+    metadata = {
+        'format': export_format,
+        'folds': [str(fold) for fold in folds],
+        'trainer_name': predictor.trainer_name,
+        'inference_allowed_mirroring_axes': predictor.allowed_mirroring_axes,
+        'patch_size': list(predictor.configuration_manager.patch_size),
+    }
+    path = os.path.join(export_folder(model_config, export_dir), "metadata.json")
+    with open(path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return path
+
+
+def load_export_metadata(model_config, export_dir=None):
+    """
+    Read the metadata written by write_export_metadata
+
+    Raises:
+        FileNotFoundError: If the model configuration was never exported
+    """
+    path = os.path.join(export_folder(model_config, export_dir), "metadata.json")
+    with open(path) as f:
+        return json.load(f)
+
+
+def _exported_network_class():
+    """
+    Build the torch.nn.Module wrapper lazily so torch stays an optional import
+    """
+    import numpy as np
+    import torch
+
+    class ExportedNetwork(torch.nn.Module):
+        """
+        Stand-in for the nnUNet network that runs exported graphs
+
+        nnUNetPredictor ensembles folds by calling network.load_state_dict()
+        with each entry of list_of_parameters before running the sliding window.
+        Here those entries are fold names, so load_state_dict() switches the
+        active session instead of copying weights.
+        """
+        def __init__(self, sessions, export_format):
+            super().__init__()
+            self.sessions = sessions
+            self.export_format = export_format
+            self.active_fold = next(iter(sessions))
+
+        def load_state_dict(self, state_dict, strict=True):
+            self.active_fold = str(state_dict)
+
+        def forward(self, x):
+            session = self.sessions[self.active_fold]
+            if self.export_format == 'torchscript':
+                return session(x.float().cpu()).to(x.device)
+            logits = session.run(None, {'input': np.ascontiguousarray(x.float().cpu().numpy())})[0]
+            return torch.from_numpy(logits).to(x.device)
+
+    return ExportedNetwork
+
+
+def _load_session(path, export_format, device, num_threads):
+    """
+    Open an exported graph tuned for CPU inference
+    """
+    if export_format == 'torchscript':
+        import torch
+        module = torch.jit.load(path, map_location=device)
+        return torch.jit.optimize_for_inference(module)
+
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = num_threads
+    providers = ['CPUExecutionProvider']
+    if device == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    return ort.InferenceSession(path, sess_options=options, providers=providers)
+
+
+class ExportedPredictorPool(PredictorPool):
+    """
+    Predictor pool whose predictors run exported ONNX/TorchScript graphs
+
+    Predictors are rebuilt from plans.json, dataset.json and the export
+    metadata, so the PyTorch checkpoints are never loaded. Preprocessing,
+    sliding window, mirroring and export reuse the regular nnUNet code.
+    """
+    def __init__(self, results_dir=None, export_dir=None, **kwargs):
+        super().__init__(results_dir=results_dir, **kwargs)
+        self.export_dir = export_dir or settings.NNUNET_EXPORT_DIR
+
+    def _key(self, model_config, device):
+        return ("exported",) + super()._key(model_config, device)
+
+    def is_exported(self, model_config):
+        """
+        Check whether every fold a model configuration needs has been exported
+        """
+        try:
+            metadata = load_export_metadata(model_config, self.export_dir)
+        except (OSError, ValueError):
+            return False
+        folds = self._folds(model_config, metadata)
+        extension = EXPORT_FORMATS.get(metadata.get('format'))
+        folder = export_folder(model_config, self.export_dir)
+        return bool(folds) and all(os.path.exists(os.path.join(folder, f"fold_{fold}.{extension}")) for fold in folds)
+
+    def _folds(self, model_config, metadata):
+        if model_config.get("folds") is None:
+            return metadata['folds']
+        return [str(fold) for fold in model_config["folds"] if str(fold) in metadata['folds']]
+
+    def _create_predictor(self, model_config, device):
+        """
+        Build a predictor for one model configuration around its exported graphs
+        """
+        configure_nnunet_environment()
+        import torch
+        from batchgenerators.utilities.file_and_folder_operations import load_json
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+        metadata = load_export_metadata(model_config, self.export_dir)
+        folds = self._folds(model_config, metadata)
+        if not folds:
+            raise FileNotFoundError(f"No exported folds for {model_config['dataset']} ({model_config['config']})")
+
+        model_folder = self.model_folder(model_config)
+        plans_manager = PlansManager(load_json(os.path.join(model_folder, "plans.json")))
+        configuration_manager = plans_manager.get_configuration(model_config["config"])
+        dataset_json = load_json(os.path.join(model_folder, "dataset.json"))
+
+        num_threads = settings.NNUNET_EXPORTED_THREADS or os.cpu_count() or 1
+        folder = export_folder(model_config, self.export_dir)
+        extension = EXPORT_FORMATS[metadata['format']]
+        sessions = {
+            fold: _load_session(os.path.join(folder, f"fold_{fold}.{extension}"), metadata['format'], device,
+                                num_threads)
+            for fold in folds
+        }
+        network = _exported_network_class()(sessions, metadata['format'])
+
+        predictor = nnUNetPredictor(
+            tile_step_size=model_config.get("tile_step_size", 0.5),
+            use_gaussian=True,
+            use_mirroring=model_config.get("use_mirroring", True),
+            perform_everything_on_device=False,
+            device=torch.device(device),
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=False
+        )
+        logger.info(f"Loading exported {metadata['format']} model from {folder} (folds {', '.join(folds)})")
+        predictor.manual_initialization(
+            network, plans_manager, configuration_manager, list(folds), dataset_json,
+            metadata['trainer_name'], tuple(metadata['inference_allowed_mirroring_axes'] or ()) or None
+        )
+        return predictor
+
+
+_exported_predictor_pool = None
+_exported_predictor_pool_lock = threading.Lock()
+
+
+def get_exported_predictor_pool():
+    """
+    Get the exported-graph predictor pool for the current worker process
+    """
+    global _exported_predictor_pool
+    with _exported_predictor_pool_lock:
+        if _exported_predictor_pool is None:
+            _exported_predictor_pool = ExportedPredictorPool()
+        return _exported_predictor_pool
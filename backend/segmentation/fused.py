@@ -0,0 +1,149 @@
+import os
+import logging
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from .components import replace_mask
+
+# fused.py
+logger = logging.getLogger(__name__)
+
+# Labels of the fused multi-label volume; tumor is written over lung, so the lung
+# layer is every labelled voxel and the tumor layer only label 2
+FUSED_LABELS = {'lung': 1, 'tumor': 2}
+
+# Task file field of each separate mask
+MASK_FIELDS = {'tumor': 'tumor_segmentation', 'lung': 'lung_segmentation'}
+
+
+def fused_file_for(task_id):
+    return str(Path(settings.MEDIA_ROOT) / "segmentations" / f"fused_seg_{task_id}.nii.gz")
+
+
+def layer_file_for(task_id, layer):
+    return str(Path(settings.MEDIA_ROOT) / "segmentations" / f"{layer}_seg_{task_id}.nii.gz")
+
+
+def fuse_masks(tumor, lung, tumor_label=1):
+    """
+    Combine tumor and lung masks into one uint8 volume (0 background, 1 lung, 2 tumor)
+
+    Args:
+        tumor: Tumor label array
+        lung: Lung label array on the same grid (any non-zero label is lung)
+        tumor_label: Label counted as tumor
+    """
+    fused = np.zeros(np.shape(tumor), dtype=np.uint8)
+    fused[np.asarray(lung) != 0] = FUSED_LABELS['lung']
+    fused[np.asarray(tumor) == tumor_label] = FUSED_LABELS['tumor']
+    return fused
+
+
+def write_fused_mask(file_path, img, fused):
+    """
+    Write a fused volume with the geometry of one of its source masks
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    replace_mask(file_path, img, fused)
+    return file_path
+
+
+def fuse_mask_files(result_files, file_path):
+    """
+    Fuse a case's separate tumor and lung mask files
+
+    Args:
+        result_files: Dictionary with 'tumor_segmentation' and 'lung_segmentation' paths
+        file_path: Path of the fused volume
+
+    Returns:
+        file_path
+    """
+    from .postprocessing import load_mask
+
+    tumor_img, tumor = load_mask(result_files['tumor_segmentation'])
+    _, lung = load_mask(result_files['lung_segmentation'])
+    if lung.shape != tumor.shape:
+        raise ValueError(f"Tumor and lung segmentations differ in shape: {tumor.shape} vs {lung.shape}")
+    return write_fused_mask(file_path, tumor_img, fuse_masks(tumor, lung))
+
+
+def layer_mask(data, layer):
+    """
+    0/1 uint8 mask of one layer of fused labels
+
+    Post-processing keeps only tumors inside the lungs, so tumor voxels are
+    lung voxels too and the lung layer includes them.
+    """
+    if layer == 'lung':
+        selected = data != 0
+    else:
+        selected = data == FUSED_LABELS[layer]
+    return selected.view(np.uint8)
+
+
+def load_layer(source):
+    """
+    Decode one mask layer
+
+    Args:
+        source: NIfTI path of a separate mask, or a (fused volume path, layer) tuple
+
+    Returns:
+        Tuple of (image, label array); layers of a fused volume are 0/1 uint8 masks
+    """
+    from .postprocessing import load_mask
+
+    if isinstance(source, tuple):
+        path, layer = source
+        img, data = load_mask(path)
+        return img, layer_mask(data, layer)
+    return load_mask(source)
+
+
+def source_path(source):
+    """
+    File a mask layer source is read from
+    """
+    return source[0] if isinstance(source, tuple) else source
+
+
+def mask_sources(task):
+    """
+    Mask layers of a task and where to read them from
+
+    Returns:
+        Dictionary mapping 'tumor' and 'lung' to the separate mask path when it
+        exists, otherwise to a (fused volume path, layer) tuple
+    """
+    sources = {}
+    fused = task.fused_segmentation
+    fused_path = fused.path if fused and os.path.exists(fused.path) else None
+    for layer, field_name in MASK_FIELDS.items():
+        field = getattr(task, field_name)
+        if field and os.path.exists(field.path):
+            sources[layer] = field.path
+        elif fused_path:
+            sources[layer] = (fused_path, layer)
+    return sources
+
+
+def materialize_layer(task, layer):
+    """
+    Separate mask file of a task layer, extracted from the fused volume on first request
+
+    Returns:
+        Path of the mask file, or None if the task has neither
+    """
+    source = mask_sources(task).get(layer)
+    if not isinstance(source, tuple):
+        return source
+
+    img, data = load_layer(source)
+    file_path = layer_file_for(task.id, layer)
+    replace_mask(file_path, img, data)
+    field_name = MASK_FIELDS[layer]
+    getattr(task, field_name).name = os.path.relpath(file_path, settings.MEDIA_ROOT)
+    task.save(update_fields=[field_name])
+    logger.info(f"Extracted {layer} mask of task {task.id} from its fused volume")
+    return file_path
@@ -0,0 +1,218 @@
+import os
+import threading
+import logging
+import numpy as np
+from django.conf import settings
+from .preprocessing import SharedPreprocessor
+from .streaming import StreamingPredictor, should_stream
+from .probabilities import probability_file_for, foreground_from_logits, write_foreground_probabilities
+
+# inference.py
+logger = logging.getLogger(__name__)
+
+
+def configure_nnunet_environment(env=None):
+    """
+    Point nnUNet at our raw/preprocessed/results folders
+
+    nnunetv2.paths reads these variables once at import time, so this must run
+    before nnunetv2 is imported in the worker process.
+
+    Args:
+        env: Mapping to update (default: os.environ)
+
+    Returns:
+        The updated mapping
+    """
+    env = os.environ if env is None else env
+    env["nnUNet_raw"] = settings.NNUNET_RAW
+    env["nnUNet_preprocessed"] = settings.NNUNET_PREPROCESSED
+    env["nnUNet_results"] = settings.NNUNET_RESULTS
+    # nnUNet caps its inference threads at nnUNet_def_n_proc (default 8)
+    env.setdefault("nnUNet_def_n_proc", str(os.cpu_count() or 1))
+    return env
+
+
+class PredictorPool:
+    """
+    Process-wide pool of initialised nnUNetPredictor instances
+
+    Each model configuration is loaded once per Celery worker process and kept
+    resident, so repeated predict() calls skip interpreter start-up, the torch
+    import and checkpoint loading that the nnUNetv2_predict CLI pays every time.
+    """
+    def __init__(self, results_dir=None, trainer="nnUNetTrainer", plans="nnUNetPlans"):
+        self.results_dir = results_dir or settings.NNUNET_RESULTS
+        self.trainer = trainer
+        self.plans = plans
+        self._predictors = {}
+        self._locks = {}
+        self._pool_lock = threading.Lock()
+
+    def model_folder(self, model_config):
+        """
+        Get the trained model folder for a model configuration
+        """
+        return os.path.join(
+            self.results_dir,
+            model_config["dataset"],
+            f"{self.trainer}__{self.plans}__{model_config['config']}"
+        )
+
+    def _key(self, model_config, device):
+        folds = model_config.get("folds")
+        return (
+            model_config["dataset"], model_config["config"], device,
+            tuple(folds) if folds is not None else None,
+            model_config.get("use_mirroring", True),
+            model_config.get("tile_step_size", 0.5),
+        )
+
+    def _create_predictor(self, model_config, device):
+        """
+        Build and initialise a predictor for one model configuration
+
+        The optional tier keys of model_config ('folds', 'use_mirroring',
+        'tile_step_size') select the fold ensemble and sliding window settings.
+        """
+        configure_nnunet_environment()
+        import torch
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+        if device == "cpu":
+            # Same as nnUNetv2_predict: let torch use all cores on CPU
+            torch.set_num_threads(os.cpu_count() or 1)
+
+        predictor = nnUNetPredictor(
+            tile_step_size=model_config.get("tile_step_size", 0.5),
+            use_gaussian=True,
+            use_mirroring=model_config.get("use_mirroring", True),
+            perform_everything_on_device=device == "cuda",
+            device=torch.device(device),
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=False
+        )
+        model_folder = self.model_folder(model_config)
+        logger.info(f"Loading nnUNet model from {model_folder}")
+        predictor.initialize_from_trained_model_folder(
+            model_folder,
+            use_folds=model_config.get("folds"),  # None auto-detects the available folds
+            checkpoint_name="checkpoint_final.pth"
+        )
+        return predictor
+
+    def get(self, model_config, device):
+        """
+        Get the resident predictor for a model configuration, loading it on first use
+
+        Returns:
+            Tuple of (predictor, lock). Hold the lock while running the predictor,
+            nnUNet swaps fold weights into the shared network during inference.
+        """
+        key = self._key(model_config, device)
+        with self._pool_lock:
+            if key not in self._predictors:
+                self._predictors[key] = self._create_predictor(model_config, device)
+                self._locks[key] = threading.Lock()
+                logger.info(f"Model {model_config['dataset']} ({model_config['config']}, "
+                            f"tier {model_config.get('tier', 'default')}) loaded on {device}")
+            return self._predictors[key], self._locks[key]
+
+    def is_loaded(self, model_config, device):
+        return self._key(model_config, device) in self._predictors
+
+    def warmup(self, model_configs, device):
+        """
+        Load a list of model configurations ahead of the first task
+        """
+        for model_config in model_configs:
+            self.get(model_config, device)
+
+    def predict(self, input_file_path, output_file_path, model_config, device, shared_input=None, num_threads=None):
+        """
+        Run in-process prediction for a single nnUNet-named input file
+
+        Args:
+            input_file_path: Path to the input case_0000.nii.gz file
+            output_file_path: Path to write the segmentation to
+            model_config: Model configuration dictionary
+            device: 'cpu' or 'cuda'
+            shared_input: Optional SharedPreprocessor reused across models for the same input
+            num_threads: Optional torch thread budget for this call. torch.set_num_threads
+                sets the OpenMP thread count of the calling thread, so concurrent
+                calls from different threads each keep their own budget.
+
+        When model_config['save_probabilities'] is set, the tumor probability map
+        is also written next to the segmentation (see probabilities.probability_file_for).
+
+        Returns:
+            Path to the written segmentation
+        """
+        import torch
+        from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        predictor, lock = self.get(model_config, device)
+        if shared_input is None:
+            shared_input = SharedPreprocessor(input_file_path)
+        probability_file_path = probability_file_for(output_file_path) if model_config.get("save_probabilities") \
+            else None
+
+        # Volumes too large for the memory ceiling are preprocessed and predicted slab by slab.
+        # Decided from the header, before preprocessing holds any volume in memory
+        data_shape, original_shape = shared_input.estimated_shape(predictor)
+        if should_stream(data_shape, predictor.label_manager.num_segmentation_heads, original_shape):
+            spill_dir = shared_input.spill()
+            data, properties = shared_input.preprocess_streamed(predictor)
+            with lock:
+                return StreamingPredictor(predictor, spill_dir).predict(data, properties, output_file_path,
+                                                                        probability_file_path)
+
+        data, properties = shared_input.preprocess(predictor, as_tensor=False)
+        data = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+        with lock:
+            logits = predictor.predict_logits_from_preprocessed_data(data).cpu()
+        del data
+
+        # Keep only the float16 foreground channel, not every channel's logits, for the probability map
+        foreground = foreground_from_logits(logits.numpy(), predictor.label_manager.has_regions) \
+            if probability_file_path else None
+        segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+            logits, predictor.plans_manager, predictor.configuration_manager,
+            predictor.label_manager, properties, return_probabilities=False,
+            num_threads_torch=num_threads or torch.get_num_threads()
+        )
+        del logits
+        if foreground is not None:
+            write_foreground_probabilities(foreground, properties, predictor.plans_manager.transpose_backward,
+                                           probability_file_path)
+            del foreground
+
+        predictor.plans_manager.image_reader_writer_class().write_seg(segmentation, output_file_path, properties)
+        logger.info(f"Generated segmentation at {output_file_path}")
+        return output_file_path
+
+    def clear(self):
+        """
+        Drop all resident predictors
+        """
+        with self._pool_lock:
+            self._predictors.clear()
+            self._locks.clear()
+
+
+_predictor_pool = None
+_predictor_pool_lock = threading.Lock()
+
+
+def get_predictor_pool():
+    """
+    Get the predictor pool for the current worker process
+    """
+    global _predictor_pool
+    with _predictor_pool_lock:
+        if _predictor_pool is None:
+            _predictor_pool = PredictorPool()
+        return _predictor_pool
@@ -0,0 +1,65 @@
+import time
+import tracemalloc
+import nibabel as nib
+from nibabel.processing import resample_to_output
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from segmentation.nnunet_handler import NNUNetHandler
+from segmentation.resampling import ChunkedResampler
+
+
+class Command(BaseCommand):
+    help = 'Compare the chunked resampler against nibabel resample_to_output on a NIfTI scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NIfTI scan to resample')
+        parser.add_argument('--spacing', type=float, nargs=3, default=None,
+                            help="Target spacing in mm (default: the models' plans spacing)")
+        parser.add_argument('--order', type=int, default=settings.SEGMENTATION_RESAMPLE_ORDER,
+                            help='Spline interpolation order')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 0],
+                            help='Thread counts to benchmark the chunked resampler with (0 = all cores)')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per method; the fastest is reported')
+        parser.add_argument('--skip-baseline', action='store_true', help='Do not run resample_to_output')
+
+    def _measure(self, run, repeat):
+        best = None
+        peak = 0
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            shape = run()
+            elapsed = time.perf_counter() - start
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            best = elapsed if best is None else min(best, elapsed)
+        return best, peak, shape
+
+    def _report(self, name, elapsed, peak, shape, baseline=None):
+        speedup = f'  {baseline / elapsed:5.1f}x' if baseline else ''
+        self.stdout.write(f'{name:<28} {elapsed:8.2f} s  {peak / 1024 ** 2:9.1f} MiB peak  {shape}{speedup}')
+
+    def handle(self, *args, **options):
+        try:
+            img = nib.load(options['path'])
+        except Exception as e:
+            raise CommandError(f"Could not load {options['path']}: {e}")
+        spacing = tuple(options['spacing'] or NNUNetHandler().target_spacing())
+        self.stdout.write(f"{options['path']}: {img.shape} at {img.header.get_zooms()[:3]} mm, "
+                          f"{img.get_data_dtype()} -> {spacing} mm, order {options['order']}")
+
+        baseline = None
+        if not options['skip_baseline']:
+            def run_baseline():
+                return resample_to_output(nib.load(options['path']), voxel_sizes=spacing,
+                                          order=options['order']).shape
+            baseline, peak, shape = self._measure(run_baseline, options['repeat'])
+            self._report('resample_to_output', baseline, peak, shape)
+
+        for threads in options['threads']:
+            resampler = ChunkedResampler(spacing, order=options['order'], num_threads=threads or None)
+
+            def run_chunked():
+                return resampler.resample(nib.load(options['path'], keep_file_open=True)).shape
+            elapsed, peak, shape = self._measure(run_chunked, options['repeat'])
+            self._report(f'chunked ({resampler.num_threads} thread(s))', elapsed, peak, shape, baseline)
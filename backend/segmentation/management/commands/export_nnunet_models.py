@@ -0,0 +1,73 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from segmentation.exported import EXPORT_FORMATS, export_folder, export_model, write_export_metadata
+from segmentation.inference import configure_nnunet_environment, get_predictor_pool
+from segmentation.nnunet_handler import NNUNetHandler
+
+
+class Command(BaseCommand):
+    help = 'Export the tumor and lung nnUNet checkpoints to ONNX or TorchScript for the exported inference engine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='onnx',
+                            help='Exported graph format (default: onnx)')
+        parser.add_argument('--configs', nargs='+', default=None,
+                            help="nnUNet configurations to export (default: each model's own, e.g. 3d_fullres)")
+        parser.add_argument('--folds', nargs='+', default=None,
+                            help='Folds to export (default: every trained fold)')
+        parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+
+    def handle(self, *args, **options):
+        configure_nnunet_environment()
+        try:
+            import torch
+            from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        except ImportError as e:
+            raise CommandError(f"Exporting requires torch and nnunetv2: {e}")
+        if options['format'] == 'onnx':
+            try:
+                import onnx
+            except ImportError:
+                raise CommandError("Exporting to ONNX requires the onnx package")
+
+        handler = NNUNetHandler()
+        pool = get_predictor_pool()
+        exported = 0
+        for base_model in (handler.tumor_model, handler.lung_model):
+            for config in options['configs'] or [base_model['config']]:
+                model_config = {'dataset': base_model['dataset'], 'config': config}
+                model_folder = pool.model_folder(model_config)
+                if not os.path.isdir(model_folder):
+                    self.stdout.write(self.style.WARNING(f'No trained model at {model_folder}, skipping'))
+                    continue
+
+                folds = options['folds'] or sorted(
+                    name[len('fold_'):] for name in os.listdir(model_folder)
+                    if name.startswith('fold_') and os.path.exists(os.path.join(model_folder, name, 'checkpoint_final.pth'))
+                )
+                if not folds:
+                    self.stdout.write(self.style.WARNING(f'No trained folds in {model_folder}, skipping'))
+                    continue
+
+                predictor = None
+                for fold in folds:
+                    predictor = nnUNetPredictor(device=torch.device('cpu'), verbose=False, allow_tqdm=False)
+                    predictor.initialize_from_trained_model_folder(
+                        model_folder,
+                        use_folds=(int(fold) if fold.isdigit() else fold,),
+                        checkpoint_name='checkpoint_final.pth'
+                    )
+                    path = export_model(predictor, model_config, fold, options['format'], opset=options['opset'])
+                    self.stdout.write(f'Exported {model_config["dataset"]} ({config}) fold {fold} to {path}')
+                    exported += 1
+
+                write_export_metadata(predictor, model_config, folds, options['format'])
+                self.stdout.write(self.style.SUCCESS(
+                    f'{model_config["dataset"]} ({config}) ready in {export_folder(model_config)}'
+                ))
+
+        if not exported:
+            raise CommandError('No models were exported')
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {exported} fold(s). Set NNUNET_INFERENCE_ENGINE=exported to use them.'
+        ))
@@ -0,0 +1,184 @@
+import os
+import json
+import base64
+import shutil
+import logging
+import numpy as np
+from django.conf import settings
+
+# mask_encoding.py
+logger = logging.getLogger(__name__)
+
+ENCODINGS = ('bitpacked', 'rle')
+
+
+def _bounding_box(selected):
+    """
+    Inclusive-exclusive [start, stop] voxel range of the True voxels along each axis
+    """
+    box = []
+    for axis in range(3):
+        other_axes = tuple(other for other in range(3) if other != axis)
+        indices = np.flatnonzero(selected.any(axis=other_axes))
+        box.append([int(indices[0]), int(indices[-1]) + 1])
+    return box
+
+
+def _slice_runs(crop):
+    """
+    Run-length encode every z slice of a cropped boolean mask
+
+    Each slice is flattened with x varying fastest (the NIfTI voxel order) and
+    encoded as alternating [start, length] integers.
+
+    Returns:
+        Dictionary mapping the crop's z index to its run list, for non-empty slices only
+    """
+    depth = crop.shape[2]
+    flat_slices = np.ascontiguousarray(crop.transpose(2, 1, 0)).reshape(depth, -1).astype(np.int8)
+    edges = np.diff(np.pad(flat_slices, ((0, 0), (1, 1))), axis=1)
+    slice_indices, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+    if not slice_indices.size:
+        return {}
+
+    # np.nonzero is ordered by slice, so each slice's runs are contiguous
+    boundaries = np.flatnonzero(np.diff(slice_indices)) + 1
+    pairs = np.stack([starts, stops - starts], axis=1)
+    return {
+        int(indices[0]): slice_pairs.ravel().tolist()
+        for indices, slice_pairs in zip(np.split(slice_indices, boundaries), np.split(pairs, boundaries))
+    }
+
+
+def encode_mask(mask, affine, zooms):
+    """
+    Encode a label volume as sparse per-label masks
+
+    Every non-zero label is stored twice, cropped to its bounding box:
+    bit-packed (np.packbits of the crop in C order, base64) and as per-slice
+    runs. Together with the shape and affine this reconstructs the volume
+    exactly; see decode_mask.
+
+    Args:
+        mask: 3D integer label array
+        affine: 4x4 voxel-to-scanner affine
+        zooms: Voxel size in mm
+
+    Returns:
+        JSON-serializable dictionary
+    """
+    mask = np.asarray(mask)
+    labels = {}
+    counts = np.bincount(mask.ravel()) if mask.dtype.kind == 'u' and mask.dtype.itemsize <= 2 else None
+    values = np.flatnonzero(counts) if counts is not None else np.unique(mask)
+    for label in values:
+        if label == 0:
+            continue
+        selected = mask == label
+        box = _bounding_box(selected)
+        crop = selected[tuple(slice(start, stop) for start, stop in box)]
+        labels[str(int(label))] = {
+            'voxel_count': int(counts[label]) if counts is not None else int(crop.sum()),
+            'bbox': box,
+            'bitpacked': base64.b64encode(np.packbits(crop, axis=None)).decode('ascii'),
+            'rle': {str(z + box[2][0]): runs for z, runs in _slice_runs(crop).items()},
+        }
+
+    return {
+        'shape': list(mask.shape),
+        'dtype': mask.dtype.name,
+        'affine': np.asarray(affine).tolist(),
+        'zooms': [float(zoom) for zoom in zooms],
+        'labels': labels,
+    }
+
+
+def decode_mask(document, encoding='bitpacked'):
+    """
+    Rebuild the dense label volume from an encoded mask document
+
+    Args:
+        document: Dictionary as returned by encode_mask (or the masks endpoint)
+        encoding: Which representation to decode, 'bitpacked' or 'rle'
+
+    Returns:
+        Dense label array
+    """
+    mask = np.zeros(document['shape'], dtype=document['dtype'])
+    for label, entry in document['labels'].items():
+        box = entry['bbox']
+        crop_shape = [stop - start for start, stop in box]
+        if encoding == 'bitpacked':
+            bits = np.unpackbits(np.frombuffer(base64.b64decode(entry['bitpacked']), dtype=np.uint8),
+                                 count=int(np.prod(crop_shape)))
+            crop = bits.reshape(crop_shape).astype(bool)
+        else:
+            crop = np.zeros(crop_shape, dtype=bool)
+            for z, runs in entry['rle'].items():
+                # Slices are flattened with x fastest, i.e. a (y, x) array in C order
+                flat = np.zeros(crop_shape[0] * crop_shape[1], dtype=bool)
+                for start, length in zip(runs[::2], runs[1::2]):
+                    flat[start:start + length] = True
+                crop[:, :, int(z) - box[2][0]] = flat.reshape(crop_shape[1], crop_shape[0]).T
+        mask[tuple(slice(start, stop) for start, stop in box)][crop] = int(label)
+    return mask
+
+
+class MaskEncodingStore:
+    """
+    Encoded masks of completed tasks, one JSON document per layer
+
+    Layout:
+        <encoding_dir>/<task_id>/<layer>.json
+    """
+    def __init__(self, encoding_dir=None):
+        self.encoding_dir = str(encoding_dir or settings.MASK_ENCODING_DIR)
+
+    def _path(self, task_id, layer):
+        return os.path.join(self.encoding_dir, str(task_id), f"{layer}.json")
+
+    def save(self, task_id, layer, document):
+        path = self._path(task_id, layer)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(document, f, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    def load(self, task_id, layer):
+        """
+        Encoded mask of a task layer, or None if it has not been generated
+        """
+        try:
+            with open(self._path(task_id, layer)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def discard(self, task_id):
+        shutil.rmtree(os.path.join(self.encoding_dir, str(task_id)), ignore_errors=True)
+
+
+def encode_task_masks(task_id, sources, store=None):
+    """
+    Encode and store every mask layer of a task
+
+    Args:
+        task_id: Task the masks belong to
+        sources: Dictionary mapping mask layer names to sources (see fused.mask_sources)
+
+    Returns:
+        Dictionary mapping layer names to (dense bytes, encoded bytes)
+    """
+    from .fused import load_layer
+
+    store = store or MaskEncodingStore()
+    sizes = {}
+    for layer, source in sources.items():
+        img, mask = load_layer(source)
+        document = encode_mask(mask, img.affine, img.header.get_zooms()[:3])
+        store.save(task_id, layer, document)
+        sizes[layer] = (mask.nbytes, os.path.getsize(store._path(task_id, layer)))
+        logger.info(f"Encoded {layer} mask of task {task_id}: {sizes[layer][0]} -> {sizes[layer][1]} bytes")
+    return sizes
@@ -0,0 +1,182 @@
+import os
+import re
+import logging
+import mimetypes
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework.views import APIView
+from .models import SegmentationTask
+
+# media.py
+logger = logging.getLogger(__name__)
+
+# Bytes read at a time when streaming a file
+STREAM_BLOCK_SIZE = 256 * 1024
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# NIfTI volumes are gzip streams; mimetypes would report them as application/x-nifti or nothing
+CONTENT_TYPES = {'.gz': 'application/gzip', '.nii': 'application/octet-stream'}
+
+# Media folders holding task files; the rest of MEDIA_ROOT (unfinished chunked
+# uploads, kept probability maps) is never served
+SERVED_FOLDERS = ('uploads', 'segmentations')
+
+# Task file fields a served path must belong to
+TASK_FILE_FIELDS = ('nifti_file', 'tumor_segmentation', 'lung_segmentation', 'fused_segmentation')
+
+
+def file_etag(stat):
+    """
+    Strong ETag of a file from its inode, mtime and size
+
+    Task files are always replaced rather than rewritten in place, so a changed
+    file gets a new inode and mtime. Validating a request never reads the file.
+    """
+    return quote_etag(f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+
+def task_for_media(path):
+    """
+    Task one of whose files is stored at a MEDIA_ROOT-relative path, or None
+    """
+    query = Q()
+    for field_name in TASK_FILE_FIELDS:
+        query |= Q(**{field_name: path})
+    return SegmentationTask.objects.filter(query).first()
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header
+
+    Returns:
+        (start, stop) byte range, None to serve the whole file (no header, or one
+        this view does not support such as multiple ranges), or False if the
+        range cannot be satisfied
+    """
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        return (max(size - length, 0), size) if length and size else False
+    start = int(first)
+    stop = min(int(last) + 1, size) if last else size
+    if start >= size or stop <= start:
+        return False
+    return start, stop
+
+
+def _file_blocks(path, start, stop):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = f.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # Weak comparison, as required for If-None-Match
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in etags}
+    modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return modified_since is not None and int(last_modified) <= modified_since
+
+
+def _range_allowed(request, etag, last_modified):
+    # If-Range: only honour the range when the client's copy is still current
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    range_date = parse_http_date_safe(if_range)
+    return range_date is not None and int(last_modified) <= range_date
+
+
+class MediaFileView(APIView):
+    """
+    Serve a task's input or segmentation file with validators and byte-range support
+
+    Only files under SERVED_FOLDERS that belong to a SegmentationTask are
+    served, with the same authentication and permissions as the task API.
+    Responses carry a strong ETag and Last-Modified; matching If-None-Match /
+    If-Modified-Since requests get a 304, and a single 'Range: bytes=' range is
+    answered with 206 Partial Content. Files are streamed from disk and never
+    read into memory whole.
+    """
+    http_method_names = ['get', 'head', 'options']
+
+    def get(self, request, path):
+        if path.split('/', 1)[0] not in SERVED_FOLDERS:
+            raise Http404("File not found")
+        task = task_for_media(path)
+        if task is None:
+            raise Http404("File not found")
+        self.check_object_permissions(request, task)
+        return serve_file(request, path)
+
+
+def serve_file(request, path):
+    """
+    Response for a file under MEDIA_ROOT, honouring conditional and range headers
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("File not found")
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404("File not found")
+    if not os.path.isfile(full_path):
+        raise Http404("File not found")
+
+    etag = file_etag(stat)
+    last_modified = stat.st_mtime
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        # Always revalidate; with the ETag a repeat view is a bodiless 304
+        'Cache-Control': 'private, no-cache',
+    }
+
+    if _not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        content_type = CONTENT_TYPES.get(os.path.splitext(full_path)[1]) \
+            or mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size) \
+            if _range_allowed(request, etag, last_modified) else None
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{stat.st_size}"
+        elif byte_range is None:
+            response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        else:
+            start, stop = byte_range
+            response = StreamingHttpResponse(_file_blocks(full_path, start, stop), status=206,
+                                             content_type=content_type)
+            response['Content-Length'] = str(stop - start)
+            response['Content-Range'] = f"bytes {start}-{stop - 1}/{stat.st_size}"
+
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,246 @@
+import os
+import json
+import shutil
+import struct
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from django.conf import settings
+
+# meshes.py
+logger = logging.getLogger(__name__)
+
+# Binary mesh layout (little endian):
+#   magic b'MLM1', uint32 vertex count, uint32 triangle count, uint8 index size
+#   (2 or 4 bytes), 3 padding bytes, float32[3] origin, float32[3] scale,
+#   then uint16[vertex count * 3] quantized positions, padding to 4 bytes and
+#   uint16/uint32[triangle count * 3] vertex indices.
+# A position is origin + quantized * scale, in scanner (RAS) millimetres.
+MESH_MAGIC = b'MLM1'
+MESH_HEADER = struct.Struct('<4sIIB3x3f3f')
+QUANTIZATION_LEVELS = 65535
+
+
+def encode_mesh(vertices, faces):
+    """
+    Pack a triangle mesh into the compact binary mesh format
+
+    Args:
+        vertices: (N, 3) float vertex positions
+        faces: (M, 3) integer vertex indices
+
+    Returns:
+        Mesh bytes
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    faces = np.asarray(faces).reshape(-1, 3)
+    if len(vertices):
+        origin = vertices.min(axis=0)
+        scale = np.maximum(vertices.max(axis=0) - origin, 1e-6) / QUANTIZATION_LEVELS
+        quantized = np.rint((vertices - origin) / scale).astype('<u2')
+    else:
+        origin, scale = np.zeros(3), np.ones(3)
+        quantized = np.zeros((0, 3), dtype='<u2')
+    index_dtype = np.dtype('<u2') if len(vertices) <= 65536 else np.dtype('<u4')
+
+    positions = quantized.tobytes()
+    padding = b'\0' * (-len(positions) % 4)
+    header = MESH_HEADER.pack(MESH_MAGIC, len(vertices), len(faces), index_dtype.itemsize, *origin, *scale)
+    return header + positions + padding + faces.astype(index_dtype).tobytes()
+
+
+def decode_mesh(data):
+    """
+    Unpack binary mesh bytes
+
+    Returns:
+        Tuple of ((N, 3) float32 vertices, (M, 3) integer faces)
+    """
+    magic, vertex_count, triangle_count, index_size, *values = MESH_HEADER.unpack_from(data)
+    if magic != MESH_MAGIC:
+        raise ValueError("Not a mesh file")
+    origin, scale = np.array(values[:3], dtype=np.float32), np.array(values[3:], dtype=np.float32)
+    offset = MESH_HEADER.size
+    quantized = np.frombuffer(data, dtype='<u2', count=vertex_count * 3, offset=offset).reshape(-1, 3)
+    offset += quantized.nbytes + (-quantized.nbytes % 4)
+    faces = np.frombuffer(data, dtype=f'<u{index_size}', count=triangle_count * 3, offset=offset).reshape(-1, 3)
+    return origin + quantized.astype(np.float32) * scale, faces
+
+
+def extract_surface(mask, affine, step_size=1):
+    """
+    Extract the surface of a binary mask with marching cubes
+
+    The mask is cropped to its bounding box (padded by one voxel so the surface
+    is closed) before extraction. Larger step sizes march over coarser cubes,
+    giving decimated meshes with roughly step_size^2 fewer triangles.
+
+    Args:
+        mask: 3D boolean array
+        affine: 4x4 voxel-to-scanner affine
+        step_size: Marching cubes step in voxels
+
+    Returns:
+        Tuple of ((N, 3) vertices in scanner millimetres, (M, 3) faces)
+    """
+    from skimage.measure import marching_cubes
+
+    if not mask.any():
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+    box = []
+    for axis in range(3):
+        indices = np.flatnonzero(mask.any(axis=tuple(other for other in range(3) if other != axis)))
+        box.append((indices[0], indices[-1] + 1))
+    crop = np.pad(mask[tuple(slice(start, stop) for start, stop in box)], 1).astype(np.float32)
+
+    vertices, faces, _, _ = marching_cubes(crop, level=0.5, step_size=step_size, allow_degenerate=False)
+    # Back to full-volume voxel coordinates, then to scanner space
+    vertices += np.array([start - 1 for start, _ in box], dtype=vertices.dtype)
+    affine = np.asarray(affine)
+    vertices = vertices @ affine[:3, :3].T + affine[:3, 3]
+    return vertices, faces
+
+
+def file_digest(path):
+    """
+    SHA-256 of a mask file, identifying the mask version its meshes were built from
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MeshStore:
+    """
+    Content-addressed cache of surface meshes, keyed by the mask file's hash
+
+    Tasks whose masks are identical (e.g. result cache hits) share one set of
+    meshes, and a mask that is replaced gets new ones.
+
+    Layout:
+        <mesh_dir>/<mask sha256>/meta.json
+        <mesh_dir>/<mask sha256>/L<level>.mesh
+        <mesh_dir>/tasks/<task_id>.json   (layer -> mask sha256)
+    """
+    def __init__(self, mesh_dir=None, steps=None, num_workers=None):
+        self.mesh_dir = str(mesh_dir or settings.MESH_CACHE_DIR)
+        self.steps = tuple(steps or settings.MESH_DECIMATION_STEPS)
+        self.num_workers = num_workers or settings.MESH_WORKERS or os.cpu_count() or 1
+
+    def _task_index_path(self, task_id):
+        return os.path.join(self.mesh_dir, 'tasks', f"{task_id}.json")
+
+    def mesh_path(self, digest, level):
+        return os.path.join(self.mesh_dir, digest, f"L{level}.mesh")
+
+    def meta(self, digest):
+        try:
+            with open(os.path.join(self.mesh_dir, digest, 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def task_meshes(self, task_id):
+        """
+        Dictionary mapping each layer of a task to its mask hash and mesh metadata
+        """
+        try:
+            with open(self._task_index_path(task_id)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {layer: {'digest': digest, **(self.meta(digest) or {'levels': []})}
+                for layer, digest in index.items()}
+
+    def build(self, task_id, sources):
+        """
+        Extract the meshes of every mask layer of a task, reusing cached ones
+
+        The (layer, decimation level) extractions run on a thread pool.
+
+        Args:
+            task_id: Task the masks belong to
+            sources: Dictionary mapping layer names to mask sources (see fused.mask_sources)
+
+        Returns:
+            Dictionary mapping layer names to whether their meshes were extracted (False: cached)
+        """
+        from .fused import load_layer, source_path
+
+        # A layer of a fused volume is addressed by the volume's hash and the layer
+        digests = {layer: file_digest(source_path(source)) + (f"-fused-{layer}" if isinstance(source, tuple) else '')
+                   for layer, source in sources.items()}
+        pending = {layer: source for layer, source in sources.items() if self.meta(digests[layer]) is None}
+
+        masks = {}
+        for layer, source in pending.items():
+            img, data = load_layer(source)
+            masks[layer] = (data > 0, img.affine)
+
+        def extract(layer, level, step):
+            mask, affine = masks[layer]
+            vertices, faces = extract_surface(mask, affine, step)
+            data = encode_mesh(vertices, faces)
+            self._write(self.mesh_path(digests[layer], level), data)
+            return {'level': level, 'step_size': step, 'vertex_count': len(vertices),
+                    'triangle_count': len(faces), 'bytes': len(data)}
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {layer: [executor.submit(extract, layer, level, step) for level, step in enumerate(self.steps)]
+                       for layer in pending}
+            for layer, layer_futures in futures.items():
+                levels = [future.result() for future in layer_futures]
+                self._write(os.path.join(self.mesh_dir, digests[layer], 'meta.json'),
+                            json.dumps({'levels': levels}).encode())
+                logger.info(f"Extracted {layer} meshes for task {task_id}: "
+                            f"{', '.join(str(level['triangle_count']) for level in levels)} triangles")
+
+        self._write(self._task_index_path(task_id), json.dumps(digests).encode())
+        return {layer: layer in pending for layer in sources}
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def discard(self, task_id):
+        """
+        Forget a task's meshes; shared mesh files are left to other tasks
+        """
+        try:
+            os.remove(self._task_index_path(task_id))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """
+        Remove meshes no task refers to any more
+
+        Returns:
+            Number of mask versions removed
+        """
+        referenced = set()
+        tasks_dir = os.path.join(self.mesh_dir, 'tasks')
+        if os.path.isdir(tasks_dir):
+            for entry in os.scandir(tasks_dir):
+                try:
+                    with open(entry.path) as f:
+                        referenced.update(json.load(f).values())
+                except (OSError, ValueError):
+                    continue
+
+        removed = 0
+        if os.path.isdir(self.mesh_dir):
+            for entry in os.scandir(self.mesh_dir):
+                if entry.is_dir() and entry.name != 'tasks' and entry.name not in referenced:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+        return removed
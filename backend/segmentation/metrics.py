@@ -0,0 +1,138 @@
+import logging
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+from django.conf import settings
+
+# metrics.py
+logger = logging.getLogger(__name__)
+
+
+class _UnionFind:
+    """
+    Disjoint sets over component ids, used to join components split by slab boundaries
+    """
+    def __init__(self):
+        self.parent = [0]  # id 0 is background
+
+    def add(self, count):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + count))
+        return start
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def _iter_slabs(data, slab_size):
+    """
+    Yield (start, slab) along the last axis, in the stored dtype
+
+    Slabs along the last axis are contiguous in a NIfTI file, so proxies
+    decompress each byte once.
+    """
+    depth = data.shape[-1]
+    for start in range(0, depth, slab_size):
+        yield start, np.asanyarray(data[..., start:start + slab_size])
+
+
+def _count_labels(slab, counts):
+    if slab.dtype.kind in 'bu' and slab.size:
+        for label, count in enumerate(np.bincount(slab.ravel())):
+            if count:
+                counts[label] = counts.get(label, 0) + int(count)
+    else:
+        labels, label_counts = np.unique(slab, return_counts=True)
+        for label, count in zip(labels.tolist(), label_counts.tolist()):
+            counts[label] = counts.get(label, 0) + int(count)
+
+
+def compute_label_metrics(segmentation_file_path=None, data=None, zooms=None, foreground_label=None,
+                          count_components=True, slab_size=None):
+    """
+    Voxel counts, volume and connected components of a label volume in one pass
+
+    The labels are read through the image's dataobj in their stored dtype, one
+    slab of slices at a time, so a uint8 mask is never expanded to float64.
+    Components are labelled per slab (6-connectivity, like ndimage.label's
+    default) and joined across slab boundaries with a union-find.
+
+    Args:
+        segmentation_file_path: Path to a NIfTI label volume
+        data: Label array (or array proxy) to use instead of loading a file
+        zooms: Voxel size in mm, required with data
+        foreground_label: Label counted as foreground (default: every non-zero label)
+        count_components: Whether to count connected foreground components
+        slab_size: Slices per slab (default: settings.SEGMENTATION_METRICS_SLAB_SIZE)
+
+    Returns:
+        Dictionary with 'label_counts', 'foreground_voxels', 'volume_cm3',
+        'component_count', 'component_sizes' (voxels per component, largest first) and
+        'slice_voxels' (foreground voxels per slice along the last axis)
+    """
+    if data is None:
+        img = nib.load(segmentation_file_path)
+        data = img.dataobj
+        zooms = img.header.get_zooms()
+    slab_size = slab_size or settings.SEGMENTATION_METRICS_SLAB_SIZE
+    voxel_volume = float(np.prod(zooms[:3]))
+
+    label_counts = {}
+    foreground_voxels = 0
+    slice_voxels = []
+    components = _UnionFind()
+    component_voxels = [0]
+    previous_plane = None
+    structure = ndimage.generate_binary_structure(3, 1)
+
+    for start, slab in _iter_slabs(data, slab_size):
+        _count_labels(slab, label_counts)
+        foreground = slab > 0 if foreground_label is None else slab == foreground_label
+        per_slice = np.count_nonzero(foreground.reshape(-1, foreground.shape[-1]), axis=0)
+        slice_voxels.extend(per_slice.tolist())
+        foreground_voxels += int(per_slice.sum())
+        if not count_components:
+            continue
+
+        labeled, num_features = ndimage.label(foreground, structure=structure)
+        if num_features:
+            component_voxels.extend(np.bincount(labeled.ravel(), minlength=num_features + 1)[1:].tolist())
+            # Give this slab's components ids after the previous slabs' ones
+            offset = components.add(num_features)
+            labeled[foreground] += offset - 1
+        first_plane = labeled[..., 0]
+        if previous_plane is not None:
+            touching = (previous_plane > 0) & (first_plane > 0)
+            if touching.any():
+                pairs = np.unique(np.stack([previous_plane[touching], first_plane[touching]], axis=1), axis=0)
+                for a, b in pairs:
+                    components.union(int(a), int(b))
+        previous_plane = labeled[..., -1].copy()
+        del labeled, foreground, slab
+
+    component_sizes = []
+    if count_components:
+        sizes = {}
+        for component_id in range(1, len(components.parent)):
+            root = components.find(component_id)
+            sizes[root] = sizes.get(root, 0) + component_voxels[component_id]
+        component_sizes = sorted(sizes.values(), reverse=True)
+
+    return {
+        'label_counts': label_counts,
+        'foreground_voxels': foreground_voxels,
+        'volume_cm3': foreground_voxels * voxel_volume / 1000,
+        'component_count': len(component_sizes) if count_components else None,
+        'component_sizes': component_sizes,
+        'slice_voxels': slice_voxels,
+    }
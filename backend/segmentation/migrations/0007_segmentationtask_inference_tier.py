@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0006_remove_segmentationtask_lesion_volume_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='inference_tier',
+            field=models.CharField(choices=[('fast', 'Fast'), ('balanced', 'Balanced'), ('full', 'Full')], default='full', max_length=20),
+        ),
+    ]
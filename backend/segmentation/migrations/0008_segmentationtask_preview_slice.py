@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0007_segmentationtask_inference_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='preview_slice',
+            field=models.IntegerField(blank=True, help_text='Axial slice index used for previews', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0008_segmentationtask_preview_slice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Percent of the pipeline completed'),
+        ),
+        migrations.AlterField(
+            model_name='segmentationtask',
+            name='status',
+            field=models.CharField(choices=[('preprocessing', 'Preprocessing'), ('queued', 'Queued'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+    ]
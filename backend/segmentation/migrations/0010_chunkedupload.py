@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0009_segmentationtask_progress_alter_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('file_name', models.CharField(max_length=255)),
+                ('total_size', models.BigIntegerField(help_text='Size of the whole file in bytes')),
+                ('chunk_size', models.PositiveIntegerField(help_text='Size of every chunk but the last in bytes')),
+                ('sha256', models.CharField(blank=True, default='', help_text='Optional checksum of the whole file, verified on completion', max_length=64)),
+                ('inference_tier', models.CharField(choices=[('fast', 'Fast'), ('balanced', 'Balanced'), ('full', 'Full')], default='full', max_length=20)),
+                ('received_chunks', models.JSONField(blank=True, default=list)),
+                ('status', models.CharField(choices=[('uploading', 'Uploading'), ('completed', 'Completed')], default='uploading', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('task', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload', to='segmentation.segmentationtask')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
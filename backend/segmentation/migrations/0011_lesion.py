@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0010_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lesion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField(help_text='Rank by size within the task, starting at 1')),
+                ('voxel_count', models.PositiveIntegerField()),
+                ('volume', models.FloatField(help_text='Lesion volume in cubic centimeters')),
+                ('longest_diameter', models.FloatField(help_text='Longest axial diameter in millimeters')),
+                ('diameter_slice', models.PositiveIntegerField(help_text='Axial slice of the longest diameter')),
+                ('centroid', models.JSONField(help_text='Centroid in scanner coordinates (mm)')),
+                ('centroid_voxel', models.JSONField(help_text='Centroid in voxel coordinates')),
+                ('bbox', models.JSONField(help_text='[start, stop) voxel range along each axis')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lesions', to='segmentation.segmentationtask')),
+            ],
+            options={
+                'ordering': ['task', 'index'],
+                'indexes': [models.Index(fields=['longest_diameter'], name='segmentatio_longest_3909d5_idx'), models.Index(fields=['volume'], name='segmentatio_volume_95edd5_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='lesion',
+            constraint=models.UniqueConstraint(fields=('task', 'index'), name='unique_lesion_index_per_task'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0011_lesion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesion',
+            name='mean_probability',
+            field=models.FloatField(blank=True, help_text="Mean tumor probability of the lesion's voxels", null=True),
+        ),
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='mean_entropy',
+            field=models.FloatField(blank=True, help_text='Mean voxel entropy (bits) over the uncertain region', null=True),
+        ),
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='mean_probability',
+            field=models.FloatField(blank=True, help_text='Mean tumor probability of the predicted tumor voxels', null=True),
+        ),
+        migrations.AlterField(
+            model_name='segmentationtask',
+            name='confidence_score',
+            field=models.FloatField(blank=True, help_text='Model confidence score (0–1): 1 - mean voxel entropy', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0012_confidence_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='removed_components',
+            field=models.JSONField(blank=True, help_text='Tumor components removed by post-processing, with the reason', null=True),
+        ),
+    ]
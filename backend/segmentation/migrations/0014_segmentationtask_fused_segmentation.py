@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:33
+
+from django.db import migrations, models
+import segmentation.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0013_segmentationtask_removed_components'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='fused_segmentation',
+            field=models.FileField(blank=True, max_length=255, null=True, upload_to=segmentation.models.fused_segmentation_path),
+        ),
+    ]
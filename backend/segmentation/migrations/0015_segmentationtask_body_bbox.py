@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0014_segmentationtask_fused_segmentation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='body_bbox',
+            field=models.JSONField(blank=True, help_text='[start, stop) voxel range per axis of the body crop the models run on; masks are pasted back into the full volume', null=True),
+        ),
+    ]
@@ -39,14 +39,25 @@ def lung_segmentation_path(instance, filename):
     """Generate file path for lung segmentation results."""
     return os.path.join('segmentations', f"lung_seg_{instance.id}.nii.gz")
 
+def fused_segmentation_path(instance, filename):
+    """Generate file path for fused (background/lung/tumor) segmentation results."""
+    return os.path.join('segmentations', f"fused_seg_{instance.id}.nii.gz")
+
 class SegmentationTask(models.Model):
     """Model for tracking lung image segmentation tasks."""
     STATUS_CHOICES = [
+        ('preprocessing', 'Preprocessing'),
         ('queued', 'Queued'),
         ('processing', 'Processing'),
         ('completed', 'Completed'),
         ('failed', 'Failed'),
     ]
+    # Speed/quality tiers, configured in settings.NNUNET_INFERENCE_TIERS
+    INFERENCE_TIER_CHOICES = [
+        ('fast', 'Fast'),
+        ('balanced', 'Balanced'),
+        ('full', 'Full'),
+    ]
     
     id             = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user           = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
@@ -54,10 +65,17 @@ class SegmentationTask(models.Model):
     file_name      = models.CharField(max_length=255)
     nifti_file     = models.FileField(upload_to=nifti_file_path)
     status         = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    inference_tier = models.CharField(max_length=20, choices=INFERENCE_TIER_CHOICES, default='full')
+    progress       = models.PositiveSmallIntegerField(default=0,
+                                                      help_text="Percent of the pipeline completed")
     tumor_segmentation = models.FileField(upload_to=tumor_segmentation_path,
                                       max_length=255, null=True, blank=True)
     lung_segmentation = models.FileField(upload_to=lung_segmentation_path,
                                       max_length=255, null=True, blank=True)
+    # uint8 labels 0 background, 1 lung, 2 tumor; with SEGMENTATION_FUSED_OUTPUT the
+    # separate masks above are only extracted from it when requested
+    fused_segmentation = models.FileField(upload_to=fused_segmentation_path,
+                                      max_length=255, null=True, blank=True)
     error          = models.TextField(null=True, blank=True)
     created_at     = models.DateTimeField(auto_now_add=True)
     updated_at     = models.DateTimeField(auto_now=True)
@@ -69,7 +87,18 @@ class SegmentationTask(models.Model):
     lesion_count    = models.IntegerField(null=True, blank=True,
                                            help_text="Number of distinct lesions")
     confidence_score = models.FloatField(null=True, blank=True,
-                                         help_text="Model confidence score (0–1)")
+                                         help_text="Model confidence score (0–1): 1 - mean voxel entropy")
+    mean_probability = models.FloatField(null=True, blank=True,
+                                         help_text="Mean tumor probability of the predicted tumor voxels")
+    mean_entropy    = models.FloatField(null=True, blank=True,
+                                         help_text="Mean voxel entropy (bits) over the uncertain region")
+    removed_components = models.JSONField(null=True, blank=True,
+                                          help_text="Tumor components removed by post-processing, with the reason")
+    preview_slice   = models.IntegerField(null=True, blank=True,
+                                           help_text="Axial slice index used for previews")
+    body_bbox       = models.JSONField(null=True, blank=True,
+                                       help_text="[start, stop) voxel range per axis of the body crop the "
+                                                 "models run on; masks are pasted back into the full volume")
     
     class Meta:
         ordering = ['-created_at']
@@ -82,3 +111,78 @@ class SegmentationTask(models.Model):
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('segmentation-detail', kwargs={'pk': self.pk})
+
+
+class Lesion(models.Model):
+    """A connected tumor component of a task's segmentation, queryable across tasks."""
+    task             = models.ForeignKey(SegmentationTask, on_delete=models.CASCADE, related_name='lesions')
+    index            = models.PositiveIntegerField(help_text="Rank by size within the task, starting at 1")
+    voxel_count      = models.PositiveIntegerField()
+    volume           = models.FloatField(help_text="Lesion volume in cubic centimeters")
+    longest_diameter = models.FloatField(help_text="Longest axial diameter in millimeters")
+    diameter_slice   = models.PositiveIntegerField(help_text="Axial slice of the longest diameter")
+    centroid         = models.JSONField(help_text="Centroid in scanner coordinates (mm)")
+    centroid_voxel   = models.JSONField(help_text="Centroid in voxel coordinates")
+    bbox             = models.JSONField(help_text="[start, stop) voxel range along each axis")
+    mean_probability = models.FloatField(null=True, blank=True,
+                                         help_text="Mean tumor probability of the lesion's voxels")
+    
+    class Meta:
+        ordering = ['task', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['task', 'index'], name='unique_lesion_index_per_task'),
+        ]
+        indexes = [
+            models.Index(fields=['longest_diameter']),
+            models.Index(fields=['volume']),
+        ]
+    
+    def __str__(self):
+        return f"Lesion {self.index} of {self.task_id} – {self.longest_diameter:.1f} mm"
+
+
+class ChunkedUpload(models.Model):
+    """Resumable upload of a NIfTI file sent in numbered, checksummed chunks."""
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('completed', 'Completed'),
+    ]
+    
+    id              = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    file_name       = models.CharField(max_length=255)
+    total_size      = models.BigIntegerField(help_text="Size of the whole file in bytes")
+    chunk_size      = models.PositiveIntegerField(help_text="Size of every chunk but the last in bytes")
+    sha256          = models.CharField(max_length=64, blank=True, default='',
+                                       help_text="Optional checksum of the whole file, verified on completion")
+    inference_tier  = models.CharField(max_length=20, choices=SegmentationTask.INFERENCE_TIER_CHOICES,
+                                       default='full')
+    received_chunks = models.JSONField(default=list, blank=True)
+    status          = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    task            = models.OneToOneField(SegmentationTask, on_delete=models.SET_NULL, null=True, blank=True,
+                                           related_name='upload')
+    created_at      = models.DateTimeField(auto_now_add=True)
+    updated_at      = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"{self.file_name} – {len(self.received_chunks)}/{self.total_chunks} chunks"
+    
+    @property
+    def total_chunks(self):
+        return max(-(-self.total_size // self.chunk_size), 1)
+    
+    @property
+    def part_path(self):
+        """Preallocated file the chunks are written into."""
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{self.id}.part")
+    
+    def chunk_length(self, index):
+        """Expected size of a chunk in bytes."""
+        return min(self.chunk_size, self.total_size - index * self.chunk_size)
+    
+    @property
+    def missing_chunks(self):
+        received = set(self.received_chunks)
+        return [index for index in range(self.total_chunks) if index not in received]
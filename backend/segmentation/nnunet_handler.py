@@ -1,4 +1,5 @@
 import os
+import json
 import subprocess
 import tempfile
 import shutil
@@ -7,7 +8,16 @@ import numpy as np
 from django.conf import settings
 from pathlib import Path
 import logging
-from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+from .inference import configure_nnunet_environment, get_predictor_pool
+from .preprocessing import SharedPreprocessor
+from .execution import plan_model_execution
+from .workspace import TaskWorkspace
+from .cropping import mask_bounding_box, bounding_box_fraction, crop_image, paste_mask
+from .backends import BackendUnavailable, get_inference_backend, output_file_for
+from .metrics import compute_label_metrics
+from .probabilities import probability_file_for, load_probability_map, compute_confidence, paste_probabilities
+from .resampling import plans_target_spacing
 
 
 
@@ -18,9 +28,12 @@ class NNUNetHandler:
     """
     Handler for nnUNet lung and tumor segmentation models
     """
-    def __init__(self):
+    def __init__(self, tier=None):
         """
         Handler for nnUNet lung and tumor segmentation models
+        
+        Args:
+            tier: Inference tier from settings.NNUNET_INFERENCE_TIERS (default: settings.NNUNET_DEFAULT_TIER)
         """
         # Path to the trained model folder - IMPORTANT: This should be the base nnunet folder
         self.model_folder = settings.NNUNET_BASE
@@ -43,7 +56,28 @@ class NNUNetHandler:
             # Simplified configuration - only include necessary params
         }
         
+        # Apply the speed/quality tier (fold subset, mirroring, tile step, configuration)
+        self.tier = tier or settings.NNUNET_DEFAULT_TIER
+        if self.tier not in settings.NNUNET_INFERENCE_TIERS:
+            raise ValueError(f"Unknown inference tier '{self.tier}'")
+        self.tumor_model = self._apply_tier(self.tumor_model, self.tier)
+        self.lung_model = self._apply_tier(self.lung_model, self.tier)
+        
+        # The tumor model also writes its foreground probabilities, used for the confidence metrics
+        self.tumor_model["save_probabilities"] = settings.SEGMENTATION_SAVE_PROBABILITIES
+        
+        # Inference engine: 'exported' (ONNX/TorchScript graphs), 'in_process' (resident
+        # PyTorch models) or 'subprocess' (nnUNetv2_predict CLI), see backends.py
+        self.inference_engine = settings.NNUNET_INFERENCE_ENGINE
+        self.backend = get_inference_backend(self.inference_engine, self.device)
+        
+        # Cascade mode runs the lung model first and the tumor model only on the padded lung region
+        self.cascade_mode = settings.NNUNET_CASCADE_MODE
+        self.cascade_margin_mm = settings.NNUNET_CASCADE_MARGIN_MM
+        
         # Input and output directories
+        # Predictions run in per-task workspaces under NNUNET_SCRATCH_DIR, the
+        # shared output directory only holds pre-computed results for fallback_inference
         self.input_dir = settings.NNUNET_INPUT_DIR
         self.output_dir = settings.NNUNET_OUTPUT_DIR
         
@@ -79,21 +113,274 @@ class NNUNetHandler:
         logger.info("No CUDA-capable GPU detected. Using CPU.")
         return "cpu"
 
-    def predict(self, input_file_path, timeout=1800):
+    def _apply_tier(self, model_config, tier):
+        """
+        Add a tier's inference settings to a model configuration
+        
+        A tier's configuration (e.g. 3d_lowres) and folds are only used when they
+        were trained for the model, otherwise the model's own configuration and
+        every available fold are used.
+        
+        Returns:
+            New model configuration dictionary
+        """
+        tier_settings = settings.NNUNET_INFERENCE_TIERS[tier]
+        pool = get_predictor_pool()
+        model_config = {
+            **model_config,
+            "tier": tier,
+            "use_mirroring": tier_settings.get("use_mirroring", True),
+            "tile_step_size": tier_settings.get("tile_step_size", 0.5),
+        }
+        
+        tier_config = tier_settings.get("config")
+        if tier_config and tier_config != model_config["config"]:
+            if os.path.isdir(pool.model_folder({**model_config, "config": tier_config})):
+                model_config["config"] = tier_config
+            else:
+                logger.info(f"{model_config['dataset']} has no {tier_config} model, "
+                            f"tier '{tier}' uses {model_config['config']}")
+        
+        folds = tier_settings.get("folds")
+        model_folder = pool.model_folder(model_config)
+        if folds is not None and os.path.isdir(model_folder):
+            trained = tuple(fold for fold in folds if os.path.isdir(os.path.join(model_folder, f"fold_{fold}")))
+            if not trained:
+                logger.info(f"{model_config['dataset']} has none of folds {folds}, tier '{tier}' uses all folds")
+            folds = trained or None
+        model_config["folds"] = tuple(folds) if folds is not None else None
+        return model_config
+    
+    def preload_models(self):
+        """
+        Load the tumor and lung models into this process's inference backend
+        """
+        try:
+            backend = self._available_backend()
+            backend.warmup([self.tumor_model, self.lung_model])
+            # Models the exported runtime cannot serve are loaded by its fallback
+            missing = [model_config for model_config in (self.tumor_model, self.lung_model)
+                       if not backend.is_available(model_config)]
+            if missing and backend.fallback:
+                get_inference_backend(backend.fallback, self.device).warmup(missing)
+        except Exception as e:
+            logger.warning(f"Could not preload nnUNet models: {str(e)}")
+
+    def target_spacing(self):
+        """
+        Spacing uploads are resampled to before inference
+        
+        The finest spacing per axis over the tumor and lung models' plans, so
+        nnUNet's own resampling becomes a no-op for the finer model. Falls back to
+        settings.SEGMENTATION_RESAMPLE_SPACING when no 3d plans are available.
+        
+        Returns:
+            Tuple of three spacings in mm, in the axis order of the NIfTI file
+        """
+        pool = get_predictor_pool()
+        spacings = []
+        for model_config in (self.tumor_model, self.lung_model):
+            try:
+                spacing = plans_target_spacing(pool.model_folder(model_config), model_config['config'])
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(f"No plans spacing for {model_config['dataset']} ({model_config['config']}): {str(e)}")
+                continue
+            if spacing is not None:
+                spacings.append(spacing)
+        
+        if not spacings:
+            return tuple(settings.SEGMENTATION_RESAMPLE_SPACING)
+        return tuple(float(value) for value in np.min(spacings, axis=0))
+    
+    def model_version(self):
+        """
+        Identify the tumor and lung models that produce results, for cache keys
+
+        Uses settings.SEGMENTATION_MODEL_VERSION when set, otherwise the model
+        configurations plus the size and modification time of their plans and
+        checkpoint files, so retrained weights never reuse stale results.
+        """
+        if settings.SEGMENTATION_MODEL_VERSION:
+            return settings.SEGMENTATION_MODEL_VERSION
+
+        import hashlib
+        digest = hashlib.sha256()
+        pool = get_predictor_pool()
+        for model_config in (self.tumor_model, self.lung_model):
+            # Includes the tier's folds, mirroring and tile step
+            digest.update(json.dumps(model_config, sort_keys=True).encode())
+            model_folder = Path(pool.model_folder(model_config))
+            for path in sorted([model_folder / "plans.json", *model_folder.glob("fold_*/checkpoint_final.pth")]):
+                if path.exists():
+                    stat = path.stat()
+                    digest.update(f"{path.relative_to(model_folder)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        # Cropped tumor inference can differ slightly from full-volume inference
+        if self.cascade_mode:
+            digest.update(f"cascade:{self.cascade_margin_mm}".encode())
+        if settings.SEGMENTATION_BODY_CROP:
+            digest.update(f"body_crop:{settings.SEGMENTATION_BODY_MARGIN_MM}".encode())
+        return digest.hexdigest()[:16]
+
+    def _available_backend(self, model_config=None):
+        """
+        Get the configured backend, or the first fallback that can run in this process
+        """
+        backend = self.backend
+        while not backend.is_available(model_config) and backend.fallback:
+            backend = get_inference_backend(backend.fallback, self.device)
+        return backend
+    
+    def _nnunet_input_name(self, input_file_path):
+        """
+        Get the nnUNet-conformant file name (case_0000.nii.gz) for an input file
+        """
+        input_name = os.path.basename(input_file_path)
+        
+        # Remove all extensions
+        if input_name.endswith('.nii.gz'):
+            input_name = input_name[:-7]
+        elif input_name.endswith('.nii'):
+            input_name = input_name[:-4]
+        elif input_name.endswith('.gz'):
+            input_name = input_name[:-3]
+            
+        # Make sure it has the required _0000 suffix
+        if not input_name.endswith('_0000'):
+            input_name = f"{input_name}_0000"
+        
+        return f"{input_name}.nii.gz"
+    
+    def _output_file_for(self, input_file_path, output_dir):
+        """
+        Get the segmentation file nnUNet writes for an input file
+        """
+        return output_file_for(input_file_path, output_dir)
+    
+    def predict(self, input_file_path, timeout=1800, task_id=None, crop=None):
         """
         Run prediction on an input NIFTI file for both tumor and lung segmentation
         
         Args:
             input_file_path: Path to the input .nii.gz file
             timeout: Timeout for prediction process in seconds (default: 30 minutes)
+            task_id: Task id (default: taken from the input file name)
+            crop: Optional tuple of slices the models run on (see cropping.body_bounding_box)
             
         Returns:
             Dictionary containing paths to both segmentation files
         """
         # Extract the task_id from the input file path
-        file_basename = os.path.basename(input_file_path)
-        task_id = file_basename.split('_')[0]
+        if task_id is None:
+            file_basename = os.path.basename(input_file_path)
+            task_id = file_basename.split('_')[0]
+        task_id = str(task_id)
+        
+        results, errors = self.predict_batch([(task_id, input_file_path)], timeout,
+                                             crops={task_id: crop} if crop else None)
+        if task_id not in results:
+            raise RuntimeError(f"Error in nnUNet prediction: {errors.get(task_id, 'no output produced')}")
+        return results[task_id]
+    
+    def predict_batch(self, cases, timeout=1800, crops=None):
+        """
+        Run tumor and lung segmentation for several input files in one model session
+        
+        All intermediate files live in a private TaskWorkspace that is removed
+        afterwards, so several batches can be predicted on one host at the same time.
+        The CLI engine predicts the whole workspace input folder with a single
+        nnUNetv2_predict call per model; the resident engines (in-process and
+        exported) run the cases one after another.
+        
+        Cases with a crop are staged into the workspace as that region only, and
+        their masks and probability maps are pasted back into the geometry of the
+        input file, so the models' sliding windows skip everything outside it.
+        
+        Args:
+            cases: List of (task_id, input_file_path) tuples
+            timeout: Timeout for each prediction process in seconds (default: 30 minutes)
+            crops: Optional dictionary mapping task ids to tuples of slices in voxel coordinates
             
+        Returns:
+            Tuple of (results, errors). results maps task ids to dictionaries with
+            paths to both segmentation files, errors maps task ids that produced
+            no output to the error message.
+        """
+        results = {}
+        errors = {}
+        cases = [(str(task_id), input_file_path) for task_id, input_file_path in cases]
+        
+        try:
+            with TaskWorkspace(cases[0][0]) as workspace:
+                # nnUNet requires input files to be named as case_0000.nii.gz
+                input_copies = {}
+                case_crops = {}
+                for task_id, input_file_path in cases:
+                    input_copy_path = os.path.join(workspace.input_dir, self._nnunet_input_name(input_file_path))
+                    bbox = self._valid_crop((crops or {}).get(task_id), input_file_path)
+                    if bbox is not None:
+                        crop_image(input_file_path, bbox, input_copy_path)
+                        case_crops[task_id] = (bbox, input_file_path)
+                        logger.info(f"Cropped input file to {bbox} in {input_copy_path} for nnUNet processing")
+                    else:
+                        shutil.copy(input_file_path, input_copy_path)
+                        logger.info(f"Copied and renamed input file to {input_copy_path} for nnUNet processing")
+                    input_copies[task_id] = input_copy_path
+                
+                # Prepare environment variables for nnUNet
+                env = configure_nnunet_environment(os.environ.copy())
+                
+                if not self._available_backend().predicts_folder:
+                    # Models are resident, run the cases one by one to keep one preprocessed volume in memory
+                    output_files = {'tumor': {}, 'lung': {}}
+                    for task_id, input_copy_path in input_copies.items():
+                        try:
+                            case_outputs = self._run_models([input_copy_path], env, timeout, workspace=workspace)
+                        except Exception as e:
+                            logger.exception(f"Error in nnUNet prediction for task {task_id}: {str(e)}")
+                            errors[task_id] = str(e)
+                            continue
+                        for seg_type in output_files:
+                            output_files[seg_type].update(case_outputs[seg_type])
+                else:
+                    output_files = self._run_models(list(input_copies.values()), env, timeout, workspace=workspace)
+                
+                for task_id, input_copy_path in input_copies.items():
+                    if task_id in errors:
+                        continue
+                    try:
+                        results[task_id] = self._collect_outputs(task_id, input_copy_path, output_files,
+                                                                 *case_crops.get(task_id, ()))
+                    except Exception as e:
+                        logger.exception(f"Error collecting nnUNet outputs for task {task_id}: {str(e)}")
+                        errors[task_id] = str(e)
+        except Exception as e:
+            logger.exception(f"Error in nnUNet prediction: {str(e)}")
+            for task_id, _ in cases:
+                if task_id not in results:
+                    errors.setdefault(task_id, str(e))
+        
+        return results, errors
+    
+    def _valid_crop(self, bbox, input_file_path):
+        """
+        Get a crop if it lies inside the input volume, None otherwise
+        """
+        if not bbox:
+            return None
+        shape = nib.load(input_file_path).shape[:3]
+        if len(bbox) != 3 or any(not 0 <= s.start < s.stop <= size for s, size in zip(bbox, shape)):
+            logger.warning(f"Crop {bbox} does not fit {input_file_path} of shape {shape}, using the full volume")
+            return None
+        return tuple(bbox)
+    
+    def _collect_outputs(self, task_id, input_copy_path, output_files, bbox=None, reference_file_path=None):
+        """
+        Move one case's model outputs from the workspace to the media folder
+        
+        The tumor probability map, when the model wrote one, is returned as
+        'tumor_probabilities'. Outputs of a cropped input are pasted back into
+        the geometry of reference_file_path, the uncropped input.
+        """
         # Create destination paths with consistent naming
         tumor_dest = str(Path(settings.MEDIA_ROOT) / "segmentations" / f"tumor_seg_{task_id}.nii.gz")
         lung_dest = str(Path(settings.MEDIA_ROOT) / "segmentations" / f"lung_seg_{task_id}.nii.gz")
@@ -101,188 +388,201 @@ class NNUNetHandler:
         # Ensure destination directory exists
         os.makedirs(os.path.dirname(tumor_dest), exist_ok=True)
         
-        try:
-            # Process input file name to ensure it follows nnUNet convention
-            # nnUNet requires input files to be named as case_0000.nii.gz
-            input_basename = os.path.basename(input_file_path)
-            
-            # Remove all extensions
-            input_name = input_basename
-            if input_name.endswith('.nii.gz'):
-                input_name = input_name[:-7]
-            elif input_name.endswith('.nii'):
-                input_name = input_name[:-4]
-            elif input_name.endswith('.gz'):
-                input_name = input_name[:-3]
-                
-            # Make sure it has the required _0000 suffix
-            if not input_name.endswith('_0000'):
-                input_name = f"{input_name}_0000"
-                
-            # Create the properly formatted filename
-            proper_input_name = f"{input_name}.nii.gz"
-            input_copy_path = os.path.join(self.input_dir, proper_input_name)
-            
-            # Clear input directory to prevent confusion with multiple files
-            for file in os.listdir(self.input_dir):
-                file_path = os.path.join(self.input_dir, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            
-            # Copy input file to input directory with proper naming
-            shutil.copy(input_file_path, input_copy_path)
-            logger.info(f"Copied and renamed input file to {input_copy_path} for nnUNet processing")
-            
-            # Prepare environment variables for nnUNet
-            env = os.environ.copy()
-            env["nnUNet_raw"] = settings.NNUNET_RAW
-            env["nnUNet_preprocessed"] = settings.NNUNET_PREPROCESSED
-            env["nnUNet_results"] = settings.NNUNET_RESULTS
-            
-            # Run tumor segmentation model
-            logger.info(f"Running tumor segmentation for {input_file_path}")
-            tumor_output_dir = os.path.join(self.output_dir, "tumor_segmentation")
-            tumor_file = self._run_prediction(input_copy_path, tumor_output_dir, self.tumor_model, env, timeout)
-            if tumor_file:
-                shutil.copy(tumor_file, tumor_dest)
-                logger.info(f"Tumor segmentation saved to {tumor_dest}")
+        for seg_type, dest in [('tumor', tumor_dest), ('lung', lung_dest)]:
+            output_file = output_files[seg_type].get(input_copy_path)
+            if not output_file or not os.path.exists(output_file):
+                raise RuntimeError(f"{seg_type.capitalize()} segmentation failed to produce output file")
+            if bbox is not None:
+                paste_mask(output_file, bbox, reference_file_path, dest)
+                os.remove(output_file)
             else:
-                raise RuntimeError("Tumor segmentation failed to produce output file")
-            
-            # Run lung segmentation model
-            logger.info(f"Running lung segmentation for {input_file_path}")
-            lung_output_dir = os.path.join(self.output_dir, "lung_segmentation")
-            lung_file = self._run_prediction(input_copy_path, lung_output_dir, self.lung_model, env, timeout)
-            if lung_file:
-                shutil.copy(lung_file, lung_dest)
-                logger.info(f"Lung segmentation saved to {lung_dest}")
+                shutil.move(output_file, dest)
+            logger.info(f"{seg_type.capitalize()} segmentation saved to {dest}")
+        
+        # Ensure file permissions are set correctly
+        for dest in [tumor_dest, lung_dest]:
+            os.chmod(dest, 0o644)
+            file_size = os.path.getsize(dest)
+            logger.info(f"Saved file size for {dest}: {file_size} bytes")
+        
+        logger.info(f"Segmentation completed: saved to {tumor_dest} and {lung_dest}")
+        outputs = {
+            'tumor_segmentation': tumor_dest,
+            'lung_segmentation': lung_dest
+        }
+        
+        probability_file = probability_file_for(output_files['tumor'][input_copy_path])
+        if os.path.exists(probability_file):
+            outputs['tumor_probabilities'] = probability_file_for(tumor_dest)
+            if bbox is not None:
+                paste_probabilities(probability_file, bbox, nib.load(tumor_dest).shape,
+                                    outputs['tumor_probabilities'])
+                os.remove(probability_file)
             else:
-                raise RuntimeError("Lung segmentation failed to produce output file")
-            
-            # Ensure file permissions are set correctly
-            for dest in [tumor_dest, lung_dest]:
-                os.chmod(dest, 0o644)
-                file_size = os.path.getsize(dest)
-                logger.info(f"Saved file size for {dest}: {file_size} bytes")
+                shutil.move(probability_file, outputs['tumor_probabilities'])
+        return outputs
+    
+    def _run_models(self, input_files, env, timeout=1800, workspace=None):
+        """
+        Run the tumor and lung models, one after another or side by side
+        
+        NNUNET_EXECUTION_MODE decides the mode (see plan_model_execution). In
+        concurrent mode each model gets its own slice of the CPU cores so the two
+        runs do not oversubscribe the machine.
+        
+        Args:
+            input_files: Paths to the nnUNet-named input files
+            env: Environment variables
+            timeout: Timeout for each prediction in seconds (default: 30 minutes)
+            workspace: TaskWorkspace to write the model outputs to
             
-            logger.info(f"Segmentation completed: saved to {tumor_dest} and {lung_dest}")
-            return {
-                'tumor_segmentation': tumor_dest,
-                'lung_segmentation': lung_dest
-            }
+        Returns:
+            Dictionary mapping 'tumor' and 'lung' to {input file: segmentation file}
+        """
+        if self.cascade_mode:
+            return self._run_cascade(input_files, env, timeout, workspace)
+        
+        runs = {
+            'tumor': (workspace.output_dir("tumor_segmentation"), self.tumor_model),
+            'lung': (workspace.output_dir("lung_segmentation"), self.lung_model),
+        }
+        mode, cpu_sets = plan_model_execution(len(runs), self.device)
+        
+        # Decode and preprocess each input once for both models
+        shared_inputs = {input_file: SharedPreprocessor(input_file, num_models=len(runs))
+                         for input_file in input_files}
+        
+        def run(seg_type, cpu_set):
+            output_dir, model_config = runs[seg_type]
+            logger.info(f"Running {seg_type} segmentation for {len(input_files)} case(s)")
+            return self._run_prediction(input_files, output_dir, model_config, env, timeout,
+                                        shared_inputs=shared_inputs, cpu_set=cpu_set)
+        
+        try:
+            if mode == "sequential":
+                return {seg_type: run(seg_type, None) for seg_type in runs}
+            
+            logger.info(f"Running {', '.join(runs)} segmentation concurrently on "
+                        f"{' + '.join(str(len(cpu_set)) for cpu_set in cpu_sets)} cores")
+            with ThreadPoolExecutor(max_workers=len(runs)) as executor:
+                futures = {
+                    seg_type: executor.submit(run, seg_type, cpu_set)
+                    for seg_type, cpu_set in zip(runs, cpu_sets)
+                }
+                return {seg_type: future.result() for seg_type, future in futures.items()}
+        finally:
+            for shared_input in shared_inputs.values():
+                shared_input.clear()
+    
+    def _run_cascade(self, input_files, env, timeout=1800, workspace=None):
+        """
+        Run the lung model, then the tumor model on the padded lung bounding box
+        
+        Tumors only occur inside the lungs, so the tumor model's sliding window
+        skips the abdomen, air and table. Tumor masks are pasted back into the
+        full volume. Cases with an empty lung mask run the tumor model on the
+        full volume.
+        
+        Args:
+            input_files: Paths to the nnUNet-named input files
+            env: Environment variables
+            timeout: Timeout for each prediction in seconds (default: 30 minutes)
+            workspace: TaskWorkspace to write the model outputs to
             
-        except Exception as e:
-            logger.exception(f"Error in nnUNet prediction: {str(e)}")
-            raise RuntimeError(f"Error in nnUNet prediction: {str(e)}")
+        Returns:
+            Dictionary mapping 'tumor' and 'lung' to {input file: segmentation file}
+        """
+        shared_inputs = {input_file: SharedPreprocessor(input_file) for input_file in input_files}
+        try:
+            logger.info(f"Running lung segmentation for {len(input_files)} case(s)")
+            lung_outputs = self._run_prediction(input_files, workspace.output_dir("lung_segmentation"),
+                                                self.lung_model, env, timeout, shared_inputs=shared_inputs)
+        finally:
+            for shared_input in shared_inputs.values():
+                shared_input.clear()
+        
+        # Crop each input to its lung region, keeping the nnUNet file names
+        tumor_input_dir = workspace.output_dir("tumor_input")
+        tumor_inputs = {}
+        crops = {}
+        for input_file in input_files:
+            if input_file not in lung_outputs:
+                continue
+            tumor_input = os.path.join(tumor_input_dir, os.path.basename(input_file))
+            tumor_inputs[tumor_input] = input_file
+            bbox = mask_bounding_box(lung_outputs[input_file], self.cascade_margin_mm)
+            if bbox is None:
+                logger.warning(f"Empty lung mask for {input_file}, running tumor model on the full volume")
+                shutil.copy(input_file, tumor_input)
+                continue
+            crop_image(input_file, bbox, tumor_input)
+            crops[tumor_input] = bbox
+            logger.info(f"Cropped {input_file} to lung region {bbox} "
+                        f"({bounding_box_fraction(bbox, nib.load(input_file).shape):.0%} of voxels)")
+        
+        if not tumor_inputs:
+            raise RuntimeError("Lung segmentation produced no output, cannot run tumor cascade")
+        
+        logger.info(f"Running tumor segmentation for {len(tumor_inputs)} case(s) on lung regions")
+        cropped_outputs = self._run_prediction(list(tumor_inputs), workspace.output_dir("tumor_cropped"),
+                                               self.tumor_model, env, timeout)
+        
+        # Paste the tumor masks back into full-volume coordinates
+        tumor_dir = workspace.output_dir("tumor_segmentation")
+        tumor_outputs = {}
+        for tumor_input, cropped_output in cropped_outputs.items():
+            input_file = tumor_inputs[tumor_input]
+            output_file = self._output_file_for(input_file, tumor_dir)
+            cropped_probabilities = probability_file_for(cropped_output)
+            if tumor_input in crops:
+                paste_mask(cropped_output, crops[tumor_input], lung_outputs[input_file], output_file)
+                if os.path.exists(cropped_probabilities):
+                    paste_probabilities(cropped_probabilities, crops[tumor_input], nib.load(output_file).shape,
+                                        probability_file_for(output_file))
+                    os.remove(cropped_probabilities)
+            else:
+                shutil.move(cropped_output, output_file)
+                if os.path.exists(cropped_probabilities):
+                    shutil.move(cropped_probabilities, probability_file_for(output_file))
+            tumor_outputs[input_file] = output_file
+        
+        return {'tumor': tumor_outputs, 'lung': lung_outputs}
     
-    def _run_prediction(self, input_file_path, output_dir, model_config, env, timeout=1800):
+    def _run_prediction(self, input_files, output_dir, model_config, env, timeout=1800, shared_inputs=None,
+                        cpu_set=None):
         """
         Helper method to run prediction for a specific model
         
+        Uses the backend named by NNUNET_INFERENCE_ENGINE, falling back along its
+        chain (exported -> in_process -> subprocess) when the model has no
+        exported graphs or nnunetv2/torch cannot be imported in this process.
+        
         Args:
-            input_file_path: Path to the input .nii.gz file
-            output_dir: Directory to save the output segmentation
+            input_files: Paths to the input .nii.gz files, all in the same folder
+            output_dir: Directory to save the output segmentations
             model_config: Model configuration dictionary
             env: Environment variables
             timeout: Timeout for prediction process in seconds (default: 30 minutes)
-        """
-        try:
-            # Clear the output directory to avoid mixing with previous runs
-            for file in os.listdir(output_dir):
-                file_path = os.path.join(output_dir, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            
-            # Get the directory containing the input file
-            input_dir = os.path.dirname(input_file_path)
-            
-            # Run nnUNet prediction
-            cmd = [
-                "nnUNetv2_predict",
-                "-i", input_dir,
-                "-o", output_dir,
-                "-d", model_config["dataset"],
-                "-c", model_config["config"],
-                "-tr", "nnUNetTrainer",  # Add trainer parameter back
-                "-device", self.device
-            ]
-            
-            # Execute nnUNet prediction
-            cmd_str = ' '.join(cmd)
-            logger.info(f"Running nnUNet prediction with command: {cmd_str}")
-            
-            # Modified to stream output in real time
-            process = subprocess.Popen(
-                cmd,
-                env=env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                bufsize=1  # Line buffered
-            )
+            shared_inputs: Optional {input file: SharedPreprocessor} (in-process only)
+            cpu_set: Optional list of CPU cores this run is limited to
             
-            # Stream output in real-time
-            def log_output(pipe, prefix):
-                for line in iter(pipe.readline, ''):
-                    if line:
-                        line = line.strip()
-                        if line:
-                            logger.info(f"{prefix}: {line}")
-            
-            # Create threads to handle stdout and stderr streams
-            import threading
-            stdout_thread = threading.Thread(target=log_output, args=(process.stdout, "nnUNet"))
-            stderr_thread = threading.Thread(target=log_output, args=(process.stderr, "nnUNet"))
-            
-            # Set as daemon threads so they don't block program exit
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            
-            # Start the threads
-            stdout_thread.start()
-            stderr_thread.start()
-            
-            # Wait for the process to complete with timeout
-            try:
-                return_code = process.wait(timeout=timeout)
-                
-                # Wait for output threads to finish
-                stdout_thread.join(5)  # Wait up to 5 seconds
-                stderr_thread.join(5)  # Wait up to 5 seconds
-                
-                # Collect any remaining output
-                stdout, stderr = process.communicate(timeout=5)
-                if stdout:
-                    logger.info(f"nnUNet final output: {stdout}")
-                if stderr:
-                    logger.warning(f"nnUNet final stderr: {stderr}")
-                
-                if return_code != 0:
-                    error_msg = f"nnUNet prediction failed with code {return_code}"
-                    if stderr:
-                        error_msg += f": {stderr}"
-                    logger.error(error_msg)
-                    raise RuntimeError(error_msg)
-            except subprocess.TimeoutExpired:
-                process.kill()
-                logger.error(f"nnUNet prediction timed out after {timeout} seconds")
-                raise RuntimeError(f"nnUNet prediction timed out after {timeout} seconds")
-            
-            # Find output file
-            output_files = [os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith('.nii.gz')]
-            if not output_files:
-                error_msg = f"No output segmentation file was generated in {output_dir}"
-                logger.error(error_msg)
-                raise FileNotFoundError(error_msg)
-            
-            # Return the first output file (there should be only one)
-            result_file = output_files[0]
-            logger.info(f"Generated segmentation at {result_file}")
-            return result_file
-            
-        except Exception as e:
-            logger.exception(f"Error running prediction: {str(e)}")
-            raise RuntimeError(f"Error running prediction: {str(e)}")
+        Returns:
+            Dictionary mapping each input file to its segmentation file
+        """
+        backend = self.backend
+        while True:
+            if backend.is_available(model_config):
+                try:
+                    return backend.predict(input_files, output_dir, model_config, env, timeout,
+                                           shared_inputs=shared_inputs, cpu_set=cpu_set)
+                except BackendUnavailable as e:
+                    reason = str(e)
+            else:
+                reason = f"cannot run {model_config['dataset']} ({model_config['config']}) in this process"
+            if not backend.fallback:
+                raise RuntimeError(f"No inference backend available: {reason}")
+            logger.warning(f"{backend.name} backend unavailable ({reason}), falling back to {backend.fallback}")
+            backend = get_inference_backend(backend.fallback, self.device)
     
     def fallback_inference(self, input_file_path):
         """
@@ -381,45 +681,35 @@ class NNUNetHandler:
             Dictionary with metrics
         """
         try:
-            # Load the segmentation file
-            seg_img = nib.load(segmentation_file_path)
-            seg_data = seg_img.get_fdata()
-
-            # Debug: check unique labels
-            unique_labels = np.unique(seg_data)
-            logger.debug(f"Unique labels in segmentation: {unique_labels}")
-            
-            # Get voxel dimensions in mm
-            voxel_dims = seg_img.header.get_zooms()
-            voxel_volume = voxel_dims[0] * voxel_dims[1] * voxel_dims[2]  # in mm³
-            
-            # Check if this is tumor or lung segmentation based on file name
+            # Labels are read in their stored dtype, slab by slab (see metrics.py)
             is_tumor = 'tumor' in os.path.basename(segmentation_file_path).lower()
             
             if is_tumor:
-                # For tumor segmentation (assume label 1 is tumor)
-                tumor_voxels = np.sum(seg_data == 1)
-                tumor_volume = (tumor_voxels * voxel_volume) / 1000  # Convert to cm³
-                
-                # Count distinct lesions using connected component analysis
-                labeled_array, num_features = ndimage.label(seg_data == 1)
-                lesion_count = num_features
+                # For tumor segmentation (assume label 1 is tumor), count distinct lesions
+                # with connected component analysis in the same pass
+                metrics = compute_label_metrics(segmentation_file_path, foreground_label=1)
+                logger.debug(f"Label voxel counts in segmentation: {metrics['label_counts']}")
                 
-                # Simulated confidence score
-                confidence_score = 0.94  # 94% confidence
+                # Confidence comes from the probability map saved next to the mask, if any
+                confidence_score = None
+                img = nib.load(segmentation_file_path)
+                probabilities = load_probability_map(probability_file_for(segmentation_file_path), img.shape)
+                if probabilities is not None:
+                    confidence = compute_confidence(probabilities, img.dataobj, foreground_label=1)
+                    confidence_score = confidence['confidence_score']
                 
                 return {
-                    "tumor_volume": round(tumor_volume, 2),
-                    "lesion_count": lesion_count,
+                    "tumor_volume": round(metrics['volume_cm3'], 2),  # in cm³
+                    "lesion_count": metrics['component_count'],
                     "confidence_score": confidence_score
                 }
             else:
                 # For lung segmentation (assume all non-zero is lung)
-                lung_voxels = np.sum(seg_data > 0)
-                lung_volume = (lung_voxels * voxel_volume) / 1000  # Convert to cm³
+                metrics = compute_label_metrics(segmentation_file_path, count_components=False)
+                logger.debug(f"Label voxel counts in segmentation: {metrics['label_counts']}")
                 
                 return {
-                    "lung_volume": round(lung_volume, 2)
+                    "lung_volume": round(metrics['volume_cm3'], 2)  # in cm³
                 }
         except Exception as e:
             logger.exception(f"Error calculating segmentation metrics: {str(e)}")
@@ -0,0 +1,128 @@
+import os
+import logging
+import numpy as np
+import nibabel as nib
+from django.conf import settings
+from .metrics import compute_label_metrics
+from .lesions import analyze_lesions
+from .components import filter_tumor_components, replace_mask
+from .probabilities import load_probability_map, compute_confidence
+from .fused import fuse_masks, write_fused_mask
+
+# postprocessing.py
+logger = logging.getLogger(__name__)
+
+
+def load_mask(file_path):
+    """
+    Decode a segmentation mask once, in its stored dtype
+
+    Args:
+        file_path: Path to a NIfTI segmentation
+
+    Returns:
+        Tuple of (image, label array)
+
+    Raises:
+        ValueError: If the file is missing, unreadable or not a 3D volume
+    """
+    if not os.path.exists(file_path):
+        raise ValueError(f"Segmentation file not found at {file_path}")
+    try:
+        img = nib.load(file_path)
+        # An unscaled proxy decodes to its on-disk dtype, so a uint8 mask stays uint8
+        data = np.asanyarray(img.dataobj)
+    except Exception as e:
+        raise ValueError(f"Segmentation file {file_path} could not be read: {str(e)}")
+
+    if data.ndim != 3:
+        raise ValueError(f"Segmentation {file_path} has shape {data.shape}, expected a 3D volume")
+    if data.dtype.kind not in 'biu':
+        logger.warning(f"Segmentation {file_path} is stored as {data.dtype}, expected integer labels")
+    return img, data
+
+
+def _preview_slice(*slice_voxel_counts):
+    """
+    Axial slice with the largest foreground area of the first mask that has any
+    """
+    for counts in slice_voxel_counts:
+        if counts and max(counts) > 0:
+            return int(np.argmax(counts))
+    return None
+
+
+def postprocess_segmentations(result_files, probabilities_path=None, fused_path=None):
+    """
+    Verify, analyze and summarize the tumor and lung masks of a case
+
+    Each mask is decompressed exactly once; validation, volumes, lesion
+    measurements and the preview slice are all derived from that in-memory copy.
+    Tumor components outside the (margin-dilated) lungs or below the minimum
+    volume are removed first (see filter_tumor_components); the tumor file is
+    then replaced with the cleaned mask. The tumor probability map, when
+    given, is memory-mapped and read slab by slab for the confidence metrics.
+
+    Args:
+        result_files: Dictionary with 'tumor_segmentation' and 'lung_segmentation' paths
+        probabilities_path: Optional tumor probability map of the prediction (see probabilities.py)
+        fused_path: Optional path to also write the fused multi-label volume to (see fused.py)
+
+    Returns:
+        Dictionary with the task metrics: 'tumor_volume', 'lung_volume',
+        'lesion_count', 'confidence_score', 'mean_probability', 'mean_entropy',
+        'preview_slice', 'lesions' (per-lesion measurements, see
+        analyze_lesions) and 'removed_components' (None when filtering is
+        disabled). The confidence metrics are None without probabilities.
+
+    Raises:
+        ValueError: If a mask is unreadable or the masks do not share a grid
+    """
+    tumor_img, tumor_data = load_mask(result_files['tumor_segmentation'])
+    tumor_zooms = tumor_img.header.get_zooms()[:3]
+    lung_img, lung_data = load_mask(result_files['lung_segmentation'])
+    if lung_img.shape != tumor_img.shape:
+        raise ValueError(f"Tumor and lung segmentations differ in shape: "
+                         f"{tumor_img.shape} vs {lung_img.shape}")
+    if not np.allclose(lung_img.affine, tumor_img.affine, atol=1e-3):
+        logger.warning("Tumor and lung segmentations have different affines")
+
+    # Reconcile the independently predicted masks before anything is measured
+    removed_components = None
+    if settings.SEGMENTATION_FILTER_TUMOR_COMPONENTS:
+        tumor_data, removed_components = filter_tumor_components(tumor_data, lung_data, tumor_zooms,
+                                                                 foreground_label=1)
+        if removed_components:
+            replace_mask(result_files['tumor_segmentation'], tumor_img, tumor_data)
+    if fused_path:
+        write_fused_mask(fused_path, tumor_img, fuse_masks(tumor_data, lung_data))
+
+    # Label 1 is tumor; lesions are labelled and measured once on the decoded mask
+    tumor_metrics = compute_label_metrics(data=tumor_data, zooms=tumor_zooms, foreground_label=1,
+                                          count_components=False)
+    probabilities = load_probability_map(probabilities_path, tumor_img.shape)
+    lesions = analyze_lesions(tumor_data, tumor_zooms, tumor_img.affine, foreground_label=1,
+                              probabilities=probabilities)
+    confidence = {'confidence_score': None, 'mean_probability': None, 'mean_entropy': None}
+    if probabilities is not None:
+        confidence = compute_confidence(probabilities, tumor_data, foreground_label=1)
+    del tumor_data, probabilities
+
+    # Every non-zero label is lung
+    lung_metrics = compute_label_metrics(data=lung_data, zooms=lung_img.header.get_zooms()[:3],
+                                         count_components=False)
+    del lung_data
+
+    logger.debug(f"Label voxel counts - tumor: {tumor_metrics['label_counts']}, "
+                 f"lung: {lung_metrics['label_counts']}")
+
+    preview_slice = _preview_slice(tumor_metrics['slice_voxels'], lung_metrics['slice_voxels'])
+    return {
+        'tumor_volume': round(tumor_metrics['volume_cm3'], 2),  # in cm³
+        'lung_volume': round(lung_metrics['volume_cm3'], 2),  # in cm³
+        'lesion_count': len(lesions),
+        **confidence,
+        'preview_slice': tumor_img.shape[2] // 2 if preview_slice is None else preview_slice,
+        'lesions': lesions,
+        'removed_components': removed_components,
+    }
@@ -0,0 +1,472 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+from copy import deepcopy
+import numpy as np
+import nibabel as nib
+from django.conf import settings
+from .resampling import NIBABEL_ORDER_READERS, resample_slab, resampling_orders, resize_weights
+
+# preprocessing.py
+logger = logging.getLogger(__name__)
+
+# nnUNet normalization schemes that map every voxel on its own, so slabs normalize like the whole volume
+VOXELWISE_NORMALIZATION = ('CTNormalization', 'NoNormalization', 'RGBTo01Normalization')
+
+
+def _new_shape(shape, spacing, target_spacing):
+    """
+    Spatial shape after resampling, rounded like nnUNet's compute_new_shape
+    """
+    return tuple(int(np.round(size * current / target)) for size, current, target in
+                 zip(shape, spacing, target_spacing))
+
+
+def _crop_to_nonzero(data):
+    """
+    nnUNet's crop to the nonzero bounding box, without a segmentation
+
+    Returns:
+        Tuple of (cropped data, nonzero mask labels, bbox)
+    """
+    from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
+    return crop_to_nonzero(data, None)
+
+
+class SharedPreprocessor:
+    """
+    Decode and preprocess one input case once for several nnUNet models
+
+    Mirrors nnUNet's DefaultPreprocessor (transpose -> crop -> normalize -> resample)
+    with every step keyed on the plan settings it depends on. Once a step has
+    been computed from its parent the parent's arrays are released and only
+    their (small) properties stay around, except for the cropped image: the
+    tumor and lung plans normalize differently, so the crop is the deepest
+    step they share and is kept until the last of num_models has used it.
+    """
+    def __init__(self, input_file_path, num_models=1):
+        self.input_file_path = input_file_path
+        # Models still to preprocess this input; the crop is released by the last one
+        self._pending_models = num_models
+        self._cache = {}
+        # Properties of every step computed so far, kept after its arrays are released
+        self._properties = {}
+        # Concurrent model runs wait for each other's steps instead of repeating them
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self._spill_dir = None
+
+    def _shares_crop(self):
+        return self._pending_models > 1
+
+    def _finish_model(self):
+        with self._lock:
+            self._pending_models -= 1
+
+    def _cached(self, key, compute, parent=None):
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            value = compute()
+            self._cache[key] = value
+            if parent is not None:
+                self._cache.pop(parent, None)
+            return value
+
+    def clear(self):
+        """
+        Release all cached arrays
+        """
+        self._cache.clear()
+        self._properties.clear()
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _spill_directory(self, spill_root=None):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(
+                prefix=".spill_", dir=spill_root or os.path.dirname(self.input_file_path)
+            )
+        return self._spill_dir
+
+    def _spill_path(self):
+        return os.path.join(self._spill_dir, f"{len(os.listdir(self._spill_dir))}.npy")
+
+    def _spill_array(self, array):
+        path = self._spill_path()
+        np.save(path, array)
+        return np.load(path, mmap_mode="r")
+
+    def _open_spill(self, shape):
+        return np.lib.format.open_memmap(self._spill_path(), mode="w+", dtype=np.float32, shape=tuple(shape))
+
+    def _spill_value(self, value):
+        if isinstance(value, np.ndarray) and not isinstance(value, np.memmap) and value.nbytes:
+            return self._spill_array(value)
+        if isinstance(value, tuple):
+            return tuple(self._spill_value(item) for item in value)
+        return value
+
+    def spill(self, spill_root=None):
+        """
+        Move every cached array to a read-only memory map on disk
+
+        Used by streaming inference so the cached (preprocessed) volume no
+        longer counts towards the worker's resident memory.
+        Later steps read them back page by page.
+
+        Args:
+            spill_root: Directory to create the spill folder in (default: next to the input file)
+        """
+        with self._lock:
+            self._spill_directory(spill_root)
+            for key, value in self._cache.items():
+                self._cache[key] = self._spill_value(value)
+        logger.info(f"Spilled preprocessed arrays to {self._spill_dir}")
+        return self._spill_dir
+
+    @staticmethod
+    def _decode_key(reader_writer_class):
+        return ("decode", reader_writer_class.__name__)
+
+    def _crop_key(self, reader_writer_class, transpose_forward):
+        return ("crop", self._decode_key(reader_writer_class), tuple(transpose_forward))
+
+    def _normalize_key(self, plans_manager, configuration_manager):
+        return (
+            "normalize",
+            self._crop_key(plans_manager.image_reader_writer_class, plans_manager.transpose_forward),
+            tuple(configuration_manager.normalization_schemes),
+            tuple(configuration_manager.use_mask_for_norm),
+            json.dumps(plans_manager.foreground_intensity_properties_per_channel, sort_keys=True)
+        )
+
+    def _resample_key(self, plans_manager, configuration_manager):
+        # The input is fixed, so the plan's spacing determines the target spacing
+        return (
+            "resample", self._normalize_key(plans_manager, configuration_manager),
+            tuple(configuration_manager.spacing),
+            configuration_manager.configuration['resampling_fn_data'],
+            json.dumps(configuration_manager.configuration['resampling_fn_data_kwargs'], sort_keys=True)
+        )
+
+    @staticmethod
+    def _target_spacing(original_spacing, configuration_manager):
+        target_spacing = list(configuration_manager.spacing)
+        if len(target_spacing) < len(original_spacing):
+            # 2d configurations keep the spacing between slices
+            target_spacing = [original_spacing[0]] + target_spacing
+        return target_spacing
+
+    def _decode(self, reader_writer_class):
+        key = self._decode_key(reader_writer_class)
+
+        def compute():
+            image, properties = reader_writer_class().read_images([self.input_file_path])
+            self._properties[key] = properties
+            return image, properties
+
+        return key, self._cached(key, compute)
+
+    def _crop(self, reader_writer_class, transpose_forward):
+        decode_key = self._decode_key(reader_writer_class)
+        key = self._crop_key(reader_writer_class, transpose_forward)
+
+        def compute():
+            _, (image, _) = self._decode(reader_writer_class)
+            data = image.astype(np.float32)
+            self._cache.pop(decode_key, None)
+            del image
+            data = data.transpose([0, *[i + 1 for i in transpose_forward]])
+            crop_properties = {'shape_before_cropping': data.shape[1:]}
+            data, seg, bbox = _crop_to_nonzero(data)
+            crop_properties['bbox_used_for_cropping'] = bbox
+            crop_properties['shape_after_cropping_and_before_resampling'] = data.shape[1:]
+            self._properties[key] = crop_properties
+            return data, seg, crop_properties
+
+        return key, self._cached(key, compute, parent=decode_key)
+
+    def _normalize(self, preprocessor, plans_manager, configuration_manager):
+        crop_key = self._crop_key(plans_manager.image_reader_writer_class, plans_manager.transpose_forward)
+        key = self._normalize_key(plans_manager, configuration_manager)
+
+        shared = self._shares_crop()
+
+        def compute():
+            _, (data, seg, _) = self._crop(
+                plans_manager.image_reader_writer_class, plans_manager.transpose_forward
+            )
+            if shared:
+                # DefaultPreprocessor normalizes in place, keep the crop intact for the other models
+                data = data.copy()
+            else:
+                # The last model releases the crop first and normalizes it in place without a copy
+                self._cache.pop(crop_key, None)
+                if not data.flags.writeable:
+                    data = np.array(data)
+            return preprocessor._normalize(
+                data, seg, configuration_manager, plans_manager.foreground_intensity_properties_per_channel
+            )
+
+        return key, self._cached(key, compute, parent=None if shared else crop_key)
+
+    def _resample(self, preprocessor, plans_manager, configuration_manager):
+        from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+
+        decode_key = self._decode_key(plans_manager.image_reader_writer_class)
+        crop_key = self._crop_key(plans_manager.image_reader_writer_class, plans_manager.transpose_forward)
+        normalize_key = self._normalize_key(plans_manager, configuration_manager)
+        key = self._resample_key(plans_manager, configuration_manager)
+
+        def compute():
+            _, normalized = self._normalize(preprocessor, plans_manager, configuration_manager)
+            properties = self._properties[decode_key]
+            original_spacing = [properties['spacing'][i] for i in plans_manager.transpose_forward]
+            target_spacing = self._target_spacing(original_spacing, configuration_manager)
+            new_shape = compute_new_shape(normalized.shape[1:], original_spacing, target_spacing)
+            return configuration_manager.resampling_fn_data(normalized, new_shape, original_spacing, target_spacing)
+
+        data = self._cached(key, compute, parent=normalize_key)
+        case_properties = deepcopy(self._properties[decode_key])
+        case_properties.update(self._properties[crop_key])
+        return data, case_properties
+
+    @staticmethod
+    def _nonzero_bbox(image, slab_slices):
+        """
+        nnUNet's crop to nonzero bounding box, found slab by slab
+
+        Filling holes in the nonzero mask (as crop_to_nonzero does) never grows
+        its bounding box, so the mask itself is never built for the whole volume.
+        """
+        masks = [np.zeros(size, dtype=bool) for size in image.shape[1:]]
+        for lo in range(0, image.shape[1], slab_slices):
+            nonzero = np.any(np.asarray(image[:, lo:lo + slab_slices]) != 0, axis=0)
+            masks[0][lo:lo + slab_slices] = nonzero.any(axis=(1, 2))
+            masks[1] |= nonzero.any(axis=(0, 2))
+            masks[2] |= nonzero.any(axis=(0, 1))
+        if not masks[0].any():
+            return [[0, size] for size in image.shape[1:]]
+        return [[int(np.flatnonzero(mask)[0]), int(np.flatnonzero(mask)[-1]) + 1] for mask in masks]
+
+    def _stream_crop(self, image, transpose_forward, slab_slices):
+        """
+        Transpose and crop to nonzero into a float32 memory map
+
+        Returns:
+            Tuple of (cropped memmap, crop properties)
+        """
+        image = image.transpose([0, *[i + 1 for i in transpose_forward]])
+        bbox = self._nonzero_bbox(image, slab_slices)
+        (z_lo, z_hi), (y_lo, y_hi), (x_lo, x_hi) = bbox
+        data = self._open_spill((image.shape[0], z_hi - z_lo, y_hi - y_lo, x_hi - x_lo))
+        for lo in range(0, data.shape[1], slab_slices):
+            hi = min(lo + slab_slices, data.shape[1])
+            data[:, lo:hi] = image[:, z_lo + lo:z_lo + hi, y_lo:y_hi, x_lo:x_hi]
+        crop_properties = {
+            'shape_before_cropping': image.shape[1:],
+            'bbox_used_for_cropping': bbox,
+            'shape_after_cropping_and_before_resampling': data.shape[1:],
+        }
+        return data, crop_properties
+
+    def _stream_normalize(self, data, preprocessor, configuration_manager, intensity_properties, slab_slices,
+                          in_place=True):
+        """
+        Normalize slab by slab, in place when allowed and the memory map is writable
+
+        Only valid for VOXELWISE_NORMALIZATION schemes, which ignore the nonzero mask.
+        """
+        normalized = data if in_place and data.flags.writeable else self._open_spill(data.shape)
+        for lo in range(0, data.shape[1], slab_slices):
+            slab = np.array(data[:, lo:lo + slab_slices], dtype=np.float32)
+            seg = np.broadcast_to(np.int8(0), (1, *slab.shape[1:]))
+            normalized[:, lo:lo + slab_slices] = preprocessor._normalize(slab, seg, configuration_manager,
+                                                                         intensity_properties)
+        return normalized
+
+    def _stream_resample(self, normalized, spacing, target_spacing, resampling_kwargs, slab_slices):
+        """
+        Resample onto the target spacing slab by slab into a memory map
+
+        Uses separable spline weights (see resampling.resize_weights) sampling
+        the same coordinates and per-axis orders as nnUNet's resampling, so only
+        the input slices under one output slab are read at a time.
+        """
+        shape = normalized.shape[1:]
+        new_shape = _new_shape(shape, spacing, target_spacing)
+        orders = resampling_orders(spacing, target_spacing, resampling_kwargs)
+        weights = [resize_weights(size, out_size, order) for size, out_size, order in zip(shape, new_shape, orders)]
+        data = self._open_spill((normalized.shape[0], *new_shape))
+        for lo in range(0, new_shape[0], slab_slices):
+            weights_z = weights[0][lo:lo + slab_slices]
+            # Input slices with non-zero weight for this slab's output slices
+            columns = weights_z.indices
+            in_lo, in_hi = int(columns.min()), int(columns.max()) + 1
+            for channel in range(normalized.shape[0]):
+                slab = np.asarray(normalized[channel, in_lo:in_hi], dtype=np.float32)
+                data[channel, lo:lo + slab_slices] = resample_slab(slab, weights_z[:, in_lo:in_hi],
+                                                                    weights[1], weights[2])
+        data.flush()
+        return data
+
+    def estimated_shape(self, predictor):
+        """
+        Preprocessed input shape of a model, from the NIfTI header alone
+
+        Nothing is decoded, so whether to stream is decided before any volume
+        is in memory. The crop to nonzero is not known yet, which makes the
+        estimate an upper bound.
+
+        Args:
+            predictor: nnUNetPredictor initialised from a trained model folder
+
+        Returns:
+            Tuple of (input shape (channels, z, y, x), spatial shape before preprocessing)
+        """
+        plans_manager = predictor.plans_manager
+        img = nib.load(self.input_file_path)
+        shape, spacing = list(img.shape[:3]), [float(zoom) for zoom in img.header.get_zooms()[:3]]
+        if plans_manager.image_reader_writer_class.__name__ not in NIBABEL_ORDER_READERS:
+            # SimpleITK returns the voxel axes reversed
+            shape, spacing = shape[::-1], spacing[::-1]
+        shape = tuple(shape[i] for i in plans_manager.transpose_forward)
+        spacing = [spacing[i] for i in plans_manager.transpose_forward]
+        target_spacing = self._target_spacing(spacing, predictor.configuration_manager)
+        return (1, *_new_shape(shape, spacing, target_spacing)), shape
+
+    def preprocess_streamed(self, predictor, slab_slices=None):
+        """
+        Get the network input as a memory map, without holding whole volumes in memory
+
+        nnUNet's readers return the whole decoded image, which is moved to disk
+        straight away. Crop, normalization and resampling then run slab by slab
+        from one memory map into the next, with the same cache keys as
+        preprocess() so the other model still shares them. Custom preprocessors
+        and normalization schemes with whole-volume statistics are preprocessed
+        in memory and then spilled.
+
+        Args:
+            predictor: nnUNetPredictor initialised from a trained model folder
+            slab_slices: Slices per slab (default: settings.SEGMENTATION_RESAMPLE_CHUNK_SLICES)
+
+        Returns:
+            Tuple of (memory-mapped data, properties) for StreamingPredictor
+        """
+        from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
+
+        slab_slices = slab_slices or settings.SEGMENTATION_RESAMPLE_CHUNK_SLICES
+        plans_manager = predictor.plans_manager
+        configuration_manager = predictor.configuration_manager
+        preprocessor_class = configuration_manager.preprocessor_class
+        schemes = configuration_manager.normalization_schemes
+        self._spill_directory()
+
+        if preprocessor_class is not DefaultPreprocessor or not set(schemes) <= set(VOXELWISE_NORMALIZATION):
+            logger.warning(f"Plan uses {preprocessor_class.__name__} with {schemes}, "
+                           f"preprocessing in memory before spilling")
+            data, properties = self._preprocess(predictor)
+            self.spill()
+            self._finish_model()
+            if preprocessor_class is DefaultPreprocessor:
+                # Cached, so this returns the spilled copy
+                return self._preprocess(predictor)
+            with self._lock:
+                return self._spill_value(data), properties
+
+        reader_writer_class = plans_manager.image_reader_writer_class
+        transpose_forward = plans_manager.transpose_forward
+        decode_key = self._decode_key(reader_writer_class)
+        crop_key = self._crop_key(reader_writer_class, transpose_forward)
+        normalize_key = self._normalize_key(plans_manager, configuration_manager)
+        key = self._resample_key(plans_manager, configuration_manager)
+        shared = self._shares_crop()
+
+        def crop():
+            _, decoded = self._decode(reader_writer_class)
+            # The reader's whole image is the only full volume held in memory; move it to disk first
+            self._cache[decode_key] = self._spill_value(decoded)
+            del decoded
+            image, _ = self._cache[decode_key]
+            data, crop_properties = self._stream_crop(image, transpose_forward, slab_slices)
+            self._properties[crop_key] = crop_properties
+            return data, None, crop_properties
+
+        def normalize():
+            data, _, _ = self._cached(crop_key, crop, parent=decode_key)
+            if not shared:
+                # The last model normalizes the crop in place, so it must not outlive this step
+                self._cache.pop(crop_key, None)
+            return self._stream_normalize(data, preprocessor_class(verbose=False), configuration_manager,
+                                          plans_manager.foreground_intensity_properties_per_channel, slab_slices,
+                                          in_place=not shared)
+
+        def resample():
+            normalized = self._cached(normalize_key, normalize, parent=None if shared else crop_key)
+            properties = self._properties[decode_key]
+            spacing = [properties['spacing'][i] for i in transpose_forward]
+            return self._stream_resample(normalized, spacing, self._target_spacing(spacing, configuration_manager),
+                                         configuration_manager.configuration['resampling_fn_data_kwargs'],
+                                         slab_slices)
+
+        with self._lock:
+            data = self._cached(key, resample, parent=normalize_key)
+            # A model that did not stream may have cached its input in memory
+            data = self._spill_value(data)
+            self._cache[key] = data
+        self._finish_model()
+        case_properties = deepcopy(self._properties[decode_key])
+        case_properties.update(self._properties[crop_key])
+        logger.info(f"Streamed preprocessing to {self._spill_dir}: {self.hits} hits, {self.misses} misses")
+        return data, case_properties
+
+    def _preprocess(self, predictor):
+        from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
+
+        plans_manager = predictor.plans_manager
+        configuration_manager = predictor.configuration_manager
+        preprocessor_class = configuration_manager.preprocessor_class
+        preprocessor = preprocessor_class(verbose=False)
+
+        if preprocessor_class is DefaultPreprocessor:
+            data, properties = self._resample(preprocessor, plans_manager, configuration_manager)
+        else:
+            # Custom preprocessors may change any step, only share the decoded image
+            logger.info(f"Plan uses {preprocessor_class.__name__}, sharing decoded image only")
+            _, (image, properties) = self._decode(plans_manager.image_reader_writer_class)
+            properties = deepcopy(properties)
+            data, _, properties = preprocessor.run_case_npy(
+                image, None, properties, plans_manager, configuration_manager, predictor.dataset_json
+            )
+
+        logger.info(f"Shared preprocessing cache: {self.hits} hits, {self.misses} misses")
+        return data, properties
+
+    def preprocess(self, predictor, as_tensor=True):
+        """
+        Get the preprocessed network input for an initialised nnUNetPredictor
+
+        Each model should call this (or preprocess_streamed) once per case, so
+        the crop shared between the models is released after the last one.
+
+        Args:
+            predictor: nnUNetPredictor initialised from a trained model folder
+            as_tensor: Return a torch tensor, otherwise the (possibly memory-mapped) array
+
+        Returns:
+            Tuple of (data, properties) ready for predict_logits_from_preprocessed_data
+        """
+        data, properties = self._preprocess(predictor)
+        self._finish_model()
+        if not as_tensor:
+            return data, properties
+        import torch
+        return torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32)), properties
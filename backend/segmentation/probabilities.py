@@ -0,0 +1,343 @@
+import os
+import gzip
+import json
+import shutil
+import logging
+import zipfile
+import numpy as np
+from django.conf import settings
+from .resampling import NIBABEL_ORDER_READERS
+
+# probabilities.py
+logger = logging.getLogger(__name__)
+
+# Probability maps hold the tumor (foreground) probability of every voxel as a
+# Fortran-ordered float16 .npy in NIfTI voxel order, the same layout as the
+# mask, so z-slabs are contiguous and the map is read slab by slab through np.load(mmap_mode='r')
+PROBABILITY_SUFFIX = '_probabilities.npy'
+PROBABILITY_DTYPE = np.float16
+
+# Voxels predicted as tumor or at least this likely to be tumor form the region
+# whose entropy measures the model's uncertainty
+UNCERTAIN_PROBABILITY = 0.1
+
+RETENTION_CHOICES = ('discard', 'compressed')
+
+
+def probability_file_for(segmentation_path):
+    """
+    Probability map written next to a segmentation file
+    """
+    base = segmentation_path[:-len('.nii.gz')] if segmentation_path.endswith('.nii.gz') \
+        else os.path.splitext(segmentation_path)[0]
+    return f"{base}{PROBABILITY_SUFFIX}"
+
+
+def open_probability_map(path, shape):
+    """
+    Create a zero-filled probability map memmap of a NIfTI-ordered shape
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=PROBABILITY_DTYPE, shape=tuple(shape),
+                                     fortran_order=True)
+
+
+def _nnunet_axes(transpose_backward):
+    # nnUNet writes internal.transpose(transpose_backward) as a (z, y, x) array,
+    # whose NIfTI voxel order is the reverse
+    return [int(axis) for axis in list(transpose_backward)[::-1]]
+
+
+def model_has_regions(model_folder):
+    """
+    Whether a trained nnUNet model is region-based (sigmoid outputs)
+
+    Same rule as nnUNet's LabelManager: a label of the model's dataset.json
+    made of several classes is a region.
+    """
+    with open(os.path.join(model_folder, "dataset.json")) as f:
+        labels = json.load(f)["labels"]
+    return any(isinstance(value, (list, tuple)) and len(value) > 1 for value in labels.values())
+
+
+def model_reverses_axes(model_folder):
+    """
+    Whether a trained nnUNet model's reader reverses the NIfTI voxel axes
+
+    SimpleITK-based readers return (z, y, x) arrays; the readers in
+    NIBABEL_ORDER_READERS keep nibabel's voxel order (see resampling.py).
+    """
+    with open(os.path.join(model_folder, "plans.json")) as f:
+        reader = json.load(f).get("image_reader_writer")
+    return reader not in NIBABEL_ORDER_READERS
+
+
+def foreground_from_probabilities(probabilities, has_regions=False):
+    """
+    Tumor probability from a slab of class or region probabilities (channels first)
+
+    Softmax models give 1 - p(background); region-based (sigmoid) models, which
+    have no background channel, the largest region probability.
+    """
+    if has_regions:
+        return probabilities.max(axis=0)
+    return 1 - probabilities[0]
+
+
+def foreground_probability(logits, has_regions=False):
+    """
+    Tumor probability from a slab of network logits (channels first)
+
+    Applies the model's nonlinearity (sigmoid for regions, softmax otherwise),
+    then foreground_from_probabilities.
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    if has_regions:
+        return foreground_from_probabilities(1 / (1 + np.exp(-logits)), has_regions)
+    shifted = logits - logits.max(axis=0, keepdims=True)
+    np.exp(shifted, out=shifted)
+    shifted /= shifted.sum(axis=0, keepdims=True)
+    return foreground_from_probabilities(shifted)
+
+
+def foreground_from_logits(logits, has_regions=False, slab_slices=8):
+    """
+    Tumor probability of every voxel of a logits array, a few slices at a time
+
+    Returns a single-channel float16 array, so the logits can be freed before
+    the probability map is written.
+
+    Args:
+        logits: (channels, z, y, x) logits
+
+    Returns:
+        (z, y, x) float16 array for write_foreground_probabilities
+    """
+    foreground = np.empty(logits.shape[1:], dtype=PROBABILITY_DTYPE)
+    for lo in range(0, logits.shape[1], slab_slices):
+        foreground[lo:lo + slab_slices] = foreground_probability(logits[:, lo:lo + slab_slices], has_regions)
+    return foreground
+
+
+def write_foreground_probabilities(logits, properties, transpose_backward, output_path, has_regions=False,
+                                   weight_sums=None, slab_slices=8):
+    """
+    Write the tumor probability map of a prediction, slab by slab from its logits
+
+    Logits in nnUNet's preprocessed space are converted to probabilities a few
+    slices at a time and mapped (nearest neighbour) to the original geometry,
+    undoing nnUNet's crop to nonzero and axis transpose. Only one slab of
+    float32 probabilities exists at a time; voxels outside nnUNet's crop are 0.
+
+    Args:
+        logits: (channels, z, y, x) logits, an array or float16 memmap, or the
+            (z, y, x) result of foreground_from_logits
+        properties: nnUNet properties from preprocessing
+        transpose_backward: plans_manager.transpose_backward
+        output_path: Path of the probability map
+        has_regions: Whether the model is region-based (sigmoid outputs)
+        weight_sums: Optional per-slice blend weights the logits still need dividing by
+        slab_slices: Logit slices converted at a time
+
+    Returns:
+        output_path
+    """
+    from .streaming import _nearest_indices
+
+    axes = _nnunet_axes(transpose_backward)
+    internal_shape = list(properties['shape_before_cropping'])
+    probability_map = open_probability_map(output_path, [internal_shape[axis] for axis in axes])
+    internal = probability_map.transpose(np.argsort(axes))
+    cropped = internal[tuple(slice(*bounds) for bounds in properties['bbox_used_for_cropping'])]
+
+    target_shape = cropped.shape
+    indices = [_nearest_indices(source, target) for source, target in zip(logits.shape[-3:], target_shape)]
+    for lo in range(0, target_shape[0], slab_slices):
+        source_z = indices[0][lo:lo + slab_slices]
+        z_lo, z_hi = int(source_z.min()), int(source_z.max()) + 1
+        if logits.ndim == 3:
+            slab = None
+            probabilities = np.asarray(logits[z_lo:z_hi])
+        else:
+            slab = np.asarray(logits[:, z_lo:z_hi], dtype=np.float32)
+            if weight_sums is not None:
+                slab /= np.maximum(weight_sums[z_lo:z_hi], 1e-6)[None, :, None, None]
+            probabilities = foreground_probability(slab, has_regions)
+        cropped[lo:lo + len(source_z)] = probabilities[np.ix_(source_z - z_lo, indices[1], indices[2])]
+        del slab, probabilities
+
+    probability_map.flush()
+    del probability_map, internal, cropped
+    logger.info(f"Saved tumor probability map to {output_path}")
+    return output_path
+
+
+def convert_npz_probabilities(npz_path, output_path, has_regions=False, reversed_axes=True, slab_slices=8):
+    """
+    Convert nnUNetv2_predict's --save_probabilities output to a probability map
+
+    The probability array is streamed out of the .npz a slab at a time instead
+    of being loaded whole. Softmax models only need the background channel,
+    the first in the file; region-based models read every region channel and
+    keep the running maximum (see foreground_from_probabilities).
+
+    Args:
+        npz_path: nnUNet .npz with a (channels, z, y, x) 'probabilities' array
+        output_path: Path of the probability map
+        has_regions: Whether the model is region-based (see model_has_regions)
+        reversed_axes: Whether the array's axes are the reverse of the NIfTI voxel
+            order, as for SimpleITK readers (see model_reverses_axes)
+
+    Returns:
+        output_path
+    """
+    with zipfile.ZipFile(npz_path) as archive, archive.open('probabilities.npy') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+            else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        if fortran_order or len(shape) != 4:
+            raise ValueError(f"Unexpected probability array layout in {npz_path}: {shape}")
+
+        # A (z, y, x) array is the transpose of the NIfTI-ordered map
+        probability_map = open_probability_map(output_path, shape[1:][::-1] if reversed_axes else shape[1:])
+        internal = probability_map.T if reversed_axes else probability_map
+        slice_bytes = int(np.prod(shape[2:])) * dtype.itemsize
+        for channel in range(shape[0] if has_regions else 1):
+            for lo in range(0, shape[1], slab_slices):
+                count = min(slab_slices, shape[1] - lo)
+                slab = np.frombuffer(f.read(count * slice_bytes), dtype=dtype).reshape(1, count, *shape[2:])
+                foreground = foreground_from_probabilities(slab.astype(np.float32), has_regions)
+                if channel:
+                    foreground = np.maximum(internal[lo:lo + count], foreground)
+                internal[lo:lo + count] = foreground
+        probability_map.flush()
+        del probability_map, internal
+    return output_path
+
+
+def paste_probabilities(cropped_path, bbox, full_shape, output_path, slab_slices=32):
+    """
+    Place a probability map predicted on a crop back into full-volume coordinates
+
+    Args:
+        cropped_path: Probability map of the crop
+        bbox: Tuple of slices the crop was taken from (see cropping.mask_bounding_box)
+        full_shape: Shape of the full volume
+        output_path: Path of the full-volume probability map
+
+    Returns:
+        output_path
+    """
+    cropped = np.load(cropped_path, mmap_mode='r')
+    probability_map = open_probability_map(output_path, full_shape[:3])
+    region = probability_map[bbox]
+    if cropped.shape != region.shape:
+        raise ValueError(f"Probability map {cropped_path} has shape {cropped.shape}, "
+                         f"expected the crop's {region.shape}")
+    for lo in range(0, cropped.shape[2], slab_slices):
+        region[..., lo:lo + slab_slices] = cropped[..., lo:lo + slab_slices]
+    probability_map.flush()
+    del probability_map, region, cropped
+    return output_path
+
+
+def load_probability_map(path, shape):
+    """
+    Memory-map a probability map, or None if it is missing or does not match the mask
+
+    Args:
+        path: Probability map path (may be None)
+        shape: Shape of the mask it belongs to
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        probabilities = np.load(path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        logger.warning(f"Probability map {path} could not be read: {str(e)}")
+        return None
+    if probabilities.shape != tuple(shape):
+        logger.warning(f"Probability map {path} has shape {probabilities.shape}, the mask {tuple(shape)}")
+        return None
+    return probabilities
+
+
+def compute_confidence(probabilities, mask, foreground_label=1, slab_size=None):
+    """
+    Uncertainty metrics of a prediction, slab by slab over its probability map
+
+    Args:
+        probabilities: Tumor probability map (memmap) in the mask's voxel order
+        mask: Predicted label array
+        foreground_label: Label predicted as tumor
+        slab_size: Slices per slab (default: settings.SEGMENTATION_METRICS_SLAB_SIZE)
+
+    Returns:
+        Dictionary with 'mean_probability' (mean tumor probability of the voxels
+        predicted as tumor, None without any), 'mean_entropy' (mean binary entropy
+        in bits over the uncertain region: predicted tumor plus voxels with a tumor
+        probability of at least UNCERTAIN_PROBABILITY) and 'confidence_score'
+        (1 - mean_entropy; 1.0 when the model is certain there is no tumor)
+    """
+    slab_size = slab_size or settings.SEGMENTATION_METRICS_SLAB_SIZE
+    probability_sum = 0.0
+    foreground_voxels = 0
+    entropy_sum = 0.0
+    region_voxels = 0
+
+    for start in range(0, mask.shape[2], slab_size):
+        p = np.asarray(probabilities[..., start:start + slab_size], dtype=np.float32)
+        foreground = np.asarray(mask[..., start:start + slab_size]) == foreground_label
+        probability_sum += float(p[foreground].sum(dtype=np.float64))
+        foreground_voxels += int(foreground.sum())
+
+        region = p[foreground | (p >= UNCERTAIN_PROBABILITY)]
+        region = np.clip(region, 1e-6, 1 - 1e-6)
+        entropy_sum += float(-(region * np.log2(region) + (1 - region) * np.log2(1 - region)).sum(dtype=np.float64))
+        region_voxels += region.size
+        del p, foreground, region
+
+    mean_entropy = entropy_sum / region_voxels if region_voxels else 0.0
+    return {
+        'mean_probability': round(probability_sum / foreground_voxels, 4) if foreground_voxels else None,
+        'mean_entropy': round(mean_entropy, 4),
+        'confidence_score': round(1 - mean_entropy, 4),
+    }
+
+
+def retained_probability_path(task_id):
+    return os.path.join(settings.MEDIA_ROOT, 'probabilities', f"tumor_prob_{task_id}.npy.gz")
+
+
+def retain_probabilities(path, task_id, retention=None):
+    """
+    Discard a task's probability map or keep a gzip-compressed copy
+
+    Args:
+        path: Probability map produced by inference
+        task_id: Task the map belongs to
+        retention: 'discard' or 'compressed' (default: settings.SEGMENTATION_PROBABILITY_RETENTION)
+
+    Returns:
+        Path of the kept copy, or None
+    """
+    retention = retention or settings.SEGMENTATION_PROBABILITY_RETENTION
+    if retention not in RETENTION_CHOICES:
+        raise ValueError(f"Unknown probability retention '{retention}'")
+    if not path or not os.path.exists(path):
+        return None
+
+    kept = None
+    try:
+        if retention == 'compressed':
+            kept = retained_probability_path(task_id)
+            os.makedirs(os.path.dirname(kept), exist_ok=True)
+            temp_path = f"{kept}.{os.getpid()}.tmp"
+            with open(path, 'rb') as source, gzip.open(temp_path, 'wb', compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.replace(temp_path, kept)
+            logger.info(f"Kept compressed probability map for task {task_id} at {kept}")
+    finally:
+        os.remove(path)
+    return kept
@@ -0,0 +1,237 @@
+import os
+import json
+import zlib
+import shutil
+import logging
+import tempfile
+import itertools
+import numpy as np
+from django.conf import settings
+from .volume_cache import VolumeCache
+
+# pyramid.py
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+# Fast zlib level; masks are mostly zeros and compress well even at level 1
+ZLIB_LEVEL = 1
+
+
+def downsample2(array, is_mask):
+    """
+    Halve every axis of a 3D array
+
+    Image intensities are averaged over 2x2x2 blocks; masks keep the largest
+    label of each block so small lesions stay visible at coarse levels. Odd
+    axes are padded by repeating the last slice.
+    """
+    pad = [(0, size % 2) for size in array.shape]
+    if any(after for _, after in pad):
+        array = np.pad(array, pad, mode='edge')
+    nx, ny, nz = (size // 2 for size in array.shape)
+    blocks = array.reshape(nx, 2, ny, 2, nz, 2)
+    if is_mask:
+        return blocks.max(axis=(1, 3, 5))
+    reduced = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    if array.dtype.kind in 'iu':
+        reduced = np.rint(reduced)
+    return reduced.astype(array.dtype)
+
+
+def _level_affine(affine, factor):
+    # A level voxel covers `factor` source voxels per axis and sits at their centre
+    scale = np.diag([factor, factor, factor, 1.0])
+    scale[:3, 3] = (factor - 1) / 2
+    return (np.asarray(affine) @ scale).tolist()
+
+
+def _chunk_grid(shape, chunk_shape):
+    return [range(0, size, chunk) for size, chunk in zip(shape, chunk_shape)]
+
+
+def _write_chunks(array, path, chunk_shape):
+    """
+    Write an array as independently zlib-compressed chunks
+
+    Returns:
+        List of [offset, length] per chunk, in C order of the chunk grid
+    """
+    offsets = []
+    position = 0
+    with open(path, 'wb') as f:
+        for origin in itertools.product(*_chunk_grid(array.shape, chunk_shape)):
+            region = tuple(slice(start, start + size) for start, size in zip(origin, chunk_shape))
+            data = zlib.compress(np.ascontiguousarray(array[region]).tobytes(), ZLIB_LEVEL)
+            f.write(data)
+            offsets.append([position, len(data)])
+            position += len(data)
+    return offsets
+
+
+class VolumePyramid:
+    """
+    Multi-resolution, chunked copies of a task's image and masks
+
+    Level n is downsampled by factors[n - 1] (2x, 4x and 8x by default); level 0
+    is the full-resolution volume served from the VolumeCache. Each level is
+    stored as independently compressed chunks, so any region at any level is
+    read by decompressing only the chunks it overlaps.
+
+    Layout:
+        <pyramid_dir>/<task_id>/manifest.json
+        <pyramid_dir>/<task_id>/<layer>_L<level>.chunks
+    """
+    def __init__(self, task_id, pyramid_dir=None):
+        self.task_id = str(task_id)
+        self.pyramid_dir = str(pyramid_dir or settings.VOLUME_PYRAMID_DIR)
+        self.path = os.path.join(self.pyramid_dir, self.task_id)
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        """
+        Manifest of the built pyramid, or None if it has not been built
+        """
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.path, MANIFEST_NAME)) as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                return None
+        return self._manifest
+
+    def build(self, sources, factors=None, chunk_size=None, volume_cache=None):
+        """
+        Build every level of every layer, replacing any earlier pyramid
+
+        The full-resolution volumes come from the VolumeCache (decoding each
+        NIfTI once and warming the slice cache). The first level is reduced
+        slab by slab from that memory map; later levels from the previous one.
+
+        Args:
+            sources: Dictionary mapping layer names to NIfTI paths (or fused mask sources)
+            factors: Downsampling factors, powers of two (default: settings.VOLUME_PYRAMID_FACTORS)
+            chunk_size: Edge length of the cubic chunks (default: settings.VOLUME_PYRAMID_CHUNK_SIZE)
+
+        Returns:
+            The manifest
+        """
+        factors = sorted(factors or settings.VOLUME_PYRAMID_FACTORS)
+        chunk_shape = [chunk_size or settings.VOLUME_PYRAMID_CHUNK_SIZE] * 3
+        volume_cache = volume_cache or VolumeCache()
+        os.makedirs(self.pyramid_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=f".{self.task_id}.", dir=self.pyramid_dir)
+
+        try:
+            manifest = {'chunk_shape': chunk_shape, 'levels': [], 'layers': {}}
+            for layer, source_path in sources.items():
+                volume, meta = volume_cache.volume(self.task_id, layer, source_path)
+                if not manifest['levels']:
+                    manifest['levels'] = [{
+                        'level': 0, 'factor': 1, 'shape': meta['shape'],
+                        'zooms': meta['zooms'], 'affine': meta['affine'],
+                    }]
+                manifest['layers'][layer] = {'dtype': meta['dtype'], 'levels': {}}
+
+                array, factor = volume, 1
+                for level, target in enumerate(factors, start=1):
+                    while factor < target:
+                        array = self._reduce(array, layer != 'image')
+                        factor *= 2
+                    file_name = f"{layer}_L{level}.chunks"
+                    offsets = _write_chunks(array, os.path.join(build_dir, file_name), chunk_shape)
+                    manifest['layers'][layer]['levels'][str(level)] = {'file': file_name, 'offsets': offsets}
+                    if len(manifest['levels']) <= level:
+                        manifest['levels'].append({
+                            'level': level, 'factor': factor, 'shape': list(array.shape),
+                            'zooms': [zoom * factor for zoom in meta['zooms']],
+                            'affine': _level_affine(meta['affine'], factor),
+                        })
+                del volume, array
+
+            with open(os.path.join(build_dir, MANIFEST_NAME), 'w') as f:
+                json.dump(manifest, f)
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.replace(build_dir, self.path)
+        except Exception:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+
+        self._manifest = manifest
+        logger.info(f"Built {len(factors)}-level pyramid for task {self.task_id} ({', '.join(sources)})")
+        return manifest
+
+    @staticmethod
+    def _reduce(array, is_mask, slab_slices=32):
+        # Reduce a (possibly memory-mapped) volume slab by slab along z
+        if not isinstance(array, np.memmap):
+            return downsample2(array, is_mask)
+        return np.concatenate([
+            downsample2(np.asarray(array[..., start:start + slab_slices]), is_mask)
+            for start in range(0, array.shape[2], slab_slices)
+        ], axis=2)
+
+    def read_region(self, layer, level, region):
+        """
+        Read a region of one level, decompressing only the chunks it overlaps
+
+        Args:
+            layer: Layer name
+            level: Pyramid level (1 or higher)
+            region: Tuple of three (start, stop) voxel ranges at that level
+
+        Returns:
+            Array of the region in the layer's dtype
+
+        Raises:
+            KeyError: If the layer or level was not built
+            ValueError: If the region is empty or outside the level
+        """
+        manifest = self.manifest
+        if manifest is None:
+            raise KeyError("Pyramid has not been built")
+        level_info = manifest['levels'][level] if 0 < level < len(manifest['levels']) else None
+        entry = manifest['layers'][layer]['levels'][str(level)] if level_info else None
+        if entry is None:
+            raise KeyError(f"No level {level} for layer {layer}")
+        shape, chunk_shape = level_info['shape'], manifest['chunk_shape']
+        if any(not 0 <= start < stop <= size for (start, stop), size in zip(region, shape)):
+            raise ValueError(f"Region {region} is outside level {level} of shape {shape}")
+
+        dtype = np.dtype(manifest['layers'][layer]['dtype'])
+        output = np.empty([stop - start for start, stop in region], dtype=dtype)
+        grid = [len(axis) for axis in _chunk_grid(shape, chunk_shape)]
+        chunk_ranges = [range(start // chunk, (stop - 1) // chunk + 1)
+                        for (start, stop), chunk in zip(region, chunk_shape)]
+
+        with open(os.path.join(self.path, entry['file']), 'rb') as f:
+            for index in itertools.product(*chunk_ranges):
+                offset, length = entry['offsets'][int(np.ravel_multi_index(index, grid))]
+                f.seek(offset)
+                origin = [i * chunk for i, chunk in zip(index, chunk_shape)]
+                chunk_dims = [min(chunk, size - o) for chunk, size, o in zip(chunk_shape, shape, origin)]
+                chunk = np.frombuffer(zlib.decompress(f.read(length)), dtype=dtype).reshape(chunk_dims)
+
+                source, target = [], []
+                for (start, stop), o, dim in zip(region, origin, chunk_dims):
+                    lo, hi = max(start, o), min(stop, o + dim)
+                    source.append(slice(lo - o, hi - o))
+                    target.append(slice(lo - start, hi - start))
+                output[tuple(target)] = chunk[tuple(source)]
+        return output
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def task_layer_sources(task):
+    """
+    Sources of the layers a task has files for: the image path and the mask sources (see fused.mask_sources)
+    """
+    from .fused import mask_sources
+
+    sources = {}
+    if task.nifti_file and os.path.exists(task.nifti_file.path):
+        sources['image'] = task.nifti_file.path
+    sources.update(mask_sources(task))
+    return sources
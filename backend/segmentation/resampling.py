@@ -0,0 +1,267 @@
+import os
+import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import ndimage, sparse
+from django.conf import settings
+
+# resampling.py
+logger = logging.getLogger(__name__)
+
+# Spline weights below this are dropped, which keeps each axis' weight matrix banded
+WEIGHT_TOLERANCE = 1e-6
+
+# Spacing ratio above which nnUNet resamples the low-resolution axis separately
+ANISOTROPY_THRESHOLD = 3
+
+# nnUNet readers that return arrays in nibabel's (x, y, z) axis order; SimpleITK reverses it
+NIBABEL_ORDER_READERS = ('NibabelIO', 'NibabelIOWithReorient')
+
+
+def plans_target_spacing(model_folder, config):
+    """
+    Target spacing of an nnUNet configuration, in the axis order of the NIfTI file
+
+    nnUNet stores spacings after its reader's axis order and transpose_forward
+    have been applied; both are undone here.
+
+    Args:
+        model_folder: Trained model folder containing plans.json
+        config: nnUNet configuration name, e.g. '3d_fullres'
+
+    Returns:
+        Tuple of three spacings in mm, or None for 2d configurations
+    """
+    with open(os.path.join(model_folder, 'plans.json')) as f:
+        plans = json.load(f)
+
+    configuration = plans['configurations'][config]
+    while 'spacing' not in configuration and 'inherits_from' in configuration:
+        configuration = plans['configurations'][configuration['inherits_from']]
+    spacing = configuration['spacing']
+    if len(spacing) != 3:
+        return None
+
+    reader_spacing = [0.0] * 3
+    for axis, value in zip(plans.get('transpose_forward', [0, 1, 2]), spacing):
+        reader_spacing[axis] = float(value)
+    if plans.get('image_reader_writer') in NIBABEL_ORDER_READERS:
+        return tuple(reader_spacing)
+    return tuple(reversed(reader_spacing))
+
+
+def spline_weights(in_size, out_size, step, order, offset=0.0):
+    """
+    Sparse (out_size, in_size) matrix that resamples one axis
+
+    Output voxel i samples input coordinate i * step + offset. Built by
+    interpolating the identity, so it matches ndimage's spline interpolation
+    (mode 'nearest') along that axis exactly, up to WEIGHT_TOLERANCE.
+    """
+    weights = ndimage.affine_transform(
+        np.eye(in_size), [step, 1.0], offset=[offset, 0.0], output_shape=(out_size, in_size), order=order,
+        mode='nearest', prefilter=order > 1
+    )
+    weights[np.abs(weights) < WEIGHT_TOLERANCE] = 0
+    return sparse.csr_matrix(weights.astype(np.float32))
+
+
+def resize_weights(in_size, out_size, order):
+    """
+    Spline weights that resize one axis like skimage's resize (used by nnUNet)
+
+    Voxel centres are aligned, so output voxel i samples input coordinate
+    (i + 0.5) * in_size / out_size - 0.5.
+    """
+    step = in_size / out_size
+    return spline_weights(in_size, out_size, step, order, offset=0.5 * step - 0.5)
+
+
+def resampling_orders(spacing, target_spacing, resampling_kwargs):
+    """
+    Spline order per axis, following nnUNet's resample_data_or_seg_to_shape
+
+    An anisotropic case resamples its single low-resolution axis with order_z.
+    """
+    order = resampling_kwargs.get('order', 3)
+    force_separate_z = resampling_kwargs.get('force_separate_z')
+    if force_separate_z is not None:
+        reference = spacing if force_separate_z else None
+    elif max(spacing) / min(spacing) > ANISOTROPY_THRESHOLD:
+        reference = spacing
+    elif max(target_spacing) / min(target_spacing) > ANISOTROPY_THRESHOLD:
+        reference = target_spacing
+    else:
+        reference = None
+
+    orders = [order] * len(spacing)
+    if reference is not None:
+        lowres_axes = np.flatnonzero(np.isclose(reference, max(reference)))
+        if len(lowres_axes) == 1:
+            orders[lowres_axes[0]] = resampling_kwargs.get('order_z', 0)
+    return orders
+
+
+def resample_slab(slab, weights_z, weights_y, weights_x):
+    """
+    Apply one sparse weight matrix per axis to a (z, y, x) slab
+    """
+    nz, ny, nx = slab.shape
+    data = (weights_z @ slab.reshape(nz, -1)).reshape(-1, ny, nx)
+    out_z = data.shape[0]
+    data = (weights_y @ data.transpose(1, 0, 2).reshape(ny, -1)).reshape(-1, out_z, nx).transpose(1, 0, 2)
+    return (weights_x @ data.reshape(-1, nx).T).T.reshape(out_z, -1, weights_x.shape[0])
+
+
+class ChunkedResampler:
+    """
+    Bounded-memory, multi-threaded spline resampling onto a new voxel spacing
+
+    The voxel axes are kept and only their spacing changes, so no reorientation
+    happens. Axis-aligned spline interpolation is separable: each axis is
+    resampled with a sparse, banded weight matrix (the prefilter and the spline
+    kernel folded together), which needs far fewer multiply-adds per voxel than
+    a 3D spline kernel. Output slices are produced in chunks along the last
+    axis; each chunk's input is read sequentially from the image proxy in its
+    stored dtype and resampled on a thread pool, so only a few chunks of input
+    are held at a time next to the output array.
+    """
+    def __init__(self, target_spacing, order=None, num_threads=None, chunk_slices=None):
+        self.target_spacing = np.asarray(target_spacing, dtype=np.float64)
+        self.order = settings.SEGMENTATION_RESAMPLE_ORDER if order is None else order
+        self.num_threads = num_threads or settings.SEGMENTATION_RESAMPLE_THREADS or os.cpu_count() or 1
+        self.chunk_slices = chunk_slices or settings.SEGMENTATION_RESAMPLE_CHUNK_SLICES
+        if not 0 <= self.order <= 5:
+            raise ValueError(f"Interpolation order must be between 0 and 5, got {self.order}")
+
+    def output_geometry(self, img):
+        """
+        Shape, affine and per-axis step (in input voxels) of the resampled grid
+
+        The first voxel keeps its position, so the output covers the input extent.
+        """
+        zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+        steps = self.target_spacing / zooms
+        shape = tuple(int(np.floor((size - 1) / step + 1e-6)) + 1 for size, step in zip(img.shape[:3], steps))
+        affine = img.affine @ np.diag([*steps, 1.0])
+        return shape, affine, steps
+
+    def needs_resampling(self, img, tolerance=0.01):
+        """
+        Whether the image's spacing differs from the target by more than tolerance (relative)
+        """
+        zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+        return bool(np.any(np.abs(zooms - self.target_spacing) > tolerance * self.target_spacing))
+
+    def axis_weights(self, in_size, out_size, step):
+        """
+        Sparse (out_size, in_size) matrix that resamples one axis (see spline_weights)
+        """
+        return spline_weights(in_size, out_size, step, self.order)
+
+    def _resample_chunk(self, slab, weights_x, weights_y, weights_z):
+        nx, ny, nz = slab.shape
+        out_x, out_y, out_z = weights_x.shape[0], weights_y.shape[0], weights_z.shape[0]
+        # Last axis first: (x*y, z) -> (x*y, out_z)
+        data = (weights_z @ slab.reshape(-1, nz).T).T.reshape(nx, ny, out_z)
+        data = (weights_y @ data.transpose(1, 0, 2).reshape(ny, -1)).reshape(out_y, nx, out_z)
+        data = (weights_x @ data.transpose(1, 0, 2).reshape(nx, -1)).reshape(out_x, out_y, out_z)
+        return data
+
+    def _slabs(self, img, weights_z):
+        """
+        Yield (output slice range, input slab, input start) per chunk, reading the input once
+        """
+        out_depth = weights_z.shape[0]
+        buffer, buffer_lo, buffer_hi = None, 0, 0
+        for out_lo in range(0, out_depth, self.chunk_slices):
+            out_hi = min(out_lo + self.chunk_slices, out_depth)
+            # Input slices with non-zero weight for this chunk's output slices
+            columns = weights_z[out_lo:out_hi].indices
+            lo, hi = int(columns.min()), int(columns.max()) + 1
+
+            # Keep the overlap with the previous chunk and append the new slices
+            new_slices = np.asanyarray(img.dataobj[..., max(buffer_hi, lo):hi]).astype(np.float32, copy=False)
+            if buffer is None or lo >= buffer_hi:
+                buffer = new_slices
+            else:
+                buffer = np.concatenate([buffer[..., lo - buffer_lo:], new_slices], axis=2)
+            buffer_lo, buffer_hi = lo, hi
+            yield (out_lo, out_hi), buffer, lo
+
+    def resample(self, img, progress=None):
+        """
+        Resample an image onto the target spacing
+
+        Args:
+            img: 3D nibabel image, ideally loaded with keep_file_open=True
+            progress: Optional callable receiving the fraction of chunks done
+
+        Returns:
+            Resampled Nifti1Image in the input's stored dtype (float32 for scaled data)
+        """
+        if len(img.shape) != 3:
+            raise ValueError(f"Expected a 3D image, got shape {img.shape}")
+        shape, affine, steps = self.output_geometry(img)
+
+        stored_dtype = np.asanyarray(img.dataobj[..., :1]).dtype
+        dtype = stored_dtype if stored_dtype.kind in 'iu' else np.dtype(np.float32)
+        output = np.empty(shape, dtype=dtype)
+        total_chunks = -(-shape[2] // self.chunk_slices)
+        logger.info(f"Resampling {img.shape} at {img.header.get_zooms()[:3]} mm to {shape} at "
+                    f"{tuple(self.target_spacing)} mm (order {self.order}, {self.num_threads} thread(s))")
+
+        completed = 0
+
+        def store(chunk, future):
+            nonlocal completed
+            out_lo, out_hi = chunk
+            values = future.result()
+            if dtype.kind in 'iu':
+                info = np.iinfo(dtype)
+                values = np.clip(np.rint(values), info.min, info.max)
+            output[..., out_lo:out_hi] = values
+            completed += 1
+            if progress is not None:
+                progress(completed / total_chunks)
+
+        weights_x, weights_y, weights_z = (
+            self.axis_weights(size, out_size, step) for size, out_size, step in zip(img.shape, shape, steps)
+        )
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for chunk, slab, lo in self._slabs(img, weights_z):
+                out_lo, out_hi = chunk
+                chunk_weights = weights_z[out_lo:out_hi, lo:lo + slab.shape[2]]
+                pending.append((chunk, executor.submit(
+                    self._resample_chunk, slab, weights_x, weights_y, chunk_weights
+                )))
+                # Bound the input slabs held by queued work
+                while len(pending) >= 2 * self.num_threads:
+                    store(*pending.popleft())
+            while pending:
+                store(*pending.popleft())
+
+        header = img.header.copy()
+        header.set_data_dtype(dtype)
+        resampled = nib.Nifti1Image(output, affine, header=header)
+        resampled.set_qform(affine, code=int(img.header['qform_code']) or 1)
+        resampled.set_sform(affine, code=int(img.header['sform_code']) or 1)
+        return resampled
+
+    def resample_file(self, input_path, output_path, progress=None):
+        """
+        Resample a NIfTI file, writing the result to output_path
+
+        Returns:
+            False if the file already has the target spacing and nothing was written
+        """
+        img = nib.load(input_path, keep_file_open=True)
+        if not self.needs_resampling(img):
+            logger.info(f"{input_path} already has spacing {img.header.get_zooms()[:3]}, not resampling")
+            return False
+        nib.save(self.resample(img, progress=progress), output_path)
+        return True
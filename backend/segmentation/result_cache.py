@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+import nibabel as nib
+import numpy as np
+from django.conf import settings
+
+# result_cache.py
+logger = logging.getLogger(__name__)
+
+CACHED_FILES = {
+    'tumor_segmentation': 'tumor.nii.gz',
+    'lung_segmentation': 'lung.nii.gz',
+    'fused_segmentation': 'fused.nii.gz',
+}
+
+
+def cached_fields():
+    """
+    Result files an entry must have for the current output mode (see SEGMENTATION_FUSED_OUTPUT)
+    """
+    if settings.SEGMENTATION_FUSED_OUTPUT:
+        return ['fused_segmentation']
+    return ['tumor_segmentation', 'lung_segmentation']
+
+
+def link_or_copy(source, dest):
+    """
+    Hard link source to dest, copying when a link is not possible
+
+    Linked files share one inode, so callers must replace segmentation files
+    (write to a new file and rename) rather than rewrite them in place.
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy(source, dest)
+
+
+class SegmentationResultCache:
+    """
+    Content-addressed on-disk cache of segmentation results
+
+    Entries are keyed on a hash of the decoded voxel data, the affine and the
+    model version, so re-uploads of the same study reuse the stored tumor/lung
+    masks and metrics instead of running inference again. The cache is bounded
+    to max_bytes and evicts least recently used entries.
+
+    Layout:
+        <cache_dir>/<key>/tumor.nii.gz
+        <cache_dir>/<key>/lung.nii.gz
+        <cache_dir>/<key>/fused.nii.gz    (instead of the two masks with SEGMENTATION_FUSED_OUTPUT)
+        <cache_dir>/<key>/metrics.json
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = str(cache_dir or settings.SEGMENTATION_CACHE_DIR)
+        self.max_bytes = settings.SEGMENTATION_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def compute_key(self, input_file_path, model_version, slab_size=32):
+        """
+        Hash the decoded voxel array, affine and model version of an input file
+
+        The voxels are read in their stored dtype, slab by slab along the last
+        axis, so hashing never holds a float64 copy of the volume.
+
+        Args:
+            input_file_path: Path to the input NIfTI file
+            model_version: String identifying the models that produce the results
+            slab_size: Number of slices hashed at a time
+
+        Returns:
+            Hex digest identifying the cache entry
+        """
+        img = nib.load(input_file_path)
+        digest = hashlib.sha256()
+        digest.update(model_version.encode())
+        digest.update(str(img.shape).encode())
+        digest.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+
+        dataobj = img.dataobj
+        # Scaling changes the decoded values without changing the stored ones
+        digest.update(str((getattr(dataobj, 'slope', 1.0), getattr(dataobj, 'inter', 0.0))).encode())
+        digest.update(str(img.get_data_dtype()).encode())
+
+        # Unscaled proxies return slabs in the stored dtype; slabs along the
+        # last axis are contiguous in the file, so compressed inputs are read once
+        for start in range(0, img.shape[-1], slab_size):
+            slab = np.asarray(dataobj[..., start:start + slab_size])
+            digest.update(np.ascontiguousarray(slab).tobytes())
+
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key):
+        """
+        Get a cache entry and mark it as recently used
+
+        Returns:
+            Dictionary with the cached file paths and 'metrics', or None on a miss
+        """
+        entry_dir = self._entry_dir(key)
+        metrics_path = os.path.join(entry_dir, 'metrics.json')
+        files = {field: os.path.join(entry_dir, CACHED_FILES[field]) for field in cached_fields()}
+        if not os.path.exists(metrics_path) or not all(os.path.exists(path) for path in files.values()):
+            return None
+
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+        os.utime(entry_dir)
+        logger.info(f"Segmentation cache hit for {key}")
+        return {**files, 'metrics': metrics}
+
+    def materialize(self, entry, task_id):
+        """
+        Link a cache entry's masks into the media folder for a task
+
+        Returns:
+            Dictionary containing paths to the segmentation files
+        """
+        result_files = {
+            field: str(Path(settings.MEDIA_ROOT) / "segmentations" / f"{field.split('_')[0]}_seg_{task_id}.nii.gz")
+            for field in CACHED_FILES if field in entry
+        }
+        for field, dest in result_files.items():
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            link_or_copy(entry[field], dest)
+        return result_files
+
+    def store(self, key, result_files, metrics):
+        """
+        Add a task's segmentation files and metrics to the cache
+
+        Args:
+            key: Key from compute_key
+            result_files: Dictionary containing paths to the segmentation files
+            metrics: JSON-serializable metrics to copy onto later tasks
+        """
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            os.utime(entry_dir)
+            return
+
+        # Build the entry next to its final location and rename it into place,
+        # so concurrent workers never see a half-written entry
+        staging_dir = tempfile.mkdtemp(prefix=f".{key}_", dir=self.cache_dir)
+        try:
+            for field, name in CACHED_FILES.items():
+                if field in result_files:
+                    link_or_copy(result_files[field], os.path.join(staging_dir, name))
+            with open(os.path.join(staging_dir, 'metrics.json'), 'w') as f:
+                json.dump(metrics, f)
+            os.rename(staging_dir, entry_dir)
+            logger.info(f"Stored segmentation results in cache as {key}")
+        except OSError as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir):
+                raise
+            logger.info(f"Cache entry {key} was stored by another worker: {e}")
+
+        self.evict()
+
+    def _entry_size(self, entry_dir):
+        return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+
+        Returns:
+            Number of entries removed
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                entries.append((entry.stat().st_mtime, entry.path, self._entry_size(entry.path)))
+
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info(f"Evicted {removed} segmentation cache entries")
+        return removed
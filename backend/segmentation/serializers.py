@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import SegmentationTask
+from django.urls import reverse
+from .models import SegmentationTask, ChunkedUpload, Lesion
 import os
 import logging
 
@@ -12,43 +13,68 @@ class SegmentationTaskSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = SegmentationTask
-        fields = ['id', 'user', 'file_name', 'status', 'created_at']
-        read_only_fields = ['id', 'user', 'status', 'created_at']
+        fields = ['id', 'user', 'file_name', 'status', 'progress', 'inference_tier', 'created_at']
+        read_only_fields = ['id', 'user', 'status', 'progress', 'created_at']
+
+class LesionSerializer(serializers.ModelSerializer):
+    """Serializer for per-lesion measurements"""
+    
+    class Meta:
+        model = Lesion
+        fields = [
+            'id', 'task', 'index', 'voxel_count', 'volume', 'longest_diameter', 'diameter_slice',
+            'centroid', 'centroid_voxel', 'bbox', 'mean_probability'
+        ]
+        read_only_fields = fields
 
 class SegmentationTaskDetailSerializer(serializers.ModelSerializer):
     """Detailed serializer for segmentation tasks"""
     user = serializers.StringRelatedField(read_only=True)
     tumor_segmentation_url = serializers.SerializerMethodField()
     lung_segmentation_url = serializers.SerializerMethodField()
+    fused_segmentation_url = serializers.SerializerMethodField()
     nifti_file_url = serializers.SerializerMethodField()
+    lesions = LesionSerializer(many=True, read_only=True)
     
     class Meta:
         model = SegmentationTask
         fields = [
-            'id', 'user', 'file_name', 'status',
-            'tumor_volume', 'lung_volume', 'lesion_count', 'confidence_score',
-            'tumor_segmentation_url', 'lung_segmentation_url',
+            'id', 'user', 'file_name', 'status', 'progress', 'inference_tier',
+            'tumor_volume', 'lung_volume', 'lesion_count', 'confidence_score', 'mean_probability',
+            'mean_entropy', 'preview_slice', 'lesions', 'removed_components',
+            'tumor_segmentation_url', 'lung_segmentation_url', 'fused_segmentation_url',
             'nifti_file_url',
             'created_at', 'updated_at'
         ]
         read_only_fields = [
-            'id', 'user', 'status', 'tumor_segmentation_url', 'lung_segmentation_url',
-            'nifti_file_url',
-            'lesion_count', 'confidence_score',
-            'error', 'created_at', 'updated_at'
+            'id', 'user', 'status', 'progress', 'inference_tier', 'tumor_segmentation_url', 'lung_segmentation_url',
+            'fused_segmentation_url', 'nifti_file_url',
+            'lesion_count', 'confidence_score', 'mean_probability', 'mean_entropy', 'preview_slice', 'lesions',
+            'removed_components', 'error', 'created_at', 'updated_at'
         ]
     
+    def _mask_url(self, obj, layer):
+        field = getattr(obj, f"{layer}_segmentation")
+        if field:
+            url = field.url
+        elif obj.fused_segmentation:
+            # Extracted from the fused volume when first requested
+            url = reverse('segmentation-task-segmentation-file', kwargs={'pk': obj.pk, 'layer': layer})
+        else:
+            return None
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+    
     def get_tumor_segmentation_url(self, obj):
-        if obj.tumor_segmentation:
-            request = self.context.get('request')
-            url = obj.tumor_segmentation.url
-            return request.build_absolute_uri(url) if request else url
-        return None
+        return self._mask_url(obj, 'tumor')
     
     def get_lung_segmentation_url(self, obj):
-        if obj.lung_segmentation:
+        return self._mask_url(obj, 'lung')
+    
+    def get_fused_segmentation_url(self, obj):
+        if obj.fused_segmentation:
             request = self.context.get('request')
-            url = obj.lung_segmentation.url
+            url = obj.fused_segmentation.url
             return request.build_absolute_uri(url) if request else url
         return None
     
@@ -57,4 +83,18 @@ class SegmentationTaskDetailSerializer(serializers.ModelSerializer):
             request = self.context.get('request')
             url = obj.nifti_file.url
             return request.build_absolute_uri(url) if request else url
-        return None
\ No newline at end of file
+        return None
+
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    """Serializer for resumable chunked uploads"""
+    total_chunks = serializers.IntegerField(read_only=True)
+    missing_chunks = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+    
+    class Meta:
+        model = ChunkedUpload
+        fields = [
+            'id', 'file_name', 'total_size', 'chunk_size', 'total_chunks',
+            'received_chunks', 'missing_chunks', 'status', 'inference_tier', 'task',
+            'created_at', 'updated_at'
+        ]
+        read_only_fields = fields
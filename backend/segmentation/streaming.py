@@ -0,0 +1,233 @@
+import os
+import logging
+import numpy as np
+from django.conf import settings
+from .probabilities import write_foreground_probabilities
+from .resampling import resample_slab, resampling_orders, resize_weights
+
+# streaming.py
+logger = logging.getLogger(__name__)
+
+# Share of the memory ceiling kept free for network weights, activations and the interpreter
+MODEL_OVERHEAD_FRACTION = 0.5
+
+
+def estimate_inference_memory(data_shape, num_classes, original_shape):
+    """
+    Estimate the peak bytes of a whole-volume nnUNet prediction
+
+    Counts the preprocessed input, nnUNet's logit and prediction-count buffers,
+    the logits and probabilities resampled to the original shape and the final
+    segmentation. Network activations are not included.
+
+    Args:
+        data_shape: Shape of the preprocessed input (channels, z, y, x)
+        num_classes: Number of segmentation heads of the model
+        original_shape: Spatial shape of the case before preprocessing
+    """
+    channels = data_shape[0]
+    voxels = int(np.prod(data_shape[1:]))
+    original_voxels = int(np.prod(original_shape))
+    return voxels * (4 * channels + 4 * num_classes + 4) + original_voxels * (8 * num_classes + 1)
+
+
+def should_stream(data_shape, num_classes, original_shape, max_memory_bytes=None, mode=None):
+    """
+    Decide whether a case needs memory-bounded streaming inference
+
+    Args:
+        mode: 'auto', 'always' or 'never' (default: settings.NNUNET_STREAMING_MODE)
+    """
+    mode = mode or settings.NNUNET_STREAMING_MODE
+    if mode in ("always", "never"):
+        return mode == "always"
+    max_memory_bytes = max_memory_bytes or settings.NNUNET_MAX_INFERENCE_MEMORY_GB * 1024 ** 3
+    return estimate_inference_memory(data_shape, num_classes, original_shape) > max_memory_bytes
+
+
+def slab_depth(plane_shape, channels, num_classes, patch_depth, max_memory_bytes):
+    """
+    Number of slices per slab that keeps a slab's buffers under the ceiling
+
+    Per slice a slab needs its input copy, nnUNet's logits and prediction
+    counts, the fold ensemble sum and the float32 view of the accumulator.
+    Slabs are never thinner than twice the patch depth.
+    """
+    plane = int(np.prod(plane_shape))
+    bytes_per_slice = plane * (4 * channels + 12 * num_classes + 4)
+    budget = max_memory_bytes * (1 - MODEL_OVERHEAD_FRACTION)
+    return max(int(budget // bytes_per_slice), 2 * patch_depth)
+
+
+def _blend_weights(depth, lo, hi, total, overlap):
+    """
+    Linear ramps over the slices a slab shares with its neighbours
+
+    Neighbouring ramps add up to one, so blended logits keep their scale.
+    """
+    weights = np.ones(depth, dtype=np.float32)
+    ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap if overlap else None
+    if overlap and lo > 0:
+        weights[:overlap] = ramp
+    if overlap and hi < total:
+        weights[-overlap:] = ramp[::-1]
+    return weights
+
+
+def _nearest_indices(source_size, target_size):
+    """
+    Source index of every target index for nearest-neighbour resampling
+    """
+    return np.minimum(((np.arange(target_size) + 0.5) * source_size / target_size).astype(np.int64),
+                      source_size - 1)
+
+
+class StreamingPredictor:
+    """
+    Memory-bounded sliding-window inference for very large volumes
+
+    The preprocessed input is read in overlapping z-slabs from a memory-mapped
+    array. Each slab runs through nnUNet's own sliding window (all folds,
+    mirroring), and its logits are blended into a float16 on-disk accumulator.
+    Like nnUNet's export, the logits are then resampled to the original spacing
+    before the segmentation is taken, slab by slab, so no whole-volume float
+    buffer is ever allocated.
+    """
+    def __init__(self, predictor, work_dir, max_memory_bytes=None):
+        self.predictor = predictor
+        self.work_dir = work_dir
+        self.max_memory_bytes = max_memory_bytes or settings.NNUNET_MAX_INFERENCE_MEMORY_GB * 1024 ** 3
+
+    @property
+    def num_classes(self):
+        return self.predictor.label_manager.num_segmentation_heads
+
+    def _patch_depth(self):
+        patch_size = self.predictor.configuration_manager.patch_size
+        # 2d configurations predict slice by slice and need no overlap
+        return patch_size[0] if len(patch_size) == 3 else 1
+
+    def _predict_slab(self, slab):
+        import torch
+        return self.predictor.predict_logits_from_preprocessed_data(
+            torch.from_numpy(np.ascontiguousarray(slab, dtype=np.float32))
+        ).cpu().numpy()
+
+    def _segment_slab(self, logits):
+        import torch
+        segmentation = self.predictor.label_manager.convert_logits_to_segmentation(torch.from_numpy(logits))
+        return np.asarray(segmentation.cpu() if hasattr(segmentation, 'cpu') else segmentation)
+
+    def _logit_weights(self, source_shape, target_shape, properties):
+        """
+        Per-axis weights resampling logits to the original spacing
+
+        Same spacings and spline orders as nnUNet's resampling_fn_probabilities
+        in convert_predicted_logits_to_segmentation_with_correct_shape.
+        """
+        configuration_manager = self.predictor.configuration_manager
+        original_spacing = [properties['spacing'][i] for i in self.predictor.plans_manager.transpose_forward]
+        spacing = list(configuration_manager.spacing)
+        if len(spacing) < len(original_spacing):
+            # 2d configurations keep the spacing between slices
+            spacing = [original_spacing[0]] + spacing
+        orders = resampling_orders(spacing, original_spacing,
+                                   configuration_manager.configuration['resampling_fn_probabilities_kwargs'])
+        return [resize_weights(source, target, order) for source, target, order in
+                zip(source_shape, target_shape, orders)]
+
+    def predict_logits(self, data):
+        """
+        Blend slab logits into an on-disk float16 accumulator
+
+        Args:
+            data: Preprocessed input (channels, z, y, x), ideally a memmap
+
+        Returns:
+            Tuple of (accumulator memmap, per-slice weight sums)
+        """
+        channels, depth_total = data.shape[0], data.shape[1]
+        patch_depth = self._patch_depth()
+        overlap = patch_depth if len(self.predictor.configuration_manager.patch_size) == 3 else 0
+        depth = min(slab_depth(data.shape[2:], channels, self.num_classes, patch_depth, self.max_memory_bytes),
+                    depth_total)
+        step = max(depth - overlap, 1)
+
+        accumulator = np.lib.format.open_memmap(
+            os.path.join(self.work_dir, "logits.npy"), mode="w+", dtype=np.float16,
+            shape=(self.num_classes, *data.shape[1:])
+        )
+        weight_sums = np.zeros(depth_total, dtype=np.float32)
+
+        starts = list(range(0, max(depth_total - overlap, 1), step))
+        logger.info(f"Streaming inference over {len(starts)} slab(s) of {depth} slices "
+                    f"({overlap} overlapping) for volume {data.shape}")
+        for lo in starts:
+            hi = min(lo + depth, depth_total)
+            logits = self._predict_slab(data[:, lo:hi])
+            weights = _blend_weights(hi - lo, lo, hi, depth_total, min(overlap, hi - lo))
+            logits *= weights[None, :, None, None]
+            region = accumulator[:, lo:hi].astype(np.float32)
+            region += logits
+            accumulator[:, lo:hi] = region
+            weight_sums[lo:hi] += weights
+            del logits, region
+            if hi == depth_total:
+                break
+
+        accumulator.flush()
+        return accumulator, weight_sums
+
+    def predict(self, data, properties, output_file_path, probability_file_path=None):
+        """
+        Predict a case and write its segmentation in the original geometry
+
+        Args:
+            data: Preprocessed input (channels, z, y, x), ideally a memmap
+            properties: nnUNet properties from preprocessing
+            output_file_path: Path to write the segmentation to
+            probability_file_path: Optional path to write the tumor probability map to
+                (see probabilities.py), read slab by slab from the same accumulator
+
+        Returns:
+            Path to the written segmentation
+        """
+        plans_manager = self.predictor.plans_manager
+        accumulator, weight_sums = self.predict_logits(data)
+
+        # Logits resampled to the cropped original shape first, then segmented
+        target_shape = tuple(properties['shape_after_cropping_and_before_resampling'])
+        weights_z, weights_y, weights_x = self._logit_weights(accumulator.shape[1:], target_shape, properties)
+        dtype = np.uint8 if len(self.predictor.label_manager.foreground_labels) < 255 else np.uint16
+        cropped = np.zeros(target_shape, dtype=dtype)
+
+        depth = max(slab_depth(target_shape[1:], 1, self.num_classes, 1, self.max_memory_bytes), 1)
+        for lo in range(0, target_shape[0], depth):
+            hi = min(lo + depth, target_shape[0])
+            # Accumulator slices with non-zero weight for this slab's output slices
+            columns = weights_z[lo:hi].indices
+            z_lo, z_hi = int(columns.min()), int(columns.max()) + 1
+            logits = accumulator[:, z_lo:z_hi].astype(np.float32)
+            logits /= np.maximum(weight_sums[z_lo:z_hi], 1e-6)[None, :, None, None]
+            resampled = np.stack([resample_slab(channel, weights_z[lo:hi, z_lo:z_hi], weights_y, weights_x)
+                                  for channel in logits])
+            del logits
+            cropped[lo:hi] = self._segment_slab(resampled)
+            del resampled
+
+        if probability_file_path:
+            write_foreground_probabilities(accumulator, properties, plans_manager.transpose_backward,
+                                           probability_file_path, self.predictor.label_manager.has_regions,
+                                           weight_sums=weight_sums)
+        del accumulator
+        os.remove(os.path.join(self.work_dir, "logits.npy"))
+
+        # Undo nnUNet's crop to nonzero and axis transpose
+        full = np.zeros(properties['shape_before_cropping'], dtype=dtype)
+        full[tuple(slice(*bounds) for bounds in properties['bbox_used_for_cropping'])] = cropped
+        del cropped
+        full = full.transpose(plans_manager.transpose_backward)
+
+        plans_manager.image_reader_writer_class().write_seg(full, output_file_path, properties)
+        logger.info(f"Generated streamed segmentation at {output_file_path}")
+        return output_file_path
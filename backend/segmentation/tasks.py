@@ -6,7 +6,6 @@ from datetime import timedelta
 from pathlib import Path
 import os
 import time
-import nibabel as nib
 import shutil
 import logging
 
@@ -17,11 +16,97 @@ logger = logging.getLogger(__name__)
 def dummy_log_test():
     print(">>> Logging works in Celery task <<<")
 
+# Task progress (percent) at the end of each pipeline stage
+PREPROCESSING_PROGRESS = {'resampling': 5, 'resampled': 15, 'queued': 20}
+PROCESSING_PROGRESS = 30
+COMPLETED_PROGRESS = 100
+
+def _set_progress(task_id, progress, **fields):
+    """
+    Update a task's progress (and any other fields) without a full save
+    """
+    from .models import SegmentationTask
+    SegmentationTask.objects.filter(id=task_id).update(progress=progress, updated_at=timezone.now(), **fields)
+
+@shared_task
+def preprocess_segmentation_task(task_id):
+    """
+    Resample an uploaded scan to the models' plans spacing, then queue it for segmentation
+    
+    Runs off the request thread so uploads return as soon as the file is stored.
+    The resampled image is written next to the upload and swapped in atomically,
+    so a crash never leaves a half-written input behind. If resampling fails the
+    task continues with the full-resolution file.
+    
+    With SEGMENTATION_BODY_CROP the body's bounding box is stored on the task as
+    body_bbox; the upload itself keeps its full geometry for the viewer.
+    """
+    import nibabel as nib
+    from .models import SegmentationTask
+    from .nnunet_handler import NNUNetHandler
+    from .resampling import ChunkedResampler
+    from .cropping import body_bounding_box, bounding_box_fraction
+    
+    print(f"Starting preprocessing for task {task_id}")
+    try:
+        task = SegmentationTask.objects.get(id=task_id)
+        input_path = task.nifti_file.path
+    except Exception as e:
+        _fail_segmentation_task(task_id, e)
+        return
+    
+    temp_path = os.path.join(os.path.dirname(input_path), f".resampling_{os.path.basename(input_path)}")
+    try:
+        # Resample once, straight to the spacing nnUNet plans for this tier's models
+        target_spacing = NNUNetHandler(tier=task.inference_tier).target_spacing()
+        _set_progress(task_id, PREPROCESSING_PROGRESS['resampling'])
+        
+        start, end = PREPROCESSING_PROGRESS['resampling'], PREPROCESSING_PROGRESS['resampled']
+        reported = [start]
+        def report(fraction):
+            progress = start + int(fraction * (end - start))
+            if progress > reported[-1]:
+                reported.append(progress)
+                _set_progress(task_id, progress)
+        
+        if ChunkedResampler(target_spacing).resample_file(input_path, temp_path, progress=report):
+            # Replace the original file with the resampled one
+            os.replace(temp_path, input_path)
+            print(f"Resampled task {task_id} input to {target_spacing} mm")
+    except Exception as e:
+        # If something goes wrong, log and continue with full‑res
+        print(f"Warning: down‐sampling failed for task {task_id}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    # Find the body so inference skips the air and table around it
+    body_bbox = None
+    if settings.SEGMENTATION_BODY_CROP:
+        try:
+            bbox = body_bounding_box(input_path)
+            if bbox is not None:
+                body_bbox = [[s.start, s.stop] for s in bbox]
+                print(f"Body crop for task {task_id}: {body_bbox} "
+                      f"({bounding_box_fraction(bbox, nib.load(input_path).shape):.0%} of voxels)")
+        except Exception as e:
+            print(f"Warning: body crop failed for task {task_id}, using the full volume: {e}")
+    
+    _set_progress(task_id, PREPROCESSING_PROGRESS['queued'], status='queued', body_bbox=body_bbox)
+    process_segmentation_task.delay(str(task_id))
+    print(f"Preprocessing complete, queued task {task_id} for segmentation")
+
 @shared_task
 def process_segmentation_task(task_id):
-    """Process a segmentation task asynchronously"""
+    """
+    Process a segmentation task asynchronously
+    
+    Queued tasks are gathered into micro-batches of up to SEGMENTATION_BATCH_SIZE
+    (waiting at most SEGMENTATION_BATCH_WAIT_SECONDS) so that one model session
+    serves several uploads. Tasks picked up by another worker's batch are skipped.
+    """
     from .models import SegmentationTask
     from .nnunet_handler import NNUNetHandler
+    from .batching import collect_batch
     
     print(f"Starting segmentation task {task_id}")
     
@@ -37,113 +122,318 @@ def process_segmentation_task(task_id):
     celery_handler.setLevel(logging.INFO)
     logging.getLogger().addHandler(celery_handler)
     
+    task_ids = [str(task_id)]
     try:
-        # Get the task
-        task = SegmentationTask.objects.get(id=task_id)
-        print(f"Successfully retrieved task: {task}")
-        print(f"Task file name: {task.file_name}")
-        print(f"Task status before processing: {task.status}")
+        # Claim this task and any other queued tasks for one batch
+        task_ids = collect_batch(task_id)
+        if not task_ids:
+            if not SegmentationTask.objects.filter(id=task_id).exists():
+                print(f"❌ ERROR: Task {task_id} not found in database")
+            else:
+                print(f"Task {task_id} is not queued or was picked up by another batch, skipping")
+            return
         
-        print(f"Updating task status to 'processing'...")
-        task.status = 'processing'
-        task.save(update_fields=['status', 'updated_at'])
-        print(f"Task status updated to: {task.status}")
-
-        # Initialize handler and get input path
-        nnunet_handler = NNUNetHandler()
-        input_file_path = task.nifti_file.path
-        print(f"Input NIFTI file path: {input_file_path}")
+        tasks = {str(task.id): task for task in SegmentationTask.objects.filter(id__in=task_ids)}
+        print(f"Processing batch of {len(task_ids)} task(s): {', '.join(task_ids)}")
+        
+        # Initialize handler for the batch's inference tier and get input paths
+        nnunet_handler = NNUNetHandler(tier=tasks[task_ids[0]].inference_tier)
+        cases = [(batch_task_id, tasks[batch_task_id].nifti_file.path) for batch_task_id in task_ids]
+        for batch_task_id, input_file_path in cases:
+            print(f"Input NIFTI file path for {batch_task_id}: {input_file_path}")
         
-        # Run segmentation
+        # Serve repeat uploads of the same study from the result cache
+        cache_keys = {}
+        if settings.SEGMENTATION_CACHE_ENABLED:
+            cases, cache_keys = _complete_cached_tasks(cases, tasks, nnunet_handler)
+            if not cases:
+                return
+        
+        # Run segmentation for the whole batch, on the body crops found during preprocessing
+        crops = {
+            batch_task_id: tuple(slice(start, stop) for start, stop in tasks[batch_task_id].body_bbox)
+            for batch_task_id, _ in cases if tasks[batch_task_id].body_bbox
+        }
         try:
-            print(f"Running nnUNet segmentation on {input_file_path}")
-            result_files = nnunet_handler.predict(input_file_path)
+            print(f"Running nnUNet segmentation on {len(cases)} file(s)")
+            results, errors = nnunet_handler.predict_batch(cases, crops=crops)
         except Exception as e:
-            print(f"Using fallback segmentation due to error: {str(e)}")
             import traceback
             print(traceback.format_exc())
-            result_files = nnunet_handler.fallback_inference(input_file_path)
-        
-        # Verify both result files exist
-        for seg_type, file_path in result_files.items():
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"Result file not found at {file_path}")
-            print(f"{seg_type} file generated at: {file_path}")
-        
-        # Update database references
-        media_relative_paths = {
-            'tumor_segmentation': os.path.relpath(result_files['tumor_segmentation'], settings.MEDIA_ROOT),
-            'lung_segmentation': os.path.relpath(result_files['lung_segmentation'], settings.MEDIA_ROOT)
-        }
-        
-        # Clear any existing file references
-        for field_name in ['tumor_segmentation', 'lung_segmentation']:
-            old_file = getattr(task, field_name)
-            if old_file:
-                old_file_path = old_file.path
-                old_file.delete(save=False)
-                # Only delete the old file if it's different from the new one
-                if os.path.exists(old_file_path) and old_file_path != result_files[field_name]:
-                    try:
-                        os.remove(old_file_path)
-                        print(f"Removed old {field_name} file: {old_file_path}")
-                    except OSError as e:
-                        print(f"Failed to remove old file {old_file_path}: {e}")
+            results, errors = {}, {batch_task_id: str(e) for batch_task_id in task_ids}
         
-        # Update the task with the file paths
-        task.tumor_segmentation.name = media_relative_paths['tumor_segmentation']
-        task.lung_segmentation.name = media_relative_paths['lung_segmentation']
-        task.save(update_fields=['tumor_segmentation', 'lung_segmentation'])
-        
-        # Verify the saved files can be loaded with nibabel
-        for seg_type, file_path in result_files.items():
+        # Fan the per-case outputs back out to each task
+        for batch_task_id, input_file_path in cases:
             try:
-                test_load = nib.load(file_path)
-                test_shape = test_load.shape
-                test_datatype = test_load.get_data_dtype()
-                print(f"Verification successful - Saved {seg_type} NIFTI shape: {test_shape}, datatype: {test_datatype}")
+                result_files = results.get(batch_task_id)
+                if result_files is None:
+                    print(f"Using fallback segmentation due to error: {errors.get(batch_task_id)}")
+                    result_files = nnunet_handler.fallback_inference(input_file_path)
+                # The probability map only feeds post-processing, it is not a task or cache file
+                probabilities_path = result_files.pop('tumor_probabilities', None)
+                metrics = _complete_segmentation_task(tasks[batch_task_id], result_files, nnunet_handler,
+                                                      probabilities_path=probabilities_path)
             except Exception as e:
-                print(f"WARNING - Saved {seg_type} file verification failed: {str(e)}")
-        
-        # Set task to completed with metrics
-        try:
-            # Analyze both segmentations
-            tumor_metrics = nnunet_handler.analyze_segmentation(task.tumor_segmentation.path)
-            lung_metrics = nnunet_handler.analyze_segmentation(task.lung_segmentation.path)
+                _fail_segmentation_task(batch_task_id, e)
+                continue
             
-            # Update task with combined metrics
-            task.tumor_volume = tumor_metrics.get('tumor_volume')
-            task.lung_volume = lung_metrics.get('lung_volume')
-            task.lesion_count = tumor_metrics.get('lesion_count')
-            task.confidence_score = tumor_metrics.get('confidence_score')
-            print(f"Analysis complete with metrics: Tumor={tumor_metrics}, Lung={lung_metrics}")
-        except Exception as e:
-            print(f"WARNING - Failed to compute metrics: {str(e)}")
+            # Only real model outputs are cached, never fallback results
+            if batch_task_id in results and batch_task_id in cache_keys:
+                try:
+                    from .result_cache import SegmentationResultCache
+                    SegmentationResultCache().store(cache_keys[batch_task_id], result_files, metrics)
+                except Exception as e:
+                    print(f"WARNING - Failed to cache results for task {batch_task_id}: {str(e)}")
         
-        task.status = 'completed'
-        task.save()
-        print(f"Completed segmentation task {task_id}")
-        
-    except SegmentationTask.DoesNotExist:
-        print(f"❌ ERROR: Task {task_id} not found in database")
     except Exception as e:
-        print(f"Error processing segmentation task {task_id}: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-        
-        try:
-            print(f"Attempting to update task status to 'failed'...")
-            task = SegmentationTask.objects.get(id=task_id)
-            task.status = 'failed'
-            task.error = str(e)
-            task.save(update_fields=['status', 'error', 'updated_at'])
-            print(f"✓ Task status updated to 'failed'")
-        except Exception as update_error:
-            print(f"Failed to update task status: {str(update_error)}")
+        for batch_task_id in task_ids:
+            _fail_segmentation_task(batch_task_id, e)
     finally:
         # Remove the logging handler
         logging.getLogger().removeHandler(celery_handler)
 
+def _complete_cached_tasks(cases, tasks, nnunet_handler):
+    """
+    Complete the tasks whose input is already in the result cache
+    
+    Args:
+        cases: List of (task_id, input_file_path) tuples
+        tasks: Dictionary mapping task ids to SegmentationTask objects
+        nnunet_handler: Handler providing the model version
+    
+    Returns:
+        Tuple of (cases that still need inference, dictionary mapping task ids to cache keys)
+    """
+    from .result_cache import SegmentationResultCache
+    
+    try:
+        cache = SegmentationResultCache()
+        model_version = nnunet_handler.model_version()
+    except Exception as e:
+        print(f"WARNING - Segmentation cache unavailable: {str(e)}")
+        return cases, {}
+    
+    remaining = []
+    cache_keys = {}
+    for batch_task_id, input_file_path in cases:
+        try:
+            cache_keys[batch_task_id] = cache.compute_key(input_file_path, model_version)
+            entry = cache.lookup(cache_keys[batch_task_id])
+        except Exception as e:
+            print(f"WARNING - Cache lookup failed for task {batch_task_id}: {str(e)}")
+            entry = None
+        
+        if entry is None:
+            remaining.append((batch_task_id, input_file_path))
+            continue
+        
+        print(f"Cache hit for task {batch_task_id}, reusing stored segmentation results")
+        try:
+            result_files = cache.materialize(entry, batch_task_id)
+            _complete_segmentation_task(tasks[batch_task_id], result_files, nnunet_handler,
+                                        metrics=entry['metrics'])
+        except Exception as e:
+            _fail_segmentation_task(batch_task_id, e)
+    
+    return remaining, cache_keys
+
+def _complete_segmentation_task(task, result_files, nnunet_handler, metrics=None, probabilities_path=None):
+    """
+    Store the segmentation files and metrics on a task and mark it completed
+    
+    Args:
+        task: SegmentationTask to complete
+        result_files: Dictionary containing paths to both segmentation files
+        nnunet_handler: Handler that produced the segmentations
+        metrics: Metrics to store instead of post-processing the files (e.g. from the result cache)
+        probabilities_path: Tumor probability map for the confidence metrics; discarded or
+            kept compressed afterwards according to SEGMENTATION_PROBABILITY_RETENTION
+    
+    With SEGMENTATION_FUSED_OUTPUT the task keeps one fused multi-label volume
+    instead of the two masks (see fused.py), and result_files is updated in
+    place to hold only 'fused_segmentation', the file the result cache stores.
+    
+    Returns:
+        Dictionary of the metrics stored on the task
+    """
+    from .postprocessing import postprocess_segmentations
+    from .lesions import store_lesions
+    from .probabilities import retain_probabilities
+    from .fused import fused_file_for, fuse_mask_files
+    
+    task_id = task.id
+    fused_path = fused_file_for(task_id) if settings.SEGMENTATION_FUSED_OUTPUT else None
+    
+    # Verify both result files exist
+    for seg_type, file_path in result_files.items():
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Result file not found at {file_path}")
+        print(f"{seg_type} file generated at: {file_path}")
+    
+    # Decode each mask once to validate and analyze it together (post-processing also writes the fused volume)
+    fuse_files = fused_path and metrics is not None and 'fused_segmentation' not in result_files
+    if metrics is None:
+        try:
+            metrics = postprocess_segmentations(result_files, probabilities_path, fused_path=fused_path)
+        finally:
+            retain_probabilities(probabilities_path, task_id)
+        print(f"Post-processing complete with metrics: {metrics}")
+    else:
+        retain_probabilities(probabilities_path, task_id)
+    
+    # Keep only the fused volume; the separate masks are extracted again on request
+    if fused_path:
+        if fuse_files:
+            fuse_mask_files(result_files, fused_path)
+        if 'fused_segmentation' not in result_files:
+            for field_name in ['tumor_segmentation', 'lung_segmentation']:
+                os.remove(result_files.pop(field_name))
+            result_files['fused_segmentation'] = fused_path
+        file_fields = ['tumor_segmentation', 'lung_segmentation', 'fused_segmentation']
+    else:
+        file_fields = ['tumor_segmentation', 'lung_segmentation']
+    
+    # Update database references
+    media_relative_paths = {
+        field_name: os.path.relpath(file_path, settings.MEDIA_ROOT) for field_name, file_path in result_files.items()
+    }
+    
+    # Clear any existing file references
+    for field_name in file_fields:
+        old_file = getattr(task, field_name)
+        if old_file:
+            old_file_path = old_file.path
+            old_file.delete(save=False)
+            # Only delete the old file if it's different from the new one
+            if os.path.exists(old_file_path) and old_file_path != result_files.get(field_name):
+                try:
+                    os.remove(old_file_path)
+                    print(f"Removed old {field_name} file: {old_file_path}")
+                except OSError as e:
+                    print(f"Failed to remove old file {old_file_path}: {e}")
+    
+    # Update the task with the file paths
+    for field_name in file_fields:
+        getattr(task, field_name).name = media_relative_paths.get(field_name)
+    task.save(update_fields=file_fields)
+    
+    # Update task with combined metrics; per-lesion measurements go to their own table
+    for field_name, value in metrics.items():
+        if field_name != 'lesions':
+            setattr(task, field_name, value)
+    
+    task.status = 'completed'
+    task.progress = COMPLETED_PROGRESS
+    task.save()
+    if metrics.get('lesions') is not None:
+        store_lesions(task, metrics['lesions'])
+    print(f"Completed segmentation task {task_id}")
+    
+    # Viewer assets are built off the inference worker's critical path
+    for viewer_task in (build_volume_pyramid, encode_segmentation_masks, extract_segmentation_meshes):
+        try:
+            viewer_task.delay(str(task_id))
+        except Exception as e:
+            print(f"WARNING - Failed to queue {viewer_task.name} for task {task_id}: {str(e)}")
+    return metrics
+
+def _fail_segmentation_task(task_id, error):
+    """
+    Mark a task as failed with the given error
+    """
+    from .models import SegmentationTask
+    
+    print(f"Error processing segmentation task {task_id}: {str(error)}")
+    import traceback
+    print(traceback.format_exc())
+    
+    try:
+        print(f"Attempting to update task status to 'failed'...")
+        task = SegmentationTask.objects.get(id=task_id)
+        task.status = 'failed'
+        task.error = str(error)
+        task.save(update_fields=['status', 'error', 'updated_at'])
+        print(f"✓ Task status updated to 'failed'")
+    except Exception as update_error:
+        print(f"Failed to update task status: {str(update_error)}")
+
+@shared_task
+def build_volume_pyramid(task_id):
+    """
+    Build the 2x/4x/8x downsampled, chunked copies of a completed task's volumes
+    
+    Viewers fetch the coarse levels first and refine region by region
+    (/api/segmentation/tasks/<id>/pyramid/). The pyramid is rebuilt from
+    scratch, so re-running the task after the masks change is safe.
+    """
+    from .models import SegmentationTask
+    from .pyramid import VolumePyramid, task_layer_sources
+    
+    try:
+        task = SegmentationTask.objects.get(id=task_id)
+    except SegmentationTask.DoesNotExist:
+        print(f"Task {task_id} no longer exists, skipping volume pyramid")
+        return None
+    
+    sources = task_layer_sources(task)
+    if not sources:
+        print(f"Task {task_id} has no volumes to build a pyramid from")
+        return None
+    
+    start = time.time()
+    manifest = VolumePyramid(task_id).build(sources)
+    print(f"Built volume pyramid for task {task_id} in {time.time() - start:.1f}s")
+    return [level['shape'] for level in manifest['levels']]
+
+@shared_task
+def encode_segmentation_masks(task_id):
+    """
+    Store sparse (bounding-box bit-packed and per-slice run-length) copies of a task's masks
+    
+    Served by /api/segmentation/tasks/<id>/masks/<layer>/ as a small alternative
+    to downloading the dense NIfTI volumes.
+    """
+    from .models import SegmentationTask
+    from .mask_encoding import encode_task_masks
+    from .fused import mask_sources
+    
+    try:
+        task = SegmentationTask.objects.get(id=task_id)
+    except SegmentationTask.DoesNotExist:
+        print(f"Task {task_id} no longer exists, skipping mask encoding")
+        return None
+    
+    sources = mask_sources(task)
+    sizes = encode_task_masks(task_id, sources)
+    for layer, (dense, encoded) in sizes.items():
+        print(f"Encoded {layer} mask for task {task_id}: {dense} -> {encoded} bytes ({dense / max(encoded, 1):.0f}x)")
+    return sizes
+
+@shared_task
+def extract_segmentation_meshes(task_id):
+    """
+    Extract decimated lung and tumor surface meshes for the 3D viewer
+    
+    Meshes are cached by the hash of each mask file, so identical masks (result
+    cache hits) are only extracted once and a replaced mask gets new meshes.
+    """
+    from .models import SegmentationTask
+    from .meshes import MeshStore
+    from .fused import mask_sources
+    
+    try:
+        task = SegmentationTask.objects.get(id=task_id)
+    except SegmentationTask.DoesNotExist:
+        print(f"Task {task_id} no longer exists, skipping mesh extraction")
+        return None
+    
+    sources = mask_sources(task)
+    start = time.time()
+    extracted = MeshStore().build(task_id, sources)
+    print(f"Meshes for task {task_id} ready in {time.time() - start:.1f}s "
+          f"(extracted: {', '.join(layer for layer, new in extracted.items() if new) or 'none, cached'})")
+    return extracted
+
 @shared_task
 def cleanup_old_tasks(days=30):
     """
@@ -153,9 +443,32 @@ def cleanup_old_tasks(days=30):
         days: Number of days before tasks are considered old (default: 30)
     """
     from .models import SegmentationTask
+    from .workspace import cleanup_stale_workspaces
+    from .uploads import expire_uploads
+    from .volume_cache import VolumeCache
+    from .pyramid import VolumePyramid
+    from .mask_encoding import MaskEncodingStore
+    from .meshes import MeshStore
+    from .probabilities import retained_probability_path
+    
+    removed_workspaces = cleanup_stale_workspaces()
+    print(f"Removed {removed_workspaces} abandoned task workspaces")
+    removed_uploads = expire_uploads()
+    print(f"Removed {removed_uploads} expired chunked uploads")
+    
     cutoff_date = timezone.now() - timedelta(days=days)
     old_tasks = SegmentationTask.objects.filter(created_at__lt=cutoff_date)
     print(f"Cleaning up {old_tasks.count()} segmentation tasks older than {days} days")
+    volume_cache = VolumeCache()
+    mesh_store = MeshStore()
+    for old_task_id in old_tasks.values_list('id', flat=True):
+        volume_cache.discard(old_task_id)
+        VolumePyramid(old_task_id).discard()
+        MaskEncodingStore().discard(old_task_id)
+        mesh_store.discard(old_task_id)
+        if os.path.exists(retained_probability_path(old_task_id)):
+            os.remove(retained_probability_path(old_task_id))
     old_tasks.delete()
+    print(f"Removed {mesh_store.prune()} unreferenced mesh sets")
     print(f"Cleanup complete - removed tasks older than {cutoff_date}")
     return old_tasks.count()
\ No newline at end of file
@@ -0,0 +1,102 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from django.test import override_settings
+from segmentation.models import SegmentationTask
+from segmentation.batching import claim_task, collect_batch
+from segmentation.tasks import process_segmentation_task, PROCESSING_PROGRESS
+
+
+@pytest.fixture
+def queued_tasks(test_user, test_nifti_file):
+    """Create three queued segmentation tasks"""
+    return [
+        SegmentationTask.objects.create(
+            user=test_user,
+            file_name=f"scan_{i}.nii.gz",
+            nifti_file=test_nifti_file,
+            status="queued"
+        )
+        for i in range(3)
+    ]
+
+
+@pytest.mark.django_db
+class TestBatchCollection:
+    """Test cases for micro-batch collection"""
+
+    def test_claim_task_once(self, queued_tasks):
+        """Test a task can only be claimed by one worker"""
+        task = queued_tasks[0]
+
+        assert claim_task(task.id) is True
+        assert claim_task(task.id) is False
+
+        task.refresh_from_db()
+        assert task.status == 'processing'
+        assert task.progress == PROCESSING_PROGRESS
+
+    def test_collect_batch(self, queued_tasks):
+        """Test queued tasks are gathered up to the batch size"""
+        batch = collect_batch(queued_tasks[1].id, max_size=2, max_wait=0)
+
+        assert len(batch) == 2
+        assert batch[0] == str(queued_tasks[1].id)
+        assert SegmentationTask.objects.filter(status='processing').count() == 2
+        assert SegmentationTask.objects.filter(status='queued').count() == 1
+
+    def test_collect_batch_same_tier(self, queued_tasks):
+        """Test tasks with a different inference tier are left for another batch"""
+        SegmentationTask.objects.filter(id=queued_tasks[2].id).update(inference_tier='fast')
+
+        batch = collect_batch(queued_tasks[0].id, max_size=3, max_wait=0)
+
+        assert str(queued_tasks[2].id) not in batch
+        assert len(batch) == 2
+
+    def test_collect_batch_already_claimed(self, queued_tasks):
+        """Test a task picked up by another batch is skipped"""
+        collect_batch(queued_tasks[0].id, max_size=3, max_wait=0)
+
+        assert collect_batch(queued_tasks[1].id, max_size=3, max_wait=0) == []
+
+
+@pytest.mark.django_db
+class TestBatchedProcessing:
+    """Test cases for processing a batch of segmentation tasks"""
+
+    def test_outputs_fanned_out_to_tasks(self, queued_tasks):
+        """Test each task in the batch gets its own result, failures use the fallback"""
+        task_ids = [str(task.id) for task in queued_tasks]
+        results = {
+            task_ids[0]: {'tumor_segmentation': 'tumor_0', 'lung_segmentation': 'lung_0'},
+            task_ids[1]: {'tumor_segmentation': 'tumor_1', 'lung_segmentation': 'lung_1'},
+        }
+        errors = {task_ids[2]: 'no output'}
+        fallback = {'tumor_segmentation': 'tumor_fb', 'lung_segmentation': 'lung_fb'}
+
+        mock_handler = MagicMock()
+        mock_handler.predict_batch.return_value = (results, errors)
+        mock_handler.fallback_inference.return_value = fallback
+
+        with patch('segmentation.nnunet_handler.NNUNetHandler', return_value=mock_handler), \
+             patch('segmentation.tasks._complete_segmentation_task') as mock_complete, \
+             override_settings(SEGMENTATION_BATCH_SIZE=3, SEGMENTATION_BATCH_WAIT_SECONDS=0):
+            process_segmentation_task(task_ids[0])
+
+        mock_handler.predict_batch.assert_called_once()
+        assert len(mock_handler.predict_batch.call_args[0][0]) == 3
+        mock_handler.fallback_inference.assert_called_once()
+
+        completed = {call[0][0].id: call[0][1] for call in mock_complete.call_args_list}
+        assert completed[queued_tasks[0].id] == results[task_ids[0]]
+        assert completed[queued_tasks[1].id] == results[task_ids[1]]
+        assert completed[queued_tasks[2].id] == fallback
+
+    def test_skips_task_claimed_by_other_batch(self, queued_tasks):
+        """Test a task already in another batch is not processed twice"""
+        claim_task(queued_tasks[0].id)
+
+        with patch('segmentation.nnunet_handler.NNUNetHandler') as mock_handler_class:
+            process_segmentation_task(str(queued_tasks[0].id))
+
+        mock_handler_class.assert_not_called()
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy import ndimage
+from django.test import override_settings
+from segmentation.components import filter_tumor_components, replace_mask
+from segmentation.postprocessing import postprocess_segmentations, load_mask
+
+
+def _masks():
+    lung = np.zeros((40, 30, 20), dtype=np.uint8)
+    lung[5:20, 5:25, 2:18] = 1
+    tumor = np.zeros_like(lung)
+    tumor[8:12, 8:12, 5:9] = 1      # inside the lung, 64 voxels
+    tumor[21:23, 10:12, 5:7] = 1    # 2 voxels (1.5 mm) past the lung border, 8 voxels
+    tumor[32:36, 10:14, 5:9] = 1    # far outside the lung, 64 voxels
+    tumor[10, 20, 10] = 1           # inside the lung but a single voxel
+    return tumor, lung
+
+
+class TestFilterTumorComponents:
+    """Test cases for removing false-positive tumor components"""
+
+    def test_removes_outside_and_small(self):
+        """Test components far from the lung and below the volume threshold are removed"""
+        tumor, lung = _masks()
+
+        filtered, removed = filter_tumor_components(tumor, lung, (0.75, 1.0, 1.0), margin_mm=3.0, min_volume_mm3=2.0)
+
+        expected = tumor.copy()
+        expected[32:36, 10:14, 5:9] = 0
+        expected[10, 20, 10] = 0
+        np.testing.assert_array_equal(filtered, expected)
+        assert sorted((component['reason'], component['voxel_count']) for component in removed) == \
+            [('outside_lung', 64), ('too_small', 1)]
+        outside = next(component for component in removed if component['reason'] == 'outside_lung')
+        assert outside['bbox'] == [[32, 36], [10, 14], [5, 9]]
+        assert outside['centroid_voxel'] == [33.5, 11.5, 6.5]
+        assert outside['volume'] == pytest.approx(64 * 0.75 / 1000)
+        # The input is left untouched
+        assert tumor[32:36, 10:14, 5:9].all()
+
+    def test_margin_is_in_millimetres(self):
+        """Test the lung margin is measured with the voxel spacing"""
+        tumor, lung = _masks()
+
+        _, removed = filter_tumor_components(tumor, lung, (0.5, 1.0, 1.0), margin_mm=0.9, min_volume_mm3=0)
+        assert [component['voxel_count'] for component in removed] == [8, 64]
+
+        _, removed = filter_tumor_components(tumor, lung, (0.5, 1.0, 1.0), margin_mm=1.0, min_volume_mm3=0)
+        assert [component['voxel_count'] for component in removed] == [64]
+
+    def test_matches_dilated_lung_reference(self):
+        """Test the cropped distance transform agrees with dilating the whole lung mask"""
+        rng = np.random.RandomState(5)
+        lung = (ndimage.gaussian_filter(rng.rand(36, 32, 24), 3) > 0.52).astype(np.uint8)
+        tumor = (ndimage.gaussian_filter(rng.rand(36, 32, 24), 1) > 0.62).astype(np.uint8)
+        zooms = (1.0, 1.0, 1.0)
+
+        filtered, removed = filter_tumor_components(tumor, lung, zooms, margin_mm=2.0, min_volume_mm3=0)
+
+        near = ndimage.distance_transform_edt(lung == 0, sampling=zooms) <= 2.0
+        labeled, count = ndimage.label(tumor)
+        keep = np.zeros(count + 1, dtype=bool)
+        keep[np.unique(labeled[near & (labeled > 0)])] = True
+        keep[0] = False
+        np.testing.assert_array_equal(filtered, keep[labeled].astype(np.uint8))
+        assert len(removed) == count - keep.sum() > 0
+
+    def test_nothing_to_remove(self):
+        """Test clean masks and empty lungs are returned as they are"""
+        tumor, lung = _masks()
+        tumor[30:, :, :] = 0
+        tumor[10, 20, 10] = 0
+
+        filtered, removed = filter_tumor_components(tumor, lung, (1.0, 1.0, 1.0), margin_mm=3.0, min_volume_mm3=2.0)
+        assert filtered is tumor and removed == []
+
+        filtered, removed = filter_tumor_components(tumor, np.zeros_like(lung), (1.0, 1.0, 1.0), margin_mm=3.0,
+                                                    min_volume_mm3=2.0)
+        assert filtered is tumor and removed == []
+
+
+class TestPostprocessingFilter:
+    """Test cases for the filter in post-processing"""
+
+    def _result_files(self, tmp_path):
+        tumor, lung = _masks()
+        result_files = {}
+        for name, data in (('tumor_segmentation', tumor), ('lung_segmentation', lung)):
+            result_files[name] = str(tmp_path / f"{name}.nii.gz")
+            nib.save(nib.Nifti1Image(data, np.eye(4)), result_files[name])
+        return result_files
+
+    def test_replaces_tumor_file(self, tmp_path):
+        """Test metrics use the filtered mask, which replaces the file without touching hard links"""
+        result_files = self._result_files(tmp_path)
+        cached = str(tmp_path / "cached.nii.gz")
+        os.link(result_files['tumor_segmentation'], cached)
+
+        with override_settings(SEGMENTATION_LUNG_MARGIN_MM=3.0, SEGMENTATION_MIN_COMPONENT_MM3=2.0):
+            metrics = postprocess_segmentations(result_files)
+
+        assert metrics['lesion_count'] == 2
+        assert metrics['tumor_volume'] == round(72 / 1000, 2)
+        assert sorted(component['reason'] for component in metrics['removed_components']) == \
+            ['outside_lung', 'too_small']
+        img, data = load_mask(result_files['tumor_segmentation'])
+        assert data.dtype == np.uint8
+        assert int(data.sum()) == 72
+        np.testing.assert_array_equal(img.affine, np.eye(4))
+        assert int(load_mask(cached)[1].sum()) == 137
+
+    def test_disabled(self, tmp_path):
+        """Test the filter can be switched off"""
+        result_files = self._result_files(tmp_path)
+        mtime = os.stat(result_files['tumor_segmentation']).st_mtime_ns
+
+        with override_settings(SEGMENTATION_FILTER_TUMOR_COMPONENTS=False):
+            metrics = postprocess_segmentations(result_files)
+
+        assert metrics['lesion_count'] == 4
+        assert metrics['removed_components'] is None
+        assert os.stat(result_files['tumor_segmentation']).st_mtime_ns == mtime
+
+    def test_replace_mask_cleans_up_on_error(self, tmp_path):
+        """Test a failed write leaves the original file and no temporary files"""
+        result_files = self._result_files(tmp_path)
+        img, data = load_mask(result_files['tumor_segmentation'])
+        before = sorted(os.listdir(tmp_path))
+
+        with pytest.raises(Exception):
+            replace_mask(result_files['tumor_segmentation'], img, np.zeros((2, 2), dtype=object))
+
+        assert sorted(os.listdir(tmp_path)) == before
+        assert int(load_mask(result_files['tumor_segmentation'])[1].sum()) == 137
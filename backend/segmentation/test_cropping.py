@@ -0,0 +1,174 @@
+import os
+import numpy as np
+import nibabel as nib
+from unittest.mock import patch
+from django.test import override_settings
+from segmentation.cropping import mask_bounding_box, crop_image, paste_mask, body_bounding_box
+from segmentation.nnunet_handler import NNUNetHandler
+from segmentation.workspace import TaskWorkspace
+
+
+def _write_nifti(path, data, affine=None):
+    nib.save(nib.Nifti1Image(data, np.diag([2.0, 1.0, 1.0, 1.0]) if affine is None else affine), str(path))
+    return str(path)
+
+
+def _lung_mask(shape=(20, 20, 20)):
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[6:10, 5:12, 8:15] = 1
+    return mask
+
+
+def _chest_ct(shape=(40, 40, 12)):
+    """Body cylinder with air-filled lungs, a scanner table 2 voxels below it, and air around"""
+    x, y = np.mgrid[:shape[0], :shape[1]]
+    body = (x - 18) ** 2 / 12 ** 2 + (y - 16) ** 2 / 9 ** 2 <= 1
+    lungs = ((x - 13) ** 2 + (y - 16) ** 2 <= 9) | ((x - 23) ** 2 + (y - 16) ** 2 <= 9)
+    image = np.full(shape, -1000, dtype=np.int16)
+    image[body] = 40
+    image[lungs] = -850
+    image[2:36, 28:30] = 300
+    return image
+
+
+class TestCropping:
+    """Test cases for lung region cropping helpers"""
+
+    def test_bounding_box_margin_in_mm(self, tmp_path):
+        """Test the margin is converted to voxels per axis and clipped to the volume"""
+        mask_path = _write_nifti(tmp_path / "lung.nii.gz", _lung_mask())
+
+        bbox = mask_bounding_box(mask_path, margin_mm=6)
+
+        # 2 mm voxels on the first axis, 1 mm on the others
+        assert bbox == (slice(3, 13), slice(0, 18), slice(2, 20))
+
+    def test_empty_mask(self, tmp_path):
+        """Test an empty mask has no bounding box"""
+        mask_path = _write_nifti(tmp_path / "lung.nii.gz", np.zeros((5, 5, 5), dtype=np.uint8))
+
+        assert mask_bounding_box(mask_path, margin_mm=10) is None
+
+    def test_crop_and_paste_round_trip(self, tmp_path):
+        """Test a crop keeps world coordinates and pastes back into place"""
+        image = np.random.RandomState(0).randint(-1000, 1000, (20, 20, 20)).astype(np.int16)
+        image_path = _write_nifti(tmp_path / "image.nii.gz", image)
+        bbox = (slice(3, 13), slice(2, 14), slice(5, 18))
+
+        cropped_path = crop_image(image_path, bbox, str(tmp_path / "cropped.nii.gz"))
+        cropped = nib.load(cropped_path)
+        np.testing.assert_array_equal(np.asanyarray(cropped.dataobj), image[bbox])
+        np.testing.assert_allclose(cropped.affine @ [0, 0, 0, 1], nib.load(image_path).affine @ [3, 2, 5, 1])
+
+        pasted_path = paste_mask(cropped_path, bbox, image_path, str(tmp_path / "pasted.nii.gz"))
+        pasted = nib.load(pasted_path)
+        assert pasted.shape == image.shape
+        np.testing.assert_array_equal(pasted.affine, nib.load(image_path).affine)
+        np.testing.assert_array_equal(np.asanyarray(pasted.dataobj)[bbox], image[bbox])
+        assert not np.asanyarray(pasted.dataobj)[:3].any()
+
+
+class TestBodyCrop:
+    """Test cases for the body bounding box and cropped inference"""
+
+    def test_body_bounding_box(self, tmp_path):
+        """Test the box covers the body, lungs included, but not the table or surrounding air"""
+        image_path = _write_nifti(tmp_path / "ct.nii.gz", _chest_ct(), np.eye(4))
+
+        bbox = body_bounding_box(image_path, threshold_hu=-500, step_mm=2, margin_mm=1)
+
+        # The body spans [6, 31) x [7, 26) and every slice; the table at y = 28 is left out
+        assert bbox == (slice(6, 31), slice(6, 27), slice(0, 12))
+
+    def test_no_body_or_no_margin(self, tmp_path):
+        """Test air-only scans and bodies filling the volume are not cropped"""
+        air_path = _write_nifti(tmp_path / "air.nii.gz", np.full((10, 10, 10), -1000, dtype=np.int16))
+        full_path = _write_nifti(tmp_path / "full.nii.gz", np.zeros((10, 10, 10), dtype=np.int16))
+
+        assert body_bounding_box(air_path, threshold_hu=-500, step_mm=2, margin_mm=0) is None
+        assert body_bounding_box(full_path, threshold_hu=-500, step_mm=2, margin_mm=0) is None
+
+    def test_predictions_pasted_into_full_volume(self, tmp_path):
+        """Test both models see only the crop and their outputs come back in the input geometry"""
+        handler = NNUNetHandler()
+        handler.cascade_mode = False
+        image = _chest_ct()
+        input_path = _write_nifti(tmp_path / "task-1_scan.nii.gz", image)
+        bbox = (slice(5, 32), slice(6, 27), slice(0, 12))
+        model_inputs = []
+
+        def fake_prediction(input_files, output_dir, model_config, env, timeout=1800, shared_inputs=None,
+                            cpu_set=None):
+            outputs = {}
+            for input_file in input_files:
+                cropped = np.asanyarray(nib.load(input_file).dataobj)
+                model_inputs.append(cropped.shape)
+                output_file = handler._output_file_for(input_file, output_dir)
+                _write_nifti(output_file, (cropped == -850).astype(np.uint8), nib.load(input_file).affine)
+                if model_config is handler.tumor_model:
+                    probabilities = np.lib.format.open_memmap(output_file[:-7] + "_probabilities.npy", mode='w+',
+                                                              dtype=np.float16, shape=cropped.shape,
+                                                              fortran_order=True)
+                    probabilities[:] = 0.5
+                    probabilities.flush()
+                outputs[input_file] = output_file
+            return outputs
+
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media"), NNUNET_SCRATCH_DIR=str(tmp_path / "scratch")), \
+             patch.object(handler, '_run_prediction', side_effect=fake_prediction):
+            results, errors = handler.predict_batch([("task-1", input_path)], crops={"task-1": bbox})
+
+        assert errors == {}
+        assert model_inputs == [(27, 21, 12)] * 2
+        for field in ('tumor_segmentation', 'lung_segmentation'):
+            mask = nib.load(results["task-1"][field])
+            np.testing.assert_array_equal(mask.affine, nib.load(input_path).affine)
+            np.testing.assert_array_equal(np.asanyarray(mask.dataobj), (image == -850).astype(np.uint8))
+        probabilities = np.load(results["task-1"]['tumor_probabilities'])
+        assert probabilities.shape == image.shape
+        assert probabilities[bbox].min() == 0.5 and np.count_nonzero(probabilities) == 27 * 21 * 12
+
+    def test_crop_outside_volume_ignored(self, tmp_path):
+        """Test a crop that does not fit the input falls back to the full volume"""
+        handler = NNUNetHandler()
+        input_path = _write_nifti(tmp_path / "scan.nii.gz", np.zeros((10, 10, 10), dtype=np.int16))
+
+        assert handler._valid_crop((slice(0, 5), slice(0, 12), slice(0, 10)), input_path) is None
+        assert handler._valid_crop(None, input_path) is None
+        assert handler._valid_crop([slice(0, 5)] * 3, input_path) == (slice(0, 5),) * 3
+
+
+class TestCascade:
+    """Test cases for the lung-first cascade in NNUNetHandler"""
+
+    def test_tumor_model_runs_on_lung_region(self, tmp_path):
+        """Test the tumor model sees only the padded lung box and its mask is pasted back"""
+        with override_settings(NNUNET_CASCADE_MODE=True, NNUNET_CASCADE_MARGIN_MM=0):
+            handler = NNUNetHandler()
+        tumor_inputs = []
+
+        def fake_prediction(input_files, output_dir, model_config, env, timeout=1800, shared_inputs=None,
+                            cpu_set=None):
+            outputs = {}
+            for input_file in input_files:
+                output_file = handler._output_file_for(input_file, output_dir)
+                if model_config is handler.lung_model:
+                    _write_nifti(output_file, _lung_mask())
+                else:
+                    tumor_inputs.append(nib.load(input_file).shape)
+                    _write_nifti(output_file, np.ones(nib.load(input_file).shape, dtype=np.uint8))
+                outputs[input_file] = output_file
+            return outputs
+
+        with TaskWorkspace("task-1", root=str(tmp_path)) as workspace:
+            input_file = _write_nifti(os.path.join(workspace.input_dir, "scan_0000.nii.gz"),
+                                      np.zeros((20, 20, 20), dtype=np.int16))
+            with patch.object(handler, '_run_prediction', side_effect=fake_prediction):
+                outputs = handler._run_models([input_file], env={}, workspace=workspace)
+
+            tumor = nib.load(outputs['tumor'][input_file])
+            tumor_data = np.asanyarray(tumor.dataobj)
+
+        assert tumor_inputs == [(4, 7, 7)]
+        assert tumor.shape == (20, 20, 20)
+        np.testing.assert_array_equal(tumor_data, _lung_mask())
@@ -0,0 +1,175 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from segmentation.models import SegmentationTask
+from segmentation.fused import (
+    FUSED_LABELS, fuse_masks, fuse_mask_files, load_layer, mask_sources, materialize_layer
+)
+from segmentation.postprocessing import load_mask
+from segmentation.result_cache import SegmentationResultCache
+from segmentation.tasks import _complete_segmentation_task
+from segmentation.volume_cache import VolumeCache
+
+
+def _masks():
+    lung = np.zeros((12, 10, 6), dtype=np.uint8)
+    lung[2:10, 2:8, 1:5] = 1
+    tumor = np.zeros_like(lung)
+    tumor[4:6, 4:6, 2:4] = 1
+    return tumor, lung
+
+
+def _save(path, data):
+    nib.save(nib.Nifti1Image(data, np.diag([0.8, 0.8, 2.0, 1.0])), str(path))
+    return str(path)
+
+
+@pytest.fixture
+def media_root(tmp_path):
+    with override_settings(MEDIA_ROOT=str(tmp_path / "media"), VOLUME_CACHE_DIR=str(tmp_path / "volumes"),
+                           SEGMENTATION_FUSED_OUTPUT=True, SEGMENTATION_LUNG_MARGIN_MM=3.0,
+                           SEGMENTATION_MIN_COMPONENT_MM3=2.0):
+        yield tmp_path / "media"
+
+
+@pytest.fixture
+def fused_task(media_root):
+    """Completed task whose masks are stored only as a fused volume"""
+    tumor, lung = _masks()
+    segmentations = media_root / "segmentations"
+    segmentations.mkdir(parents=True)
+    result_files = {
+        'tumor_segmentation': _save(segmentations / "tumor_out.nii.gz", tumor),
+        'lung_segmentation': _save(segmentations / "lung_out.nii.gz", lung),
+    }
+    task = SegmentationTask.objects.create(file_name="scan.nii.gz", status="processing")
+    with patch('segmentation.tasks.build_volume_pyramid'), patch('segmentation.tasks.encode_segmentation_masks'), \
+            patch('segmentation.tasks.extract_segmentation_meshes'):
+        _complete_segmentation_task(task, result_files, None)
+    task.refresh_from_db()
+    return task, tumor, lung, result_files
+
+
+class TestFuseMasks:
+    """Test cases for combining the masks into one label volume"""
+
+    def test_labels(self):
+        """Test tumor voxels are written over lung voxels"""
+        tumor, lung = _masks()
+        tumor[0, 0, 0] = 1
+
+        fused = fuse_masks(tumor, lung)
+
+        assert fused.dtype == np.uint8
+        assert int((fused == FUSED_LABELS['tumor']).sum()) == 9
+        assert int((fused == FUSED_LABELS['lung']).sum()) == int(lung.sum()) - 8
+        assert fused[0, 0, 1] == 0
+
+    def test_layers_round_trip(self, tmp_path):
+        """Test both masks are given back unchanged by the fused volume"""
+        tumor, lung = _masks()
+        result_files = {'tumor_segmentation': _save(tmp_path / "tumor.nii.gz", tumor),
+                        'lung_segmentation': _save(tmp_path / "lung.nii.gz", lung)}
+
+        fused_path = fuse_mask_files(result_files, str(tmp_path / "fused.nii.gz"))
+
+        np.testing.assert_array_equal(load_layer((fused_path, 'tumor'))[1], tumor)
+        np.testing.assert_array_equal(load_layer((fused_path, 'lung'))[1], lung)
+
+
+@pytest.mark.django_db
+class TestFusedOutput:
+    """Test cases for tasks stored as a fused volume"""
+
+    def test_completion_keeps_only_fused_volume(self, fused_task):
+        """Test the separate masks are replaced by the fused volume"""
+        task, tumor, lung, result_files = fused_task
+
+        assert task.status == 'completed'
+        assert task.lesion_count == 1
+        assert not task.tumor_segmentation and not task.lung_segmentation
+        assert task.fused_segmentation.name == f"segmentations/fused_seg_{task.id}.nii.gz"
+        assert set(result_files) == {'fused_segmentation'}
+        assert os.listdir(os.path.dirname(task.fused_segmentation.path)) == [f"fused_seg_{task.id}.nii.gz"]
+        _, fused = load_mask(task.fused_segmentation.path)
+        np.testing.assert_array_equal(fused, fuse_masks(tumor, lung))
+
+    def test_layers_read_from_fused_volume(self, fused_task):
+        """Test viewer assets decode each layer from the fused volume without extracting files"""
+        task, tumor, lung, _ = fused_task
+
+        sources = mask_sources(task)
+        assert sources == {'tumor': (task.fused_segmentation.path, 'tumor'),
+                           'lung': (task.fused_segmentation.path, 'lung')}
+        np.testing.assert_array_equal(load_layer(sources['tumor'])[1], tumor)
+
+        volume, meta = VolumeCache().volume(task.id, 'lung', sources['lung'])
+        assert meta['dtype'] == 'uint8'
+        np.testing.assert_array_equal(volume, lung)
+        assert not task.tumor_segmentation and not task.lung_segmentation
+
+    def test_segmentation_file_endpoint(self, fused_task, api_client):
+        """Test a separate mask is extracted once when first requested"""
+        task, tumor, lung, _ = fused_task
+        url = reverse('segmentation-task-segmentation-file', kwargs={'pk': task.id, 'layer': 'tumor'})
+
+        detail = api_client.get(reverse('segmentation-task-detail', kwargs={'pk': task.id}))
+        assert detail.data['tumor_segmentation_url'].endswith(url)
+        assert detail.data['fused_segmentation_url'].endswith(task.fused_segmentation.url)
+
+        response = api_client.get(url)
+
+        assert response.status_code == status.HTTP_302_FOUND
+        task.refresh_from_db()
+        assert response['Location'] == task.tumor_segmentation.url
+        np.testing.assert_array_equal(load_mask(task.tumor_segmentation.path)[1], tumor)
+        assert mask_sources(task)['tumor'] == task.tumor_segmentation.path
+        np.testing.assert_array_equal(load_mask(materialize_layer(task, 'lung'))[1], lung)
+        detail = api_client.get(reverse('segmentation-task-detail', kwargs={'pk': task.id}))
+        assert detail.data['tumor_segmentation_url'].endswith(task.tumor_segmentation.url)
+
+        with patch('segmentation.fused.replace_mask') as mock_replace:
+            assert materialize_layer(task, 'tumor') == task.tumor_segmentation.path
+            mock_replace.assert_not_called()
+
+    def test_segmentation_file_missing(self, media_root, api_client):
+        """Test tasks without any masks return 404"""
+        task = SegmentationTask.objects.create(file_name="scan.nii.gz", status="processing")
+
+        response = api_client.get(reverse('segmentation-task-segmentation-file',
+                                          kwargs={'pk': task.id, 'layer': 'lung'}))
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+class TestFusedResultCache:
+    """Test cases for caching fused results"""
+
+    def test_store_and_materialize(self, media_root, tmp_path):
+        """Test fused entries hold one volume and separate entries miss in fused mode"""
+        tumor, lung = _masks()
+        cache = SegmentationResultCache(cache_dir=str(tmp_path / "cache"))
+        fused_path = _save(tmp_path / "fused.nii.gz", fuse_masks(tumor, lung))
+        separate = {'tumor_segmentation': _save(tmp_path / "tumor.nii.gz", tumor),
+                    'lung_segmentation': _save(tmp_path / "lung.nii.gz", lung)}
+
+        cache.store('fused', {'fused_segmentation': fused_path}, {'lesion_count': 1})
+        cache.store('separate', separate, {'lesion_count': 1})
+
+        assert sorted(os.listdir(tmp_path / "cache" / "fused")) == ['fused.nii.gz', 'metrics.json']
+        assert cache.lookup('separate') is None
+        entry = cache.lookup('fused')
+        result_files = cache.materialize(entry, 'task')
+        assert result_files == {
+            'fused_segmentation': str(media_root / "segmentations" / "fused_seg_task.nii.gz"),
+        }
+        assert os.path.samefile(result_files['fused_segmentation'], fused_path)
+
+        with override_settings(SEGMENTATION_FUSED_OUTPUT=False):
+            assert cache.lookup('fused') is None
+            assert set(cache.lookup('separate')) == {'tumor_segmentation', 'lung_segmentation', 'metrics'}
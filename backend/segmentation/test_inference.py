@@ -0,0 +1,285 @@
+import os
+import json
+import pytest
+import numpy as np
+from unittest.mock import patch, MagicMock
+from django.test import override_settings
+from segmentation.inference import PredictorPool
+from segmentation.execution import partition_cpus, plan_model_execution
+from segmentation.nnunet_handler import NNUNetHandler
+from segmentation.backends import BackendUnavailable, CLIBackend, TorchBackend, ExportedBackend
+from segmentation.exported import ExportedPredictorPool, export_folder, _exported_network_class
+
+TUMOR_MODEL = {"dataset": "Dataset002_Lung_split", "config": "3d_fullres"}
+
+
+class TestPredictorPool:
+    """Test cases for the resident predictor pool"""
+
+    def test_model_folder(self):
+        """Test trained model folder resolution"""
+        pool = PredictorPool(results_dir="/results")
+        assert pool.model_folder(TUMOR_MODEL) == \
+            "/results/Dataset002_Lung_split/nnUNetTrainer__nnUNetPlans__3d_fullres"
+
+    def test_predictor_loaded_once(self):
+        """Test that a model is only loaded once per process"""
+        pool = PredictorPool(results_dir="/results")
+
+        with patch.object(pool, '_create_predictor', return_value=MagicMock()) as mock_create:
+            first, _ = pool.get(TUMOR_MODEL, "cpu")
+            second, _ = pool.get(TUMOR_MODEL, "cpu")
+
+        assert first is second
+        mock_create.assert_called_once_with(TUMOR_MODEL, "cpu")
+        assert pool.is_loaded(TUMOR_MODEL, "cpu")
+
+    def test_clear(self):
+        """Test dropping resident predictors"""
+        pool = PredictorPool(results_dir="/results")
+
+        with patch.object(pool, '_create_predictor', return_value=MagicMock()):
+            pool.get(TUMOR_MODEL, "cpu")
+        pool.clear()
+
+        assert not pool.is_loaded(TUMOR_MODEL, "cpu")
+
+
+class TestInferenceEngineSelection:
+    """Test that NNUNetHandler honours the configured inference engine"""
+
+    @override_settings(NNUNET_INFERENCE_ENGINE='subprocess')
+    def test_subprocess_engine(self, tmp_path):
+        """Test the CLI path is used when configured"""
+        handler = NNUNetHandler()
+
+        with patch.object(CLIBackend, 'predict', return_value='out.nii.gz') as mock_cli, \
+             patch.object(TorchBackend, 'predict') as mock_in_process:
+            result = handler._run_prediction(['in_0000.nii.gz'], str(tmp_path), TUMOR_MODEL, {})
+
+        assert result == 'out.nii.gz'
+        mock_cli.assert_called_once()
+        mock_in_process.assert_not_called()
+
+    @override_settings(NNUNET_INFERENCE_ENGINE='in_process')
+    def test_in_process_falls_back_without_nnunet(self, tmp_path):
+        """Test fallback to the CLI when nnunetv2 cannot be imported"""
+        handler = NNUNetHandler()
+
+        with patch.object(TorchBackend, 'is_available', return_value=True), \
+             patch.object(TorchBackend, 'predict', side_effect=BackendUnavailable("torch")), \
+             patch.object(CLIBackend, 'predict', return_value='out.nii.gz') as mock_cli:
+            result = handler._run_prediction(['in_0000.nii.gz'], str(tmp_path), TUMOR_MODEL, {})
+
+        assert result == 'out.nii.gz'
+        mock_cli.assert_called_once()
+
+    @override_settings(NNUNET_INFERENCE_ENGINE='exported')
+    def test_exported_falls_back_for_unexported_model(self, tmp_path):
+        """Test models without exported graphs run on the PyTorch backend"""
+        handler = NNUNetHandler()
+
+        with patch.object(TorchBackend, 'is_available', return_value=True), \
+             patch.object(ExportedBackend, 'is_available', return_value=False), \
+             patch.object(TorchBackend, 'predict', return_value='out.nii.gz') as mock_torch:
+            result = handler._run_prediction(['in_0000.nii.gz'], str(tmp_path), TUMOR_MODEL, {})
+
+        assert result == 'out.nii.gz'
+        mock_torch.assert_called_once()
+
+    @override_settings(NNUNET_INFERENCE_ENGINE='onnx')
+    def test_unknown_engine(self):
+        """Test an unknown engine name is rejected"""
+        with pytest.raises(ValueError):
+            NNUNetHandler()
+
+
+class TestExportedModels:
+    """Test cases for the exported-graph runtime"""
+
+    def _write_export(self, export_dir, folds, files):
+        folder = export_folder(TUMOR_MODEL, str(export_dir))
+        os.makedirs(folder)
+        with open(os.path.join(folder, "metadata.json"), "w") as f:
+            json.dump({'format': 'onnx', 'folds': folds, 'trainer_name': 'nnUNetTrainer',
+                       'inference_allowed_mirroring_axes': [0, 1, 2], 'patch_size': [64, 64, 64]}, f)
+        for fold in files:
+            open(os.path.join(folder, f"fold_{fold}.onnx"), "wb").close()
+
+    def test_is_exported(self, tmp_path):
+        """Test a model counts as exported only when every needed fold graph exists"""
+        self._write_export(tmp_path, ["0", "1"], ["0"])
+        pool = ExportedPredictorPool(results_dir="/results", export_dir=str(tmp_path))
+
+        assert pool.is_exported({**TUMOR_MODEL, "folds": (0,)})
+        assert not pool.is_exported({**TUMOR_MODEL, "folds": None})
+        assert not pool.is_exported({"dataset": "Dataset003_Lung_only", "config": "3d_fullres"})
+
+    def test_network_switches_fold_sessions(self):
+        """Test load_state_dict selects the fold session nnUNet ensembles over"""
+        torch = pytest.importorskip("torch")
+        sessions = {
+            "0": MagicMock(**{'run.return_value': [np.zeros((1, 2, 4, 4, 4), dtype=np.float32)]}),
+            "1": MagicMock(**{'run.return_value': [np.ones((1, 2, 4, 4, 4), dtype=np.float32)]}),
+        }
+        network = _exported_network_class()(sessions, 'onnx')
+
+        network.load_state_dict("1")
+        logits = network(torch.zeros((1, 1, 4, 4, 4)))
+
+        assert logits.sum().item() == 128
+        sessions["0"].run.assert_not_called()
+
+
+class TestInferenceTiers:
+    """Test cases for speed/quality inference tiers"""
+
+    def test_tier_applied_to_models(self, tmp_path):
+        """Test a tier's folds, mirroring and step size reach both models"""
+        fast_model = tmp_path / "Dataset002_Lung_split" / "nnUNetTrainer__nnUNetPlans__3d_fullres"
+        (fast_model / "fold_0").mkdir(parents=True)
+
+        with patch('segmentation.nnunet_handler.get_predictor_pool',
+                   return_value=PredictorPool(results_dir=str(tmp_path))):
+            handler = NNUNetHandler(tier='fast')
+
+        # No 3d_lowres model is trained, so the tier keeps 3d_fullres
+        assert handler.tumor_model['config'] == '3d_fullres'
+        assert handler.tumor_model['folds'] == (0,)
+        assert handler.tumor_model['use_mirroring'] is False
+        assert handler.tumor_model['tile_step_size'] == 0.75
+
+    def test_unknown_tier(self):
+        """Test an unknown tier is rejected"""
+        with pytest.raises(ValueError):
+            NNUNetHandler(tier='turbo')
+
+    def test_tiers_use_separate_predictors(self):
+        """Test predictors with different tier settings are not shared"""
+        pool = PredictorPool(results_dir="/results")
+        fast = {**TUMOR_MODEL, "folds": (0,), "use_mirroring": False, "tile_step_size": 0.75}
+        full = {**TUMOR_MODEL, "folds": None, "use_mirroring": True, "tile_step_size": 0.5}
+
+        with patch.object(pool, '_create_predictor', side_effect=lambda *args: MagicMock()):
+            assert pool.get(fast, "cpu")[0] is not pool.get(full, "cpu")[0]
+
+    def test_cli_flags(self, tmp_path):
+        """Test the CLI is given the tier's folds, step size and TTA setting"""
+        handler = NNUNetHandler(tier='fast')
+        process = MagicMock()
+        process.wait.return_value = 0
+        process.communicate.return_value = ("", "")
+        process.stdout.readline.return_value = ''
+        process.stderr.readline.return_value = ''
+
+        with patch('segmentation.backends.subprocess.Popen', return_value=process) as mock_popen:
+            with pytest.raises(RuntimeError):
+                # No output is written, only the command line matters here
+                CLIBackend("cpu").predict([str(tmp_path / "in_0000.nii.gz")], str(tmp_path),
+                                          {**handler.tumor_model, "folds": (0,)}, {})
+
+        cmd = mock_popen.call_args[0][0]
+        assert cmd[cmd.index("-f") + 1] == "0"
+        assert cmd[cmd.index("-step_size") + 1] == "0.75"
+        assert "--disable_tta" in cmd
+
+
+class TestSharedPreprocessor:
+    """Test cases for preprocessing shared between models"""
+
+    def test_input_decoded_once(self):
+        """Test that the input file is only read once for several models"""
+        from segmentation.preprocessing import SharedPreprocessor
+
+        reads = []
+
+        class FakeReaderWriter:
+            def read_images(self, files):
+                reads.append(files)
+                return "image", {"spacing": [1.0, 1.0, 1.0]}
+
+        shared = SharedPreprocessor("case_0000.nii.gz")
+        first_key, first = shared._decode(FakeReaderWriter)
+        second_key, second = shared._decode(FakeReaderWriter)
+
+        assert first is second
+        assert first_key == second_key
+        assert reads == [["case_0000.nii.gz"]]
+        assert (shared.hits, shared.misses) == (1, 1)
+
+        shared.clear()
+        shared._decode(FakeReaderWriter)
+        assert len(reads) == 2
+
+    def test_crop_shared_between_plans(self):
+        """Test plans that differ only in normalization share one decode and one crop"""
+        from segmentation.preprocessing import SharedPreprocessor
+
+        reads = []
+        image = np.arange(64, dtype=np.int16).reshape(1, 4, 4, 4)
+
+        class FakeReaderWriter:
+            def read_images(self, files):
+                reads.append(files)
+                return image, {"spacing": [1.0, 1.0, 1.0]}
+
+        def plans(scale):
+            return MagicMock(image_reader_writer_class=FakeReaderWriter, transpose_forward=[0, 1, 2],
+                             foreground_intensity_properties_per_channel={'0': {'scale': scale}})
+
+        def normalize(data, seg, configuration_manager, intensity_properties):
+            data *= intensity_properties['0']['scale']
+            return data
+
+        configuration_manager = MagicMock(normalization_schemes=['CTNormalization'], use_mask_for_norm=[False])
+        preprocessor = MagicMock()
+        preprocessor._normalize.side_effect = normalize
+        shared = SharedPreprocessor("case_0000.nii.gz", num_models=2)
+
+        with patch('segmentation.preprocessing._crop_to_nonzero',
+                   side_effect=lambda data: (data, None, [[0, 4]] * 3)) as crop:
+            _, tumor = shared._normalize(preprocessor, plans(2.0), configuration_manager)
+            shared._finish_model()
+            _, lung = shared._normalize(preprocessor, plans(3.0), configuration_manager)
+
+        assert reads == [["case_0000.nii.gz"]]
+        assert crop.call_count == 1
+        np.testing.assert_array_equal(tumor, image * 2.0)
+        np.testing.assert_array_equal(lung, image * 3.0)
+        # The last model released the decoded and cropped arrays
+        assert [key[0] for key in shared._cache] == ["normalize", "normalize"]
+
+
+class TestExecutionPlanning:
+    """Test cases for sequential/concurrent model execution planning"""
+
+    def test_partition_cpus(self):
+        """Test splitting cores into near-equal groups"""
+        assert partition_cpus(list(range(32)), 2) == [list(range(16)), list(range(16, 32))]
+        assert partition_cpus([0, 1, 2], 2) == [[0, 1], [2]]
+
+    @override_settings(NNUNET_EXECUTION_MODE='sequential')
+    def test_sequential_mode(self):
+        """Test every model gets all cores in sequential mode"""
+        with patch('segmentation.execution.available_cpus', return_value=list(range(32))):
+            mode, cpu_sets = plan_model_execution(2, "cpu")
+
+        assert mode == "sequential"
+        assert cpu_sets == [list(range(32)), list(range(32))]
+
+    @override_settings(NNUNET_EXECUTION_MODE='auto', NNUNET_CONCURRENT_MIN_CORES=16,
+                       NNUNET_CONCURRENT_MIN_MEMORY_GB=24)
+    def test_auto_mode(self):
+        """Test auto mode only goes concurrent with enough cores and memory on CPU"""
+        with patch('segmentation.execution.available_cpus', return_value=list(range(32))), \
+             patch('segmentation.execution.available_memory_gb', return_value=64):
+            assert plan_model_execution(2, "cpu")[0] == "concurrent"
+            assert plan_model_execution(2, "cuda")[0] == "sequential"
+
+        with patch('segmentation.execution.available_cpus', return_value=list(range(32))), \
+             patch('segmentation.execution.available_memory_gb', return_value=8):
+            assert plan_model_execution(2, "cpu")[0] == "sequential"
+
+        with patch('segmentation.execution.available_cpus', return_value=list(range(8))), \
+             patch('segmentation.execution.available_memory_gb', return_value=64):
+            assert plan_model_execution(2, "cpu")[0] == "sequential"
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from django.urls import reverse
+from rest_framework import status
+from segmentation.lesions import analyze_lesions, store_lesions
+from segmentation.models import SegmentationTask, Lesion
+
+
+class TestAnalyzeLesions:
+    """Test cases for the vectorized per-lesion analysis"""
+
+    def test_measurements(self):
+        """Test counts, volumes, boxes, centroids and diameters of separate lesions"""
+        mask = np.zeros((30, 20, 12), dtype=np.uint8)
+        mask[4:10, 2:5, 3:6] = 1      # 6 x 3 voxels in plane, 3 slices
+        mask[20:22, 10:12, 8] = 1     # 2 x 2 voxels, one slice
+        mask[22, 12, 8] = 1           # touches the previous lesion only diagonally
+        mask[0:3, 0:3, 0:3] = 2       # another label
+
+        lesions = analyze_lesions(mask, (0.5, 1.0, 2.0))
+
+        assert [lesion['voxel_count'] for lesion in lesions] == [54, 4, 1]
+        assert [lesion['index'] for lesion in lesions] == [1, 2, 3]
+        largest = lesions[0]
+        assert largest['volume'] == pytest.approx(54 * 0.5 * 1.0 * 2.0 / 1000)
+        assert largest['bbox'] == [[4, 10], [2, 5], [3, 6]]
+        assert largest['centroid_voxel'] == [6.5, 3.0, 4.0]
+        assert largest['centroid'] == [3.25, 3.0, 8.0]
+        # 3 mm x 3 mm in plane, measured edge to edge along the diagonal
+        assert largest['longest_diameter'] == pytest.approx(np.hypot(3.0, 3.0), rel=2e-3)
+        # A single voxel spans its own diagonal
+        assert lesions[2]['longest_diameter'] == pytest.approx(np.hypot(0.5, 1.0), rel=2e-3)
+        assert lesions[1]['diameter_slice'] == 8
+
+    def test_matches_per_lesion_reference(self):
+        """Test the single pass agrees with labelling and measuring lesion by lesion"""
+        mask = (ndimage.gaussian_filter(np.random.RandomState(3).rand(40, 36, 16), 2) > 0.53).astype(np.uint8)
+        labeled, count = ndimage.label(mask)
+        assert count > 3
+
+        lesions = analyze_lesions(mask, (0.8, 0.8, 2.5))
+
+        assert len(lesions) == count
+        assert [lesion['voxel_count'] for lesion in lesions] == sorted(np.bincount(labeled.ravel())[1:])[::-1]
+        for lesion in lesions:
+            (x0, x1), (y0, y1), (z0, z1) = lesion['bbox']
+            ids = np.unique(labeled[x0:x1, y0:y1, z0:z1])
+            component = next(labeled == i for i in ids[ids > 0]
+                             if ndimage.find_objects((labeled == i).astype(np.uint8))[0] == (slice(x0, x1), slice(y0, y1), slice(z0, z1))
+                             and (labeled == i).sum() == lesion['voxel_count'])
+            np.testing.assert_allclose(lesion['centroid_voxel'], ndimage.center_of_mass(component), atol=0.01)
+            # Brute-force in-plane diameter of the widest slice, between voxel edges
+            best = 0.0
+            for z in np.flatnonzero(component.any(axis=(0, 1))):
+                points = np.argwhere(component[:, :, z]) * 0.8
+                corners = np.concatenate([points + [dx, dy] for dx in (0, 0.8) for dy in (0, 0.8)])
+                distances = np.linalg.norm(corners[:, None] - corners[None], axis=2)
+                best = max(best, distances.max())
+            assert lesion['longest_diameter'] == pytest.approx(best, rel=2e-3)
+
+    def test_empty_mask(self):
+        """Test a mask without tumor has no lesions"""
+        assert analyze_lesions(np.zeros((4, 4, 4), dtype=np.uint8), (1, 1, 1)) == []
+
+
+@pytest.mark.django_db
+class TestLesionQueries:
+    """Test cases for storing and querying lesions across tasks"""
+
+    def test_store_and_filter(self, api_client):
+        """Test lesions replace earlier rows and can be filtered by diameter"""
+        mask = np.zeros((40, 40, 4), dtype=np.uint8)
+        mask[0:35, 0:2, 1] = 1
+        mask[38:40, 38:40, 1] = 1
+        tasks = [SegmentationTask.objects.create(file_name=f"scan{i}.nii.gz", status="completed") for i in range(2)]
+        store_lesions(tasks[0], [{'index': 1, 'voxel_count': 1, 'volume': 0.001, 'longest_diameter': 1.0,
+                                  'diameter_slice': 0, 'centroid': [0, 0, 0], 'centroid_voxel': [0, 0, 0],
+                                  'bbox': [[0, 1]] * 3}])
+        store_lesions(tasks[0], analyze_lesions(mask, (1.0, 1.0, 1.0)))
+        store_lesions(tasks[1], analyze_lesions(mask[::2, ::2], (1.0, 1.0, 1.0)))
+
+        assert Lesion.objects.filter(task=tasks[0]).count() == 2
+        response = api_client.get(reverse('lesion-list'), {'min_diameter': 30})
+        assert response.status_code == status.HTTP_200_OK
+        results = response.json()
+        results = results['results'] if isinstance(results, dict) else results
+        assert [(lesion['task'], lesion['index']) for lesion in results] == [(str(tasks[0].id), 1)]
+
+        detail = api_client.get(reverse('segmentation-task-detail', kwargs={'pk': tasks[1].id})).json()
+        assert [lesion['voxel_count'] for lesion in detail['lesions']] == [18, 1]
+        assert api_client.get(reverse('lesion-list'), {'min_diameter': 'big'}).status_code \
+            == status.HTTP_400_BAD_REQUEST
+        assert api_client.get(reverse('lesion-list'), {'task': 'not-a-uuid'}).status_code \
+            == status.HTTP_400_BAD_REQUEST
+        task_lesions = api_client.get(reverse('lesion-list'), {'task': str(tasks[1].id)}).json()
+        task_lesions = task_lesions['results'] if isinstance(task_lesions, dict) else task_lesions
+        assert {lesion['task'] for lesion in task_lesions} == {str(tasks[1].id)}
@@ -0,0 +1,89 @@
+import json
+import numpy as np
+import nibabel as nib
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from segmentation.mask_encoding import encode_mask, decode_mask
+from segmentation.models import SegmentationTask
+from segmentation.tasks import encode_segmentation_masks
+
+
+def _sphere_mask(shape, center, radius, label=1):
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+    inside = sum((axis - c) ** 2 for axis, c in zip(grid, center)) <= radius ** 2
+    return inside.astype(np.uint8) * label
+
+
+class TestMaskEncoding:
+    """Test cases for the sparse mask encodings"""
+
+    @pytest.mark.parametrize('encoding', ['bitpacked', 'rle'])
+    def test_round_trip(self, encoding):
+        """Test every label is reconstructed exactly from either encoding"""
+        mask = _sphere_mask((20, 17, 9), (6, 5, 4), 3)
+        mask[12:18, 10:16, 1:3] = 2
+        mask[19, 0, 8] = 2
+
+        document = json.loads(json.dumps(encode_mask(mask, np.eye(4), (1.0, 1.0, 2.5))))
+
+        np.testing.assert_array_equal(decode_mask(document, encoding), mask)
+        assert document['labels']['2']['bbox'] == [[12, 20], [0, 16], [1, 9]]
+        assert document['labels']['1']['voxel_count'] == int((mask == 1).sum())
+
+    def test_empty_mask(self):
+        """Test a mask without labels encodes to no labels"""
+        document = encode_mask(np.zeros((4, 4, 4), dtype=np.uint8), np.eye(4), (1, 1, 1))
+
+        assert document['labels'] == {}
+        np.testing.assert_array_equal(decode_mask(document), np.zeros((4, 4, 4)))
+
+    def test_small_tumor_shrinks_over_100x(self):
+        """Test a typical small lesion encodes far smaller than the dense volume"""
+        mask = _sphere_mask((160, 160, 96), (70, 90, 40), 6)
+
+        document = encode_mask(mask, np.eye(4), (1, 1, 1))
+
+        for encoding in ('bitpacked', 'rle'):
+            payload = {**document, 'labels': {label: {encoding: entry[encoding], 'bbox': entry['bbox']}
+                                              for label, entry in document['labels'].items()}}
+            assert mask.nbytes / len(json.dumps(payload)) > 100
+
+
+@pytest.mark.django_db
+class TestMaskEndpoint:
+    """Test cases for generating and serving encoded masks"""
+
+    def test_generate_and_serve(self, api_client, tmp_path):
+        """Test the completed task's masks are served in the requested encoding"""
+        tumor = _sphere_mask((24, 24, 12), (10, 12, 6), 4)
+        path = tmp_path / "tumor.nii.gz"
+        nib.save(nib.Nifti1Image(tumor, np.diag([0.7, 0.7, 2.0, 1.0])), str(path))
+
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media"), MASK_ENCODING_DIR=str(tmp_path / "masks")):
+            task = SegmentationTask.objects.create(
+                file_name="scan.nii.gz",
+                tumor_segmentation=SimpleUploadedFile("tumor.nii.gz", path.read_bytes()),
+                status="completed",
+            )
+
+            def get(layer='tumor', **params):
+                return api_client.get(reverse('segmentation-task-mask', kwargs={'pk': task.id, 'layer': layer}),
+                                      params)
+
+            assert get().status_code == status.HTTP_404_NOT_FOUND
+            sizes = encode_segmentation_masks(str(task.id))
+            assert set(sizes) == {'tumor'}
+
+            response = get(encoding='rle')
+            assert response.status_code == status.HTTP_200_OK
+            document = response.json()
+            assert document['encoding'] == 'rle'
+            assert 'bitpacked' not in document['labels']['1']
+            assert document['affine'][0][0] == pytest.approx(0.7)
+            np.testing.assert_array_equal(decode_mask(document, 'rle'), tumor)
+
+            assert get(encoding='dense').status_code == status.HTTP_400_BAD_REQUEST
+            assert get(layer='lung').status_code == status.HTTP_404_NOT_FOUND
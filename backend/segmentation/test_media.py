@@ -0,0 +1,125 @@
+import os
+import pytest
+from unittest.mock import patch
+from django.test import override_settings
+from django.utils.http import http_date
+from rest_framework.permissions import IsAuthenticated
+from segmentation.media import MediaFileView, parse_range
+from segmentation.models import SegmentationTask
+
+CONTENT = bytes(range(256)) * 1024  # 256 KiB
+
+
+@pytest.fixture
+def media_file(tmp_path, db):
+    for folder in ("segmentations", "chunked_uploads", "probabilities"):
+        (tmp_path / folder).mkdir()
+    path = tmp_path / "segmentations" / "tumor_seg_1.nii.gz"
+    path.write_bytes(CONTENT)
+    SegmentationTask.objects.create(file_name="scan.nii.gz", status="completed",
+                                    tumor_segmentation="segmentations/tumor_seg_1.nii.gz")
+    with override_settings(MEDIA_ROOT=str(tmp_path)):
+        yield path
+
+
+def _body(response):
+    return b"".join(response.streaming_content) if response.streaming else response.content
+
+
+class TestParseRange:
+    """Test cases for Range header parsing"""
+
+    @pytest.mark.parametrize('header, expected', [
+        ('bytes=0-99', (0, 100)),
+        ('bytes=100-', (100, 1000)),
+        ('bytes=-50', (950, 1000)),
+        ('bytes=990-5000', (990, 1000)),
+        ('bytes=1000-', False),
+        ('bytes=-0', False),
+        ('bytes=0-9,20-29', None),
+        ('items=0-9', None),
+        (None, None),
+    ])
+    def test_ranges(self, header, expected):
+        """Test single ranges are resolved and unsupported forms fall back to the whole file"""
+        assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.django_db
+class TestServeMedia:
+    """Test cases for the media-serving view"""
+
+    URL = "/media/segmentations/tumor_seg_1.nii.gz"
+
+    def test_full_download_with_validators(self, client, media_file):
+        """Test a full download carries an ETag and Last-Modified"""
+        response = client.get(self.URL)
+
+        assert response.status_code == 200
+        assert _body(response) == CONTENT
+        stat = os.stat(media_file)
+        assert response['ETag'] == f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        assert response['Last-Modified'] == http_date(os.stat(media_file).st_mtime)
+        assert response['Accept-Ranges'] == 'bytes'
+        assert response['Content-Type'] == 'application/gzip'
+
+    def test_conditional_requests(self, client, media_file):
+        """Test matching validators get a bodiless 304 without the file being read"""
+        etag = client.get(self.URL)['ETag']
+        with patch('segmentation.media.FileResponse') as mock_response:
+            assert client.get(self.URL, HTTP_IF_NONE_MATCH=etag).status_code == 304
+            assert client.get(self.URL, HTTP_IF_NONE_MATCH=f'"other", W/{etag}').status_code == 304
+            mock_response.assert_not_called()
+
+        last_modified = client.get(self.URL)['Last-Modified']
+        not_modified = client.get(self.URL, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert not_modified.status_code == 304
+        assert not_modified['ETag'] == etag
+        assert client.get(self.URL, HTTP_IF_NONE_MATCH='"stale"').status_code == 200
+
+        # Replacing the file changes its ETag
+        replacement = media_file.with_name("replacement")
+        replacement.write_bytes(CONTENT[::-1])
+        os.replace(replacement, media_file)
+        assert client.get(self.URL, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    def test_byte_ranges(self, client, media_file):
+        """Test single ranges are served as 206 and unsatisfiable ones as 416"""
+        response = client.get(self.URL, HTTP_RANGE='bytes=1000-300999')
+        assert response.status_code == 206
+        assert _body(response) == CONTENT[1000:301000]
+        assert response['Content-Range'] == f"bytes 1000-262143/{len(CONTENT)}"
+        assert response['Content-Length'] == str(len(CONTENT) - 1000)
+
+        assert _body(client.get(self.URL, HTTP_RANGE='bytes=-10')) == CONTENT[-10:]
+
+        response = client.get(self.URL, HTTP_RANGE=f'bytes={len(CONTENT)}-')
+        assert response.status_code == 416
+        assert response['Content-Range'] == f"bytes */{len(CONTENT)}"
+
+    def test_if_range(self, client, media_file):
+        """Test a range is only honoured when If-Range matches the current file"""
+        etag = client.get(self.URL)['ETag']
+
+        assert client.get(self.URL, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code == 206
+        stale = client.get(self.URL, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        assert stale.status_code == 200
+        assert _body(stale) == CONTENT
+
+    def test_missing_and_unsafe_paths(self, client, media_file):
+        """Test missing files, directories and paths outside MEDIA_ROOT are 404"""
+        assert client.get("/media/segmentations/missing.nii.gz").status_code == 404
+        assert client.get("/media/segmentations/").status_code == 404
+        assert client.get("/media/../secret").status_code == 404
+        assert client.post(self.URL).status_code == 405
+
+    def test_only_task_files_served(self, client, media_file):
+        """Test files outside the task folders, or not belonging to a task, are 404"""
+        for name in ("chunked_uploads/upload.part", "probabilities/tumor_prob_1.npy.gz", "segmentations/other.nii.gz"):
+            (media_file.parent.parent / name).write_bytes(CONTENT)
+            assert client.get(f"/media/{name}").status_code == 404
+
+    def test_task_permissions_apply(self, client, media_file):
+        """Test the task API's permission classes guard the files"""
+        with patch.object(MediaFileView, 'permission_classes', [IsAuthenticated]):
+            assert client.get(self.URL).status_code in (401, 403)
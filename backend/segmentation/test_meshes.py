@@ -0,0 +1,129 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from segmentation.meshes import MeshStore, encode_mesh, decode_mesh, extract_surface
+from segmentation.models import SegmentationTask
+from segmentation.tasks import extract_segmentation_meshes
+
+TETRAHEDRON = (np.array([[0, 0, 0], [10, 0, 0], [0, 20, 0], [0, 0, 5]], dtype=np.float64),
+               np.array([[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]]))
+
+
+def _cube_mask(shape=(12, 12, 10)):
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[3:9, 2:8, 2:7] = 1
+    return mask
+
+
+def _nifti(path, data):
+    nib.save(nib.Nifti1Image(data, np.diag([0.8, 0.8, 2.0, 1.0])), str(path))
+    return str(path)
+
+
+class TestMeshFormat:
+    """Test cases for the quantized binary mesh format"""
+
+    def test_round_trip(self):
+        """Test positions survive quantization within a fraction of a micron"""
+        vertices, faces = TETRAHEDRON
+
+        data = encode_mesh(vertices - 100, faces)
+        decoded_vertices, decoded_faces = decode_mesh(data)
+
+        np.testing.assert_allclose(decoded_vertices, vertices - 100, atol=1e-3)
+        np.testing.assert_array_equal(decoded_faces, faces)
+        assert decoded_faces.dtype == np.uint16
+        # Header, 4 vertices of 6 bytes, 4 triangles of 6 bytes
+        assert len(data) == 40 + 24 + 24
+
+    def test_large_and_empty_meshes(self):
+        """Test meshes over 65536 vertices switch to 32-bit indices and empty meshes encode"""
+        vertices = np.random.RandomState(0).rand(70000, 3)
+        faces = np.array([[0, 1, 69999]])
+
+        assert decode_mesh(encode_mesh(vertices, faces))[1].dtype == np.uint32
+        empty_vertices, empty_faces = decode_mesh(encode_mesh(np.zeros((0, 3)), np.zeros((0, 3))))
+        assert empty_vertices.shape == (0, 3) and empty_faces.shape == (0, 3)
+        with pytest.raises(ValueError):
+            decode_mesh(b'\0' * 40)
+
+    def test_marching_cubes_surface(self):
+        """Test the extracted surface encloses the mask in scanner coordinates"""
+        pytest.importorskip("skimage")
+        affine = np.diag([0.8, 0.8, 2.0, 1.0])
+        affine[:3, 3] = [-50, -40, 10]
+
+        vertices, faces = extract_surface(_cube_mask() > 0, affine, step_size=1)
+        coarse_vertices, coarse_faces = extract_surface(_cube_mask() > 0, affine, step_size=2)
+
+        assert len(faces) > len(coarse_faces) > 0
+        np.testing.assert_allclose(vertices.min(axis=0), [-50 + 2.5 * 0.8, -40 + 1.5 * 0.8, 10 + 1.5 * 2.0])
+        np.testing.assert_allclose(vertices.max(axis=0), [-50 + 8.5 * 0.8, -40 + 7.5 * 0.8, 10 + 6.5 * 2.0])
+
+
+class TestMeshStore:
+    """Test cases for the content-addressed mesh cache"""
+
+    def test_meshes_are_cached_per_mask_version(self, tmp_path):
+        """Test identical masks reuse meshes and a replaced mask is extracted again"""
+        store = MeshStore(mesh_dir=tmp_path / "meshes", steps=(1, 2), num_workers=2)
+        first = _nifti(tmp_path / "first.nii.gz", _cube_mask())
+        copy = _nifti(tmp_path / "copy.nii.gz", _cube_mask())
+
+        with patch('segmentation.meshes.extract_surface', return_value=TETRAHEDRON) as mock_extract:
+            assert store.build("a", {'tumor': first}) == {'tumor': True}
+            assert store.build("b", {'tumor': copy}) == {'tumor': False}
+            assert mock_extract.call_count == 2
+
+            _nifti(tmp_path / "copy.nii.gz", _cube_mask() * 0)
+            assert store.build("b", {'tumor': copy}) == {'tumor': True}
+
+        meshes = store.task_meshes("a")['tumor']
+        assert [level['step_size'] for level in meshes['levels']] == [1, 2]
+        assert meshes['levels'][0]['triangle_count'] == 4
+        assert store.task_meshes("b")['tumor']['digest'] != meshes['digest']
+
+        store.discard("a")
+        assert store.task_meshes("a") == {}
+        assert store.prune() == 1
+        assert store.task_meshes("b")['tumor']['levels']
+
+
+@pytest.mark.django_db
+class TestMeshEndpoints:
+    """Test cases for serving task meshes"""
+
+    def test_list_and_download(self, api_client, tmp_path):
+        """Test a task's meshes are listed with URLs and downloaded as binary"""
+        mask_path = _nifti(tmp_path / "tumor.nii.gz", _cube_mask())
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media"), MESH_CACHE_DIR=str(tmp_path / "meshes"),
+                               MESH_DECIMATION_STEPS=(1, 2)):
+            task = SegmentationTask.objects.create(
+                file_name="scan.nii.gz",
+                tumor_segmentation=SimpleUploadedFile("tumor.nii.gz", open(mask_path, 'rb').read()),
+                status="completed",
+            )
+            url = reverse('segmentation-task-mesh', kwargs={'pk': task.id, 'layer': 'tumor', 'level': 0})
+            assert api_client.get(url).status_code == status.HTTP_404_NOT_FOUND
+
+            with patch('segmentation.meshes.extract_surface', return_value=TETRAHEDRON):
+                assert extract_segmentation_meshes(str(task.id)) == {'tumor': True}
+
+            listing = api_client.get(reverse('segmentation-task-meshes', kwargs={'pk': task.id})).json()
+            levels = listing['layers']['tumor']['levels']
+            assert [level['level'] for level in levels] == [0, 1]
+            assert levels[1]['url'].endswith(f"/tasks/{task.id}/meshes/tumor/1/")
+
+            response = api_client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            assert 'immutable' in response['Cache-Control']
+            vertices, faces = decode_mesh(response.content)
+            np.testing.assert_array_equal(faces, TETRAHEDRON[1])
+
+            missing = reverse('segmentation-task-mesh', kwargs={'pk': task.id, 'layer': 'tumor', 'level': 2})
+            assert api_client.get(missing).status_code == status.HTTP_404_NOT_FOUND
@@ -0,0 +1,82 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from scipy import ndimage
+from segmentation.metrics import compute_label_metrics
+from segmentation.nnunet_handler import NNUNetHandler
+
+
+def _write_mask(path, data, zooms=(0.5, 1.0, 2.0)):
+    img = nib.Nifti1Image(data, np.diag([*zooms, 1.0]))
+    nib.save(img, str(path))
+    return str(path)
+
+
+class TestLabelMetrics:
+    """Test cases for the slab-wise metrics engine"""
+
+    @pytest.mark.parametrize("slab_size", [1, 3, 7, 64])
+    def test_matches_whole_volume_labelling(self, slab_size):
+        """Test counts and components match ndimage on the full array for any slab size"""
+        data = (np.random.RandomState(0).rand(20, 18, 16) > 0.7).astype(np.uint8)
+        data[data > 0] = np.random.RandomState(1).randint(1, 3, int(data.sum()))
+
+        metrics = compute_label_metrics(data=data, zooms=(1.0, 1.0, 1.0), foreground_label=1,
+                                        slab_size=slab_size)
+
+        labeled, expected_count = ndimage.label(data == 1)
+        assert metrics['component_count'] == expected_count
+        assert metrics['foreground_voxels'] == int((data == 1).sum())
+        assert metrics['component_sizes'] == sorted(np.bincount(labeled.ravel())[1:].tolist(), reverse=True)
+        assert metrics['label_counts'] == {label: int((data == label).sum()) for label in (0, 1, 2)}
+
+    def test_component_joined_through_later_slab(self):
+        """Test a U-shaped lesion split by slab boundaries counts once"""
+        data = np.zeros((5, 5, 9), dtype=np.uint8)
+        data[1, 1, 0:8] = 1
+        data[3, 1, 0:8] = 1
+        data[1:4, 1, 7] = 1
+
+        metrics = compute_label_metrics(data=data, zooms=(1.0, 1.0, 1.0), slab_size=2)
+
+        assert metrics['component_count'] == 1
+        assert metrics['component_sizes'] == [17]
+
+    def test_reads_file_in_stored_dtype(self, tmp_path):
+        """Test a mask file is measured without a float copy"""
+        data = np.zeros((10, 10, 10), dtype=np.uint8)
+        data[2:4, 2:4, 2:4] = 1
+        path = _write_mask(tmp_path / "lung.nii.gz", data)
+
+        with patch.object(nib.Nifti1Image, 'get_fdata', side_effect=AssertionError("float copy")):
+            metrics = compute_label_metrics(path, count_components=False)
+
+        assert metrics['foreground_voxels'] == 8
+        assert metrics['volume_cm3'] == pytest.approx(8 * 1.0 / 1000)
+        assert metrics['component_count'] is None
+
+
+class TestAnalyzeSegmentation:
+    """Test cases for NNUNetHandler.analyze_segmentation"""
+
+    def test_tumor_metrics(self, tmp_path):
+        """Test tumor volume and lesion count"""
+        data = np.zeros((20, 20, 20), dtype=np.uint8)
+        data[2:4, 2:4, 2:4] = 1
+        data[10:15, 10:12, 10:20] = 1
+        path = _write_mask(tmp_path / "tumor_seg_1.nii.gz", data, zooms=(1.0, 1.0, 1.0))
+
+        metrics = NNUNetHandler().analyze_segmentation(path)
+
+        assert metrics['lesion_count'] == 2
+        assert metrics['tumor_volume'] == round((8 + 100) / 1000, 2)
+
+    def test_lung_metrics(self, tmp_path):
+        """Test lung volume counts every non-zero label"""
+        data = np.zeros((20, 20, 20), dtype=np.uint8)
+        data[:10] = 1
+        data[10:] = 2
+        path = _write_mask(tmp_path / "lung_seg_1.nii.gz", data, zooms=(2.0, 2.0, 2.0))
+
+        assert NNUNetHandler().analyze_segmentation(path) == {"lung_volume": 64.0}
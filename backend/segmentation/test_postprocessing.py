@@ -0,0 +1,118 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch, MagicMock
+from django.test import override_settings
+from segmentation.postprocessing import postprocess_segmentations, load_mask
+from segmentation.tasks import _complete_segmentation_task
+
+
+def _write_mask(path, data, zooms=(1.0, 1.0, 1.0)):
+    nib.save(nib.Nifti1Image(data, np.diag([*zooms, 1.0])), str(path))
+    return str(path)
+
+
+def _result_files(tmp_path, tumor, lung):
+    return {
+        'tumor_segmentation': _write_mask(tmp_path / "tumor_seg_1.nii.gz", tumor),
+        'lung_segmentation': _write_mask(tmp_path / "lung_seg_1.nii.gz", lung),
+    }
+
+
+class TestPostprocessSegmentations:
+    """Test cases for the single-load post-processing stage"""
+
+    def test_metrics_and_preview_slice(self, tmp_path):
+        """Test volumes, lesions and the preview slice come from one decode per mask"""
+        tumor = np.zeros((20, 20, 20), dtype=np.uint8)
+        tumor[2:4, 2:4, 2:4] = 1
+        tumor[10:15, 10:12, 10:20] = 1
+        lung = np.zeros((20, 20, 20), dtype=np.uint8)
+        lung[:, :10] = 1
+        result_files = _result_files(tmp_path, tumor, lung)
+
+        with patch('segmentation.postprocessing.nib.load', wraps=nib.load) as mock_load, \
+             patch.object(nib.Nifti1Image, 'get_fdata', side_effect=AssertionError("float copy")):
+            metrics = postprocess_segmentations(result_files)
+
+        assert mock_load.call_count == 2
+        lesions = metrics.pop('lesions')
+        assert [lesion['voxel_count'] for lesion in lesions] == [100, 8]
+        assert metrics == {
+            'tumor_volume': round(108 / 1000, 2),
+            'lung_volume': 4.0,
+            'lesion_count': 2,
+            'confidence_score': None,
+            'mean_probability': None,
+            'mean_entropy': None,
+            'preview_slice': 10,
+            'removed_components': [],
+        }
+
+    def test_preview_falls_back_to_lung(self, tmp_path):
+        """Test an empty tumor mask previews the slice with the most lung"""
+        lung = np.zeros((8, 8, 8), dtype=np.uint8)
+        lung[:, :, 5] = 1
+        result_files = _result_files(tmp_path, np.zeros((8, 8, 8), dtype=np.uint8), lung)
+
+        metrics = postprocess_segmentations(result_files)
+
+        assert metrics['lesion_count'] == 0
+        assert metrics['preview_slice'] == 5
+
+    def test_shape_mismatch(self, tmp_path):
+        """Test masks on different grids are rejected"""
+        result_files = _result_files(tmp_path, np.zeros((8, 8, 8), dtype=np.uint8),
+                                     np.zeros((8, 8, 6), dtype=np.uint8))
+
+        with pytest.raises(ValueError, match="differ in shape"):
+            postprocess_segmentations(result_files)
+
+    def test_invalid_masks(self, tmp_path):
+        """Test unreadable and non-3D masks are rejected"""
+        corrupt = tmp_path / "corrupt.nii.gz"
+        corrupt.write_bytes(b"not a nifti")
+
+        with pytest.raises(ValueError, match="could not be read"):
+            load_mask(str(corrupt))
+        with pytest.raises(ValueError, match="expected a 3D volume"):
+            load_mask(_write_mask(tmp_path / "4d.nii.gz", np.zeros((4, 4, 4, 2), dtype=np.uint8)))
+
+
+class TestCompleteSegmentationTask:
+    """Test cases for completing a task from its segmentation files"""
+
+    def test_invalid_mask_is_not_completed(self, tmp_path):
+        """Test a mask that fails validation raises before the task is updated"""
+        result_files = _result_files(tmp_path, np.zeros((8, 8, 8), dtype=np.uint8),
+                                     np.zeros((8, 8, 6), dtype=np.uint8))
+        task = MagicMock()
+
+        with override_settings(MEDIA_ROOT=str(tmp_path)), pytest.raises(ValueError):
+            _complete_segmentation_task(task, result_files, MagicMock())
+
+        task.save.assert_not_called()
+
+    def test_given_metrics_skip_postprocessing(self, tmp_path):
+        """Test cached metrics are stored without decoding the masks"""
+        result_files = _result_files(tmp_path, np.zeros((8, 8, 8), dtype=np.uint8),
+                                     np.zeros((8, 8, 8), dtype=np.uint8))
+        task = MagicMock(tumor_segmentation=MagicMock(), lung_segmentation=MagicMock())
+        task.tumor_segmentation.__bool__.return_value = False
+        task.lung_segmentation.__bool__.return_value = False
+
+        with override_settings(MEDIA_ROOT=str(tmp_path)), \
+             patch('segmentation.postprocessing.postprocess_segmentations') as mock_postprocess, \
+             patch('segmentation.tasks.build_volume_pyramid.delay') as mock_pyramid, \
+             patch('segmentation.tasks.encode_segmentation_masks.delay') as mock_encode, \
+             patch('segmentation.tasks.extract_segmentation_meshes.delay') as mock_meshes:
+            metrics = _complete_segmentation_task(task, result_files, MagicMock(),
+                                                  metrics={'tumor_volume': 1.5})
+
+        mock_postprocess.assert_not_called()
+        mock_pyramid.assert_called_once_with(str(task.id))
+        mock_encode.assert_called_once_with(str(task.id))
+        mock_meshes.assert_called_once_with(str(task.id))
+        assert metrics == {'tumor_volume': 1.5}
+        assert task.tumor_volume == 1.5
+        assert task.status == 'completed'
@@ -0,0 +1,251 @@
+import os
+import gzip
+import json
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from django.test import override_settings
+from segmentation.backends import CLIBackend
+from segmentation.postprocessing import postprocess_segmentations
+from segmentation.probabilities import (
+    probability_file_for, open_probability_map, foreground_probability, foreground_from_logits,
+    write_foreground_probabilities, convert_npz_probabilities, model_has_regions, model_reverses_axes, paste_probabilities, load_probability_map, compute_confidence,
+    retain_probabilities
+)
+from segmentation.test_streaming import _fake_predictor, _streaming_predictor
+
+
+def _softmax_foreground(logits):
+    exp = np.exp(logits - logits.max(axis=0))
+    return 1 - exp[0] / exp.sum(axis=0)
+
+
+def _write_map(path, values):
+    probability_map = open_probability_map(str(path), values.shape)
+    probability_map[:] = values
+    probability_map.flush()
+    return str(path)
+
+
+class TestWriteProbabilities:
+    """Test cases for writing tumor probability maps from logits"""
+
+    def test_foreground_probability(self):
+        """Test softmax and sigmoid (region) foreground probabilities"""
+        logits = np.array([[0.0, 2.0], [0.0, -1.0]], dtype=np.float32).reshape(2, 2, 1, 1)
+        np.testing.assert_allclose(foreground_probability(logits)[:, 0, 0], [0.5, 1 / (1 + np.exp(3))], rtol=1e-6)
+        np.testing.assert_allclose(foreground_probability(logits, has_regions=True)[:, 0, 0],
+                                   [0.5, 1 / (1 + np.exp(-2))], rtol=1e-6)
+
+    def test_crop_and_transpose_undone(self, tmp_path):
+        """Test the map is in the segmentation's NIfTI voxel order with zeros outside nnUNet's crop"""
+        logits = np.random.RandomState(0).randn(2, 6, 5, 4).astype(np.float32)
+        transpose_backward = [2, 0, 1]
+        properties = {
+            'shape_before_cropping': (8, 5, 4),
+            'bbox_used_for_cropping': [[1, 7], [0, 5], [0, 4]],
+        }
+        path = str(tmp_path / "tumor_probabilities.npy")
+
+        write_foreground_probabilities(logits, properties, transpose_backward, path, slab_slices=4)
+
+        full = np.zeros((8, 5, 4), dtype=np.float32)
+        full[1:7] = _softmax_foreground(logits)
+        # write_seg saves a (z, y, x) array, so its NIfTI voxel order is the reverse
+        expected = full.transpose(transpose_backward).T
+        probability_map = np.load(path, mmap_mode='r')
+        assert probability_map.dtype == np.float16
+        assert probability_map.flags.f_contiguous
+        np.testing.assert_allclose(probability_map, expected, atol=1e-3)
+
+    def test_foreground_channel_written_like_logits(self, tmp_path):
+        """Test a map written from the extracted foreground channel matches one written from the logits"""
+        logits = np.random.RandomState(3).randn(3, 6, 5, 4).astype(np.float32)
+        properties = {
+            'shape_before_cropping': (6, 5, 4),
+            'bbox_used_for_cropping': [[0, 6], [0, 5], [0, 4]],
+        }
+
+        for has_regions in (False, True):
+            expected = write_foreground_probabilities(logits, properties, [0, 1, 2], str(tmp_path / "logits.npy"),
+                                                      has_regions)
+            foreground = foreground_from_logits(logits, has_regions, slab_slices=4)
+            path = write_foreground_probabilities(foreground, properties, [0, 1, 2],
+                                                  str(tmp_path / "foreground.npy"))
+
+            assert foreground.dtype == np.float16 and foreground.shape == (6, 5, 4)
+            np.testing.assert_allclose(np.load(path), np.load(expected), atol=1e-3)
+
+    def test_streamed_prediction_writes_probabilities(self, tmp_path):
+        """Test streaming inference writes the map from its blended accumulator"""
+        data = np.random.RandomState(2).randn(1, 30, 8, 8).astype(np.float32)
+        predictor = _fake_predictor()
+        predictor.label_manager.has_regions = False
+        streaming, slabs = _streaming_predictor(predictor, tmp_path, max_memory_bytes=64 * 32 * 40)
+        properties = {
+            'spacing': [1.0, 1.0, 1.0],
+            'shape_after_cropping_and_before_resampling': (30, 8, 8),
+            'shape_before_cropping': (30, 8, 8),
+            'bbox_used_for_cropping': [[0, 30], [0, 8], [0, 8]],
+        }
+        path = str(tmp_path / "seg_probabilities.npy")
+
+        streaming.predict(data, properties, str(tmp_path / "seg.nii.gz"), path)
+
+        assert len(slabs) > 1
+        expected = _softmax_foreground(np.concatenate([-data, data]))
+        np.testing.assert_allclose(np.load(path).T, expected, atol=2e-3)
+        assert not os.path.exists(tmp_path / "logits.npy")
+
+    def test_convert_npz(self, tmp_path):
+        """Test the CLI's softmax .npz is converted without changing the voxel order"""
+        logits = np.random.RandomState(1).randn(3, 7, 4, 5)
+        softmax = (np.exp(logits) / np.exp(logits).sum(axis=0)).astype(np.float32)
+        np.savez_compressed(tmp_path / "case.npz", probabilities=softmax)
+
+        path = convert_npz_probabilities(str(tmp_path / "case.npz"), str(tmp_path / "case_probabilities.npy"),
+                                         slab_slices=3)
+
+        np.testing.assert_allclose(np.load(path), (1 - softmax[0]).T, atol=1e-3)
+
+    def test_convert_npz_regions(self, tmp_path):
+        """Test region-based outputs, which have no background channel, take the largest region"""
+        sigmoid = np.random.RandomState(4).rand(3, 7, 4, 5).astype(np.float32)
+        np.savez_compressed(tmp_path / "case.npz", probabilities=sigmoid)
+
+        path = convert_npz_probabilities(str(tmp_path / "case.npz"), str(tmp_path / "case_probabilities.npy"),
+                                         has_regions=True, slab_slices=3)
+
+        np.testing.assert_allclose(np.load(path), sigmoid.max(axis=0).T, atol=1e-3)
+
+    def test_cli_conversion_uses_model_regions(self, tmp_path):
+        """Test the CLI backend reads whether the model is region-based from its dataset.json"""
+        (tmp_path / "model").mkdir()
+        with open(tmp_path / "model" / "dataset.json", "w") as f:
+            json.dump({"labels": {"background": 0, "lung": [1, 2], "tumor": 2}}, f)
+        with open(tmp_path / "model" / "plans.json", "w") as f:
+            json.dump({"image_reader_writer": "NibabelIO"}, f)
+        assert model_has_regions(str(tmp_path / "model"))
+        np.savez_compressed(tmp_path / "case.npz", probabilities=np.zeros((2, 2, 2, 2), dtype=np.float32))
+
+        with patch('segmentation.backends.get_predictor_pool') as mock_pool, \
+             patch('segmentation.backends.convert_npz_probabilities') as mock_convert:
+            mock_pool.return_value.model_folder.return_value = str(tmp_path / "model")
+            CLIBackend("cpu")._convert_probabilities(str(tmp_path / "case.nii.gz"), {"dataset": "Dataset002"})
+
+        assert mock_convert.call_args[0][2:] == (True, False)
+        assert not os.path.exists(tmp_path / "case.npz")
+
+    @pytest.mark.parametrize("reader, reversed_axes", [("SimpleITKIO", True), ("NibabelIO", False),
+                                                       ("NibabelIOWithReorient", False)])
+    def test_convert_npz_reader_order(self, tmp_path, reader, reversed_axes):
+        """Test the map follows the mask's voxel order for SimpleITK and nibabel readers"""
+        (tmp_path / "model").mkdir()
+        with open(tmp_path / "model" / "plans.json", "w") as f:
+            json.dump({"image_reader_writer": reader}, f)
+        softmax = np.random.RandomState(3).dirichlet(np.ones(2), size=(3, 4, 5)).transpose(3, 0, 1, 2)
+        np.savez_compressed(tmp_path / "case.npz", probabilities=softmax.astype(np.float32))
+
+        assert model_reverses_axes(str(tmp_path / "model")) is reversed_axes
+        path = convert_npz_probabilities(str(tmp_path / "case.npz"), str(tmp_path / "case_probabilities.npy"),
+                                         reversed_axes=model_reverses_axes(str(tmp_path / "model")), slab_slices=2)
+
+        expected = 1 - softmax[0]
+        np.testing.assert_allclose(np.load(path), expected.T if reversed_axes else expected, atol=1e-3)
+
+    def test_paste_and_load(self, tmp_path):
+        """Test cascade crops are pasted back and mismatched maps are ignored"""
+        cropped = _write_map(tmp_path / "crop.npy", np.full((3, 2, 4), 0.75, dtype=np.float32))
+        bbox = (slice(1, 4), slice(2, 4), slice(0, 4))
+
+        path = paste_probabilities(cropped, bbox, (5, 5, 4), str(tmp_path / "full.npy"))
+
+        probability_map = load_probability_map(path, (5, 5, 4))
+        assert probability_map[bbox].min() == 0.75
+        assert probability_map.sum() == pytest.approx(0.75 * 24)
+        assert load_probability_map(path, (5, 5, 5)) is None
+        assert load_probability_map(str(tmp_path / "missing.npy"), (5, 5, 4)) is None
+        with pytest.raises(ValueError):
+            paste_probabilities(cropped, bbox[::-1], (5, 5, 4), str(tmp_path / "swapped.npy"))
+        assert probability_file_for("/media/tumor_seg_1.nii.gz") == "/media/tumor_seg_1_probabilities.npy"
+
+
+class TestConfidence:
+    """Test cases for the slab-wise uncertainty metrics"""
+
+    def test_metrics(self, tmp_path):
+        """Test mean probability and entropy over predicted tumor and uncertain voxels"""
+        probabilities = np.zeros((4, 4, 6), dtype=np.float32)
+        mask = np.zeros((4, 4, 6), dtype=np.uint8)
+        probabilities[0, 0, :] = 0.5       # uncertain background: 1 bit each
+        mask[1, 1, :] = 1
+        probabilities[1, 1, :] = 1.0       # confident tumor: 0 bits
+        probabilities[2, 2, 0] = 0.05      # below the uncertainty threshold
+        probability_map = np.load(_write_map(tmp_path / "p.npy", probabilities), mmap_mode='r')
+
+        confidence = compute_confidence(probability_map, mask, slab_size=4)
+
+        assert confidence['mean_probability'] == pytest.approx(1.0, abs=1e-4)
+        assert confidence['mean_entropy'] == pytest.approx(0.5, abs=1e-3)
+        assert confidence['confidence_score'] == pytest.approx(0.5, abs=1e-3)
+
+    def test_certain_background(self, tmp_path):
+        """Test a prediction with no tumor and no doubt is fully confident"""
+        probability_map = np.load(_write_map(tmp_path / "p.npy", np.zeros((4, 4, 4), dtype=np.float32)))
+
+        confidence = compute_confidence(probability_map, np.zeros((4, 4, 4), dtype=np.uint8))
+
+        assert confidence == {'mean_probability': None, 'mean_entropy': 0.0, 'confidence_score': 1.0}
+
+    def test_postprocessing_uses_probabilities(self, tmp_path):
+        """Test task and per-lesion confidence metrics come from the probability map"""
+        tumor = np.zeros((10, 10, 10), dtype=np.uint8)
+        tumor[1:3, 1:3, 1:3] = 1
+        tumor[6:9, 6:9, 6:9] = 1
+        probabilities = np.where(tumor > 0, 0.9, 0.0).astype(np.float32)
+        probabilities[1:3, 1:3, 1:3] = 0.6
+        result_files = {}
+        for name, data in (('tumor_segmentation', tumor), ('lung_segmentation', np.ones_like(tumor))):
+            result_files[name] = str(tmp_path / f"{name}.nii.gz")
+            nib.save(nib.Nifti1Image(data, np.eye(4)), result_files[name])
+
+        metrics = postprocess_segmentations(result_files, _write_map(tmp_path / "p.npy", probabilities))
+
+        assert [lesion['mean_probability'] for lesion in metrics['lesions']] == \
+            [pytest.approx(0.9, abs=1e-3), pytest.approx(0.6, abs=1e-3)]
+        assert metrics['mean_probability'] == pytest.approx((27 * 0.9 + 8 * 0.6) / 35, abs=1e-3)
+        assert 0 < metrics['confidence_score'] < 1
+        assert metrics['confidence_score'] == pytest.approx(1 - metrics['mean_entropy'], abs=1e-4)
+
+
+class TestRetention:
+    """Test cases for discarding or keeping probability maps"""
+
+    def test_discard(self, tmp_path):
+        """Test the default retention removes the map"""
+        path = _write_map(tmp_path / "p.npy", np.zeros((2, 2, 2), dtype=np.float32))
+
+        with override_settings(MEDIA_ROOT=str(tmp_path), SEGMENTATION_PROBABILITY_RETENTION='discard'):
+            assert retain_probabilities(path, 'task') is None
+
+        assert not os.path.exists(path)
+        assert not os.path.exists(tmp_path / "probabilities")
+
+    def test_compressed(self, tmp_path):
+        """Test compressed retention keeps a gzip copy that loads back to the same map"""
+        values = np.random.RandomState(0).rand(4, 3, 2).astype(np.float32)
+        path = _write_map(tmp_path / "p.npy", values)
+
+        with override_settings(MEDIA_ROOT=str(tmp_path)):
+            kept = retain_probabilities(path, 'task', retention='compressed')
+
+        assert kept == str(tmp_path / "probabilities" / "tumor_prob_task.npy.gz")
+        assert not os.path.exists(path)
+        with gzip.open(kept) as f:
+            np.testing.assert_array_equal(np.load(f), values.astype(np.float16))
+
+    def test_unknown_retention(self, tmp_path):
+        """Test an unknown retention setting is rejected"""
+        with pytest.raises(ValueError, match="Unknown probability retention"):
+            retain_probabilities(str(tmp_path / "p.npy"), 'task', retention='forever')
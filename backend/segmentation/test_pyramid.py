@@ -0,0 +1,152 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from segmentation.models import SegmentationTask
+from segmentation.pyramid import VolumePyramid, downsample2
+from segmentation.tasks import build_volume_pyramid
+from segmentation.volume_cache import VolumeCache
+
+
+def _nifti(path, data):
+    nib.save(nib.Nifti1Image(data, np.diag([0.5, 0.5, 1.0, 1.0])), str(path))
+    return str(path)
+
+
+@pytest.fixture
+def pyramid_dirs(tmp_path):
+    with override_settings(MEDIA_ROOT=str(tmp_path / "media"),
+                           VOLUME_CACHE_DIR=str(tmp_path / "volumes"),
+                           VOLUME_PYRAMID_DIR=str(tmp_path / "pyramids"),
+                           VOLUME_PYRAMID_FACTORS=(2, 4, 8),
+                           VOLUME_PYRAMID_CHUNK_SIZE=4):
+        yield tmp_path
+
+
+class TestDownsample:
+    """Test cases for the 2x block reduction"""
+
+    def test_image_mean_and_mask_max(self):
+        """Test images are block-averaged and masks keep any labelled voxel"""
+        image = np.arange(4 * 4 * 2, dtype=np.int16).reshape(4, 4, 2)
+        mask = np.zeros((4, 4, 2), dtype=np.uint8)
+        mask[3, 3, 1] = 2
+
+        reduced = downsample2(image, is_mask=False)
+        assert reduced.dtype == np.int16
+        np.testing.assert_array_equal(reduced, np.rint(image.reshape(2, 2, 2, 2, 1, 2).mean(axis=(1, 3, 5))))
+        np.testing.assert_array_equal(downsample2(mask, is_mask=True)[..., 0], [[0, 0], [0, 2]])
+
+    def test_odd_shapes_are_padded(self):
+        """Test odd axes round up by repeating the edge voxels"""
+        assert downsample2(np.ones((5, 3, 1), dtype=np.float32), is_mask=False).shape == (3, 2, 1)
+
+
+class TestVolumePyramid:
+    """Test cases for building and reading chunked pyramid levels"""
+
+    def test_regions_match_direct_downsampling(self, pyramid_dirs):
+        """Test any region of any level equals the same region of the reduced volume"""
+        image = np.random.RandomState(0).randint(-1000, 1000, (19, 13, 11)).astype(np.int16)
+        source = _nifti(pyramid_dirs / "scan.nii.gz", image)
+        pyramid = VolumePyramid("task")
+
+        manifest = pyramid.build({'image': source}, volume_cache=VolumeCache(slab_size=3))
+
+        assert [level['shape'] for level in manifest['levels']] == [[19, 13, 11], [10, 7, 6], [5, 4, 3], [3, 2, 2]]
+        assert manifest['levels'][1]['zooms'] == pytest.approx([1.0, 1.0, 2.0])
+        # Level voxel (0, 0, 0) sits at the centre of the source block it covers
+        np.testing.assert_allclose(np.asarray(manifest['levels'][2]['affine'])[:3, 3], [0.75, 0.75, 1.5])
+
+        expected = image
+        for level in (1, 2, 3):
+            expected = downsample2(expected, is_mask=False)
+            np.testing.assert_array_equal(pyramid.read_region('image', level, [(0, n) for n in expected.shape]),
+                                          expected)
+        region = [(1, 9), (3, 7), (2, 6)]
+        np.testing.assert_array_equal(VolumePyramid("task").read_region('image', 1, region),
+                                      downsample2(image, is_mask=False)[1:9, 3:7, 2:6])
+
+    def test_invalid_reads(self, pyramid_dirs):
+        """Test unbuilt pyramids, unknown levels and out-of-range regions are rejected"""
+        with pytest.raises(KeyError):
+            VolumePyramid("missing").read_region('image', 1, [(0, 1)] * 3)
+
+        source = _nifti(pyramid_dirs / "scan.nii.gz", np.zeros((8, 8, 8), dtype=np.int16))
+        pyramid = VolumePyramid("task")
+        pyramid.build({'image': source})
+        with pytest.raises(KeyError):
+            pyramid.read_region('image', 4, [(0, 1)] * 3)
+        with pytest.raises(ValueError):
+            pyramid.read_region('image', 1, [(0, 5), (0, 4), (0, 4)])
+
+
+@pytest.mark.django_db
+class TestPyramidEndpoints:
+    """Test cases for building the pyramid of a task and serving its regions"""
+
+    @pytest.fixture
+    def task(self, pyramid_dirs):
+        image = np.arange(16 * 16 * 8, dtype=np.int16).reshape(16, 16, 8)
+        tumor = np.zeros((16, 16, 8), dtype=np.uint8)
+        tumor[5, 6, 3] = 1
+        image_path = _nifti(pyramid_dirs / "scan.nii.gz", image)
+        tumor_path = _nifti(pyramid_dirs / "tumor.nii.gz", tumor)
+        task = SegmentationTask.objects.create(
+            file_name="scan.nii.gz",
+            nifti_file=SimpleUploadedFile("scan.nii.gz", open(image_path, 'rb').read()),
+            tumor_segmentation=SimpleUploadedFile("tumor.nii.gz", open(tumor_path, 'rb').read()),
+            status="completed",
+        )
+        return task, image
+
+    def test_manifest_and_regions(self, api_client, task):
+        """Test the built levels are listed and coarse regions keep small lesions"""
+        task, image = task
+        assert api_client.get(reverse('segmentation-task-pyramid', kwargs={'pk': task.id})).status_code \
+            == status.HTTP_404_NOT_FOUND
+
+        assert build_volume_pyramid(str(task.id)) == [[16, 16, 8], [8, 8, 4], [4, 4, 2], [2, 2, 1]]
+
+        data = api_client.get(reverse('segmentation-task-pyramid', kwargs={'pk': task.id})).json()
+        assert [level['factor'] for level in data['levels']] == [1, 2, 4, 8]
+        assert data['layers'] == {'image': 'int16', 'tumor': 'uint8'}
+
+        url = reverse('segmentation-task-pyramid-region', kwargs={'pk': task.id, 'level': 3})
+        response = api_client.get(url, {'layer': 'tumor'})
+        assert response.status_code == status.HTTP_200_OK
+        assert response['X-Region-Shape'] == '2,2,1'
+        mask = np.frombuffer(response.content, dtype=response['X-Region-Dtype']).reshape(2, 2, 1)
+        np.testing.assert_array_equal(mask[..., 0], [[1, 0], [0, 0]])
+
+        url = reverse('segmentation-task-pyramid-region', kwargs={'pk': task.id, 'level': 0})
+        response = api_client.get(url, {'region': '2:5,0:16,7:8'})
+        values = np.frombuffer(response.content, dtype=np.int16).reshape(3, 16, 1)
+        np.testing.assert_array_equal(values, image[2:5, :, 7:8])
+        assert response['X-Region-Origin'] == '2,0,7'
+
+    def test_invalid_region_requests(self, api_client, task):
+        """Test malformed, out-of-range and oversized regions are rejected"""
+        task, _ = task
+        build_volume_pyramid(str(task.id))
+
+        def get(level=1, **params):
+            url = reverse('segmentation-task-pyramid-region', kwargs={'pk': task.id, 'level': level})
+            return api_client.get(url, params)
+
+        assert get(region='0:4,0:4').status_code == status.HTTP_400_BAD_REQUEST
+        assert get(region='0:9,0:4,0:4').status_code == status.HTTP_400_BAD_REQUEST
+        assert get(level=4).status_code == status.HTTP_404_NOT_FOUND
+        assert get(layer='lung').status_code == status.HTTP_404_NOT_FOUND
+        with override_settings(VOLUME_PYRAMID_MAX_REGION_VOXELS=100):
+            assert get().status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_missing_task_is_skipped(self, task):
+        """Test a missing task is skipped without building anything"""
+        with patch.object(VolumePyramid, 'build') as mock_build:
+            assert build_volume_pyramid("00000000-0000-0000-0000-000000000000") is None
+        mock_build.assert_not_called()
@@ -0,0 +1,123 @@
+import json
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from scipy import ndimage
+from django.test import override_settings
+from segmentation.nnunet_handler import NNUNetHandler
+from segmentation.resampling import ChunkedResampler, plans_target_spacing
+
+
+def _image(data, zooms, tmp_path=None):
+    img = nib.Nifti1Image(data, np.diag([*zooms, 1.0]))
+    if tmp_path is None:
+        return img
+    nib.save(img, str(tmp_path / "scan.nii.gz"))
+    return nib.load(str(tmp_path / "scan.nii.gz"), keep_file_open=True)
+
+
+class TestChunkedResampler:
+    """Test cases for chunked, threaded resampling"""
+
+    @pytest.mark.parametrize("order", [0, 1, 3])
+    def test_matches_whole_volume(self, tmp_path, order):
+        """Test chunked output matches resampling the whole volume at once"""
+        data = np.random.RandomState(0).rand(12, 10, 40).astype(np.float32)
+        img = _image(data, (1.0, 1.0, 2.5), tmp_path)
+        resampler = ChunkedResampler((0.8, 1.5, 1.0), order=order, num_threads=3, chunk_slices=7)
+
+        resampled = resampler.resample(img)
+
+        shape, _, steps = resampler.output_geometry(img)
+        expected = ndimage.affine_transform(data, steps, output_shape=shape, order=order, mode='nearest')
+        assert resampled.shape == shape == (14, 7, 98)
+        np.testing.assert_allclose(resampled.get_fdata(), expected, atol=1e-3 if order > 1 else 1e-5)
+
+    def test_geometry(self):
+        """Test the output keeps the first voxel's position and gets the target spacing"""
+        affine = np.array([[-2.0, 0, 0, 10], [0, 2.0, 0, -5], [0, 0, 3.0, 7], [0, 0, 0, 1]])
+        img = nib.Nifti1Image(np.zeros((10, 10, 10), dtype=np.int16), affine)
+
+        resampled = ChunkedResampler((1.0, 1.0, 1.0), order=1).resample(img)
+
+        assert resampled.header.get_zooms() == (1.0, 1.0, 1.0)
+        np.testing.assert_allclose(resampled.affine[:3, 3], affine[:3, 3])
+        np.testing.assert_allclose(resampled.affine @ [18, 18, 27, 1], affine @ [9, 9, 9, 1])
+
+    def test_integer_dtype_kept(self):
+        """Test integer scans stay in their stored dtype, rounded and clipped"""
+        data = np.full((4, 4, 4), 32000, dtype=np.int16)
+        data[:, :, 2:] = -1000
+
+        resampled = ChunkedResampler((1.0, 1.0, 0.5), order=3).resample(_image(data, (1.0, 1.0, 1.0)))
+
+        assert resampled.get_data_dtype() == np.int16
+        values = np.asanyarray(resampled.dataobj)
+        assert values.max() == 32767
+        assert values.min() >= -32768
+
+    def test_progress_and_skip(self, tmp_path):
+        """Test progress is reported per chunk and matching spacing is left alone"""
+        img = _image(np.zeros((4, 4, 8), dtype=np.float32), (1.0, 1.0, 1.0), tmp_path)
+        fractions = []
+
+        ChunkedResampler((1.0, 1.0, 0.5), chunk_slices=4).resample(img, progress=fractions.append)
+
+        assert fractions == [0.25, 0.5, 0.75, 1.0]
+        assert not ChunkedResampler((1.0, 1.0, 1.005)).resample_file(
+            str(tmp_path / "scan.nii.gz"), str(tmp_path / "out.nii.gz")
+        )
+        assert not (tmp_path / "out.nii.gz").exists()
+
+
+class TestPlansTargetSpacing:
+    """Test cases for reading the target spacing from nnUNet plans"""
+
+    def _write_plans(self, tmp_path, **plans):
+        (tmp_path / "plans.json").write_text(json.dumps(plans))
+        return str(tmp_path)
+
+    def test_simpleitk_axis_order(self, tmp_path):
+        """Test transpose_forward and SimpleITK's reversed axes are undone"""
+        folder = self._write_plans(
+            tmp_path,
+            image_reader_writer="SimpleITKIO",
+            transpose_forward=[0, 2, 1],
+            configurations={"3d_fullres": {"spacing": [3.0, 0.7, 0.8]},
+                            "3d_cascade_fullres": {"inherits_from": "3d_fullres"},
+                            "2d": {"spacing": [0.7, 0.8]}},
+        )
+
+        assert plans_target_spacing(folder, "3d_fullres") == (0.7, 0.8, 3.0)
+        assert plans_target_spacing(folder, "3d_cascade_fullres") == (0.7, 0.8, 3.0)
+        assert plans_target_spacing(folder, "2d") is None
+
+    def test_nibabel_axis_order(self, tmp_path):
+        """Test nibabel readers keep the file's axis order"""
+        folder = self._write_plans(
+            tmp_path,
+            image_reader_writer="NibabelIO",
+            transpose_forward=[2, 0, 1],
+            configurations={"3d_fullres": {"spacing": [3.0, 0.7, 0.8]}},
+        )
+
+        assert plans_target_spacing(folder, "3d_fullres") == (0.7, 0.8, 3.0)
+
+    def test_handler_uses_finest_model_spacing(self, tmp_path):
+        """Test uploads target the finest spacing over both models, or the configured default"""
+        handler = NNUNetHandler()
+        spacings = {handler.tumor_model['dataset']: [2.0, 0.6, 0.9], handler.lung_model['dataset']: [1.0, 0.8, 0.8]}
+        for dataset, spacing in spacings.items():
+            (tmp_path / dataset).mkdir()
+            self._write_plans(tmp_path / dataset, configurations={
+                handler.tumor_model['config']: {"spacing": spacing},
+                handler.lung_model['config']: {"spacing": spacing},
+            })
+
+        with patch('segmentation.nnunet_handler.get_predictor_pool') as mock_pool:
+            mock_pool.return_value.model_folder.side_effect = lambda config: str(tmp_path / config['dataset'])
+            assert handler.target_spacing() == (0.8, 0.6, 1.0)
+            mock_pool.return_value.model_folder.side_effect = lambda config: str(tmp_path / "missing")
+            with override_settings(SEGMENTATION_RESAMPLE_SPACING=(1.5, 1.5, 1.5)):
+                assert handler.target_spacing() == (1.5, 1.5, 1.5)
@@ -0,0 +1,140 @@
+import os
+import time
+import pytest
+import numpy as np
+import nibabel as nib
+from unittest.mock import patch, MagicMock
+from django.test import override_settings
+from segmentation.models import SegmentationTask
+from segmentation.result_cache import SegmentationResultCache
+from segmentation.tasks import process_segmentation_task
+
+
+def _write_nifti(path, data, affine=None):
+    nib.save(nib.Nifti1Image(data, np.eye(4) if affine is None else affine), str(path))
+    return str(path)
+
+
+def _write_results(directory, name):
+    tumor = _write_nifti(directory / f"tumor_{name}.nii.gz", np.zeros((4, 4, 4), dtype=np.uint8))
+    lung = _write_nifti(directory / f"lung_{name}.nii.gz", np.ones((4, 4, 4), dtype=np.uint8))
+    return {'tumor_segmentation': tumor, 'lung_segmentation': lung}
+
+
+class TestSegmentationResultCache:
+    """Test cases for the content-addressed result cache"""
+
+    def test_key_depends_on_voxels_affine_and_model(self, tmp_path):
+        """Test identical volumes share a key and any difference changes it"""
+        cache = SegmentationResultCache(cache_dir=tmp_path / "cache", max_bytes=10 ** 9)
+        data = np.arange(4 * 4 * 40, dtype=np.int16).reshape(4, 4, 40)
+        original = _write_nifti(tmp_path / "a.nii.gz", data)
+        reupload = _write_nifti(tmp_path / "b.nii", data)
+        shifted = _write_nifti(tmp_path / "c.nii.gz", data, affine=np.diag([2, 1, 1, 1]))
+        changed = data.copy()
+        changed[0, 0, 39] += 1
+        edited = _write_nifti(tmp_path / "d.nii.gz", changed)
+
+        key = cache.compute_key(original, "v1")
+        assert cache.compute_key(reupload, "v1") == key
+        assert cache.compute_key(original, "v2") != key
+        assert cache.compute_key(shifted, "v1") != key
+        assert cache.compute_key(edited, "v1") != key
+
+    def test_store_and_lookup(self, tmp_path):
+        """Test stored results come back with their metrics"""
+        cache = SegmentationResultCache(cache_dir=tmp_path / "cache", max_bytes=10 ** 9)
+        result_files = _write_results(tmp_path, "1")
+        metrics = {'tumor_volume': 1.5, 'lesion_count': 2}
+
+        assert cache.lookup("abc") is None
+        cache.store("abc", result_files, metrics)
+        entry = cache.lookup("abc")
+
+        assert entry['metrics'] == metrics
+        assert os.path.exists(entry['tumor_segmentation'])
+
+    def test_materialize_survives_task_cleanup(self, tmp_path):
+        """Test deleting a task's files leaves the cache entry intact"""
+        cache = SegmentationResultCache(cache_dir=tmp_path / "cache", max_bytes=10 ** 9)
+        cache.store("abc", _write_results(tmp_path, "1"), {})
+
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media")):
+            result_files = cache.materialize(cache.lookup("abc"), "task-1")
+
+        assert result_files['lung_segmentation'].endswith("lung_seg_task-1.nii.gz")
+        os.remove(result_files['lung_segmentation'])
+        assert cache.lookup("abc") is not None
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Test the oldest entries are evicted once the cache is full"""
+        cache = SegmentationResultCache(cache_dir=tmp_path / "cache", max_bytes=10 ** 9)
+        for key in ("old", "used", "new"):
+            cache.store(key, _write_results(tmp_path, key), {})
+        os.utime(tmp_path / "cache" / "old", (time.time() - 300, time.time() - 300))
+        os.utime(tmp_path / "cache" / "used", (time.time() - 200, time.time() - 200))
+        cache.lookup("used")
+
+        entry_size = cache._entry_size(tmp_path / "cache" / "new")
+        cache.max_bytes = 2 * entry_size
+        assert cache.evict() == 1
+
+        assert cache.lookup("old") is None
+        assert cache.lookup("used") is not None
+        assert cache.lookup("new") is not None
+
+
+@pytest.mark.django_db
+class TestCachedProcessing:
+    """Test cases for serving segmentation tasks from the result cache"""
+
+    def test_cache_hit_skips_prediction(self, test_user, test_nifti_file, tmp_path):
+        """Test a repeat upload is completed from the cache without inference"""
+        task = SegmentationTask.objects.create(
+            user=test_user,
+            file_name="scan.nii.gz",
+            nifti_file=test_nifti_file,
+            status="queued"
+        )
+        entry = {**_write_results(tmp_path, "cached"), 'metrics': {'tumor_volume': 3.0}}
+        mock_cache = MagicMock()
+        mock_cache.lookup.return_value = entry
+        mock_cache.materialize.return_value = {'tumor_segmentation': 't', 'lung_segmentation': 'l'}
+        mock_handler = MagicMock()
+
+        with patch('segmentation.nnunet_handler.NNUNetHandler', return_value=mock_handler), \
+             patch('segmentation.result_cache.SegmentationResultCache', return_value=mock_cache), \
+             patch('segmentation.tasks._complete_segmentation_task') as mock_complete, \
+             override_settings(SEGMENTATION_BATCH_WAIT_SECONDS=0, SEGMENTATION_CACHE_ENABLED=True):
+            process_segmentation_task(str(task.id))
+
+        mock_handler.predict_batch.assert_not_called()
+        assert mock_complete.call_args[1]['metrics'] == {'tumor_volume': 3.0}
+
+    def test_cache_miss_stores_prediction(self, test_user, test_nifti_file):
+        """Test model outputs are cached and fallback outputs are not"""
+        tasks = [
+            SegmentationTask.objects.create(
+                user=test_user,
+                file_name=f"scan_{i}.nii.gz",
+                nifti_file=test_nifti_file,
+                status="queued"
+            )
+            for i in range(2)
+        ]
+        task_ids = [str(task.id) for task in tasks]
+        predicted = {'tumor_segmentation': 't', 'lung_segmentation': 'l'}
+        mock_cache = MagicMock()
+        mock_cache.lookup.return_value = None
+        mock_cache.compute_key.side_effect = ["key-0", "key-1"]
+        mock_handler = MagicMock()
+        mock_handler.predict_batch.return_value = ({task_ids[0]: predicted}, {task_ids[1]: 'no output'})
+
+        with patch('segmentation.nnunet_handler.NNUNetHandler', return_value=mock_handler), \
+             patch('segmentation.result_cache.SegmentationResultCache', return_value=mock_cache), \
+             patch('segmentation.tasks._complete_segmentation_task', return_value={'tumor_volume': 1.0}), \
+             override_settings(SEGMENTATION_BATCH_SIZE=2, SEGMENTATION_BATCH_WAIT_SECONDS=0,
+                               SEGMENTATION_CACHE_ENABLED=True):
+            process_segmentation_task(task_ids[0])
+
+        mock_cache.store.assert_called_once_with("key-0", predicted, {'tumor_volume': 1.0})
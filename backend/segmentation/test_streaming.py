@@ -0,0 +1,204 @@
+import os
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from unittest.mock import MagicMock
+from segmentation.preprocessing import SharedPreprocessor
+from segmentation.resampling import resampling_orders
+from segmentation.streaming import (
+    StreamingPredictor, estimate_inference_memory, should_stream, slab_depth
+)
+
+
+def _fake_predictor(patch_size=(8, 8, 8)):
+    predictor = MagicMock()
+    predictor.label_manager.num_segmentation_heads = 2
+    predictor.label_manager.foreground_labels = [1]
+    predictor.configuration_manager.patch_size = list(patch_size)
+    predictor.configuration_manager.spacing = [1.0, 1.0, 1.0]
+    predictor.configuration_manager.configuration = {
+        'resampling_fn_probabilities_kwargs': {'is_seg': False, 'order': 1, 'order_z': 0, 'force_separate_z': None},
+    }
+    predictor.plans_manager.transpose_forward = [0, 1, 2]
+    predictor.plans_manager.transpose_backward = [0, 1, 2]
+    return predictor
+
+
+def _streaming_predictor(predictor, work_dir, max_memory_bytes):
+    streaming = StreamingPredictor(predictor, str(work_dir), max_memory_bytes=max_memory_bytes)
+    slabs = []
+
+    def predict_slab(slab):
+        # A voxel-wise model, so slab results must match a whole-volume prediction
+        slabs.append(slab.shape)
+        return np.concatenate([-slab, slab]).astype(np.float32)
+
+    streaming._predict_slab = predict_slab
+    streaming._segment_slab = lambda logits: np.argmax(logits, axis=0).astype(np.uint8)
+    return streaming, slabs
+
+
+class TestStreamingPlanning:
+    """Test cases for deciding when and how to stream"""
+
+    def test_should_stream(self):
+        """Test streaming kicks in above the memory ceiling"""
+        small = estimate_inference_memory((1, 64, 64, 64), 2, (64, 64, 64))
+
+        assert not should_stream((1, 64, 64, 64), 2, (64, 64, 64), max_memory_bytes=small + 1, mode='auto')
+        assert should_stream((1, 64, 64, 64), 2, (64, 64, 64), max_memory_bytes=small - 1, mode='auto')
+        assert should_stream((1, 4, 4, 4), 2, (4, 4, 4), mode='always')
+        assert not should_stream((1, 4096, 512, 512), 2, (4096, 512, 512), mode='never')
+
+    def test_slab_depth(self):
+        """Test slabs fit the ceiling but are never thinner than two patches"""
+        bytes_per_slice = 64 * (4 + 12 * 2 + 4)
+
+        assert slab_depth((8, 8), 1, 2, 8, bytes_per_slice * 100) == 50
+        assert slab_depth((8, 8), 1, 2, 8, bytes_per_slice) == 16
+
+
+class TestStreamingPredictor:
+    """Test cases for slab-wise inference"""
+
+    def test_matches_whole_volume(self, tmp_path):
+        """Test blended slabs give the whole-volume result, placed back into the uncropped volume"""
+        data = np.random.RandomState(0).randn(1, 50, 8, 8).astype(np.float32)
+        predictor = _fake_predictor()
+        streaming, slabs = _streaming_predictor(predictor, tmp_path, max_memory_bytes=64 * 32 * 40)
+        properties = {
+            'spacing': [1.0, 1.0, 1.0],
+            'shape_after_cropping_and_before_resampling': (50, 8, 8),
+            'shape_before_cropping': (54, 8, 8),
+            'bbox_used_for_cropping': [[2, 52], [0, 8], [0, 8]],
+        }
+
+        streaming.predict(data, properties, str(tmp_path / "seg.nii.gz"))
+
+        assert len(slabs) > 1
+        assert max(shape[1] for shape in slabs) < 50
+        written = predictor.plans_manager.image_reader_writer_class().write_seg.call_args[0][0]
+        assert written.shape == (54, 8, 8)
+        np.testing.assert_array_equal(written[2:52], (data[0] > 0).astype(np.uint8))
+        assert not written[:2].any()
+        assert not os.path.exists(tmp_path / "logits.npy")
+
+    def test_maps_back_to_original_spacing(self, tmp_path):
+        """Test logits are resampled to the shape before preprocessing and segmented after, like nnUNet"""
+        data = np.random.RandomState(1).randn(1, 15, 8, 8).astype(np.float32)
+        predictor = _fake_predictor()
+        streaming, _ = _streaming_predictor(predictor, tmp_path, max_memory_bytes=64 * 16 * 40)
+        properties = {
+            'spacing': [1.5, 0.5, 1.0],
+            'shape_after_cropping_and_before_resampling': (10, 16, 8),
+            'shape_before_cropping': (10, 16, 8),
+            'bbox_used_for_cropping': [[0, 10], [0, 16], [0, 8]],
+        }
+
+        streaming.predict(data, properties, str(tmp_path / "seg.nii.gz"))
+
+        written = predictor.plans_manager.image_reader_writer_class().write_seg.call_args[0][0]
+        # Linear interpolation of the float16 logits over the whole volume, then the argmax
+        coordinates = np.meshgrid(*[(np.arange(target) + 0.5) * source / target - 0.5
+                                    for source, target in zip((15, 8, 8), (10, 16, 8))], indexing='ij')
+        logits = data[0].astype(np.float16).astype(np.float32)
+        expected = ndimage.map_coordinates(logits, coordinates, order=1, mode='nearest') > 0
+        np.testing.assert_array_equal(written, expected.astype(np.uint8))
+
+
+class TestSpill:
+    """Test cases for moving preprocessing caches to disk"""
+
+    def test_spill_and_clear(self, tmp_path):
+        """Test cached arrays become memory maps and are removed on clear"""
+        shared = SharedPreprocessor(str(tmp_path / "case_0000.nii.gz"))
+        image = np.arange(24, dtype=np.float32).reshape(1, 2, 3, 4)
+        shared._cached(("decode", "reader"), lambda: (image, {'spacing': (1, 1, 1)}))
+
+        spill_dir = shared.spill()
+        spilled, properties = shared._cached(("decode", "reader"), lambda: None)
+
+        assert isinstance(spilled, np.memmap)
+        np.testing.assert_array_equal(spilled, image)
+        assert properties == {'spacing': (1, 1, 1)}
+        shared.clear()
+        assert not os.path.exists(spill_dir)
+
+
+class TestStreamedPreprocessing:
+    """Test cases for preprocessing slab by slab into memory maps"""
+
+    def test_estimated_shape_from_header(self, tmp_path):
+        """Test the preprocessed shape is estimated in the reader's axis order without decoding"""
+        path = tmp_path / "case_0000.nii.gz"
+        nib.save(nib.Nifti1Image(np.zeros((40, 30, 20), dtype=np.int16), np.diag([0.5, 0.5, 2.0, 1.0])), str(path))
+        predictor = _fake_predictor()
+        predictor.plans_manager.image_reader_writer_class = type('SimpleITKIO', (), {})
+        predictor.plans_manager.transpose_forward = [0, 1, 2]
+        predictor.configuration_manager.spacing = [2.0, 1.0, 1.0]
+
+        data_shape, original_shape = SharedPreprocessor(str(path)).estimated_shape(predictor)
+
+        assert data_shape == (1, 20, 15, 20)
+        assert original_shape == (20, 30, 40)
+
+    def test_crop_to_nonzero(self, tmp_path):
+        """Test the slab-wise crop finds nnUNet's bounding box and copies the box only"""
+        shared = SharedPreprocessor(str(tmp_path / "case_0000.nii.gz"))
+        shared._spill_directory()
+        image = np.zeros((1, 6, 10, 8), dtype=np.float32)
+        image[0, 1:4, 3:7, 2:5] = 1
+        image[0, 2, 4, 3] = 0
+
+        data, crop_properties = shared._stream_crop(image, [2, 0, 1], slab_slices=3)
+
+        transposed = image.transpose(0, 3, 1, 2)
+        assert crop_properties == {
+            'shape_before_cropping': (8, 6, 10),
+            'bbox_used_for_cropping': [[2, 5], [1, 4], [3, 7]],
+            'shape_after_cropping_and_before_resampling': (3, 3, 4),
+        }
+        assert isinstance(data, np.memmap)
+        np.testing.assert_array_equal(data, transposed[:, 2:5, 1:4, 3:7])
+
+    def test_normalize_in_place(self, tmp_path):
+        """Test voxel-wise normalization of slabs equals normalizing the whole volume"""
+        shared = SharedPreprocessor(str(tmp_path / "case_0000.nii.gz"))
+        shared._spill_directory()
+        data = shared._open_spill((1, 7, 4, 4))
+        data[:] = np.random.RandomState(2).randn(1, 7, 4, 4) * 100
+        expected = np.clip(data, -50, 50) / 50
+        preprocessor = MagicMock()
+        preprocessor._normalize.side_effect = lambda slab, seg, *_: np.clip(slab, -50, 50) / 50
+
+        normalized = shared._stream_normalize(data, preprocessor, None, {}, slab_slices=3)
+
+        assert normalized is data
+        assert preprocessor._normalize.call_count == 3
+        np.testing.assert_allclose(normalized, expected)
+
+    def test_resample_matches_spline(self, tmp_path):
+        """Test slab-wise resampling samples the same coordinates as a whole-volume spline"""
+        shared = SharedPreprocessor(str(tmp_path / "case_0000.nii.gz"))
+        shared._spill_directory()
+        normalized = np.random.RandomState(3).randn(1, 10, 12, 9).astype(np.float32)
+        spacing, target_spacing = [2.0, 1.0, 1.0], [1.5, 0.75, 1.2]
+
+        data = shared._stream_resample(normalized, spacing, target_spacing, {'order': 3}, slab_slices=4)
+
+        assert data.shape == (1, 13, 16, 8)
+        coordinates = np.meshgrid(*[(np.arange(out) + 0.5) * size / out - 0.5
+                                    for size, out in zip(normalized.shape[1:], data.shape[1:])], indexing='ij')
+        expected = ndimage.map_coordinates(normalized[0], coordinates, order=3, mode='nearest')
+        np.testing.assert_allclose(data[0], expected, atol=1e-3)
+
+    def testresampling_orders(self):
+        """Test only a single low-resolution axis of an anisotropic case uses order_z"""
+        kwargs = {'order': 3, 'order_z': 0, 'force_separate_z': None}
+
+        assert resampling_orders([5.0, 0.8, 0.8], [1.0, 1.0, 1.0], kwargs) == [0, 3, 3]
+        assert resampling_orders([1.0, 1.0, 1.0], [1.0, 1.0, 4.0], kwargs) == [3, 3, 0]
+        assert resampling_orders([2.0, 1.0, 1.0], [1.0, 1.0, 1.0], kwargs) == [3, 3, 3]
+        assert resampling_orders([5.0, 5.0, 1.0], [1.0, 1.0, 1.0], kwargs) == [3, 3, 3]
+        assert resampling_orders([2.0, 1.0, 1.0], [1.0, 1.0, 1.0], {**kwargs, 'force_separate_z': True}) \
+            == [0, 3, 3]
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from segmentation.models import SegmentationTask
+from segmentation.tasks import preprocess_segmentation_task, PREPROCESSING_PROGRESS
+
+
+def _upload(tmp_path, data, zooms):
+    path = tmp_path / "scan.nii.gz"
+    nib.save(nib.Nifti1Image(data, np.diag([*zooms, 1.0])), str(path))
+    return SimpleUploadedFile("scan.nii.gz", path.read_bytes(), content_type="application/gzip")
+
+
+@pytest.mark.django_db
+class TestPreprocessSegmentationTask:
+    """Test cases for the asynchronous preprocessing stage"""
+
+    def test_resamples_and_queues(self, tmp_path):
+        """Test the upload is resampled to 1 mm in place and queued for segmentation"""
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media")):
+            task = SegmentationTask.objects.create(
+                file_name="scan.nii.gz",
+                nifti_file=_upload(tmp_path, np.ones((4, 4, 4), dtype=np.float32), (2.0, 2.0, 2.0)),
+                status="preprocessing"
+            )
+
+            with patch('segmentation.tasks.process_segmentation_task.delay') as mock_process:
+                preprocess_segmentation_task(str(task.id))
+
+            task.refresh_from_db()
+            resampled = nib.load(task.nifti_file.path)
+            assert resampled.header.get_zooms()[:3] == (1.0, 1.0, 1.0)
+            assert resampled.shape == (7, 7, 7)
+            assert os.listdir(os.path.dirname(task.nifti_file.path)) == [os.path.basename(task.nifti_file.path)]
+
+        assert task.status == 'queued'
+        assert task.progress == PREPROCESSING_PROGRESS['queued']
+        mock_process.assert_called_once_with(str(task.id))
+
+    def test_resampling_failure_keeps_full_resolution(self, tmp_path):
+        """Test a scan that cannot be resampled is still queued unchanged"""
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media")):
+            task = SegmentationTask.objects.create(
+                file_name="scan.nii.gz",
+                nifti_file=SimpleUploadedFile("scan.nii.gz", b"not a nifti"),
+                status="preprocessing"
+            )
+
+            with patch('segmentation.tasks.process_segmentation_task.delay') as mock_process:
+                preprocess_segmentation_task(str(task.id))
+
+            task.refresh_from_db()
+            with open(task.nifti_file.path, 'rb') as f:
+                assert f.read() == b"not a nifti"
+
+        assert task.status == 'queued'
+        mock_process.assert_called_once_with(str(task.id))
+
+    def test_stores_body_crop(self, tmp_path):
+        """Test the body bounding box is stored on the task and the upload keeps its geometry"""
+        image = np.full((24, 24, 6), -1000, dtype=np.int16)
+        image[6:18, 4:16, :] = 40
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media"), SEGMENTATION_BODY_STEP_MM=2.0,
+                               SEGMENTATION_BODY_MARGIN_MM=2.0):
+            task = SegmentationTask.objects.create(
+                file_name="scan.nii.gz",
+                nifti_file=_upload(tmp_path, image, (1.0, 1.0, 1.0)),
+                status="preprocessing"
+            )
+
+            with patch('segmentation.tasks.process_segmentation_task.delay'):
+                preprocess_segmentation_task(str(task.id))
+
+            task.refresh_from_db()
+            assert nib.load(task.nifti_file.path).shape == (24, 24, 6)
+
+        # 2 mm samples: the box runs from just after the last air sample, padded by 2 voxels
+        assert task.body_bbox == [[3, 20], [1, 18], [0, 6]]
+        assert task.status == 'queued'
+
+    def test_body_crop_disabled(self, tmp_path):
+        """Test no crop is stored when the body crop is switched off"""
+        image = np.full((24, 24, 6), -1000, dtype=np.int16)
+        image[6:18, 4:16, :] = 40
+        with override_settings(MEDIA_ROOT=str(tmp_path / "media"), SEGMENTATION_BODY_CROP=False):
+            task = SegmentationTask.objects.create(
+                file_name="scan.nii.gz",
+                nifti_file=_upload(tmp_path, image, (1.0, 1.0, 1.0)),
+                status="preprocessing"
+            )
+
+            with patch('segmentation.tasks.process_segmentation_task.delay'):
+                preprocess_segmentation_task(str(task.id))
+
+        task.refresh_from_db()
+        assert task.body_bbox is None
+
+    def test_missing_task(self):
+        """Test a deleted task is not queued"""
+        with patch('segmentation.tasks.process_segmentation_task.delay') as mock_process:
+            preprocess_segmentation_task("00000000-0000-0000-0000-000000000000")
+
+        mock_process.assert_not_called()
@@ -0,0 +1,115 @@
+import os
+import hashlib
+import pytest
+from datetime import timedelta
+from unittest.mock import patch
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from segmentation.models import ChunkedUpload, SegmentationTask
+from segmentation.uploads import expire_uploads
+
+
+CONTENT = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.fixture
+def upload_dirs(tmp_path):
+    with override_settings(MEDIA_ROOT=str(tmp_path / "media"),
+                           CHUNKED_UPLOAD_DIR=str(tmp_path / "chunks"),
+                           CHUNKED_UPLOAD_MAX_CHUNK_SIZE=4096):
+        yield tmp_path
+
+
+def _start(api_client, **data):
+    payload = {'file_name': 'scan.nii.gz', 'total_size': len(CONTENT), 'chunk_size': 4096, **data}
+    return api_client.post(reverse('chunked-upload-list'), payload, format='json')
+
+
+def _put_chunk(api_client, upload_id, index, body, checksum=None):
+    url = reverse('chunked-upload-chunk', kwargs={'pk': upload_id, 'index': index})
+    return api_client.put(url, data=body, content_type='application/octet-stream',
+                          HTTP_X_CHUNK_SHA256=checksum or hashlib.sha256(body).hexdigest())
+
+
+def _chunk(index):
+    return CONTENT[index * 4096:(index + 1) * 4096]
+
+
+@pytest.mark.django_db
+class TestChunkedUpload:
+    """Test cases for the resumable chunked upload API"""
+
+    def test_upload_out_of_order_and_complete(self, api_client, upload_dirs):
+        """Test chunks in any order assemble the file and completion queues a task"""
+        response = _start(api_client, inference_tier='fast', sha256=hashlib.sha256(CONTENT).hexdigest())
+        assert response.status_code == status.HTTP_201_CREATED
+        upload_id = response.json()['id']
+        assert response.json()['total_chunks'] == 3
+
+        for index in (2, 0, 1):
+            assert _put_chunk(api_client, upload_id, index, _chunk(index)).status_code == status.HTTP_200_OK
+
+        with patch('segmentation.tasks.preprocess_segmentation_task.delay') as mock_preprocess:
+            response = api_client.post(reverse('chunked-upload-complete', kwargs={'pk': upload_id}))
+
+        assert response.status_code == status.HTTP_201_CREATED
+        task = SegmentationTask.objects.get(id=response.json()['task_id'])
+        assert task.status == 'preprocessing'
+        assert task.inference_tier == 'fast'
+        assert task.file_name == 'scan.nii.gz'
+        with open(task.nifti_file.path, 'rb') as f:
+            assert f.read() == CONTENT
+        assert not os.listdir(upload_dirs / "chunks")
+        mock_preprocess.assert_called_once_with(str(task.id))
+
+        # Completing again returns the same task without queueing it twice
+        with patch('segmentation.tasks.preprocess_segmentation_task.delay') as mock_preprocess:
+            response = api_client.post(reverse('chunked-upload-complete', kwargs={'pk': upload_id}))
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['task_id'] == str(task.id)
+        mock_preprocess.assert_not_called()
+
+    def test_resume_after_bad_chunk(self, api_client, upload_dirs):
+        """Test a truncated or corrupted chunk is rejected and can be re-sent"""
+        upload_id = _start(api_client).json()['id']
+
+        assert _put_chunk(api_client, upload_id, 0, _chunk(0)).status_code == status.HTTP_200_OK
+        truncated = _chunk(1)[:1000]
+        assert _put_chunk(api_client, upload_id, 1, truncated).status_code == status.HTTP_400_BAD_REQUEST
+        corrupted = _put_chunk(api_client, upload_id, 1, _chunk(1), checksum=hashlib.sha256(b"x").hexdigest())
+        assert corrupted.status_code == status.HTTP_400_BAD_REQUEST
+
+        state = api_client.get(reverse('chunked-upload-detail', kwargs={'pk': upload_id})).json()
+        assert state['received_chunks'] == [0]
+        assert state['missing_chunks'] == [1, 2]
+
+        response = api_client.post(reverse('chunked-upload-complete', kwargs={'pk': upload_id}))
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert 'missing 2 chunk(s)' in response.json()['error']
+
+    def test_rejects_invalid_uploads(self, api_client, upload_dirs):
+        """Test size limits, tiers, chunk indices and oversized chunks are validated"""
+        assert _start(api_client, total_size=0).status_code == status.HTTP_400_BAD_REQUEST
+        assert _start(api_client, chunk_size=8192).status_code == status.HTTP_400_BAD_REQUEST
+        assert _start(api_client, inference_tier='turbo').status_code == status.HTTP_400_BAD_REQUEST
+
+        upload_id = _start(api_client).json()['id']
+        assert _put_chunk(api_client, upload_id, 3, _chunk(0)).status_code == status.HTTP_400_BAD_REQUEST
+        oversized = _chunk(0) + b"extra"
+        assert _put_chunk(api_client, upload_id, 0, oversized).status_code == status.HTTP_400_BAD_REQUEST
+        assert ChunkedUpload.objects.get(id=upload_id).received_chunks == []
+
+    def test_abort_and_expire(self, api_client, upload_dirs):
+        """Test aborted and stale uploads remove their partial files"""
+        aborted = _start(api_client).json()['id']
+        stale = ChunkedUpload.objects.get(id=_start(api_client).json()['id'])
+
+        response = api_client.delete(reverse('chunked-upload-detail', kwargs={'pk': aborted}))
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+
+        ChunkedUpload.objects.filter(id=stale.id).update(updated_at=timezone.now() - timedelta(days=2))
+        assert expire_uploads(max_age_hours=24) == 1
+        assert not ChunkedUpload.objects.exists()
+        assert not os.listdir(upload_dirs / "chunks")
@@ -16,7 +16,7 @@ class TestSegmentationTaskViewSet:
         """Test successful creation of segmentation task"""
         url = reverse('segmentation-task-list')
         
-        with patch('segmentation.views.process_segmentation_task.delay') as mock_task:
+        with patch('segmentation.views.preprocess_segmentation_task.delay') as mock_task:
             response = api_client.post(url, {
                 'nifti_file': test_nifti_file
             }, format='multipart')
@@ -25,15 +25,42 @@ class TestSegmentationTaskViewSet:
         data = response.json()
         
         assert 'task_id' in data
-        assert data['status'] == 'queued'
+        assert data['status'] == 'preprocessing'
         
         # Verify task was created in database
         task = SegmentationTask.objects.get(id=data['task_id'])
-        assert task.status == 'queued'
+        assert task.status == 'preprocessing'
+        assert task.progress == 0
         assert task.file_name == 'test_scan.nii.gz'
         
-        # Verify async task was called
-        mock_task.assert_called_once()
+        # Verify async preprocessing was queued
+        mock_task.assert_called_once_with(str(task.id))
+    
+    def test_create_segmentation_task_with_tier(self, api_client, test_nifti_file):
+        """Test the inference tier is taken from the upload"""
+        url = reverse('segmentation-task-list')
+        
+        with patch('segmentation.views.preprocess_segmentation_task.delay'):
+            response = api_client.post(url, {
+                'nifti_file': test_nifti_file,
+                'inference_tier': 'fast'
+            }, format='multipart')
+        
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.json()['inference_tier'] == 'fast'
+        assert SegmentationTask.objects.get(id=response.json()['task_id']).inference_tier == 'fast'
+    
+    def test_create_segmentation_task_invalid_tier(self, api_client, test_nifti_file):
+        """Test creation fails for an unknown inference tier"""
+        url = reverse('segmentation-task-list')
+        
+        response = api_client.post(url, {
+            'nifti_file': test_nifti_file,
+            'inference_tier': 'turbo'
+        }, format='multipart')
+        
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert SegmentationTask.objects.count() == 0
     
     def test_create_segmentation_task_no_file(self, api_client):
         """Test creation fails when no file is uploaded"""
@@ -46,54 +73,18 @@ class TestSegmentationTaskViewSet:
         assert 'error' in data
         assert data['error'] == 'No file uploaded'
     
-    def test_create_segmentation_task_with_downsampling(self, api_client, test_nifti_file):
-        """Test file downsampling during task creation"""
+    def test_create_segmentation_task_does_not_resample(self, api_client, test_nifti_file):
+        """Test the upload request returns without loading the image"""
         url = reverse('segmentation-task-list')
         
-        # Mock nibabel functions
-        with patch('segmentation.views.nib.load') as mock_load, \
-             patch('segmentation.views.resample_to_output') as mock_resample, \
-             patch('segmentation.views.nib.save') as mock_save, \
-             patch('segmentation.views.process_segmentation_task.delay') as mock_task:
-            
-            # Setup mocks
-            mock_img = MagicMock()
-            mock_img_ds = MagicMock()
-            mock_load.return_value = mock_img
-            mock_resample.return_value = mock_img_ds
-            
+        with patch('segmentation.resampling.ChunkedResampler.resample_file') as mock_resample, \
+             patch('segmentation.views.preprocess_segmentation_task.delay'):
             response = api_client.post(url, {
                 'nifti_file': test_nifti_file
             }, format='multipart')
         
         assert response.status_code == status.HTTP_201_CREATED
-        
-        # Verify downsampling was attempted
-        mock_load.assert_called_once()
-        mock_resample.assert_called_once_with(mock_img, voxel_sizes=(1.0, 1.0, 1.0))
-        mock_save.assert_called_once()
-    
-    def test_create_segmentation_task_downsampling_error(self, api_client, test_nifti_file):
-        """Test task creation continues when downsampling fails"""
-        url = reverse('segmentation-task-list')
-        
-        with patch('segmentation.views.nib.load', side_effect=Exception("Nibabel error")), \
-             patch('segmentation.views.process_segmentation_task.delay') as mock_task, \
-             patch('builtins.print') as mock_print:
-            
-            response = api_client.post(url, {
-                'nifti_file': test_nifti_file
-            }, format='multipart')
-        
-        assert response.status_code == status.HTTP_201_CREATED
-        
-        # Verify warning was printed
-        mock_print.assert_called()
-        warning_call = mock_print.call_args[0][0]
-        assert "Warning: down‐sampling failed" in warning_call
-        
-        # Task should still be created and processed
-        mock_task.assert_called_once()
+        mock_resample.assert_not_called()
     
     def test_retrieve_segmentation_task(self, api_client, sample_segmentation_task):
         """Test retrieving a segmentation task"""
@@ -240,7 +231,7 @@ class TestSegmentationTaskAuthentication:
         client = APIClient()
         url = reverse('segmentation-task-list')
         
-        with patch('segmentation.views.process_segmentation_task.delay'):
+        with patch('segmentation.views.preprocess_segmentation_task.delay'):
             response = client.post(url, {
                 'nifti_file': test_nifti_file
             }, format='multipart')
@@ -258,7 +249,7 @@ class TestSegmentationTaskAuthentication:
         client.force_authenticate(user=test_user)
         url = reverse('segmentation-task-list')
         
-        with patch('segmentation.views.process_segmentation_task.delay'):
+        with patch('segmentation.views.preprocess_segmentation_task.delay'):
             response = client.post(url, {
                 'nifti_file': test_nifti_file
             }, format='multipart')
@@ -0,0 +1,162 @@
+import io
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from unittest.mock import patch
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from segmentation.models import SegmentationTask
+from segmentation.volume_cache import VolumeCache, extract_slice
+
+
+def _nifti_bytes(tmp_path, data, name):
+    path = tmp_path / name
+    nib.save(nib.Nifti1Image(data, np.diag([0.8, 0.8, 2.0, 1.0])), str(path))
+    return path
+
+
+@pytest.fixture
+def volume_dirs(tmp_path):
+    with override_settings(MEDIA_ROOT=str(tmp_path / "media"), VOLUME_CACHE_DIR=str(tmp_path / "volumes")):
+        yield tmp_path
+
+
+@pytest.fixture
+def viewable_task(volume_dirs):
+    image = np.arange(6 * 5 * 4, dtype=np.int16).reshape(6, 5, 4) * 10 - 1000
+    tumor = np.zeros((6, 5, 4), dtype=np.uint8)
+    tumor[2:4, 1:3, 1] = 1
+    image_path = _nifti_bytes(volume_dirs, image, "scan.nii.gz")
+    tumor_path = _nifti_bytes(volume_dirs, tumor, "tumor.nii.gz")
+    task = SegmentationTask.objects.create(
+        file_name="scan.nii.gz",
+        nifti_file=SimpleUploadedFile("scan.nii.gz", image_path.read_bytes()),
+        tumor_segmentation=SimpleUploadedFile("tumor.nii.gz", tumor_path.read_bytes()),
+        status="completed",
+        preview_slice=1,
+    )
+    return task, image, tumor
+
+
+class TestVolumeCache:
+    """Test cases for the memory-mapped volume cache"""
+
+    def test_builds_once_and_rebuilds_on_replace(self, tmp_path):
+        """Test a volume is decoded once and again only after its file is replaced"""
+        data = np.random.RandomState(0).randint(-1000, 1000, (7, 6, 9)).astype(np.int16)
+        source = _nifti_bytes(tmp_path, data, "scan.nii.gz")
+        cache = VolumeCache(cache_dir=tmp_path / "cache", slab_size=4)
+
+        with patch.object(VolumeCache, '_build', wraps=cache._build) as mock_build:
+            volume, meta = cache.volume("task", "image", str(source))
+            cache.volume("task", "image", str(source))
+            assert mock_build.call_count == 1
+
+            replacement = _nifti_bytes(tmp_path, data + 1, "replacement.nii.gz")
+            os.replace(replacement, source)
+            replaced, _ = cache.volume("task", "image", str(source))
+            assert mock_build.call_count == 2
+
+        assert isinstance(volume, np.memmap) and volume.flags.f_contiguous
+        np.testing.assert_array_equal(volume, data)
+        np.testing.assert_array_equal(replaced, data + 1)
+        assert meta['shape'] == [7, 6, 9] and meta['dtype'] == 'int16'
+        assert meta['zooms'] == pytest.approx([0.8, 0.8, 2.0])
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Test the oldest task entries are removed above the size limit"""
+        source = _nifti_bytes(tmp_path, np.zeros((10, 10, 10), dtype=np.int16), "scan.nii.gz")
+        cache = VolumeCache(cache_dir=tmp_path / "cache", max_bytes=3000)
+
+        cache.volume("old", "image", str(source))
+        os.utime(tmp_path / "cache" / "old", (0, 0))
+        cache.volume("new", "image", str(source))
+
+        assert os.listdir(tmp_path / "cache") == ["new"]
+
+    def test_extract_slice_orientation(self):
+        """Test slices are transposed so rows run along the plane's second axis"""
+        volume = np.arange(24).reshape(2, 3, 4)
+
+        np.testing.assert_array_equal(extract_slice(volume, 'axial', 1), volume[:, :, 1].T)
+        np.testing.assert_array_equal(extract_slice(volume, 'coronal', 2), volume[:, 2, :].T)
+        np.testing.assert_array_equal(extract_slice(volume, 'sagittal', 0), volume[0].T)
+        with pytest.raises(IndexError):
+            extract_slice(volume, 'axial', 4)
+
+
+@pytest.mark.django_db
+class TestSliceEndpoints:
+    """Test cases for the slice-serving API"""
+
+    def test_slice_metadata(self, api_client, viewable_task):
+        """Test the geometry and available layers are reported"""
+        task, _, _ = viewable_task
+
+        response = api_client.get(reverse('segmentation-task-slices', kwargs={'pk': task.id}))
+
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert data['shape'] == [6, 5, 4]
+        assert data['slice_counts'] == {'sagittal': 6, 'coronal': 5, 'axial': 4}
+        assert data['layers'] == ['image', 'tumor']
+        assert data['preview_slice'] == 1
+
+    def test_raw_slices(self, api_client, viewable_task):
+        """Test uint16 image and uint8 mask slices round-trip exactly"""
+        task, image, tumor = viewable_task
+        url = reverse('segmentation-task-slice', kwargs={'pk': task.id, 'plane': 'axial', 'index': 1})
+
+        response = api_client.get(url, {'encoding': 'uint16'})
+        assert response.status_code == status.HTTP_200_OK
+        rows, cols = (int(value) for value in response['X-Slice-Shape'].split(','))
+        values = np.frombuffer(response.content, dtype=response['X-Slice-Dtype']).reshape(rows, cols)
+        np.testing.assert_array_equal(values.astype(np.int64) + int(response['X-Value-Offset']), image[:, :, 1].T)
+
+        response = api_client.get(url, {'encoding': 'uint8', 'layer': 'tumor'})
+        mask = np.frombuffer(response.content, dtype=np.uint8).reshape(5, 6)
+        np.testing.assert_array_equal(mask, tumor[:, :, 1].T)
+
+    def test_png_with_overlay(self, api_client, viewable_task):
+        """Test PNG slices blend the tumor overlay in colour"""
+        task, _, tumor = viewable_task
+        url = reverse('segmentation-task-slice', kwargs={'pk': task.id, 'plane': 'axial', 'index': 1})
+
+        response = api_client.get(url, {'overlay': 'tumor', 'window': '-900,400'})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'] == 'image/png'
+        pixels = np.asarray(Image.open(io.BytesIO(response.content)))
+        assert pixels.shape == (5, 6, 3)
+        overlaid = tumor[:, :, 1].T > 0
+        assert (pixels[overlaid][:, 0] > pixels[overlaid][:, 2]).all()
+        assert (pixels[~overlaid][:, 0] == pixels[~overlaid][:, 2]).all()
+
+    def test_overlay_shape_mismatch(self, api_client, viewable_task, volume_dirs):
+        """Test an overlay mask on another grid than the image is a conflict, not a server error"""
+        task, _, _ = viewable_task
+        lung_path = _nifti_bytes(volume_dirs, np.ones((3, 5, 2), dtype=np.uint8), "lung.nii.gz")
+        task.lung_segmentation = SimpleUploadedFile("lung.nii.gz", lung_path.read_bytes())
+        task.save()
+        url = reverse('segmentation-task-slice', kwargs={'pk': task.id, 'plane': 'sagittal', 'index': 4})
+
+        response = api_client.get(url, {'overlay': 'lung'})
+
+        assert response.status_code == status.HTTP_409_CONFLICT
+
+    def test_invalid_requests(self, api_client, viewable_task):
+        """Test bad parameters, missing layers and out-of-range slices"""
+        task, _, _ = viewable_task
+
+        def get(index=0, **params):
+            url = reverse('segmentation-task-slice', kwargs={'pk': task.id, 'plane': 'axial', 'index': index})
+            return api_client.get(url, params)
+
+        assert get(encoding='jpeg').status_code == status.HTTP_400_BAD_REQUEST
+        assert get(window='wide').status_code == status.HTTP_400_BAD_REQUEST
+        assert get(layer='lung').status_code == status.HTTP_404_NOT_FOUND
+        assert get(index=4).status_code == status.HTTP_404_NOT_FOUND
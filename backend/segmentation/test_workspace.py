@@ -0,0 +1,47 @@
+import os
+import time
+from segmentation.workspace import TaskWorkspace, cleanup_stale_workspaces
+
+
+class TestTaskWorkspace:
+    """Test cases for per-task scratch workspaces"""
+
+    def test_workspace_lifecycle(self, tmp_path):
+        """Test the workspace is created on enter and removed on exit"""
+        with TaskWorkspace("task-1", root=str(tmp_path)) as workspace:
+            assert os.path.basename(workspace.path).startswith("task_task-1_")
+            assert os.path.isdir(workspace.input_dir)
+            output_dir = workspace.output_dir("tumor_segmentation")
+            assert os.path.isdir(output_dir)
+            assert output_dir.startswith(workspace.path)
+
+        assert not os.path.exists(workspace.path)
+
+    def test_workspaces_are_isolated(self, tmp_path):
+        """Test two workspaces for the same task do not share directories"""
+        with TaskWorkspace("task-1", root=str(tmp_path)) as first, \
+             TaskWorkspace("task-1", root=str(tmp_path)) as second:
+            assert first.input_dir != second.input_dir
+
+    def test_workspace_removed_on_error(self, tmp_path):
+        """Test the workspace is cleaned up when prediction fails"""
+        try:
+            with TaskWorkspace("task-1", root=str(tmp_path)) as workspace:
+                raise RuntimeError("prediction failed")
+        except RuntimeError:
+            pass
+
+        assert not os.path.exists(workspace.path)
+
+    def test_cleanup_stale_workspaces(self, tmp_path):
+        """Test only abandoned workspaces are removed"""
+        stale = tmp_path / "task_old_abc"
+        fresh = tmp_path / "task_new_def"
+        stale.mkdir()
+        fresh.mkdir()
+        old_time = time.time() - 48 * 3600
+        os.utime(stale, (old_time, old_time))
+
+        assert cleanup_stale_workspaces(max_age_hours=24, root=str(tmp_path)) == 1
+        assert not stale.exists()
+        assert fresh.exists()
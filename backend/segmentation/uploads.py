@@ -0,0 +1,202 @@
+import os
+import hashlib
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+# uploads.py
+logger = logging.getLogger(__name__)
+
+# Bytes read from the request and hashed at a time
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadConflict(Exception):
+    """Raised when an upload is not in a state that allows the request"""
+
+
+def create_upload(file_name, total_size, chunk_size, inference_tier, sha256=''):
+    """
+    Start a resumable upload and preallocate its file
+
+    Args:
+        file_name: Name of the NIfTI file being uploaded
+        total_size: Size of the whole file in bytes
+        chunk_size: Size of every chunk but the last in bytes
+        inference_tier: Inference tier of the task created on completion
+        sha256: Optional hex checksum of the whole file
+
+    Returns:
+        The new ChunkedUpload
+
+    Raises:
+        ValueError: If the sizes are out of range
+    """
+    from .models import ChunkedUpload
+
+    if not 0 < total_size <= settings.CHUNKED_UPLOAD_MAX_SIZE:
+        raise ValueError(f"total_size must be between 1 and {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes")
+    if not 0 < chunk_size <= settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE:
+        raise ValueError(f"chunk_size must be between 1 and {settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE} bytes")
+
+    upload = ChunkedUpload.objects.create(
+        file_name=os.path.basename(file_name),
+        total_size=total_size,
+        chunk_size=chunk_size,
+        inference_tier=inference_tier,
+        sha256=sha256.lower(),
+    )
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    # Sparse on most filesystems; chunks are written in place at their offsets
+    with open(upload.part_path, 'wb') as f:
+        f.truncate(total_size)
+    logger.info(f"Started upload {upload.id} of {file_name}: {total_size} bytes in {upload.total_chunks} chunk(s)")
+    return upload
+
+
+def write_chunk(upload, index, stream, sha256):
+    """
+    Stream one chunk from the request body to its offset in the upload file
+
+    The chunk is only recorded as received once its length and checksum match,
+    so a retry after a dropped connection simply overwrites the partial bytes.
+    Memory use is one copy buffer regardless of the chunk size.
+
+    Args:
+        upload: ChunkedUpload receiving the chunk
+        index: Zero-based chunk number
+        stream: File-like request body
+        sha256: Hex SHA-256 of the chunk as sent by the client
+
+    Returns:
+        The updated ChunkedUpload
+
+    Raises:
+        ValueError: If the index, length or checksum is wrong
+        UploadConflict: If the upload was already completed
+    """
+    from .models import ChunkedUpload
+
+    if upload.status != 'uploading':
+        raise UploadConflict(f"Upload {upload.id} is already {upload.status}")
+    if not 0 <= index < upload.total_chunks:
+        raise ValueError(f"Chunk index must be between 0 and {upload.total_chunks - 1}")
+    if not sha256:
+        raise ValueError("A SHA-256 checksum of the chunk is required")
+
+    expected = upload.chunk_length(index)
+    digest = hashlib.sha256()
+    written = 0
+    with open(upload.part_path, 'r+b') as f:
+        f.seek(index * upload.chunk_size)
+        while written <= expected:
+            # Read one byte past the chunk to detect oversized bodies
+            block = stream.read(min(COPY_BUFFER_SIZE, expected + 1 - written))
+            if not block:
+                break
+            if written + len(block) > expected:
+                raise ValueError(f"Chunk {index} is larger than the expected {expected} bytes")
+            digest.update(block)
+            f.write(block)
+            written += len(block)
+
+    if written != expected:
+        raise ValueError(f"Chunk {index} has {written} bytes, expected {expected}")
+    if digest.hexdigest() != sha256.lower():
+        raise ValueError(f"Checksum mismatch for chunk {index}")
+
+    # Chunks may arrive in parallel, so record them under a row lock
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+        if index not in upload.received_chunks:
+            upload.received_chunks = sorted([*upload.received_chunks, index])
+            upload.save(update_fields=['received_chunks', 'updated_at'])
+    return upload
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete_upload(upload):
+    """
+    Turn a fully received upload into a SegmentationTask and queue its preprocessing
+
+    The upload file is moved into the media uploads directory, never copied.
+    Completing an already completed upload returns its task.
+
+    Args:
+        upload: ChunkedUpload to complete
+
+    Returns:
+        Tuple of (SegmentationTask, whether it was created by this call)
+
+    Raises:
+        ValueError: If chunks are missing or the whole-file checksum does not match
+    """
+    from .models import ChunkedUpload, SegmentationTask, nifti_file_path
+    from .tasks import preprocess_segmentation_task
+
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.status == 'completed':
+            return upload.task, False
+
+        missing = upload.missing_chunks
+        if missing:
+            raise ValueError(f"Upload is missing {len(missing)} chunk(s): {missing[:20]}")
+        if upload.sha256 and _file_sha256(upload.part_path) != upload.sha256:
+            raise ValueError("Checksum mismatch for the assembled file")
+
+        task = SegmentationTask(
+            file_name=upload.file_name,
+            status='preprocessing',
+            inference_tier=upload.inference_tier,
+        )
+        task.nifti_file.name = nifti_file_path(task, upload.file_name)
+        destination = os.path.join(settings.MEDIA_ROOT, task.nifti_file.name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(upload.part_path, destination)
+        task.save()
+
+        upload.status = 'completed'
+        upload.task = task
+        upload.save(update_fields=['status', 'task', 'updated_at'])
+
+    preprocess_segmentation_task.delay(str(task.id))
+    logger.info(f"Completed upload {upload.id} as task {task.id}")
+    return task, True
+
+
+def discard_upload(upload):
+    """
+    Delete an upload and its partial file
+    """
+    if os.path.exists(upload.part_path):
+        os.remove(upload.part_path)
+    upload.delete()
+
+
+def expire_uploads(max_age_hours=None):
+    """
+    Remove unfinished uploads not touched within max_age_hours
+
+    Returns:
+        Number of uploads removed
+    """
+    from .models import ChunkedUpload
+
+    max_age_hours = settings.CHUNKED_UPLOAD_EXPIRY_HOURS if max_age_hours is None else max_age_hours
+    cutoff = timezone.now() - timedelta(hours=max_age_hours)
+    expired = ChunkedUpload.objects.filter(status='uploading', updated_at__lt=cutoff)
+    count = 0
+    for upload in expired:
+        discard_upload(upload)
+        count += 1
+    return count
@@ -13,14 +13,26 @@ PUT/PATCH /tasks/<pk>/ -> Calls update() to update a specific task.
 DELETE /tasks/<pk>/ -> Calls destroy() to delete a specific task.
 
 GET /tasks/<pk>/status/ -> Calls status() because it is a custom action with the @action decorator.
+
+GET /tasks/<pk>/segmentations/<tumor|lung>/ -> Redirects to a separate mask, extracting it from the fused volume if needed.
+
+POST /uploads/ -> Starts a resumable chunked upload.
+
+PUT /uploads/<pk>/chunks/<index>/ -> Stores one chunk (raw body, X-Chunk-SHA256 header).
+
+POST /uploads/<pk>/complete/ -> Creates the segmentation task from a finished upload.
+
+GET /lesions/?min_diameter=30 -> Lists lesions across tasks, filtered by diameter, volume or task.
 """
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import SegmentationTaskViewSet
+from .views import SegmentationTaskViewSet, ChunkedUploadViewSet, LesionViewSet
 
 # Create a router and register our viewsets
 router = DefaultRouter()
 router.register(r'tasks', SegmentationTaskViewSet, basename='segmentation-task')
+router.register(r'uploads', ChunkedUploadViewSet, basename='chunked-upload')
+router.register(r'lesions', LesionViewSet, basename='lesion')
 
 # The API URLs are determined automatically by the router
 urlpatterns = [
@@ -3,17 +3,32 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.utils import timezone
-from .models import SegmentationTask
-from .serializers import SegmentationTaskSerializer, SegmentationTaskDetailSerializer
-from .tasks import process_segmentation_task
+from .models import SegmentationTask, ChunkedUpload, Lesion
+from .serializers import (
+    SegmentationTaskSerializer, SegmentationTaskDetailSerializer, ChunkedUploadSerializer, LesionSerializer
+)
+from .tasks import preprocess_segmentation_task
+from .mask_encoding import ENCODINGS, MaskEncodingStore
+from .meshes import MeshStore
+from .pyramid import VolumePyramid
+from .fused import mask_sources, materialize_layer
+from .uploads import UploadConflict, create_upload, write_chunk, complete_upload, discard_upload
+from .volume_cache import (
+    LAYERS, PLANES, DEFAULT_WINDOW, OVERLAY_COLORS, VolumeCache,
+    extract_slice, window_to_uint8, to_uint16, render_png
+)
+from django.http import HttpResponse, HttpResponseRedirect
+from django.urls import reverse
 import logging
 from django.conf import settings
+import io
 import os
-from nibabel.processing import resample_to_output
-import nibabel as nib 
 import traceback
+import uuid
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -35,31 +50,27 @@ class SegmentationTaskViewSet(viewsets.ModelViewSet):
         if not nifti_file:
             return Response({"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Speed/quality tier: fast for triage, full ensemble for final reads
+        inference_tier = request.data.get("inference_tier") or settings.NNUNET_DEFAULT_TIER
+        if inference_tier not in dict(SegmentationTask.INFERENCE_TIER_CHOICES):
+            return Response(
+                {"error": f"Invalid inference tier '{inference_tier}'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         # 1) Save the uploaded file
         task = SegmentationTask.objects.create(
             file_name=nifti_file.name,
             nifti_file=nifti_file,
-            status="queued"
+            status="preprocessing",
+            inference_tier=inference_tier
         )
 
-        # 2) Down‐sample in place to 2 mm³ voxels
-        input_path = task.nifti_file.path
-        try:
-            # Load full‑resolution image
-            img = nib.load(input_path)
-            # Resample to 2×2×2 mm voxels
-            img_ds = resample_to_output(img, voxel_sizes=(1.0,1.0,1.0))
-            # Overwrite the original file with the smaller one
-            nib.save(img_ds, input_path)
-        except Exception as e:
-            # If something goes wrong, log and continue with full‑res
-            print(f"Warning: down‐sampling failed for task {task.id}: {e}")
-
-        # 3) Now kick off the async segmentation on the (now reduced) file
-        process_segmentation_task.delay(str(task.id))
+        # 2) Resample in the background; the task is queued for segmentation afterwards
+        preprocess_segmentation_task.delay(str(task.id))
 
         return Response(
-            {"task_id": task.id, "status": task.status},
+            {"task_id": task.id, "status": task.status, "inference_tier": task.inference_tier},
             status=status.HTTP_201_CREATED
         )
     
@@ -97,6 +108,9 @@ class SegmentationTaskViewSet(viewsets.ModelViewSet):
                     lung_path = task.lung_segmentation.path
                     files_to_check.append(('lung_segmentation', lung_path))
                 
+                if task.fused_segmentation:
+                    files_to_check.append(('fused_segmentation', task.fused_segmentation.path))
+                
                 # Verify files exist
                 missing_files = []
                 for file_type, file_path in files_to_check:
@@ -123,4 +137,385 @@ class SegmentationTaskViewSet(viewsets.ModelViewSet):
             return Response(
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )
+    
+    def _layer_volume(self, task, layer):
+        """
+        Memory-mapped volume of a task layer, or None if the task has no such file
+        
+        Masks are read from the fused volume when the task only has that.
+        """
+        if layer == 'image':
+            source = task.nifti_file.path if task.nifti_file and os.path.exists(task.nifti_file.path) else None
+        else:
+            source = mask_sources(task).get(layer)
+        if source is None:
+            return None, None
+        return VolumeCache().volume(task.id, layer, source)
+    
+    @action(detail=True, methods=['get'])
+    def slices(self, request, pk=None):
+        """
+        Geometry of a task's volume and the layers its slices can be requested for
+        """
+        task = self.get_object()
+        volume, meta = self._layer_volume(task, 'image')
+        if volume is None:
+            return Response({"error": "Input volume not found"}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            "shape": meta['shape'],
+            "dtype": meta['dtype'],
+            "zooms": meta['zooms'],
+            "affine": meta['affine'],
+            "slice_counts": {plane: meta['shape'][axis] for plane, axis in PLANES.items()},
+            "layers": ["image", *mask_sources(task)],
+            "preview_slice": task.preview_slice,
+        })
+    
+    @action(detail=True, methods=['get'], url_name='slice',
+            url_path=r'slices/(?P<plane>axial|coronal|sagittal)/(?P<index>\d+)')
+    def slice_data(self, request, pk=None, plane=None, index=None):
+        """
+        One slice of a task layer, served from the memory-mapped volume cache
+        
+        Query parameters:
+            layer: 'image' (default), 'tumor' or 'lung'
+            encoding: 'png' (default), 'uint8' or 'uint16'; raw encodings are row-major
+                bytes described by the X-Slice-Shape and X-Slice-Dtype headers
+            window: 'center,width' intensity window for png/uint8 images (default lung window)
+            overlay: Comma-separated mask layers blended over a png image
+        """
+        task = self.get_object()
+        layer = request.query_params.get("layer", "image")
+        encoding = request.query_params.get("encoding", "png")
+        overlays = [name for name in request.query_params.get("overlay", "").split(",") if name]
+        if layer not in LAYERS or encoding not in ("png", "uint8", "uint16") \
+                or any(name not in OVERLAY_COLORS for name in overlays):
+            return Response({"error": "Invalid layer, encoding or overlay"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            center, width = (float(value) for value in request.query_params.get(
+                "window", ",".join(str(value) for value in DEFAULT_WINDOW)).split(","))
+        except ValueError:
+            return Response({"error": "window must be 'center,width'"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        volume, _ = self._layer_volume(task, layer)
+        if volume is None:
+            return Response({"error": f"No {layer} volume for this task"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            values = extract_slice(volume, plane, int(index))
+        except IndexError as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        
+        offset = None
+        if layer != "image":
+            # Masks keep their labels; PNGs show any label as white
+            pixels = (values > 0).astype(np.uint8) * 255 if encoding == "png" else values
+            pixels = pixels.astype(np.uint16 if encoding == "uint16" else np.uint8)
+        elif encoding == "uint16":
+            pixels, offset = to_uint16(values)
+        else:
+            pixels = window_to_uint8(values, center, width)
+        
+        headers = {
+            "Cache-Control": "private, max-age=3600",
+            "X-Slice-Shape": f"{pixels.shape[0]},{pixels.shape[1]}",
+        }
+        if encoding == "png":
+            overlay_slices = []
+            for name in overlays:
+                mask, _ = self._layer_volume(task, name)
+                if mask is None:
+                    continue
+                # A mask on another grid than the image cannot be blended slice by slice
+                if mask.shape != volume.shape:
+                    return Response({"error": f"The {name} mask does not match the {layer} volume's shape"},
+                                    status=status.HTTP_409_CONFLICT)
+                overlay_slices.append((extract_slice(mask, plane, int(index)), OVERLAY_COLORS[name]))
+            response = HttpResponse(render_png(pixels, overlay_slices), content_type="image/png")
+        else:
+            response = HttpResponse(pixels.tobytes(), content_type="application/octet-stream")
+            headers["X-Slice-Dtype"] = pixels.dtype.name
+            if offset is not None:
+                headers["X-Value-Offset"] = str(offset)
+        for name, value in headers.items():
+            response[name] = value
+        return response
+    
+    @action(detail=True, methods=['get'])
+    def pyramid(self, request, pk=None):
+        """
+        Levels of a task's multi-resolution pyramid, coarsest last
+        
+        Level 0 is the full-resolution volume; every level lists its shape,
+        zooms and affine so clients can place coarse regions in scanner space.
+        """
+        task = self.get_object()
+        manifest = VolumePyramid(task.id).manifest
+        if manifest is None:
+            return Response({"error": "Volume pyramid has not been built yet"}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            "chunk_shape": manifest['chunk_shape'],
+            "levels": manifest['levels'],
+            "layers": {layer: info['dtype'] for layer, info in manifest['layers'].items()},
+            "max_region_voxels": settings.VOLUME_PYRAMID_MAX_REGION_VOXELS,
+        })
+    
+    @action(detail=True, methods=['get'], url_name='pyramid-region', url_path=r'pyramid/(?P<level>\d+)')
+    def pyramid_region(self, request, pk=None, level=None):
+        """
+        A region of one pyramid level as raw voxels
+        
+        Query parameters:
+            layer: 'image' (default), 'tumor' or 'lung'
+            region: 'x0:x1,y0:y1,z0:z1' voxel ranges at that level (default: the whole level)
+        
+        The body is the region's voxels in C order (x slowest), described by the
+        X-Region-Shape, X-Region-Origin and X-Region-Dtype headers. Level 0 is read
+        from the volume cache, coarser levels from their compressed chunks.
+        """
+        task = self.get_object()
+        level = int(level)
+        layer = request.query_params.get("layer", "image")
+        pyramid = VolumePyramid(task.id)
+        manifest = pyramid.manifest
+        if manifest is None or layer not in manifest['layers'] or level >= len(manifest['levels']):
+            return Response({"error": f"No pyramid level {level} for layer {layer}"}, status=status.HTTP_404_NOT_FOUND)
+        
+        shape = manifest['levels'][level]['shape']
+        try:
+            region = [(0, size) for size in shape]
+            if request.query_params.get("region"):
+                region = [tuple(int(bound) for bound in axis.split(":"))
+                          for axis in request.query_params["region"].split(",")]
+            if len(region) != 3 or any(len(axis) != 2 for axis in region):
+                raise ValueError
+        except ValueError:
+            return Response({"error": "region must be 'x0:x1,y0:y1,z0:z1'"}, status=status.HTTP_400_BAD_REQUEST)
+        if any(not 0 <= start < stop <= size for (start, stop), size in zip(region, shape)):
+            return Response({"error": f"region must lie within the level shape {shape}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if np.prod([stop - start for start, stop in region]) > settings.VOLUME_PYRAMID_MAX_REGION_VOXELS:
+            return Response({"error": "Region is too large, request a coarser level or a smaller region"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        if level == 0:
+            volume, _ = self._layer_volume(task, layer)
+            if volume is None:
+                return Response({"error": f"No {layer} volume for this task"}, status=status.HTTP_404_NOT_FOUND)
+            values = np.ascontiguousarray(volume[tuple(slice(start, stop) for start, stop in region)])
+        else:
+            values = pyramid.read_region(layer, level, region)
+        
+        response = HttpResponse(values.tobytes(), content_type="application/octet-stream")
+        response["Cache-Control"] = "private, max-age=3600"
+        response["X-Region-Shape"] = ",".join(str(size) for size in values.shape)
+        response["X-Region-Origin"] = ",".join(str(start) for start, _ in region)
+        response["X-Region-Dtype"] = values.dtype.name
+        return response
+
+    
+    @action(detail=True, methods=['get'], url_name='segmentation-file',
+            url_path=r'segmentations/(?P<layer>tumor|lung)')
+    def segmentation_file(self, request, pk=None, layer=None):
+        """
+        Redirect to a task's separate tumor or lung NIfTI mask
+        
+        Tasks stored as a fused volume (SEGMENTATION_FUSED_OUTPUT) get the mask
+        extracted on the first request; later requests reuse the file.
+        """
+        task = self.get_object()
+        if materialize_layer(task, layer) is None:
+            return Response({"error": f"No {layer} segmentation for this task"}, status=status.HTTP_404_NOT_FOUND)
+        return HttpResponseRedirect(getattr(task, f"{layer}_segmentation").url)
+    
+    @action(detail=True, methods=['get'], url_name='mask', url_path=r'masks/(?P<layer>tumor|lung)')
+    def mask(self, request, pk=None, layer=None):
+        """
+        Sparse encoding of a task's mask, generated once the task completes
+        
+        Query parameters:
+            encoding: 'bitpacked' (default) or 'rle'
+        
+        Each label is cropped to its bounding box: 'bitpacked' is the base64 of
+        np.packbits over the crop in C order, 'rle' maps each z slice to
+        [start, length, ...] runs over the crop's slice flattened with x fastest.
+        The shape, dtype and affine reconstruct the full volume.
+        """
+        task = self.get_object()
+        encoding = request.query_params.get("encoding", "bitpacked")
+        if encoding not in ENCODINGS:
+            return Response({"error": f"encoding must be one of {', '.join(ENCODINGS)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        document = MaskEncodingStore().load(task.id, layer)
+        if document is None:
+            return Response({"error": f"No encoded {layer} mask for this task"}, status=status.HTTP_404_NOT_FOUND)
+        
+        for entry in document['labels'].values():
+            for other in ENCODINGS:
+                if other != encoding:
+                    entry.pop(other, None)
+        document['encoding'] = encoding
+        return Response(document)
+    
+    @action(detail=True, methods=['get'])
+    def meshes(self, request, pk=None):
+        """
+        Surface meshes available for a task, per layer and decimation level
+        """
+        task = self.get_object()
+        layers = MeshStore().task_meshes(task.id)
+        for layer, info in layers.items():
+            for level in info['levels']:
+                level['url'] = request.build_absolute_uri(reverse(
+                    'segmentation-task-mesh', kwargs={'pk': task.id, 'layer': layer, 'level': level['level']}))
+        return Response({"format": "MLM1", "layers": layers})
+    
+    @action(detail=True, methods=['get'], url_name='mesh',
+            url_path=r'meshes/(?P<layer>tumor|lung)/(?P<level>\d+)')
+    def mesh(self, request, pk=None, layer=None, level=None):
+        """
+        One binary surface mesh (quantized uint16 positions and indexed triangles)
+        
+        The layout is documented in segmentation.meshes. Meshes are addressed by
+        the hash of their mask, so they can be cached for as long as the client likes.
+        """
+        task = self.get_object()
+        store = MeshStore()
+        info = store.task_meshes(task.id).get(layer)
+        if info is None or int(level) >= len(info['levels']):
+            return Response({"error": f"No level {level} {layer} mesh for this task"},
+                            status=status.HTTP_404_NOT_FOUND)
+        
+        with open(store.mesh_path(info['digest'], int(level)), 'rb') as f:
+            response = HttpResponse(f.read(), content_type="application/octet-stream")
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+        response["ETag"] = f'"{info["digest"]}-{level}"'
+        return response
+
+
+class ChunkedUploadViewSet(viewsets.GenericViewSet):
+    """
+    API endpoint for resumable, chunked NIfTI uploads
+    
+    POST   /uploads/                      start an upload (file_name, total_size, chunk_size)
+    GET    /uploads/<pk>/                 received and missing chunks, to resume after a drop
+    PUT    /uploads/<pk>/chunks/<index>/  raw chunk bytes with an X-Chunk-SHA256 header
+    POST   /uploads/<pk>/complete/        create the segmentation task and queue it
+    DELETE /uploads/<pk>/                 abort the upload
+    """
+    queryset = ChunkedUpload.objects.all()
+    serializer_class = ChunkedUploadSerializer
+    parser_classes = (JSONParser, FormParser)
+    
+    def create(self, request, *args, **kwargs):
+        file_name = request.data.get("file_name")
+        if not file_name:
+            return Response({"error": "file_name is required"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        inference_tier = request.data.get("inference_tier") or settings.NNUNET_DEFAULT_TIER
+        if inference_tier not in dict(SegmentationTask.INFERENCE_TIER_CHOICES):
+            return Response(
+                {"error": f"Invalid inference tier '{inference_tier}'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            upload = create_upload(
+                file_name,
+                total_size=int(request.data.get("total_size", 0)),
+                chunk_size=int(request.data.get("chunk_size") or settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE),
+                inference_tier=inference_tier,
+                sha256=request.data.get("sha256") or '',
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response(self.get_serializer(upload).data, status=status.HTTP_201_CREATED)
+    
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.get_serializer(self.get_object()).data)
+    
+    def destroy(self, request, *args, **kwargs):
+        upload = self.get_object()
+        if upload.status == 'completed':
+            return Response({"error": "Upload is already completed"}, status=status.HTTP_409_CONFLICT)
+        discard_upload(upload)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk=None, index=None):
+        """
+        Store one chunk; the body is streamed to disk, never parsed into memory
+        """
+        upload = self.get_object()
+        try:
+            # request.stream is the raw WSGI input (None for an empty body); request.data is never touched
+            stream = request.stream or io.BytesIO()
+            upload = write_chunk(upload, int(index), stream, request.headers.get("X-Chunk-SHA256", ""))
+        except UploadConflict as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            "index": int(index),
+            "received": len(upload.received_chunks),
+            "total_chunks": upload.total_chunks,
+        })
+    
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        """
+        Assemble the upload into a segmentation task and queue its preprocessing
+        """
+        upload = self.get_object()
+        try:
+            task, created = complete_upload(upload)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response(
+            {"task_id": task.id, "status": task.status, "inference_tier": task.inference_tier},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+
+class LesionViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Lesions across all tasks, e.g. /lesions/?min_diameter=30
+    
+    Query parameters:
+        task: Only lesions of this task
+        min_diameter, max_diameter: Longest axial diameter bounds in mm
+        min_volume, max_volume: Volume bounds in cm³
+    """
+    serializer_class = LesionSerializer
+    
+    FILTERS = {
+        'task': 'task_id',
+        'min_diameter': 'longest_diameter__gte',
+        'max_diameter': 'longest_diameter__lte',
+        'min_volume': 'volume__gte',
+        'max_volume': 'volume__lte',
+    }
+    
+    def get_queryset(self):
+        queryset = Lesion.objects.all()
+        for param, lookup in self.FILTERS.items():
+            value = self.request.query_params.get(param)
+            if value is None:
+                continue
+            if param == 'task':
+                try:
+                    value = uuid.UUID(value)
+                except ValueError:
+                    raise ValidationError({param: "Must be a task id"})
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValidationError({param: "Must be a number"})
+            queryset = queryset.filter(**{lookup: value})
+        return queryset
@@ -0,0 +1,241 @@
+import os
+import io
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+import nibabel as nib
+from django.conf import settings
+from .fused import layer_mask
+
+# volume_cache.py
+logger = logging.getLogger(__name__)
+
+# Task file field behind each viewable layer
+LAYERS = {
+    'image': 'nifti_file',
+    'tumor': 'tumor_segmentation',
+    'lung': 'lung_segmentation',
+}
+
+# Voxel axis held fixed by each plane
+PLANES = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+
+# Default (center, width) intensity window in HU, a lung window
+DEFAULT_WINDOW = (-600.0, 1500.0)
+
+# RGB colours of mask overlays in rendered PNGs
+OVERLAY_COLORS = {
+    'tumor': (255, 48, 48),
+    'lung': (64, 160, 255),
+}
+OVERLAY_ALPHA = 0.45
+
+
+class VolumeCache:
+    """
+    On-disk cache of uncompressed, memory-mapped copies of task volumes
+
+    A .nii.gz has to be decompressed from the start to reach any slice, so each
+    volume is decoded once into a Fortran-ordered .npy (the NIfTI voxel order,
+    which makes axial slices contiguous) and then memory-mapped for every slice
+    request. Entries are rebuilt when their source file is replaced and the
+    cache is bounded to max_bytes, evicting least recently used tasks.
+
+    Layout:
+        <cache_dir>/<task_id>/<layer>.npy
+        <cache_dir>/<task_id>/<layer>.json   (source signature, zooms, affine)
+    """
+    def __init__(self, cache_dir=None, max_bytes=None, slab_size=None):
+        self.cache_dir = str(cache_dir or settings.VOLUME_CACHE_DIR)
+        self.max_bytes = settings.VOLUME_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.slab_size = slab_size or settings.SEGMENTATION_METRICS_SLAB_SIZE
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _signature(source_path):
+        stat = os.stat(source_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+    def _paths(self, task_id, layer):
+        entry_dir = os.path.join(self.cache_dir, str(task_id))
+        return entry_dir, os.path.join(entry_dir, f"{layer}.npy"), os.path.join(entry_dir, f"{layer}.json")
+
+    def volume(self, task_id, layer, source_path):
+        """
+        Memory-mapped volume of a task layer, building the cache entry if needed
+
+        Args:
+            task_id: Task the volume belongs to
+            layer: Layer name, a key of LAYERS
+            source_path: NIfTI file the layer is decoded from, or a (fused volume path,
+                layer) tuple for a mask stored in a fused volume (see fused.py)
+
+        Returns:
+            Tuple of (read-only memmap, metadata dictionary)
+        """
+        entry_dir, array_path, meta_path = self._paths(task_id, layer)
+        fused_layer = None
+        if isinstance(source_path, tuple):
+            source_path, fused_layer = source_path
+        signature = self._signature(source_path)
+        if fused_layer is not None:
+            signature['fused_layer'] = fused_layer
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['source'] != signature or not os.path.exists(array_path):
+                meta = None
+        except (OSError, ValueError, KeyError):
+            meta = None
+
+        if meta is None:
+            meta = self._build(source_path, entry_dir, array_path, meta_path, signature, fused_layer)
+            self.evict()
+        else:
+            os.utime(entry_dir)
+        return np.load(array_path, mmap_mode='r'), meta
+
+    def _build(self, source_path, entry_dir, array_path, meta_path, signature, fused_layer=None):
+        """
+        Decode a NIfTI file slab by slab into an uncompressed .npy
+
+        With fused_layer, only that layer of a fused volume is kept, as a 0/1 uint8 mask.
+        """
+        os.makedirs(entry_dir, exist_ok=True)
+        img = nib.load(source_path, keep_file_open=True)
+        if len(img.shape) != 3:
+            raise ValueError(f"Expected a 3D volume, got shape {img.shape}")
+
+        dtype = np.asanyarray(img.dataobj[..., :1]).dtype
+        if dtype.kind == 'f':
+            dtype = np.dtype(np.float32)
+        if fused_layer is not None:
+            dtype = np.dtype(np.uint8)
+        fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=entry_dir)
+        os.close(fd)
+        try:
+            array = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=img.shape, fortran_order=True)
+            depth = img.shape[2]
+            for start in range(0, depth, self.slab_size):
+                slab = np.asanyarray(img.dataobj[..., start:start + self.slab_size])
+                array[..., start:start + self.slab_size] = slab if fused_layer is None else layer_mask(slab, fused_layer)
+            array.flush()
+            del array
+            os.replace(temp_path, array_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        meta = {
+            'source': signature,
+            'shape': list(img.shape),
+            'dtype': dtype.name,
+            'zooms': [float(zoom) for zoom in img.header.get_zooms()[:3]],
+            'affine': img.affine.tolist(),
+        }
+        temp_meta_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(temp_meta_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_meta_path, meta_path)
+        logger.info(f"Cached {source_path} as a {img.shape} {dtype.name} memory map")
+        return meta
+
+    def discard(self, task_id):
+        """
+        Remove every cached volume of a task
+        """
+        shutil.rmtree(os.path.join(self.cache_dir, str(task_id)), ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove least recently used task entries until the cache fits in max_bytes
+
+        Returns:
+            Number of entries removed
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir():
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                entries.append((entry.stat().st_mtime, entry.path, size))
+
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        # The newest entry is kept even when it alone exceeds the limit
+        for _, path, size in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info(f"Evicted {removed} volume cache entries")
+        return removed
+
+
+def extract_slice(volume, plane, index):
+    """
+    Copy one slice out of a volume, oriented for display
+
+    Rows run along the second voxel axis of the plane and columns along the
+    first (axial: rows y, columns x; coronal and sagittal: rows z).
+
+    Raises:
+        IndexError: If index is outside the volume
+    """
+    axis = PLANES[plane]
+    if not 0 <= index < volume.shape[axis]:
+        raise IndexError(f"{plane} slice {index} is outside 0-{volume.shape[axis] - 1}")
+    return np.ascontiguousarray(np.take(volume, index, axis=axis).T)
+
+
+def window_to_uint8(values, center, width):
+    """
+    Map intensities through a (center, width) window to 0-255
+    """
+    low = center - width / 2
+    scaled = (values.astype(np.float32) - low) * (255.0 / max(width, 1e-6))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def to_uint16(values):
+    """
+    Shift intensities into uint16
+
+    Returns:
+        Tuple of (uint16 array, offset to add back to recover the values)
+    """
+    offset = int(np.floor(values.min())) if values.size else 0
+    return np.clip(values.astype(np.int64) - offset, 0, 65535).astype(np.uint16), offset
+
+
+def render_png(gray, overlays=()):
+    """
+    Encode a uint8 slice as PNG, alpha-blending coloured mask overlays
+
+    Args:
+        gray: 2D uint8 slice
+        overlays: Iterable of (mask slice, (r, g, b)) pairs
+
+    Returns:
+        PNG bytes
+    """
+    from PIL import Image
+
+    if overlays:
+        rgb = np.repeat(gray[..., None], 3, axis=2).astype(np.float32)
+        for mask, color in overlays:
+            selected = mask > 0
+            rgb[selected] = rgb[selected] * (1 - OVERLAY_ALPHA) + np.asarray(color, dtype=np.float32) * OVERLAY_ALPHA
+        image = Image.fromarray(rgb.astype(np.uint8))
+    else:
+        image = Image.fromarray(gray)
+
+    buffer = io.BytesIO()
+    # Fast zlib level; slices are small and requested interactively
+    image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
@@ -0,0 +1,85 @@
+import os
+import time
+import shutil
+import tempfile
+import logging
+from django.conf import settings
+
+# workspace.py
+logger = logging.getLogger(__name__)
+
+
+class TaskWorkspace:
+    """
+    Private scratch directory for one segmentation task
+
+    Holds the nnUNet input folder and the per-model output folders for a single
+    task, so several tasks can run on the same host without clearing or reading
+    each other's files. The directory is removed when the context exits.
+
+    Usage:
+        with TaskWorkspace(task_id) as workspace:
+            workspace.input_dir
+            workspace.output_dir("tumor_segmentation")
+    """
+    def __init__(self, task_id, root=None):
+        self.task_id = str(task_id)
+        self.root = root or settings.NNUNET_SCRATCH_DIR
+        self.path = None
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        # mkdtemp keeps retries of the same task apart as well
+        self.path = tempfile.mkdtemp(prefix=f"task_{self.task_id}_", dir=self.root)
+        os.makedirs(self.input_dir)
+        logger.info(f"Created workspace {self.path} for task {self.task_id}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    @property
+    def input_dir(self):
+        return os.path.join(self.path, "input")
+
+    def output_dir(self, name):
+        """
+        Get (and create) a named output directory inside the workspace
+        """
+        path = os.path.join(self.path, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def cleanup(self):
+        """
+        Remove the workspace directory
+        """
+        if self.path and os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+            logger.info(f"Removed workspace {self.path}")
+
+
+def cleanup_stale_workspaces(max_age_hours=24, root=None):
+    """
+    Remove workspaces left behind by workers that died mid-task
+
+    Args:
+        max_age_hours: Age after which a workspace is considered abandoned
+        root: Scratch root directory (default: settings.NNUNET_SCRATCH_DIR)
+
+    Returns:
+        Number of workspaces removed
+    """
+    root = root or settings.NNUNET_SCRATCH_DIR
+    if not os.path.isdir(root):
+        return 0
+
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith("task_") and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed